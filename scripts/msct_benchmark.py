@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Performance benchmarks
+# Scenarios are registered with the @scenario decorator. A scenario function prepares its data (synthetic, generated in
+# a temporary folder) and returns the function to time. Each scenario runs in a separate process, so that its peak
+# memory (RSS) is not polluted by the other scenarios. Results are written in a json file, which can be compared
+# against a baseline to detect regressions.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import io, os, time, json, platform, multiprocessing, traceback
+from collections import OrderedDict
+
+import numpy as np
+
+import sct_utils as sct
+from msct_pipeline_scheduler import PeakRSSMonitor
+
+
+BENCHMARK_FORMAT = 'sct-benchmark'
+BENCHMARK_VERSION = 1
+
+# Status of a scenario
+STATUS_OK = 'ok'
+STATUS_SKIPPED = 'skipped'  # missing dependency or binary
+STATUS_ERROR = 'error'
+
+# default thresholds (relative increase) above which a result is a regression
+THRESHOLD_TIME = 0.2
+THRESHOLD_MEMORY = 0.2
+
+# registry of scenarios: name -> dict(function, repeat, description)
+SCENARIOS = OrderedDict()
+
+
+class BenchmarkSkipped(Exception):
+    """
+    Raised by a scenario when a dependency (python package, binary) is not available
+    """
+    pass
+
+
+def scenario(name, repeat=3, description=''):
+    """
+    Decorator registering a benchmark scenario.
+    The decorated function takes a temporary folder, prepares the data and returns the function to time (without
+    argument).
+    :param name: name of the scenario
+    :param repeat: number of timed runs
+    :param description: short description
+    """
+    def decorator(function):
+        SCENARIOS[name] = {'function': function, 'repeat': repeat, 'description': description or function.__doc__}
+        return function
+    return decorator
+
+
+def require_executable(name):
+    """
+    Skip the scenario if an executable is not installed
+    """
+    if sct.check_exe(name) is None:
+        raise BenchmarkSkipped('{} not found'.format(name))
+
+
+def require_module(name):
+    """
+    Skip the scenario if a python module is not installed, otherwise return it
+    """
+    import importlib
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise BenchmarkSkipped(str(e))
+
+
+def _current_rss():
+    """
+    Current memory of the process in MB (0 if psutil is not available)
+    """
+    try:
+        import psutil
+    except ImportError:
+        return 0.
+    return psutil.Process(os.getpid()).memory_info().rss / 1024 / 1024
+
+
+def _run_scenario(name, repeat, path_tmp):
+    """
+    Prepare and time a scenario in the current process
+    :return: dict of results
+    """
+    result = {'status': STATUS_OK}
+    curdir = os.getcwd()
+    os.chdir(path_tmp)
+    try:
+        function = SCENARIOS[name]['function'](path_tmp)
+        result['setup_rss_mb'] = _current_rss()
+        times = []
+        with PeakRSSMonitor(interval=0.02) as monitor:
+            for i in range(repeat):
+                time_start = time.time()
+                function()
+                times.append(time.time() - time_start)
+        result.update({
+         'times': times,
+         'time_min': min(times),
+         'time_median': float(np.median(times)),
+         'peak_rss_mb': monitor.peak,
+        })
+    except BenchmarkSkipped as e:
+        result = {'status': STATUS_SKIPPED, 'reason': str(e)}
+    except Exception as e:
+        result = {'status': STATUS_ERROR, 'reason': '{}: {}'.format(type(e).__name__, e),
+                  'traceback': traceback.format_exc()}
+    finally:
+        os.chdir(curdir)
+    return result
+
+
+def _run_scenario_child(name, repeat, path_tmp, queue):
+    queue.put(_run_scenario(name, repeat, path_tmp))
+
+
+def run_scenario(name, repeat=None, isolate=True):
+    """
+    Run a scenario in a temporary folder, in a separate process if isolate is True
+    :param name: name of the scenario
+    :param repeat: number of timed runs (default: the one of the scenario)
+    :param isolate: run in a separate process, so that the peak memory only accounts for this scenario
+    :return: dict of results
+    """
+    if repeat is None:
+        repeat = SCENARIOS[name]['repeat']
+    path_tmp = sct.tmp_create(basename='benchmark_' + name, verbose=0)
+    try:
+        if not isolate:
+            return _run_scenario(name, repeat, path_tmp)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_scenario_child, args=(name, repeat, path_tmp, queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Exception:
+                # queue.Empty: check that the child is still alive
+                if not process.is_alive() and queue.empty():
+                    result = {'status': STATUS_ERROR, 'reason': 'process exited with code {}'.format(process.exitcode)}
+        process.join()
+        return result
+    finally:
+        sct.rmtree(path_tmp, verbose=0)
+
+
+def get_machine_info():
+    """
+    Description of the machine, to interpret the results
+    """
+    return {
+     'platform': platform.platform(),
+     'python': platform.python_version(),
+     'numpy': np.__version__,
+     'cpu_count': multiprocessing.cpu_count(),
+     'hostname': platform.node(),
+    }
+
+
+def run_benchmarks(names=None, repeat=None, isolate=True, verbose=1):
+    """
+    Run scenarios
+    :param names: list of scenario names (default: all)
+    :param repeat: number of timed runs (default: the one of each scenario)
+    :return: dict with machine information and results of each scenario
+    """
+    if names is None:
+        names = list(SCENARIOS.keys())
+    results = OrderedDict()
+    for name in names:
+        if name not in SCENARIOS:
+            raise ValueError('Unknown benchmark scenario: {}'.format(name))
+        sct.printv('Running ' + name + '...', verbose)
+        results[name] = run_scenario(name, repeat=repeat, isolate=isolate)
+        result = results[name]
+        if result['status'] == STATUS_OK:
+            sct.printv('  time: {:.3f}s (min), {:.3f}s (median), peak RSS: {:.0f}MB'.format(
+             result['time_min'], result['time_median'], result['peak_rss_mb']), verbose)
+        else:
+            # errors are reported without raising, so that the other scenarios still run
+            sct.printv('  {}: {}'.format(result['status'], result['reason']), verbose, 'warning')
+    return {
+     'format': BENCHMARK_FORMAT,
+     'version': BENCHMARK_VERSION,
+     'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+     'sct_version': sct.__version__,
+     'machine': get_machine_info(),
+     'results': results,
+    }
+
+
+def save_results(results, fname):
+    with io.open(fname, 'wb') as f:
+        f.write(json.dumps(results, indent=1).encode('utf-8'))
+
+
+def load_results(fname):
+    with open(fname, 'r') as f:
+        results = json.load(f)
+    if results.get('format') != BENCHMARK_FORMAT:
+        raise ValueError('{} is not a benchmark result file'.format(fname))
+    return results
+
+
+def compare(results, results_baseline, threshold_time=THRESHOLD_TIME, threshold_memory=THRESHOLD_MEMORY):
+    """
+    Compare results against a baseline.
+    Time is compared on the minimum over the runs (least sensitive to noise), memory on the peak RSS.
+    :param results: output of run_benchmarks()
+    :param results_baseline: output of run_benchmarks()
+    :param threshold_time: relative increase of time above which a scenario is a regression
+    :param threshold_memory: relative increase of peak memory above which a scenario is a regression
+    :return: list of dict (name, metric, baseline, value, ratio, regression) for scenarios run in both
+    """
+    comparison = []
+    for name, result in results['results'].items():
+        baseline = results_baseline['results'].get(name)
+        if baseline is None or result['status'] != STATUS_OK or baseline['status'] != STATUS_OK:
+            continue
+        for metric, threshold in (('time_min', threshold_time), ('peak_rss_mb', threshold_memory)):
+            if not baseline[metric]:
+                continue
+            ratio = result[metric] / baseline[metric]
+            comparison.append({
+             'name': name,
+             'metric': metric,
+             'baseline': baseline[metric],
+             'value': result[metric],
+             'ratio': ratio,
+             'regression': ratio > 1 + threshold,
+            })
+    return comparison
+
+
+# ======================================================================================================================
+# Synthetic data
+# ======================================================================================================================
+def synthetic_cord(path, shape=(60, 60, 80), pixdim=(0.8, 0.8, 1.), radius=5.):
+    """
+    Write a synthetic T2-like image of a curved spinal cord (dark cord in bright CSF), its segmentation and its
+    centerline, in RPI orientation.
+    :return: file names of image, segmentation, centerline
+    """
+    import nibabel
+    nx, ny, nz = shape
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    data = np.zeros(shape, dtype=np.float32)
+    data_seg = np.zeros(shape, dtype=np.uint8)
+    data_ctl = np.zeros(shape, dtype=np.uint8)
+    rs = np.random.RandomState(0)
+    for iz in range(nz):
+        xc = nx / 2 + 8 * np.sin(2 * np.pi * iz / nz)
+        yc = ny / 2 + 4 * np.sin(np.pi * iz / nz)
+        dist = np.sqrt(((x - xc) * pixdim[0]) ** 2 + ((y - yc) * pixdim[1]) ** 2)
+        data[:, :, iz] = np.where(dist < radius, 300, np.where(dist < 2 * radius, 1000, 200))
+        data_seg[:, :, iz] = dist < radius
+        data_ctl[int(round(xc)), int(round(yc)), iz] = 1
+    data += rs.normal(0, 20, shape).astype(np.float32)
+    affine = np.diag(list(pixdim) + [1.])
+    list_fname = []
+    for suffix, d in (('', data), ('_seg', data_seg), ('_centerline', data_ctl)):
+        fname = os.path.join(path, 't2' + suffix + '.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(d, affine), fname)
+        list_fname.append(fname)
+    return list_fname
+
+
+def synthetic_timeseries(path, shape=(40, 40, 10), nt=30, fname='fmri.nii'):
+    """
+    Write a synthetic 4D time series with small random translations between volumes
+    :return: file name
+    """
+    import nibabel
+    from scipy import ndimage
+    rs = np.random.RandomState(0)
+    data_ref = np.zeros(shape, dtype=np.float32)
+    data_ref[shape[0] // 4:3 * shape[0] // 4, shape[1] // 4:3 * shape[1] // 4, :] = 1000
+    data_ref = ndimage.gaussian_filter(data_ref, 2)
+    data = np.zeros(shape + (nt,), dtype=np.float32)
+    for it in range(nt):
+        data[..., it] = ndimage.shift(data_ref, list(rs.uniform(-1, 1, 2)) + [0], order=1)
+    data += rs.normal(0, 10, data.shape).astype(np.float32)
+    fname = os.path.join(path, fname)
+    nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), fname)
+    return fname
+
+
+# ======================================================================================================================
+# Scenarios
+# ======================================================================================================================
+@scenario('straighten', repeat=1)
+def bench_straighten(path_tmp):
+    """SpinalCordStraightener.straighten on a synthetic curved cord"""
+    require_executable('isct_antsApplyTransforms')
+    from sct_straighten_spinalcord import SpinalCordStraightener
+    fname_t2, fname_seg, fname_ctl = synthetic_cord(path_tmp)
+
+    def run():
+        sc_straight = SpinalCordStraightener(fname_t2, fname_seg)
+        sc_straight.verbose = 0
+        sc_straight.path_output = path_tmp
+        sc_straight.accuracy_results = 0
+        sc_straight.straighten()
+    return run
+
+
+@scenario('moco', repeat=1)
+def bench_moco(path_tmp):
+    """msct_moco.moco (estimate and apply) on a synthetic 4D time series, groups of 3 volumes"""
+    require_executable('isct_antsSliceRegularizedRegistration')
+    import msct_moco
+    from sct_fmri_moco import Param
+    from spinalcordtoolbox.image import Image
+    synthetic_timeseries(path_tmp, fname='fmri.nii')
+    im = Image('fmri.nii')
+    msct_moco.average_groups(im, msct_moco.get_group_indexes(list(range(im.data.shape[3])), 3)).save('fmri_groups.nii')
+    msct_moco.average_groups(im, [[0, 1, 2]]).save('target.nii')
+
+    def run():
+        param = Param()
+        param.file_data = 'fmri_groups'
+        param.file_target = 'target'
+        param.path_out = ''
+        param.todo = 'estimate_and_apply'
+        param.mat_moco = 'mat_groups'
+        param.verbose = 0
+        msct_moco.moco(param)
+    return run
+
+
+@scenario('extract_metric', repeat=5)
+def bench_extract_metric(path_tmp):
+    """sct_extract_metric.extract_metric (weighted average and maximum likelihood) with 36 synthetic labels in a
+    cord-sized disk"""
+    import sct_extract_metric
+    rs = np.random.RandomState(0)
+    shape = (40, 40, 10)
+    data = rs.rand(*shape)
+    x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    mask_cord = ((x - shape[0] / 2) ** 2 + (y - shape[1] / 2) ** 2 < 8 ** 2)[:, :, np.newaxis]
+    nb_labels = 36
+    labels = np.empty([nb_labels], dtype=object)
+    for i in range(nb_labels):
+        labels[i] = rs.rand(*shape) * mask_cord
+    indiv_labels_ids = list(range(nb_labels))
+
+    def run():
+        for method in ('wa', 'ml'):
+            sct_extract_metric.extract_metric(method, data, labels, indiv_labels_ids)
+    return run
+
+
+@scenario('deepseg_sc_inference', repeat=3)
+def bench_deepseg_sc_inference(path_tmp):
+    """Inference of the sct_deepseg_sc 2D segmentation network (random weights) on 32 slices of 64x64"""
+    require_module('keras')
+    from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_seg
+    model = nn_architecture_seg(height=64, width=64, depth=2, features=32, batchnorm=True, dropout=0.0)
+    data = np.random.RandomState(0).rand(32, 64, 64, 1).astype(np.float32)
+
+    def run():
+        model.predict(data, batch_size=8)
+    return run
+
+
+@scenario('compute_tsnr', repeat=3)
+def bench_compute_tsnr(path_tmp):
+    """Slab-wise tSNR map of a synthetic 4D time series"""
+    from spinalcordtoolbox import voxelwise
+    import sct_fmri_compute_tsnr
+    fname = synthetic_timeseries(path_tmp, shape=(64, 64, 20), nt=100)
+
+    def run():
+        voxelwise.compute_maps([fname], [os.path.join(path_tmp, 'tsnr.nii')], sct_fmri_compute_tsnr.tsnr_kernel,
+                               path_tmp=path_tmp, verbose=0)
+    return run
+
+
+@scenario('resample_4d', repeat=3)
+def bench_resample_4d(path_tmp):
+    """Linear resampling of a synthetic 4D volume to half the voxel size in-plane"""
+    require_module('nipy')
+    from spinalcordtoolbox.resample import nipy_resample
+    data = np.random.RandomState(0).rand(40, 40, 10, 30)
+    shape_r = (80, 80, 10, 30)
+    transfo = np.diag([0.5, 0.5, 1., 1.])
+    transfo[:3, 3] = [-0.25, -0.25, 0.]
+
+    def run():
+        nipy_resample.resample_volumes(data, transfo, shape_r, interp_order=1, verbose=0)
+    return run
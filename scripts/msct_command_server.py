@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# SCT command server
+# Running a SCT script through sct.run() starts a new python interpreter, which imports numpy, scipy, nibabel... again.
+# The command server keeps these modules imported: it listens on a per-user unix socket, and runs each requested SCT
+# script (as __main__, with its arguments, working directory and environment) in a process forked from the server, so
+# that the script starts with warm modules. The output of the script is streamed back to the client, followed by its
+# exit code and resource usage.
+# sct.run() goes through the server when it is running (see sct_command_server), and falls back to a subprocess
+# otherwise, or when the command sets thread limits that the modules preloaded by the server cannot honour.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import os, sys, time, json, errno, socket, tempfile, shlex, traceback, importlib
+
+
+ENV_SOCKET = 'SCT_SERVER_SOCKET'  # socket of the server (default: see get_socket_path())
+ENV_SERVER = 'SCT_SERVER'  # set to 0 to run all commands in subprocesses
+
+# modules imported by the server before forking workers
+PRELOAD_MODULES = ['numpy', 'scipy', 'scipy.ndimage', 'nibabel', 'sct_utils', 'msct_parser', 'msct_types',
+                   'spinalcordtoolbox.image', 'spinalcordtoolbox.utils']
+
+# environment variables read when the preloaded modules are imported (size of the BLAS and OpenMP thread pools): a
+# command whose environment sets them differently (e.g. the thread limits of sct_pipeline jobs) runs in a subprocess
+PRELOAD_ENV_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                         'NUMEXPR_NUM_THREADS']
+
+# the server exits after this time without request (s), so that a forgotten server does not run outdated code forever
+IDLE_TIMEOUT = 3600
+
+END_MARKER = b'\0'  # separates the output of a command from its result
+SHELL_CHARACTERS = '|&;<>()$`*?[]~\n'
+
+path_scripts = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_socket_path():
+    """
+    Socket of the server of the current user
+    """
+    path = os.getenv(ENV_SOCKET)
+    if path:
+        return path
+    return os.path.join(tempfile.gettempdir(), 'sct-server-{}'.format(os.getuid()), 'socket')
+
+
+def get_argv(cmd):
+    """
+    Arguments of a command that can be run by the server: a SCT script, without shell syntax.
+    :param cmd: command as passed to sct.run(): list of arguments or string
+    :return: list of arguments, or None if the command must run in a subprocess
+    """
+    if not isinstance(cmd, (list, tuple)):
+        if any(c in cmd for c in SHELL_CHARACTERS):
+            return None
+        cmd = shlex.split(cmd)
+    if not cmd or get_script(cmd[0]) is None:
+        return None
+    return list(cmd)
+
+
+def get_script(name):
+    """
+    :return: file of a SCT python script, None if name is not a SCT python script
+    """
+    name = os.path.basename(name)
+    if not name.startswith('sct_') or name.endswith('.py'):
+        return None
+    fname = os.path.join(path_scripts, name + '.py')
+    return fname if os.path.isfile(fname) else None
+
+
+def connect(path_socket=None, timeout=None):
+    """
+    Connect to the server.
+    :return: socket, None if the server is disabled or not running
+    """
+    if os.getenv(ENV_SERVER, '1') == '0' or not hasattr(socket, 'AF_UNIX'):
+        return None
+    if path_socket is None:
+        path_socket = get_socket_path()
+    try:
+        # only trust a server owned by the current user
+        if os.stat(os.path.dirname(path_socket) or '.').st_uid != os.getuid():
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(path_socket)
+    except (OSError, IOError, socket.error):
+        return None
+    return sock
+
+
+def send_json(sock, data):
+    sock.sendall((json.dumps(data) + '\n').encode('utf-8'))
+
+
+def request(data, path_socket=None, timeout=10):
+    """
+    Send a control request ('ping', 'stop') to the server
+    :return: response (dict), None if the server is not running
+    """
+    sock = connect(path_socket, timeout=timeout)
+    if sock is None:
+        return None
+    try:
+        send_json(sock, data)
+        line = sock.makefile('rb').readline()
+    except (OSError, IOError, socket.error):
+        return None
+    finally:
+        sock.close()
+    return json.loads(line.decode('utf-8')) if line else None
+
+
+class ServerProcess(object):
+    """
+    Command running in the server, with the interface of subprocess.Popen used by sct.run(): stdout.readline() and
+    wait(). After wait(), cpu_time and peak_rss hold the resource usage of the command.
+    """
+    def __init__(self, sock, file=None):
+        self.sock = sock
+        self.file = sock.makefile('rb') if file is None else file
+        self.stdout = self
+        self.returncode = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self._result = b''
+        self._done = False
+
+    def readline(self):
+        """
+        Next line of output of the command, b'' at the end of the output
+        """
+        if self._done:
+            return b''
+        line = self.file.readline()
+        if END_MARKER in line:
+            line, self._result = line.split(END_MARKER, 1)
+            self._done = True
+        elif not line:
+            self._done = True
+        return line
+
+    def wait(self):
+        while not self._done:
+            self.readline()
+        if not self._result.endswith(b'\n'):
+            self._result += self.file.readline()
+        self.file.close()
+        self.sock.close()
+        try:
+            result = json.loads(self._result.decode('utf-8'))
+        except ValueError:
+            # server killed
+            result = {'exit_code': 1}
+        self.returncode = result['exit_code']
+        self.cpu_time = result.get('cpu')
+        self.peak_rss = result.get('peak_rss_mb')
+        return self.returncode
+
+
+def start_process(cmd, cwd=None, env=None, path_socket=None):
+    """
+    Start a command in the server.
+    :param cmd: command as passed to sct.run()
+    :return: ServerProcess, None if the command cannot run in the server (e.g. its thread limits differ from the ones
+    of the server), or if the server is not running
+    """
+    argv = get_argv(cmd)
+    if argv is None:
+        return None
+    sock = connect(path_socket)
+    if sock is None:
+        return None
+    try:
+        send_json(sock, {
+         'command': 'run',
+         'argv': argv,
+         'cwd': cwd or os.getcwd(),
+         'env': dict(os.environ if env is None else env),
+        })
+        file = sock.makefile('rb')
+        line = file.readline()
+        accepted = json.loads(line.decode('utf-8')).get('accepted', False) if line else False
+    except (OSError, IOError, socket.error, ValueError):
+        sock.close()
+        return None
+    if not accepted:
+        file.close()
+        sock.close()
+        return None
+    return ServerProcess(sock, file)
+
+
+# ======================================================================================================================
+# Server
+# ======================================================================================================================
+class CommandServer(object):
+    """
+    Server running SCT scripts in forked processes. One process is forked per connection; it forks the worker running
+    the script, waits for it and sends its exit code and resource usage to the client.
+    """
+    def __init__(self, path_socket=None, preload=PRELOAD_MODULES, idle_timeout=IDLE_TIMEOUT, verbose=1):
+        self.path_socket = path_socket or get_socket_path()
+        self.preload = preload
+        self.idle_timeout = idle_timeout
+        self.verbose = verbose
+        self.time_start = None
+        self.nb_requests = 0
+        self.sock = None
+        # values of PRELOAD_ENV_VARIABLES when the modules were preloaded
+        self.preload_env = {}
+
+    def log(self, message):
+        if self.verbose:
+            print('[sct server {}] {}'.format(time.strftime("%H:%M:%S"), message))
+            sys.stdout.flush()
+
+    def preload_modules(self):
+        self.preload_env = dict((name, os.environ.get(name)) for name in PRELOAD_ENV_VARIABLES)
+        for name in self.preload:
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                self.log('Could not import {}: {}'.format(name, e))
+        import sct_utils
+        # computed once for all the scripts
+        sct_utils.get_version()
+
+    def bind(self):
+        folder = os.path.dirname(self.path_socket)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, 0o700)
+        if request({'command': 'ping'}, self.path_socket) is not None:
+            raise RuntimeError('A server is already running on {}'.format(self.path_socket))
+        if os.path.exists(self.path_socket):
+            # left by a server that was killed
+            os.remove(self.path_socket)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path_socket)
+        os.chmod(self.path_socket, 0o600)
+        self.sock.listen(64)
+        self.sock.settimeout(1)
+
+    def serve_forever(self):
+        self.preload_modules()
+        self.bind()
+        self.time_start = time.time()
+        time_last_request = time.time()
+        self.log('Listening on {} (pid {})'.format(self.path_socket, os.getpid()))
+        try:
+            while True:
+                self.reap_children()
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    if self.idle_timeout and time.time() - time_last_request > self.idle_timeout:
+                        self.log('Idle for {}s, exiting'.format(self.idle_timeout))
+                        break
+                    continue
+                time_last_request = time.time()
+                conn.settimeout(None)
+                if not self.handle(conn):
+                    break
+        finally:
+            self.sock.close()
+            if os.path.exists(self.path_socket):
+                os.remove(self.path_socket)
+            self.log('Stopped')
+
+    @staticmethod
+    def reap_children():
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+    def handle(self, conn):
+        """
+        Handle a connection
+        :return: False if the server must stop
+        """
+        try:
+            line = conn.makefile('rb').readline()
+            data = json.loads(line.decode('utf-8'))
+        except (ValueError, OSError, IOError, socket.error):
+            conn.close()
+            return True
+        command = data.get('command')
+        if command == 'ping':
+            send_json(conn, {'pid': os.getpid(), 'uptime': time.time() - self.time_start,
+                             'requests': self.nb_requests})
+        elif command == 'stop':
+            send_json(conn, {'pid': os.getpid()})
+            conn.close()
+            return False
+        elif command == 'run':
+            # the thread pools of the preloaded modules cannot be resized in the worker
+            if any(data['env'].get(name) != value for name, value in self.preload_env.items()):
+                self.log('Thread limits differ from the server, running in a subprocess: ' + ' '.join(data['argv']))
+                send_json(conn, {'accepted': False})
+                conn.close()
+                return True
+            send_json(conn, {'accepted': True})
+            self.nb_requests += 1
+            self.log(' '.join(data['argv']))
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                # connection handler
+                code = 1
+                try:
+                    self.sock.close()
+                    run_command(conn, data)
+                    code = 0
+                finally:
+                    os._exit(code)
+        conn.close()
+        return True
+
+
+def run_command(conn, data):
+    """
+    Run a command in a forked worker, stream its output to the connection, then send its result.
+    Called in the connection handler process.
+    """
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            exit_code = run_script(conn.fileno(), data['argv'], data['cwd'], data['env'])
+        finally:
+            os._exit(exit_code)
+    while True:
+        try:
+            _, status, rusage = os.wait4(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    import msct_trace
+    result = {
+     'exit_code': -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status),
+     'cpu': rusage.ru_utime + rusage.ru_stime,
+     'peak_rss_mb': rusage.ru_maxrss / msct_trace.RU_MAXRSS_UNIT,
+    }
+    conn.sendall(END_MARKER + (json.dumps(result) + '\n').encode('utf-8'))
+    conn.close()
+
+
+def run_script(fd, argv, cwd, env):
+    """
+    Run a SCT script as __main__, with the output going to fd. Called in the worker process.
+    :return: exit code
+    """
+    import runpy
+    fd_null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(fd_null, 0)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    # the server may have replaced the standard streams
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    import sct_utils
+    sct_utils.stream_handler.stream = sys.stdout
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    # the preloaded modules were configured with the environment of the server
+    sct_utils.read_environment()
+    fname_script = get_script(argv[0])
+    sys.argv = [fname_script] + list(argv[1:])
+    exit_code = 0
+    try:
+        runpy.run_path(fname_script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        # atexit handlers do not run in forked processes that exit with os._exit()
+        import msct_trace
+        msct_trace.finish_main_span(exit_code)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return exit_code
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Download of datasets
+# - Content-addressed store: downloaded archives are kept in a local cache, under their sha256, so that repeated
+#   installations (e.g. containers sharing the cache folder) reuse them. Objects are verified against their hash before
+#   being reused.
+# - Resume: files are downloaded into partial files, with the progress of each chunk saved alongside, so that an
+#   interrupted download restarts where it stopped (HTTP range requests).
+# - Parallel retrieval: when the servers accept range requests, the file is split into chunks, downloaded by several
+#   connections, spread over the mirrors that serve the same file.
+# - Verification: the archive is checked against its expected sha256, when known (from the manifest of the dataset,
+#   or from the metadata of the file on OSF).
+# - Concurrency: several processes can share the cache. Each partial file is downloaded by one process at a time, and
+#   the index is updated under a lock (fcntl locks, which are also exclusive between threads).
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import io
+import os
+import json
+import uuid
+import fcntl
+import hashlib
+import contextlib
+import email.message
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util import Retry
+
+import sct_utils as sct
+
+
+ENV_CACHE = 'SCT_DOWNLOAD_CACHE'  # folder of the download cache
+
+CHUNK_SIZE = 16 * 1024 ** 2  # size of the chunks downloaded in parallel (bytes)
+BLOCK_SIZE = 64 * 1024  # size of the blocks read from the network and hashed (bytes)
+NB_JOBS = 4  # default number of parallel connections
+TIMEOUT = 60  # connection and read timeout (s)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_cache_dir():
+    """
+    Folder of the download cache: $SCT_DOWNLOAD_CACHE, or ~/.cache/sct/downloads
+    """
+    path = os.getenv(ENV_CACHE)
+    if path:
+        return path
+    path_cache = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(path_cache, 'sct', 'downloads')
+
+
+def file_hash(fname, algorithm='sha256'):
+    """
+    :return: hex digest of a file
+    """
+    h = hashlib.new(algorithm)
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_json(fname, data):
+    """
+    Write a json file through a temporary file and a rename, so that it is never partially written
+    """
+    fname_tmp = '{}.{}.tmp'.format(fname, uuid.uuid4().hex)
+    with io.open(fname_tmp, 'wb') as f:
+        f.write(json.dumps(data, indent=1, sort_keys=True).encode('utf-8'))
+    os.rename(fname_tmp, fname)
+
+
+@contextlib.contextmanager
+def locked(fname_lock, verbose=1):
+    """
+    Hold an exclusive lock on a file, so that other processes (and threads) using the same lock file wait
+    :param fname_lock: lock file (created if needed)
+    :return: True if the lock was held by someone else when it was requested
+    """
+    with open(fname_lock, 'a') as lock_file:
+        waited = False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            waited = True
+            sct.printv('Waiting for another process using the download cache ({})...'.format(fname_lock), verbose)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield waited
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(fname, default):
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+class ContentStore(object):
+    """
+    Local store of downloaded files, addressed by their sha256: objects/<sha256>.
+    index.json maps each url to the sha256 and file name of the file it served, so that files without known hash are
+    also found again. Partial downloads are kept in partial/, each one with a lock file (see lock_partial).
+    """
+    def __init__(self, path=None):
+        self.path = path or get_cache_dir()
+        self.path_objects = os.path.join(self.path, 'objects')
+        self.path_partial = os.path.join(self.path, 'partial')
+        self.fname_index = os.path.join(self.path, 'index.json')
+        for folder in (self.path_objects, self.path_partial):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def path_object(self, sha256):
+        return os.path.join(self.path_objects, sha256)
+
+    def get(self, urls, sha256=None):
+        """
+        Find a file in the store, and verify it. With a known hash, the file is found by its content, whatever url
+        served it. Otherwise, it is found by url: the caller should check that the url still serves the same file
+        (see is_stale).
+        :param urls: list of urls (mirrors) of the file
+        :param sha256: expected hash, if known
+        :return: (path, file name), or None if the file is not in the store
+        """
+        index = read_json(self.fname_index, {})
+        entries = [index[url] for url in urls if url in index]
+        if sha256 is not None:
+            entries = [e for e in entries if e['sha256'] == sha256] or [{'sha256': sha256, 'filename': None}]
+        for entry in entries:
+            path = self.path_object(entry['sha256'])
+            if not os.path.isfile(path):
+                continue
+            if file_hash(path) != entry['sha256']:
+                # corrupted object
+                os.remove(path)
+                continue
+            filename = entry['filename'] or next((e['filename'] for e in index.values()
+                                                  if e['sha256'] == entry['sha256']), None)
+            return path, filename
+        return None
+
+    def add(self, fname, urls, filename, sha256=None):
+        """
+        Move a downloaded file into the store.
+        :param sha256: expected hash. DownloadError is raised if the file does not match.
+        :return: path of the object
+        """
+        sha256_file = file_hash(fname)
+        if sha256 is not None and sha256_file != sha256:
+            os.remove(fname)
+            raise DownloadError('Checksum mismatch for {}: expected {}, got {}'.format(filename, sha256, sha256_file))
+        path = self.path_object(sha256_file)
+        os.rename(fname, path)
+        with locked(self.fname_index + '.lock', verbose=0):
+            index = read_json(self.fname_index, {})
+            for url in urls:
+                index[url] = {'sha256': sha256_file, 'filename': filename, 'size': os.path.getsize(path)}
+            write_json(self.fname_index, index)
+        return path
+
+    def is_stale(self, urls, info):
+        """
+        :param info: properties of the file currently served by urls[0] (see probe)
+        :return: True if the file stored for these urls differs in name or size from the file served now
+        """
+        entry = read_json(self.fname_index, {}).get(urls[0])
+        if entry is None:
+            return True
+        return (info['filename'] is not None and info['filename'] != entry['filename']) or \
+            (info['size'] is not None and info['size'] != entry.get('size'))
+
+    def partial(self, urls):
+        """
+        :return: file name of the partial download of a file (its state is stored in <file name>.json)
+        """
+        key = hashlib.sha1(json.dumps(list(urls)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path_partial, key)
+
+    def lock_partial(self, urls, verbose=1):
+        """
+        Lock the partial download of a file, so that a single process downloads it
+        :return: context manager, giving True if another process held the lock (see locked)
+        """
+        return locked(self.partial(urls) + '.lock', verbose)
+
+
+def get_session():
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=retry))
+    session.mount('http://', HTTPAdapter(max_retries=retry))
+    return session
+
+
+def probe(session, url):
+    """
+    Get the properties of the file served by a url, without downloading it.
+    :return: dict: url (after redirections), size (None if unknown), ranges (True if range requests are accepted),
+             filename
+    """
+    response = session.get(url, stream=True, timeout=TIMEOUT, headers={'Accept-Encoding': 'identity'})
+    try:
+        response.raise_for_status()
+        headers = response.headers
+        if "Content-Disposition" in headers:
+            message = email.message.Message()
+            message['Content-Disposition'] = headers['Content-Disposition']
+            filename = message.get_filename()
+        else:
+            filename = os.path.basename(requests.utils.urlparse(response.url).path) or None
+        size = int(headers['Content-Length']) if 'Content-Length' in headers else None
+        return {
+         'url': response.url,
+         'size': size,
+         'ranges': headers.get('Accept-Ranges', '').lower() == 'bytes' and size is not None,
+         'filename': filename,
+        }
+    finally:
+        response.close()
+
+
+class Progress(object):
+    """
+    Thread-safe progress bar
+    """
+    def __init__(self, total, initial=0, verbose=1):
+        self.lock = threading.Lock()
+        self.bar = None
+        if verbose:
+            from tqdm import tqdm
+            self.bar = tqdm(total=total, initial=initial, unit='B', unit_scale=True, desc="Status", ascii=True)
+
+    def update(self, n):
+        if self.bar is not None:
+            with self.lock:
+                self.bar.update(n)
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+
+
+class ChunkedDownload(object):
+    """
+    Download of a file by chunks, with range requests, resumable.
+    The state (size and number of bytes downloaded in each chunk) is saved in <fname>.json, after the data is flushed.
+    """
+    def __init__(self, fname, size, chunk_size=CHUNK_SIZE):
+        self.fname = fname
+        self.fname_state = fname + '.json'
+        self.size = size
+        self.lock = threading.Lock()
+        state = read_json(self.fname_state, {})
+        if state.get('size') == size and state.get('chunk_size') == chunk_size and os.path.isfile(fname):
+            self.chunks = state['chunks']
+        else:
+            # new download: preallocate the file
+            self.chunks = [[start, min(start + chunk_size, size), 0] for start in range(0, size, chunk_size)]
+            with open(fname, 'wb') as f:
+                f.truncate(size)
+        self.chunk_size = chunk_size
+
+    def save_state(self):
+        with self.lock:
+            write_json(self.fname_state, {'size': self.size, 'chunk_size': self.chunk_size, 'chunks': self.chunks})
+
+    def nb_downloaded(self):
+        return sum([done for start, stop, done in self.chunks])
+
+    def remaining_chunks(self):
+        return [i for i, (start, stop, done) in enumerate(self.chunks) if start + done < stop]
+
+    def download_chunk(self, session, url, i, progress):
+        """
+        Download the rest of chunk i from url
+        """
+        start, stop, done = self.chunks[i]
+        headers = {'Range': 'bytes={}-{}'.format(start + done, stop - 1), 'Accept-Encoding': 'identity'}
+        response = session.get(url, stream=True, timeout=TIMEOUT, headers=headers)
+        try:
+            if response.status_code != 206:
+                raise DownloadError('Range request not honored by {} (status {})'.format(url, response.status_code))
+            with open(self.fname, 'r+b') as f:
+                f.seek(start + done)
+                for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                    if not block:
+                        continue
+                    block = block[:stop - start - self.chunks[i][2]]
+                    f.write(block)
+                    f.flush()
+                    self.chunks[i][2] += len(block)
+                    progress.update(len(block))
+                    if start + self.chunks[i][2] >= stop:
+                        break
+        finally:
+            response.close()
+            self.save_state()
+        if start + self.chunks[i][2] < stop:
+            raise DownloadError('Connection closed before the end of the chunk')
+
+    def run(self, session, mirrors, nb_jobs=NB_JOBS, verbose=1):
+        """
+        Download the remaining chunks, spread over the mirrors. A chunk that fails is retried on the next mirror.
+        """
+        progress = Progress(self.size, self.nb_downloaded(), verbose)
+
+        def download(i):
+            errors = []
+            for attempt in range(2 * len(mirrors)):
+                url = mirrors[(i + attempt) % len(mirrors)]
+                try:
+                    self.download_chunk(session, url, i, progress)
+                    return
+                except (requests.RequestException, IOError, DownloadError) as e:
+                    errors.append(e)
+            raise DownloadError('Chunk {} failed: {}'.format(i, errors[-1]))
+
+        try:
+            with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+                # consume results to raise the first error
+                list(executor.map(download, self.remaining_chunks()))
+        finally:
+            progress.close()
+        os.remove(self.fname_state)
+
+
+def download_stream(session, url, fname, verbose=1):
+    """
+    Download a file with a single request, resuming a partial file if the server accepts range requests
+    """
+    size_partial = os.path.getsize(fname) if os.path.isfile(fname) else 0
+    headers = {'Accept-Encoding': 'identity'}
+    if size_partial:
+        headers['Range'] = 'bytes={}-'.format(size_partial)
+    response = session.get(url, stream=True, timeout=TIMEOUT, headers=headers)
+    try:
+        if response.status_code == 416:
+            # partial file already complete
+            return
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        initial = size_partial if mode == 'ab' else 0
+        total = int(response.headers.get('Content-Length', 0)) + initial
+        progress = Progress(total, initial, verbose)
+        with open(fname, mode) as f:
+            for block in response.iter_content(chunk_size=BLOCK_SIZE):
+                if block:
+                    f.write(block)
+                    progress.update(len(block))
+        progress.close()
+    finally:
+        response.close()
+
+
+def get_osf_sha256(urls, session=None):
+    """
+    Expected sha256 of a file hosted on OSF, from the metadata of the file (OSF API)
+    :param urls: list of urls (mirrors) of the file. The first url of the form https://osf.io/<id>/... is used.
+    :return: sha256, or None if not available
+    """
+    if not isinstance(urls, (list, tuple)):
+        urls = [urls]
+    for url in urls:
+        parsed = requests.utils.urlparse(url)
+        if parsed.netloc != 'osf.io' or not parsed.path.strip('/'):
+            continue
+        session = session or get_session()
+        try:
+            response = session.get('https://api.osf.io/v2/files/{}/'.format(parsed.path.strip('/').split('/')[0]),
+                                   timeout=TIMEOUT)
+            response.raise_for_status()
+            return response.json()['data']['attributes']['extra']['hashes']['sha256'] or None
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return None
+    return None
+
+
+def download(urls, sha256=None, store=None, nb_jobs=NB_JOBS, chunk_size=CHUNK_SIZE, refresh=False, verbose=1):
+    """
+    Download a file from a list of mirrors, through the content-addressed store.
+    :param urls: list of urls (mirror servers, in order of priority) or single url
+    :param sha256: expected sha256 of the file. None: not verified.
+    :param store: ContentStore (default: in get_cache_dir())
+    :param nb_jobs: number of parallel connections
+    :param chunk_size: size of the chunks downloaded in parallel (bytes)
+    :param refresh: download the file again, even if it is in the store
+    :return: path of the file (in the store), file name given by the server
+    """
+    if not isinstance(urls, (list, tuple)):
+        urls = [urls]
+    if store is None:
+        store = ContentStore()
+    session = get_session()
+
+    cached = None if refresh else store.get(urls, sha256)
+    if cached is not None and sha256 is None:
+        # found by url only: check that the url still serves the same file
+        try:
+            if store.is_stale(urls, probe(session, urls[0])):
+                sct.printv('The cached file is outdated, downloading it again.', verbose)
+                cached = None
+        except requests.RequestException:
+            pass
+    if cached is not None:
+        sct.printv('Using cached file: %s' % cached[0], verbose)
+        return cached
+
+    fname_partial = store.partial(urls)
+    with store.lock_partial(urls, verbose) as waited:
+        cached = store.get(urls, sha256) if waited else None
+        if cached is not None:
+            # downloaded by another process in the meantime
+            sct.printv('Using cached file: %s' % cached[0], verbose)
+            return cached
+        errors = []
+        for i_url, url in enumerate(urls):
+            try:
+                sct.printv('\nTrying URL: %s' % url, verbose)
+                info = probe(session, url)
+                if info['filename'] is None:
+                    sct.printv("Unexpected: link doesn't provide a filename", type="warning")
+                    continue
+                sct.printv('Downloading %s...' % info['filename'], verbose)
+                if info['ranges']:
+                    # other mirrors serving the same file take part in the download
+                    mirrors = [info['url']]
+                    for url_mirror in urls[i_url + 1:]:
+                        try:
+                            info_mirror = probe(session, url_mirror)
+                        except requests.RequestException:
+                            continue
+                        if info_mirror['ranges'] and info_mirror['size'] == info['size']:
+                            mirrors.append(info_mirror['url'])
+                    if os.path.isfile(fname_partial + '.json') or nb_jobs > 1:
+                        ChunkedDownload(fname_partial, info['size'], chunk_size).run(session, mirrors, nb_jobs, verbose)
+                    else:
+                        download_stream(session, info['url'], fname_partial, verbose)
+                else:
+                    if os.path.isfile(fname_partial + '.json'):
+                        os.remove(fname_partial + '.json')
+                    download_stream(session, info['url'], fname_partial, verbose)
+                return store.add(fname_partial, urls, info['filename'], sha256), info['filename']
+
+            except (requests.RequestException, IOError, DownloadError) as e:
+                errors.append(e)
+                sct.printv("Link download error, trying next mirror (error was: %s)" % e, type='warning')
+        raise DownloadError('Download error: {}'.format(errors[-1] if errors else 'no url'))
+
+
+def _member_path(filename, dest_folder):
+    """
+    Path where zipfile extracts an archive member (same sanitization as ZipFile.extract)
+    """
+    arcname = filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in ('', os.path.curdir, os.path.pardir))
+    return os.path.join(dest_folder, arcname)
+
+
+def extract_zip(fname, dest_folder, nb_jobs=NB_JOBS):
+    """
+    Extract a zip archive with several threads (decompression releases the GIL). Each thread reads the archive with
+    its own file handle.
+    """
+    with zipfile.ZipFile(fname) as zf:
+        members = zf.infolist()
+        # create all folders first (also the parents of files, for archives without folder entries), so that threads
+        # do not race on creating them. Then balance the files between threads by size.
+        for member in members:
+            if member.filename.endswith('/'):
+                zf.extract(member, dest_folder)
+            else:
+                path = os.path.dirname(_member_path(member.filename, dest_folder))
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+        files = sorted([m for m in members if not m.filename.endswith('/')], key=lambda m: -m.file_size)
+    groups = [files[i::nb_jobs] for i in range(nb_jobs)]
+
+    def extract(group):
+        with zipfile.ZipFile(fname) as zf:
+            for member in group:
+                zf.extract(member, dest_folder)
+
+    with ThreadPoolExecutor(max_workers=nb_jobs) as executor:
+        list(executor.map(extract, [g for g in groups if g]))
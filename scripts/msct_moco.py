@@ -423,3 +423,57 @@ def combine_matrix(param):
             file = open(os.path.join(param.mat_final, fname), 'w')
             np.savetxt(os.path.join(param.mat_final, fname), Matrix_final, fmt="%s", delimiter='  ', newline='\n')
             file.close()
+
+
+#=======================================================================================================================
+# get_group_indexes: split volume indexes into groups
+#=======================================================================================================================
+def get_group_indexes(index, group_size):
+    """
+    Split a list of volume indexes into groups of group_size consecutive elements. The remaining indexes (if the
+    number of indexes is not a multiple of group_size) are put in a last, smaller group.
+    :param index: list of volume indexes (e.g. index_dwi from identify_b0)
+    :param group_size: int
+    :return: list of list of volume indexes
+    """
+    nb_groups = len(index) // group_size
+    group_indexes = [index[(iGroup * group_size):((iGroup + 1) * group_size)] for iGroup in range(nb_groups)]
+    # add the remaining images to the last group
+    nb_remaining = len(index) % group_size
+    if nb_remaining > 0:
+        group_indexes.append(index[len(index) - nb_remaining:len(index)])
+    return group_indexes
+
+
+#=======================================================================================================================
+# average_groups: average the volumes of a 4D image by group
+#=======================================================================================================================
+def average_groups(im, group_indexes):
+    """
+    Average the volumes of a 4D image within each group, in a single pass over the data and without writing
+    intermediate files. Each volume can belong to at most one group.
+    :param im: Image (x, y, z, t)
+    :param group_indexes: list of list of volume indexes along t (e.g. output of get_group_indexes)
+    :return: Image (x, y, z, number of groups) in float32, with the header of im. With a single group, the mean is a
+    3D Image (x, y, z).
+    """
+    data = im.data
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    # group of each volume (-1 if the volume is not averaged)
+    group_of_volume = -np.ones(data.shape[3], dtype=int)
+    for iGroup, index_group in enumerate(group_indexes):
+        group_of_volume[np.asarray(index_group, dtype=int)] = iGroup
+    counts = np.bincount(group_of_volume[group_of_volume >= 0], minlength=len(group_indexes))
+
+    data_mean = np.zeros(data.shape[:3] + (len(group_indexes),), dtype=np.float32)
+    for it in np.flatnonzero(group_of_volume >= 0):
+        data_mean[..., group_of_volume[it]] += data[..., it]
+    data_mean /= counts
+    if len(group_indexes) == 1:
+        data_mean = data_mean[..., 0]
+
+    hdr = im.hdr.copy()
+    hdr.set_data_dtype(np.float32)
+    hdr.set_data_shape(data_mean.shape)
+    return Image(data_mean, hdr=hdr)
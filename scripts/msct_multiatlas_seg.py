@@ -15,22 +15,28 @@
 from __future__ import absolute_import, division
 
 import gzip
+import hashlib
+import json
 import os
 import pickle
 import shutil
 import sys
+import tempfile
 import time
 
 import numpy as np
-import pandas as pd
-from sklearn import decomposition, manifold
 
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, normalize_slice,
+from msct_gmseg_utils import (Slice, apply_transfo, average_gm_wm, normalize_slice,
                               pre_processing, register_data)
 from spinalcordtoolbox.image import Image
 from msct_parser import Parser
 from sct_utils import printv
 import sct_utils as sct
+from spinalcordtoolbox.utils import lazy_import
+
+pd = lazy_import('pandas')
+decomposition = lazy_import('sklearn.decomposition')
+manifold = lazy_import('sklearn.manifold')
 
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 
@@ -46,8 +52,13 @@ def get_parser():
     parser.add_option(name="-path-data",
                       type_value="folder",
                       description="Path to the dataset",
-                      mandatory=True,
+                      mandatory=False,
                       example='my_data/')
+    parser.add_option(name="-convert-model",
+                      type_value="folder",
+                      description="Path to a GM model saved in the legacy format (.pklz files) to convert to the array store format, in the folder given by -o. If used, no model is computed.",
+                      mandatory=False,
+                      example='gm_model/')
     parser.add_option(name="-o",
                       type_value="folder_creation",
                       description="Output folder",
@@ -409,26 +420,10 @@ class Model:
 
     # ------------------------------------------------------------------------------------------------------------------
     def save_model(self):
-        curdir = os.getcwd()
-        os.chdir(self.param_model.new_model_dir)
-        # to save:
-        # - self.slices = dictionary
-        slices = self.slices
-        pickle.dump(slices, gzip.open('slices.pklz', 'wb'), protocol=2)
-
-        # - self.intensities = for normalization
-        intensities = self.intensities
-        pickle.dump(intensities, gzip.open('intensities.pklz', 'wb'), protocol=2)
-
-        # - reduced space (pca or isomap)
-        model = self.fitted_model
-        pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
-
-        # - fitted data (=eigen vectors or embedding vectors )
-        data = self.fitted_data
-        pickle.dump(data, gzip.open('fitted_data.pklz', 'wb'), protocol=2)
-
-        os.chdir(curdir)
+        """
+        Save the model as an array store in self.param_model.new_model_dir (see save_model_store)
+        """
+        save_model_store(self.param_model.new_model_dir, self.slices, self.intensities, ReducedSpace.from_estimator(self.fitted_model, self.param_model.method), self.fitted_data, mean_image=self.mean_image)
 
     # ----------------------------------- END OF FUNCTIONS USED TO COMPUTE THE MODEL -----------------------------------
 
@@ -436,11 +431,33 @@ class Model:
     #                                       FUNCTIONS USED TO LOAD THE MODEL
     # ------------------------------------------------------------------------------------------------------------------
     def load_model(self):
-        path = os.path.abspath('.')
         printv('\nLoading model...', self.param.verbose, 'normal')
+        path_model = self.param_model.path_model_to_load
+
+        path_store = path_model if os.path.isfile(os.path.join(path_model, MODEL_STORE_MANIFEST)) else get_converted_model(path_model)
+        if path_store is not None:
+            self.slices, self.intensities, self.fitted_model, self.fitted_data, self.mean_image = load_model_store(path_store, verbose=self.param.verbose)
+            self.param_model.method = self.fitted_model.method
+        else:
+            # legacy pickled model (e.g. data/gm_model): converted once, next to the model or in the user cache
+            printv('  No ' + MODEL_STORE_MANIFEST + ' found, converting the legacy pickled model (only done once)...', self.param.verbose, 'normal')
+            self.load_legacy_model()
+            if save_converted_model(path_model, self, verbose=self.param.verbose) is None:
+                printv('  The model could not be converted: it will be loaded from the pickled files at each run (run "msct_multiatlas_seg -convert-model ' + path_model + ' -o <new_model_dir>" to convert it).', self.param.verbose, 'warning')
+
+        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
+        printv('  model: ' + self.param_model.method)
+        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
+        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
+
+    def load_legacy_model(self):
+        """
+        Load a model saved as gzipped pickles (.pklz), as produced by previous versions of SCT
+        """
+        path = os.path.abspath('.')
         os.chdir(self.param_model.path_model_to_load)
 
-        model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+        model_files = LEGACY_MODEL_FILES
         correct_model = True
         for fname in model_files.values():
             if os.path.isfile(fname):
@@ -449,7 +466,7 @@ class Model:
                 printv('  MISSING FILE: ' + fname, self.param.verbose, 'warning')
                 correct_model = False
         if not correct_model:
-            path_script = os.path.dirname(__file__)
+            os.chdir(path)
             printv('ERROR: The GM segmentation model is not compatible with this version of the code.\n'
                    'To update the model, run the following lines:\n\n'
                    'cd ' + path_sct + '\n'
@@ -457,7 +474,6 @@ class Model:
 
         # - self.slices = dictionary
         self.slices = pickle.load(gzip.open(model_files['slices'],  'rb'))
-        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
         self.mean_image = np.mean([dic_slice.im for dic_slice in self.slices], axis=0)
 
         # - self.intensities = for normalization
@@ -469,9 +485,6 @@ class Model:
         # - fitted data (=eigen vectors or embedding vectors )
         self.fitted_data = pickle.load(gzip.open(model_files['data'], 'rb'))
 
-        printv('  model: ' + self.param_model.method)
-        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
-        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
         os.chdir(path)
 
     # ------------------------------------------------------------------------------------------------------------------
@@ -500,6 +513,254 @@ class Model:
         return gm_seg_model, wm_seg_model
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+#                                               MODEL STORE
+# ----------------------------------------------------------------------------------------------------------------------
+# The model is stored as a folder of uncompressed .npy arrays described by a small JSON manifest, so that it can be
+# memory-mapped at load time instead of being unpickled and decompressed. Slices are stored as stacked arrays, and the
+# reduced space (PCA or Isomap) is stored through the plain arrays needed to project new data (see ReducedSpace).
+MODEL_STORE_FORMAT = 'sct-gm-model'
+MODEL_STORE_VERSION = 1
+MODEL_STORE_MANIFEST = 'model.json'
+# a legacy model (gzipped pickles) is converted on first use into this folder of the model, or into the user cache if
+# the model folder is read-only
+MODEL_STORE_CACHE = 'store'
+LEGACY_MODEL_FILES = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+# segmentations can have several raters per slice: they are stacked along the first axis and indexed by offsets
+LIST_SEG_KEYS = ['gm_seg', 'wm_seg', 'gm_seg_M', 'wm_seg_M']
+
+
+class ReducedSpace:
+    """
+    Model reduced space (PCA or Isomap) described by plain numpy arrays, used to project target slices.
+    It reproduces the transform() method of the scikit-learn estimators, without having to pickle them.
+    """
+    def __init__(self, method, arrays):
+        """
+        :param method: 'pca' or 'isomap'
+        :param arrays: dictionary of numpy arrays describing the reduced space (see from_estimator)
+        """
+        self.method = method
+        self.arrays = arrays
+
+    @classmethod
+    def from_estimator(cls, estimator, method):
+        """
+        Extract the arrays needed for the projection from a fitted scikit-learn PCA or Isomap estimator
+        """
+        if isinstance(estimator, ReducedSpace):
+            return estimator
+        if method == 'pca':
+            arrays = {'mean': estimator.mean_,
+                      'components': estimator.components_}
+            if getattr(estimator, 'whiten', False):
+                arrays['explained_variance'] = estimator.explained_variance_
+        elif method == 'isomap':
+            kernel_pca = estimator.kernel_pca_
+            # attributes were renamed in scikit-learn 1.0
+            eigenvectors = getattr(kernel_pca, 'eigenvectors_', None)
+            if eigenvectors is None:
+                eigenvectors = kernel_pca.alphas_
+            eigenvalues = getattr(kernel_pca, 'eigenvalues_', None)
+            if eigenvalues is None:
+                eigenvalues = kernel_pca.lambdas_
+            arrays = {'training_data': estimator.nbrs_._fit_X,
+                      'dist_matrix': estimator.dist_matrix_,
+                      'n_neighbors': np.asarray(estimator.n_neighbors),
+                      'eigenvectors': eigenvectors,
+                      'eigenvalues': eigenvalues,
+                      'K_fit_rows': kernel_pca._centerer.K_fit_rows_,
+                      'K_fit_all': np.asarray(kernel_pca._centerer.K_fit_all_)}
+        else:
+            raise ValueError('Unknown model type: ' + str(method))
+        return cls(method, dict((k, np.asarray(v)) for k, v in arrays.items()))
+
+    def transform(self, data):
+        """
+        Project data into the reduced space
+        :param data: numpy array (n_samples, n_features)
+        :return: numpy array (n_samples, n_components)
+        """
+        data = np.atleast_2d(data)
+        if self.method == 'pca':
+            data_transformed = np.dot(data - self.arrays['mean'], np.asarray(self.arrays['components']).T)
+            if 'explained_variance' in self.arrays:
+                data_transformed /= np.sqrt(self.arrays['explained_variance'])
+            return data_transformed
+
+        # Isomap: geodesic distances to the training data through the nearest neighbors of each sample
+        training_data = self.arrays['training_data']
+        n_neighbors = int(self.arrays['n_neighbors'])
+        sq_dist = (data ** 2).sum(axis=1)[:, None] - 2 * np.dot(data, np.asarray(training_data).T) + (np.asarray(training_data) ** 2).sum(axis=1)[None, :]
+        ind_neighbors = np.argsort(sq_dist, axis=1)[:, :n_neighbors]
+        dist_neighbors = np.sqrt(np.maximum(sq_dist[np.arange(sq_dist.shape[0])[:, None], ind_neighbors], 0))
+        dist_matrix = self.arrays['dist_matrix']
+        kernel = np.array([np.min(dist_matrix[ind] + dist[:, None], axis=0) for ind, dist in zip(ind_neighbors, dist_neighbors)])
+        kernel = -0.5 * kernel ** 2
+        # center kernel and project on the (non-null) eigenvectors of the fitted kernel PCA
+        kernel = kernel - self.arrays['K_fit_rows'] - (kernel.sum(axis=1) / self.arrays['K_fit_rows'].shape[0])[:, None] + self.arrays['K_fit_all']
+        eigenvalues = self.arrays['eigenvalues']
+        non_zeros = np.flatnonzero(eigenvalues)
+        scaled_eigenvectors = np.zeros_like(self.arrays['eigenvectors'])
+        scaled_eigenvectors[:, non_zeros] = self.arrays['eigenvectors'][:, non_zeros] / np.sqrt(eigenvalues[non_zeros])
+        return np.dot(kernel, scaled_eigenvectors)
+
+
+def save_model_store(path_model, slices, intensities, reduced_space, fitted_data, mean_image=None):
+    """
+    Save a GM model as a folder of .npy arrays with a JSON manifest
+    :param path_model: output folder (created if needed)
+    :param slices: list of Slice() : model dictionary
+    :param intensities: pandas DataFrame of the averaged median intensities by level (columns GM, WM, MIN, MAX)
+    :param reduced_space: ReducedSpace
+    :param fitted_data: model data in the reduced space, numpy array (n_slices, n_components)
+    :param mean_image: mean of the slices images, computed if None
+    """
+    if not os.path.exists(path_model):
+        os.makedirs(path_model)
+
+    arrays = {'id': np.asarray([dic_slice.id for dic_slice in slices]),
+              'level': np.asarray([dic_slice.level for dic_slice in slices], dtype=float),
+              'im': np.asarray([dic_slice.im for dic_slice in slices]),
+              'im_M': np.asarray([dic_slice.im_M for dic_slice in slices]),
+              'fitted_data': np.asarray(fitted_data),
+              'intensities_index': np.asarray(intensities.index)}
+    arrays['mean_image'] = np.asarray(mean_image) if mean_image is not None else np.mean(arrays['im'], axis=0)
+    for key in LIST_SEG_KEYS:
+        list_seg = [np.asarray(getattr(dic_slice, key)).reshape((-1,) + arrays['im'].shape[1:]) for dic_slice in slices]
+        arrays[key] = np.concatenate(list_seg, axis=0)
+        arrays[key + '_offsets'] = np.cumsum([0] + [len(seg) for seg in list_seg])
+    for column in intensities.columns:
+        arrays['intensities_' + column] = np.asarray(intensities[column])
+    for key, value in reduced_space.arrays.items():
+        arrays['space_' + key] = value
+
+    for key, value in arrays.items():
+        np.save(os.path.join(path_model, key + '.npy'), value)
+
+    manifest = {'format': MODEL_STORE_FORMAT,
+                'version': MODEL_STORE_VERSION,
+                'method': reduced_space.method,
+                'n_slices': len(slices),
+                'slice_shape': list(arrays['im'].shape[1:]),
+                'intensities_columns': list(intensities.columns),
+                'arrays': sorted(arrays.keys())}
+    with open(os.path.join(path_model, MODEL_STORE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def load_model_store(path_model, mmap_mode='r', verbose=1):
+    """
+    Load a GM model saved by save_model_store. Arrays are memory-mapped by default, so only the parts of the model that
+    are used are actually read from disk.
+    :param path_model: model folder
+    :param mmap_mode: mmap_mode passed to numpy.load (None to load arrays in memory)
+    :return: slices, intensities, reduced_space, fitted_data, mean_image
+    """
+    with open(os.path.join(path_model, MODEL_STORE_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != MODEL_STORE_FORMAT or manifest.get('version') != MODEL_STORE_VERSION:
+        printv('ERROR: The GM segmentation model in ' + path_model + ' has an unsupported format: ' + str(manifest.get('format')) + ' v' + str(manifest.get('version')), verbose, 'error')
+
+    arrays = {}
+    for key in manifest['arrays']:
+        arrays[key] = np.load(os.path.join(path_model, key + '.npy'), mmap_mode=mmap_mode)
+
+    slices = []
+    for i in range(manifest['n_slices']):
+        list_seg = {}
+        for key in LIST_SEG_KEYS:
+            offsets = arrays[key + '_offsets']
+            list_seg[key] = arrays[key][offsets[i]:offsets[i + 1]]
+        slices.append(Slice(slice_id=int(arrays['id'][i]), im=arrays['im'][i], gm_seg=list_seg['gm_seg'], wm_seg=list_seg['wm_seg'],
+                            im_m=arrays['im_M'][i], gm_seg_m=list_seg['gm_seg_M'], wm_seg_m=list_seg['wm_seg_M'], level=float(arrays['level'][i])))
+
+    index = np.asarray(arrays['intensities_index'])
+    intensities = pd.DataFrame(dict((column, pd.Series(np.asarray(arrays['intensities_' + column]), index=index)) for column in manifest['intensities_columns']))
+
+    reduced_space = ReducedSpace(manifest['method'], dict((key[len('space_'):], value) for key, value in arrays.items() if key.startswith('space_')))
+
+    return slices, intensities, reduced_space, arrays['fitted_data'], arrays['mean_image']
+
+
+def convert_model(path_model_in, path_model_out, verbose=1):
+    """
+    Convert a legacy GM model (gzipped pickles) to the array store format
+    """
+    param_model = ParamModel()
+    param_model.path_model_to_load = path_model_in
+    param = Param()
+    param.verbose = verbose
+    model = Model(param_model=param_model, param=param)
+    model.load_legacy_model()
+    save_legacy_model_store(path_model_out, model)
+
+
+def save_legacy_model_store(path_model, model):
+    """
+    Save a model loaded by Model.load_legacy_model() as an array store
+    """
+    method = 'isomap' if isinstance(model.fitted_model, manifold.Isomap) else 'pca'
+    save_model_store(path_model, model.slices, model.intensities, ReducedSpace.from_estimator(model.fitted_model, method), model.fitted_data, mean_image=model.mean_image)
+
+
+def get_converted_model_dirs(path_model):
+    """
+    :return: candidate folders of the array store converted from the legacy model in path_model, in order of preference
+    """
+    path_model = os.path.abspath(path_model)
+    path_cache = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return [os.path.join(path_model, MODEL_STORE_CACHE),
+            os.path.join(path_cache, 'sct', 'gm_model', hashlib.sha1(path_model.encode('utf-8')).hexdigest())]
+
+
+def get_converted_model(path_model):
+    """
+    :return: folder of the array store converted from the legacy model in path_model, None if there is no store more
+    recent than the .pklz files
+    """
+    try:
+        time_legacy = max(os.path.getmtime(os.path.join(path_model, fname)) for fname in LEGACY_MODEL_FILES.values())
+    except OSError:
+        return None
+    for path_store in get_converted_model_dirs(path_model):
+        fname_manifest = os.path.join(path_store, MODEL_STORE_MANIFEST)
+        if os.path.isfile(fname_manifest) and os.path.getmtime(fname_manifest) >= time_legacy:
+            return path_store
+    return None
+
+
+def save_converted_model(path_model, model, verbose=1):
+    """
+    Convert the legacy model in path_model, loaded in model, into the first writable folder of get_converted_model_dirs.
+    The store is written in a temporary folder then renamed, so that concurrent runs never read a partial store.
+    :return: folder of the store, None if the model could not be converted
+    """
+    for path_store in get_converted_model_dirs(path_model):
+        path_tmp = None
+        try:
+            if not os.path.isdir(os.path.dirname(path_store)):
+                os.makedirs(os.path.dirname(path_store))
+            path_tmp = tempfile.mkdtemp(prefix='.' + MODEL_STORE_CACHE + '-', dir=os.path.dirname(path_store))
+            save_legacy_model_store(path_tmp, model)
+            if get_converted_model(path_model) is not None:
+                # converted at the same time by another run
+                shutil.rmtree(path_tmp, ignore_errors=True)
+                return get_converted_model(path_model)
+            if os.path.isdir(path_store):
+                # outdated store
+                shutil.rmtree(path_store)
+            os.rename(path_tmp, path_store)
+        except (OSError, IOError, AttributeError, ValueError) as e:
+            if path_tmp is not None:
+                shutil.rmtree(path_tmp, ignore_errors=True)
+            printv('  Could not save the converted model in ' + path_store + ': ' + str(e), verbose, 'normal')
+            continue
+        printv('  Converted model saved in ' + path_store, verbose, 'normal')
+        return path_store
+    return None
+
+
 def main(args=None):
 
     if args is None:
@@ -514,10 +775,20 @@ def main(args=None):
     parser = get_parser()
     arguments = parser.parse(args)
 
-    param_model.path_data = arguments['-path-data']
-
     if '-o' in arguments:
         param_model.new_model_dir = arguments['-o']
+    if '-v' in arguments:
+        param.verbose = arguments['-v']
+
+    if '-convert-model' in arguments:
+        convert_model(arguments['-convert-model'], param_model.new_model_dir, verbose=param.verbose)
+        printv('Model converted in ' + param_model.new_model_dir, param.verbose, 'info')
+        return
+
+    if '-path-data' not in arguments:
+        printv('ERROR: -path-data is required to compute a model.', param.verbose, 'error')
+    param_model.path_data = arguments['-path-data']
+
     if '-model-type' in arguments:
         param_model.method = arguments['-model-type']
     if '-k-pca' in arguments:
@@ -540,8 +811,6 @@ def main(args=None):
         param_model.ind_rm = arguments['-ind-rm']
     if '-r' in arguments:
         param.rm_tmp = bool(int(arguments['-r']))
-    if '-v' in arguments:
-        param.verbose = arguments['-v']
 
     model = Model(param_model=param_model, param_data=param_data, param=param)
 
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Job scheduling for sct_pipeline
+# Journal keeps track of the status and result of each job on disk as soon as it finishes, so that an interrupted
+# run can be resumed without recomputing completed jobs.
+# ResourceProfiles describes the number of threads and the memory needed by each function, from declared defaults,
+# a user file, and the peak memory observed in the journal.
+# run_jobs submits jobs to a pool executor when enough CPUs and RAM are free, records them in the journal, and retries
+# failures.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import sys, io, os, time, json, hashlib, pickle, socket, uuid, threading
+import multiprocessing
+
+import concurrent.futures
+
+import pandas as pd
+
+import sct_utils as sct
+
+
+# Status of a job in the journal
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def job_key(job):
+    """
+    Identifier of a job, stable across runs
+    :param job: tuple (function, subject path, arguments, test_integrity)
+    :return: str
+    """
+    return hashlib.sha1(json.dumps([str(x) for x in job]).encode('utf-8')).hexdigest()
+
+
+def _write_atomic(path, data):
+    """Write bytes to a file through a temporary file and a rename, so that readers never see a partial file
+    """
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with io.open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class Journal(object):
+    """
+    On-disk journal of the jobs of a pipeline run.
+
+    The folder contains:
+      - journal.jsonl: one line per finished job attempt (key, function, subject, args, status, duration, attempt, ...)
+      - results/<key>.pickle: the result (pandas DataFrame) of each job
+      - results_partial.csv: all the results available so far, one row appended after each job
+    """
+    fname_journal = 'journal.jsonl'
+    fname_partial = 'results_partial.csv'
+    folder_results = 'results'
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}  # last record by job key
+        self.attempts = {}  # number of attempts by job key
+        self._partial_columns = None  # columns of results_partial.csv
+        if not os.path.isdir(os.path.join(path, self.folder_results)):
+            os.makedirs(os.path.join(path, self.folder_results))
+        self._load()
+
+    def _load(self):
+        fname = os.path.join(self.path, self.fname_journal)
+        if not os.path.isfile(fname):
+            return
+        with io.open(fname, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be truncated if the run was killed while writing it
+                    sct.log.warning('Ignoring corrupted journal line: {}'.format(line.strip()))
+                    continue
+                self.records[record['key']] = record
+                self.attempts[record['key']] = max(self.attempts.get(record['key'], 0), record.get('attempt', 1))
+
+    def status(self, key):
+        record = self.records.get(key)
+        return record['status'] if record is not None else None
+
+    def is_done(self, key):
+        return self.status(key) == STATUS_DONE and os.path.isfile(self._fname_result(key))
+
+    def _fname_result(self, key):
+        return os.path.join(self.path, self.folder_results, key + '.pickle')
+
+    def load_result(self, key):
+        with io.open(self._fname_result(key), 'rb') as f:
+            return pickle.load(f)
+
+    def record(self, job, status, duration, result=None, error=None, peak_rss=None):
+        """
+        Save the result of a job attempt and append it to the journal
+        :param job: tuple (function, subject path, arguments, test_integrity)
+        :param status: STATUS_DONE or STATUS_FAILED
+        :param duration: wall time of the job (s)
+        :param result: pandas DataFrame returned by the job
+        :param error: error message if the job failed
+        :param peak_rss: peak memory used by the job (MB)
+        """
+        key = job_key(job)
+        if result is not None:
+            _write_atomic(self._fname_result(key), pickle.dumps(result, protocol=2))
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        record = {
+            'key': key,
+            'function': job[0],
+            'subject': os.path.basename(job[1]),
+            'args': job[2],
+            'status': status,
+            'duration': duration,
+            'peak_rss': peak_rss,
+            'attempt': self.attempts[key],
+            'error': error,
+            'host': socket.gethostname(),
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.records[key] = record
+        line = json.dumps(record) + '\n'
+        with io.open(os.path.join(self.path, self.fname_journal), 'ab') as f:
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_partial_results(self, results):
+        """
+        Write the results available so far as CSV (e.g. the ones resumed from the journal)
+        :param results: list of pandas DataFrame
+        """
+        self._partial_columns = None
+        if not results:
+            return
+        data = pd.concat(results)
+        _write_atomic(os.path.join(self.path, self.fname_partial), data.to_csv().encode('utf-8'))
+        self._partial_columns = list(data.columns)
+
+    def append_partial_result(self, result):
+        """
+        Append the rows of a job result to the CSV of the results available so far. The file is only rewritten when
+        the result has columns that are not in it yet.
+        :param result: pandas DataFrame
+        """
+        fname = os.path.join(self.path, self.fname_partial)
+        if self._partial_columns is None:
+            return self.write_partial_results([result])
+        if not set(result.columns).issubset(self._partial_columns):
+            return self.write_partial_results([pd.read_csv(fname, index_col=0), result])
+        with io.open(fname, 'ab') as f:
+            f.write(result.reindex(columns=self._partial_columns).to_csv(header=False).encode('utf-8'))
+
+
+# Threads and peak memory (MB) used by the functions launched by sct_pipeline. These are conservative estimates on
+# typical data; they can be overridden with a JSON file, and are replaced by the observed peak memory once the function
+# has been run with a journal.
+DEFAULT_PROFILE = {'threads': 1, 'memory': 1000}
+DEFAULT_PROFILES = {
+    'sct_register_to_template': {'threads': 4, 'memory': 4000},
+    'sct_register_multimodal': {'threads': 4, 'memory': 3000},
+    'sct_straighten_spinalcord': {'threads': 2, 'memory': 3000},
+    'sct_warp_template': {'threads': 2, 'memory': 2000},
+    'sct_deepseg_sc': {'threads': 2, 'memory': 3000},
+    'sct_deepseg_gm': {'threads': 2, 'memory': 3000},
+    'sct_deepseg_lesion': {'threads': 2, 'memory': 3000},
+    'sct_segment_graymatter': {'threads': 1, 'memory': 2000},
+    'sct_dmri_moco': {'threads': 1, 'memory': 2000},
+    'sct_fmri_moco': {'threads': 1, 'memory': 2000},
+    'sct_propseg': {'threads': 1, 'memory': 1000},
+}
+# margin applied on the observed peak memory
+MEMORY_MARGIN = 1.2
+
+# environment variables that set the number of threads of the libraries used by the functions
+THREAD_ENV_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                        'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']
+
+
+class ResourceProfiles(object):
+    """
+    Number of threads and memory (MB) needed by each function
+    """
+    def __init__(self, fname_profiles=None, journal=None):
+        """
+        :param fname_profiles: JSON file {"function": {"threads": int, "memory": MB}, ...} overriding the defaults
+        :param journal: Journal, from which the observed peak memory of each function is learned
+        """
+        self.profiles = dict((k, dict(v)) for k, v in DEFAULT_PROFILES.items())
+        declared = {}
+        if fname_profiles is not None:
+            with io.open(fname_profiles, 'r') as f:
+                declared = json.load(f)
+            for function, profile in declared.items():
+                self.profiles.setdefault(function, dict(DEFAULT_PROFILE)).update(profile)
+        # memory declared by the user takes precedence over the memory learned from previous runs
+        if journal is not None:
+            for function, peak_rss in self.observed_peak_rss(journal).items():
+                if 'memory' not in declared.get(function, {}):
+                    self.profiles.setdefault(function, dict(DEFAULT_PROFILE))['memory'] = peak_rss * MEMORY_MARGIN
+
+    @staticmethod
+    def observed_peak_rss(journal):
+        """
+        :return: dict {function: maximum peak RSS (MB) observed in the journal}
+        """
+        peak_rss = {}
+        for record in journal.records.values():
+            if record.get('peak_rss'):
+                peak_rss[record['function']] = max(peak_rss.get(record['function'], 0), record['peak_rss'])
+        return peak_rss
+
+    def get(self, function):
+        return self.profiles.get(function, DEFAULT_PROFILE)
+
+
+class PeakRSSMonitor(object):
+    """
+    Sample the memory (RSS) of the current process and its children in a background thread, and keep the peak.
+    Falls back to resource.getrusage() if psutil is not available, in which case the peak is the maximum over the
+    lifetime of the process.
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import psutil
+            self._process = psutil.Process(os.getpid())
+        except ImportError:
+            self._process = None
+
+    def _sample(self):
+        rss = 0
+        for process in [self._process] + self._process.children(recursive=True):
+            try:
+                rss += process.memory_info().rss
+            except Exception:
+                # process terminated in the meantime
+                pass
+        self.peak = max(self.peak, rss / 1024 / 1024)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self._process is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        else:
+            import resource
+            # ru_maxrss is in kB on Linux, in bytes on OSX
+            unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+            self.peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / unit
+
+
+def _timed_call(function, job, threads=1):
+    """
+    Run function(job) in a worker, with the number of threads of the libraries set to `threads` in the environment of
+    the commands it runs (os.environ of the worker is not changed), and measure its duration and peak memory
+    :return: result, duration (s), peak RSS (MB)
+    """
+    time_start = time.time()
+    with sct.child_env(dict((variable, str(threads)) for variable in THREAD_ENV_VARIABLES)):
+        with PeakRSSMonitor() as monitor:
+            result = function(job)
+    return result, time.time() - time_start, monitor.peak
+
+
+def is_failure(result):
+    """
+    A job failed if it crashed (status 1). Other status (e.g. failed integrity testing) are results of the job.
+    """
+    return result is None or ('status' in result and (result['status'] == 1).any())
+
+
+def run_jobs(pool, function, list_jobs, journal=None, max_retries=0, profiles=None, nb_cpu=None, memory=None, verbose=1):
+    """
+    Run jobs on a pool executor, skipping those already completed in the journal and retrying the ones that failed.
+    Jobs are only submitted when the CPUs and memory they need (according to their profile) are available, so that
+    multi-threaded and memory-hungry functions do not oversubscribe the node.
+    :param pool: concurrent.futures executor (ProcessPoolExecutor or MPIPoolExecutor)
+    :param function: function called on each job, must return a pandas DataFrame
+    :param list_jobs: list of jobs, each one is a tuple (function, subject path, arguments, test_integrity)
+    :param journal: Journal, or None to keep results in memory only
+    :param max_retries: maximum number of times a failed job is submitted again
+    :param profiles: ResourceProfiles, default profiles if None
+    :param nb_cpu: number of CPUs that jobs can use, all CPUs if None
+    :param memory: memory (MB) that jobs can use, RAM available at start if None
+    :param verbose: 0: no progress display, 1: display the number of jobs completed
+    :return: list of pandas DataFrame, one per job (in completion order)
+    """
+    if profiles is None:
+        profiles = ResourceProfiles(journal=journal)
+    if not nb_cpu:
+        nb_cpu = multiprocessing.cpu_count()
+    if memory is None:
+        memory = sct.get_available_ram()
+        if memory is None:
+            sct.log.warning('Available RAM is unknown on this platform: jobs are only scheduled according to CPUs')
+            memory = float('inf')
+
+    all_results = []
+    list_todo = []
+    for job in list_jobs:
+        if journal is not None and journal.is_done(job_key(job)):
+            all_results.append(journal.load_result(job_key(job)))
+        else:
+            list_todo.append(job)
+    if journal is not None:
+        journal.write_partial_results(all_results)
+    if all_results:
+        sct.log.info('Resuming from journal {}: {}/{} job(s) already completed'.format(journal.path, len(all_results), len(list_jobs)))
+
+    def resources(job):
+        profile = profiles.get(job[0])
+        return min(int(profile['threads']), nb_cpu), float(profile['memory'])
+
+    def can_start(job):
+        threads, job_memory = resources(job)
+        if not futures:
+            # always run at least one job, even if its profile exceeds the resources of the node
+            return True
+        if threads_used[0] + threads > nb_cpu or memory_used[0] + job_memory > memory:
+            return False
+        available = sct.get_available_ram()
+        return available is None or available >= job_memory
+
+    def submit(job):
+        threads, job_memory = resources(job)
+        threads_used[0] += threads
+        memory_used[0] += job_memory
+        futures[pool.submit(_timed_call, function, job, threads)] = job
+
+    retries = {}
+    count = len(all_results)
+    futures = {}
+    threads_used, memory_used = [0], [0.]
+    try:
+        while list_todo or futures:
+            while list_todo and can_start(list_todo[0]):
+                submit(list_todo.pop(0))
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                threads, job_memory = resources(job)
+                threads_used[0] -= threads
+                memory_used[0] -= job_memory
+                subject = os.path.basename(job[1])
+                result, duration, peak_rss, error = None, None, None, None
+                try:
+                    result, duration, peak_rss = future.result()
+                except Exception as exc:
+                    error = str(exc)
+                    sct.log.error('{} {} generated an exception: {}'.format(subject, job[2], exc))
+
+                failed = is_failure(result)
+                if journal is not None:
+                    journal.record(job, STATUS_FAILED if failed else STATUS_DONE, duration, result=result, error=error, peak_rss=peak_rss)
+                if peak_rss is not None and peak_rss > job_memory:
+                    sct.log.warning('{} {} used {:.0f} MB, more than the {:.0f} MB of its profile'.format(subject, job[2], peak_rss, job_memory))
+
+                if failed and retries.get(job, 0) < max_retries:
+                    retries[job] = retries.get(job, 0) + 1
+                    sct.log.warning('{} {} failed, retrying ({}/{})'.format(subject, job[2], retries[job], max_retries))
+                    list_todo.insert(0, job)
+                    continue
+
+                count += 1
+                if verbose:
+                    sct.no_new_line_log('Processing subjects... {}/{}'.format(count, len(list_jobs)))
+                if result is not None:
+                    all_results.append(result)
+                    if journal is not None:
+                        journal.append_partial_result(result)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+    return all_results
@@ -27,6 +27,7 @@ from scipy.io import loadmat
 from nibabel import load, Nifti1Image, save
 
 from spinalcordtoolbox.image import Image
+import spinalcordtoolbox.warp
 import sct_utils as sct
 from sct_convert import convert
 from sct_register_multimodal import Paramreg
@@ -676,22 +677,12 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
                 list_warp_inv.append(file_warp2d_inv)
 
             if paramreg.algo in ['Rigid', 'Affine']:
-                # Generating null 2d warping field (for subsequent concatenation with affine transformation)
-                # TODO fixup isct_ants* parsers
-                sct.run(['isct_antsRegistration',
-                 '-d', '2',
-                 '-t', 'SyN[1,1,1]',
-                 '-c', '0',
-                 '-m', 'MI[dest_Z' + num + '.nii,src_Z' + num + '.nii,1,32]',
-                 '-o', 'warp2d_null',
-                 '-f', '1',
-                 '-s', '0',
-                ])
-                # --> outputs: warp2d_null0Warp.nii.gz, warp2d_null0InverseWarp.nii.gz
+                # Convert the affine transformation to 2d warping fields, on the grids of dest and src
                 file_mat = prefix_warp2d + '0GenericAffine.mat'
-                # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d, '-R', 'dest_Z' + num + '.nii', 'warp2d_null0Warp.nii.gz', file_mat])
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d_inv, '-R', 'src_Z' + num + '.nii', 'warp2d_null0InverseWarp.nii.gz', '-i', file_mat])
+                for file_warp, file_ref, transfo in [(file_warp2d, 'dest_Z' + num + '.nii', file_mat),
+                                                     (file_warp2d_inv, 'src_Z' + num + '.nii', '-' + file_mat)]:
+                    im_ref = load(file_ref)
+                    spinalcordtoolbox.warp.compose([transfo], im_ref.shape, im_ref.affine, ndim=2).save(file_warp, header=im_ref.header)
 
         # if an exception occurs with ants, take the last value for the transformation
         # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
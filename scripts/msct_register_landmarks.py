@@ -19,13 +19,11 @@
 #########################################################################################
 
 # TODO: homogeneize input parameters: (src=src, dest=dest), instead of (dest, src).
-# TODO: add full affine transfo
 # TODO: normalize SSE: currently, it depends on the number of landmarks
 
 from __future__ import absolute_import, division
 
 import sys, io, os
-from operator import itemgetter
 
 import numpy as np
 
@@ -33,13 +31,6 @@ import numpy as np
 import sct_utils as sct
 from nibabel import load
 
-sse_results = []
-ini_param_rotation = 0.5  # rad
-ini_param_trans_x = 270.0  # pix
-ini_param_trans_y = -150.0  # pix
-initial_step = 2
-
-
 def register_landmarks(fname_src, fname_dest, dof, fname_affine='affine.txt', verbose=1, path_qc=None):
     """
     Register two NIFTI volumes containing landmarks
@@ -102,20 +93,43 @@ def register_landmarks(fname_src, fname_dest, dof, fname_affine='affine.txt', ve
     text_file.close()
 
 
-def getNeighbors(point, set_points, k=1):
-    '''
-    Locate most similar neighbours
-    :param point: the point for which we want to compute the neighbors
-    :param trainingSet: list of other Points
-    :param k: number of neighbors wanted
-    :return: k nearest neighbors of input point
-    '''
-    distances = []
-    for other_point in set_points:
-        dist = point.euclideanDistance(other_point)
-        distances.append((other_point, dist))
-    distances.sort(key=itemgetter(1))
-    return [distances[x][0] for x in range(k)]
+def match_points(points_fixed, points_moving):
+    """
+    Closest fixed point of each moving point, found with a KD-tree
+    :param points_fixed: (N, 3) array
+    :param points_moving: (M, 3) array
+    :return: (M,) indexes in points_fixed, (M,) distances
+    """
+    from scipy.spatial import cKDTree
+    distances, indexes = cKDTree(np.asarray(points_fixed, dtype=np.float64)).query(np.asarray(points_moving, dtype=np.float64))
+    return indexes, distances
+
+
+def register_points_icp(points_fixed, points_moving, constraints='Tx_Ty_Tz_Rx_Ry_Rz', max_iter=50, tol=1e-6):
+    """
+    Iterative closest point: register points without known correspondences, by alternating the matching of each
+    moving point to its closest fixed point and the closed-form estimation of the transformation.
+    :param points_fixed: (N, 3) array
+    :param points_moving: (M, 3) array
+    :param constraints: degrees of freedom, see getRigidTransformFromLandmarks
+    :return: rotsc_matrix, translation_array, points_moving_reg, points_moving_barycenter, as returned by
+    getRigidTransformFromLandmarks, and the indexes of the matched fixed points
+    """
+    points_fixed = np.asarray(points_fixed, dtype=np.float64)
+    points_moving = np.asarray(points_moving, dtype=np.float64)
+    matrix, translation, barycenter = np.eye(3), np.zeros(3), np.mean(points_moving, axis=0)
+    points_moving_reg = points_moving
+    sse_previous = None
+    for iteration in range(max_iter):
+        indexes, distances = match_points(points_fixed, points_moving_reg)
+        sse = np.sum(distances ** 2)
+        if sse_previous is not None and sse_previous - sse <= tol * max(sse_previous, 1):
+            break
+        sse_previous = sse
+        matrix, translation, barycenter = estimate_transform(points_fixed[indexes], points_moving, constraints)
+        points_moving_reg = apply_transform(points_moving, matrix, translation, barycenter)
+    indexes, distances = match_points(points_fixed, points_moving_reg)
+    return np.matrix(matrix), np.matrix(translation), points_moving_reg.tolist(), barycenter, indexes
 
 
 def SSE(pointsA, pointsB):
@@ -163,98 +177,142 @@ def Metric_Images(imageA, imageB, type=''):
     return result_metric
 
 
-def minimize_transform(params, points_dest, points_src, constraints):
+# degrees of freedom: translations, rotations (Euler angles alpha, beta, gamma of get_rotation_matrix) and scalings
+DOF = ['Tx', 'Ty', 'Tz', 'Rx', 'Ry', 'Rz', 'Sx', 'Sy', 'Sz']
+
+
+def parse_constraints(constraints):
     """
-    Cost function to minimize
-    :param params:
-    :param points_dest:
-    :param points_src:
-    :param constraints:
-    :return: sum of squared error between pair-wise landmarks
+    :param constraints: degrees of freedom separated with "_", e.g. Tx_Ty_Tz_Rx_Ry_Sz. "Affine" frees the whole
+    linear part of the transformation.
+    :return: free translations (3,) boolean, free rotation angles (3,) boolean, free scalings (3,) boolean, affine
     """
-    # initialize dof
-    dof = [0, 0, 0, 0, 0, 0, 1, 1, 1]
-    # initialize dictionary to relate constraints index to dof
-    dict_dof = {'Tx': 0, 'Ty': 1, 'Tz': 2, 'Rx': 3, 'Ry': 4, 'Rz': 5, 'Sx': 6, 'Sy': 7, 'Sz': 8}
-    # extract constraints
     list_constraints = constraints.split('_')
-    # loop across constraints and update dof
-    for i in range(len(list_constraints)):
-        dof[dict_dof[list_constraints[i]]] = params[i]
-    # convert dof to more intuitive variables
-    tx, ty, tz, alpha, beta, gamma, scx, scy, scz = dof[0], dof[1], dof[2], dof[3], dof[4], dof[5], dof[6], dof[7], dof[8]
-    # build rotation matrix
-    rotation_matrix = np.matrix([[np.cos(alpha) * np.cos(beta), np.cos(alpha) * np.sin(beta) * np.sin(gamma) - np.sin(alpha) * np.cos(gamma), np.cos(alpha) * np.sin(beta) * np.cos(gamma) + np.sin(alpha) * np.sin(gamma)],
-                              [np.sin(alpha) * np.cos(beta), np.sin(alpha) * np.sin(beta) * np.sin(gamma) + np.cos(alpha) * np.cos(gamma), np.sin(alpha) * np.sin(beta) * np.cos(gamma) - np.cos(alpha) * np.sin(gamma)],
-                              [-np.sin(beta), np.cos(beta) * np.sin(gamma), np.cos(beta) * np.cos(gamma)]])
-    # build scaling matrix
-    scaling_matrix = np.matrix([[scx, 0.0, 0.0], [0.0, scy, 0.0], [0.0, 0.0, scz]])
-    # compute rotation+scaling matrix
-    rotsc_matrix = scaling_matrix * rotation_matrix
-    # compute center of mass from moving points (src)
-    points_src_barycenter = np.mean(points_src, axis=0)
-    # apply transformation to moving points (src)
-    points_src_reg = ((rotsc_matrix * (np.matrix(points_src) - points_src_barycenter).T).T + points_src_barycenter) + np.matrix([tx, ty, tz])
-    # record SSE for later display
-    sse_results.append(SSE(np.matrix(points_dest), points_src_reg))
-    # return SSE
-    return SSE(np.matrix(points_dest), points_src_reg)
+    for dof in list_constraints:
+        if dof not in DOF + ['Affine']:
+            raise ValueError('Unknown degree of freedom: ' + dof + '. Available: ' + ', '.join(DOF + ['Affine']))
+    free = np.array([dof in list_constraints for dof in DOF])
+    return free[0:3], free[3:6], free[6:9], 'Affine' in list_constraints
+
+
+def get_rotation_matrix(alpha, beta, gamma):
+    """
+    Rotation matrix of the Euler angles (rad) of the Rx, Ry and Rz degrees of freedom
+    """
+    return np.array([[np.cos(alpha) * np.cos(beta), np.cos(alpha) * np.sin(beta) * np.sin(gamma) - np.sin(alpha) * np.cos(gamma), np.cos(alpha) * np.sin(beta) * np.cos(gamma) + np.sin(alpha) * np.sin(gamma)],
+                     [np.sin(alpha) * np.cos(beta), np.sin(alpha) * np.sin(beta) * np.sin(gamma) + np.cos(alpha) * np.cos(gamma), np.sin(alpha) * np.sin(beta) * np.cos(gamma) - np.cos(alpha) * np.sin(gamma)],
+                     [-np.sin(beta), np.cos(beta) * np.sin(gamma), np.cos(beta) * np.cos(gamma)]])
+
+
+def get_euler_angles(rotation_matrix):
+    """
+    Inverse of get_rotation_matrix
+    :return: alpha, beta, gamma
+    """
+    beta = -np.arcsin(np.clip(rotation_matrix[2, 0], -1, 1))
+    alpha = np.arctan2(rotation_matrix[1, 0], rotation_matrix[0, 0])
+    gamma = np.arctan2(rotation_matrix[2, 1], rotation_matrix[2, 2])
+    return np.array([alpha, beta, gamma])
+
+
+def procrustes_rotation(points_fixed, points_moving):
+    """
+    Rotation minimizing the SSE between centered point sets (Kabsch algorithm)
+    :param points_fixed, points_moving: (N, 3) centered arrays
+    :return: (3, 3) rotation matrix
+    """
+    u, _, vt = np.linalg.svd(np.dot(points_fixed.T, points_moving))
+    d = np.sign(np.linalg.det(np.dot(u, vt))) or 1.
+    return np.dot(u * np.array([1., 1., d]), vt)
+
+
+def fit_scaling(points_fixed, points_moving, free_scaling):
+    """
+    Scaling along each axis minimizing the SSE between centered point sets
+    :return: (3,) scaling factors (1 for the axes that are not free or cannot be estimated)
+    """
+    scaling = np.ones(3)
+    norm = np.sum(points_moving ** 2, axis=0)
+    axes = free_scaling & (norm > 0)
+    scaling[axes] = np.sum(points_fixed * points_moving, axis=0)[axes] / norm[axes]
+    return scaling
+
+
+def estimate_transform(points_fixed, points_moving, constraints='Tx_Ty_Tz_Rx_Ry_Rz'):
+    """
+    Transformation of the moving points minimizing the SSE with the paired fixed points:
+    p -> S.R.(p - c) + c + t, where c is the barycenter of the moving points, S the scaling matrix and R the rotation.
+    As the moving points are centered, the optimal translation along a free axis is the difference of the
+    barycenters, and the linear part does not depend on the translation constraints. The linear part is solved in
+    closed form: least squares (Affine), scaling only, or Kabsch rotation (all rotations, no scaling). Other subsets of
+    rotations and scalings are initialized by projecting the closed-form solution on the free parameters, and refined
+    by Gauss-Newton (least squares on the residuals).
+    :param points_fixed, points_moving: (N, 3) arrays of paired points
+    :return: (3, 3) linear part, (3,) translation, (3,) barycenter c
+    """
+    free_translation, free_rotation, free_scaling, affine = parse_constraints(constraints)
+    points_fixed = np.asarray(points_fixed, dtype=np.float64)
+    points_moving = np.asarray(points_moving, dtype=np.float64)
+    barycenter = np.mean(points_moving, axis=0)
+    barycenter_fixed = np.mean(points_fixed, axis=0)
+    moving = points_moving - barycenter
+    fixed = points_fixed - barycenter_fixed
+    translation = np.where(free_translation, barycenter_fixed - barycenter, 0.)
+
+    if affine:
+        matrix = np.linalg.lstsq(moving, fixed, rcond=None)[0].T
+    elif not free_rotation.any():
+        matrix = np.diag(fit_scaling(fixed, moving, free_scaling))
+    elif free_rotation.all() and not free_scaling.any():
+        matrix = procrustes_rotation(fixed, moving)
+    else:
+        from scipy.optimize import least_squares
+        # initial guess: closed-form rotation, restricted to the free angles, then scaling
+        angles = np.where(free_rotation, get_euler_angles(procrustes_rotation(fixed, moving)), 0.)
+        scaling = fit_scaling(fixed, np.dot(moving, get_rotation_matrix(*angles).T), free_scaling)
+        nb_angles = np.sum(free_rotation)
+
+        def get_matrix(params):
+            angles_free = np.zeros(3)
+            angles_free[free_rotation] = params[:nb_angles]
+            scaling_free = np.ones(3)
+            scaling_free[free_scaling] = params[nb_angles:]
+            return np.dot(np.diag(scaling_free), get_rotation_matrix(*angles_free))
+
+        def residuals(params):
+            return (fixed - np.dot(moving, get_matrix(params).T)).ravel()
+
+        res = least_squares(residuals, np.concatenate([angles[free_rotation], scaling[free_scaling]]), method='lm'
+                            if fixed.size >= nb_angles + np.sum(free_scaling) else 'trf', xtol=1e-12, ftol=1e-12)
+        matrix = get_matrix(res.x)
+    return matrix, translation, barycenter
+
+
+def apply_transform(points, matrix, translation, barycenter):
+    """
+    :return: (N, 3) array of the points transformed by p -> M.(p - c) + c + t
+    """
+    return np.dot(np.asarray(points, dtype=np.float64) - barycenter, matrix.T) + barycenter + translation
 
 
 def getRigidTransformFromLandmarks(points_dest, points_src, constraints='Tx_Ty_Tz_Rx_Ry_Rz', verbose=0, path_qc=None):
     """
-    Compute affine transformation to register landmarks
-    :param points_src:
-    :param points_dest:
-    :param constraints:
+    Compute affine transformation to register landmarks, in closed form (see estimate_transform)
+    :param points_dest: list of fixed points
+    :param points_src: list of moving points, paired with points_dest
+    :param constraints: degrees of freedom separated with "_": Tx, Ty, Tz, Rx, Ry, Rz, Sx, Sy, Sz or Affine
     :param verbose: 0, 1, 2
     :return: rotsc_matrix, translation_array, points_src_reg, points_src_barycenter
     """
-    # TODO: check input constraints
-    from scipy.optimize import minimize
-
-    # initialize default parameters
-    init_param = [0, 0, 0, 0, 0, 0, 1, 1, 1]
-    # initialize parameters for optimizer
-    init_param_optimizer = []
-    # initialize dictionary to relate constraints index to dof
-    dict_dof = {'Tx': 0, 'Ty': 1, 'Tz': 2, 'Rx': 3, 'Ry': 4, 'Rz': 5, 'Sx': 6, 'Sy': 7, 'Sz': 8}
-    # extract constraints
-    list_constraints = constraints.split('_')
-    # loop across constraints and build initial_parameters
-    for i in range(len(list_constraints)):
-        init_param_optimizer.append(init_param[dict_dof[list_constraints[i]]])
-
-    # launch optimizer
-    # res = minimize(minimize_transform, x0=init_param_optimizer, args=(points_src, points_dest, constraints), method='Nelder-Mead', tol=1e-8, options={'xtol': 1e-8, 'ftol': 1e-8, 'maxiter': 10000, 'maxfev': 10000, 'disp': show})
-    res = minimize(minimize_transform, x0=init_param_optimizer, args=(points_dest, points_src, constraints), method='Powell', tol=1e-8, options={'xtol': 1e-8, 'ftol': 1e-8, 'maxiter': 100000, 'maxfev': 100000, 'disp': verbose})
-    # res = minimize(minAffineTransform, x0=initial_parameters, args=points, method='COBYLA', tol=1e-8, options={'tol': 1e-8, 'rhobeg': 0.1, 'maxiter': 100000, 'catol': 0, 'disp': show})
-    # loop across constraints and update dof
-    dof = init_param
-    for i in range(len(list_constraints)):
-        dof[dict_dof[list_constraints[i]]] = res.x[i]
-    # convert dof to more intuitive variables
-    tx, ty, tz, alpha, beta, gamma, scx, scy, scz = dof[0], dof[1], dof[2], dof[3], dof[4], dof[5], dof[6], dof[7], dof[8]
-    # convert results to intuitive variables
-    # tx, ty, tz, alpha, beta, gamma, scx, scy, scz = res.x[0], res.x[1], res.x[2], res.x[3], res.x[4], res.x[5], res.x[6], res.x[7], res.x[8]
-    # build translation matrix
-    translation_array = np.matrix([tx, ty, tz])
-    # build rotation matrix
-    rotation_matrix = np.matrix([[np.cos(alpha) * np.cos(beta), np.cos(alpha) * np.sin(beta) * np.sin(gamma) - np.sin(alpha) * np.cos(gamma), np.cos(alpha) * np.sin(beta) * np.cos(gamma) + np.sin(alpha) * np.sin(gamma)],
-                              [np.sin(alpha) * np.cos(beta), np.sin(alpha) * np.sin(beta) * np.sin(gamma) + np.cos(alpha) * np.cos(gamma), np.sin(alpha) * np.sin(beta) * np.cos(gamma) - np.cos(alpha) * np.sin(gamma)],
-                              [-np.sin(beta), np.cos(beta) * np.sin(gamma), np.cos(beta) * np.cos(gamma)]])
-    # build scaling matrix
-    scaling_matrix = np.matrix([[scx, 0.0, 0.0], [0.0, scy, 0.0], [0.0, 0.0, scz]])
-    # compute rotation+scaling matrix
-    rotsc_matrix = scaling_matrix * rotation_matrix
-    # compute center of mass from moving points (src)
-    points_src_barycenter = np.mean(points_src, axis=0)
-    # apply transformation to moving points (src)
-    points_src_reg = ((rotsc_matrix * (np.matrix(points_src) - points_src_barycenter).T).T + points_src_barycenter) + translation_array
+    matrix, translation, points_src_barycenter = estimate_transform(points_dest, points_src, constraints)
+    rotsc_matrix = np.matrix(matrix)
+    translation_array = np.matrix(translation)
+    points_src_reg = np.matrix(apply_transform(points_src, matrix, translation, points_src_barycenter))
     # display results
-    sct.printv('Matrix:\n' + str(rotation_matrix))
-    sct.printv('Center:\n' + str(points_src_barycenter))
-    sct.printv('Translation:\n' + str(translation_array))
+    sct.printv('Matrix:\n' + str(rotsc_matrix), verbose)
+    sct.printv('Center:\n' + str(points_src_barycenter), verbose)
+    sct.printv('Translation:\n' + str(translation_array), verbose)
+    sct.printv('SSE: ' + str(SSE(np.matrix(points_dest), points_src_reg)), verbose)
 
     if path_qc is not None:
         sct.create_folder(path_qc)
@@ -290,11 +348,13 @@ def getRigidTransformFromLandmarks(points_dest, points_src, constraints='Tx_Ty_T
         plt.savefig(os.path.join(path_qc, 'getRigidTransformFromLandmarks_plot.png'))
 
         fig2 = plt.figure()
-        plt.plot(sse_results)
+        error = np.sqrt(np.sum(np.square(np.array(points_dest) - np.array(points_src_reg)), axis=1))
+        plt.bar(range(number_points), error)
         plt.grid()
-        plt.title('#Iterations: ' + str(res.nit) + ', #FuncEval: ' + str(res.nfev) + ', Error: ' + str(res.fun))
-        plt.show()
-        plt.savefig(os.path.join(path_qc, 'getRigidTransformFromLandmarks_iterations.png'))
+        plt.xlabel('Landmark')
+        plt.ylabel('Distance after registration')
+        plt.title('Error: ' + str(SSE(np.matrix(points_dest), points_src_reg)))
+        plt.savefig(os.path.join(path_qc, 'getRigidTransformFromLandmarks_error.png'))
 
     # transform numpy matrix to list structure because it is easier to handle
     points_src_reg = points_src_reg.tolist()
@@ -24,16 +24,19 @@ from itertools import compress
 import numpy as np
 
 import tqdm
-from skimage import measure, filters
-import matplotlib.pyplot as plt
 
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.utils import lazy_import
 from msct_types import Centerline
 from sct_straighten_spinalcord import smooth_centerline
 
 import sct_utils as sct
 
+measure = lazy_import('skimage.measure')
+filters = lazy_import('skimage.filters')
+plt = lazy_import('matplotlib.pyplot')
+
 
 def find_contours(image, threshold=0.5, smooth_sigma=0.0, verbose=1):
     image_input = image
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Incremental testing for sct_testing
+# The testing data and the code are fingerprinted once per run from file sizes and modification times (fast tree
+# hash). Each test gets a signature combining the code fingerprint and the fingerprint of the input files referenced
+# by its arguments. TestDatabase records, for each test, its signature, the status of each set of arguments and its
+# duration, so that tests that passed with the same signature can be skipped and the longest tests started first.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import io, os, time, json, hashlib, shlex, uuid
+
+
+# extensions of the files that are part of the code fingerprint
+CODE_EXTENSIONS = ('.py', '.json', '.txt')
+
+
+def tree_signature(root, exclude=(), extensions=None):
+    """
+    Signature of all files under a folder, from a single walk of the folder.
+    :param root: folder
+    :param exclude: relative paths of sub-folders to skip
+    :param extensions: if set, only files with these extensions are considered
+    :return: dict: relative path -> (size, modification time)
+    """
+    signature = dict()
+    root = os.path.abspath(root)
+    for cwd, dirs, files in os.walk(root):
+        path_cwd = os.path.relpath(cwd, root)
+        dirs[:] = sorted([d for d in dirs if os.path.normpath(os.path.join(path_cwd, d)) not in exclude])
+        for file in files:
+            if extensions is not None and not file.endswith(extensions):
+                continue
+            path = os.path.normpath(os.path.join(path_cwd, file))
+            try:
+                data = os.stat(os.path.join(cwd, file))
+            except OSError:
+                # broken link or file removed during the walk
+                continue
+            signature[path] = (data.st_size, data.st_mtime)
+    return signature
+
+
+def tree_hash(signature, paths=None):
+    """
+    Hash of a tree signature (or of a subset of its files)
+    :param signature: output of tree_signature()
+    :param paths: if set, only these relative paths are hashed
+    :return: str
+    """
+    if paths is None:
+        paths = signature.keys()
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(json.dumps([path, signature.get(path)]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_input_files(list_args, data_signature):
+    """
+    Files of the testing data used by a test: files referenced in the arguments, and all the files of the data folders
+    containing them (where ground truth and auxiliary inputs are stored).
+    :param list_args: list of argument strings of the test
+    :param data_signature: tree_signature() of the testing data
+    :return: set of relative paths
+    """
+    list_folders = set()
+    for args in list_args:
+        for token in shlex.split(args):
+            for path in token.split(','):
+                path = os.path.normpath(path)
+                if path in data_signature or any(p.startswith(path + os.sep) for p in data_signature):
+                    list_folders.add(path.split(os.sep)[0])
+    return set([p for p in data_signature if p.split(os.sep)[0] in list_folders])
+
+
+def get_test_signature(function, list_args, data_signature, code_hash):
+    """
+    Signature of a test: changes when the code, the arguments or the input files of the test change.
+    :param function: tested function, e.g. 'sct_propseg'
+    :param list_args: list of argument strings of the test
+    :param data_signature: tree_signature() of the testing data
+    :param code_hash: tree_hash() of the code
+    :return: str
+    """
+    input_hash = tree_hash(data_signature, get_input_files(list_args, data_signature))
+    return hashlib.sha1(json.dumps([function, list(list_args), input_hash, code_hash]).encode('utf-8')).hexdigest()
+
+
+class TestDatabase(object):
+    """
+    Local database (json file) of the results of the tests, indexed by tested function.
+    Each entry holds: signature, status (global status of the function: 0 ok, 1 failure, 99 warning), list of statuses
+    (one per set of arguments), duration (s) and time of the run.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tests = dict()
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.tests = json.load(f).get('tests', dict())
+            except ValueError:
+                # corrupted database: start from scratch
+                self.tests = dict()
+
+    def is_up_to_date(self, function, signature):
+        """
+        True if the test passed the last time it ran with this signature.
+        """
+        entry = self.tests.get(function)
+        return entry is not None and entry['signature'] == signature and entry['status'] == 0
+
+    def duration(self, function):
+        """
+        Duration of the last run of a test, None if unknown
+        """
+        entry = self.tests.get(function)
+        return entry['duration'] if entry else None
+
+    def record(self, function, signature, status, list_status, duration):
+        self.tests[function] = {
+         'signature': signature,
+         'status': status,
+         'list_status': list(list_status),
+         'duration': duration,
+         'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def sort_longest_first(self, functions):
+        """
+        Sort functions by decreasing duration of their last run. Functions never run come first, since their duration
+        is unknown.
+        """
+        def key(function):
+            duration = self.duration(function)
+            return (duration is not None, -(duration or 0))
+        return sorted(functions, key=key)
+
+    def save(self):
+        """
+        Write the database through a temporary file and a rename, so that an interrupted run does not corrupt it
+        """
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_path = '{}.{}.tmp'.format(self.path, uuid.uuid4().hex)
+        with io.open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'tests': self.tests}, indent=1, sort_keys=True).encode('utf-8'))
+        os.rename(tmp_path, self.path)
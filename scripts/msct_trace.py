@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Tracing of SCT commands
+# When the environment variable SCT_TRACE is set to a file name, each SCT script (from sct.init_sct() to its exit) and
+# each command launched by sct.run() is recorded as a span: name, wall time, CPU time, peak memory (RSS), exit code and
+# id of the parent span. Spans are appended to the trace file as json lines. The id of the current span is passed to
+# child processes through the environment (SCT_TRACE_PARENT), so that nested commands, e.g.
+# sct_register_to_template -> sct_apply_transfo -> isct_antsApplyTransforms, form a single tree.
+# SCT_TRACE_SUBJECT can be set to tag the spans of a subject, to summarize a pipeline per subject.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import io, os, sys, time, json, errno, uuid, threading
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+ENV_TRACE = 'SCT_TRACE'  # trace file. Tracing is disabled if not set.
+ENV_PARENT = 'SCT_TRACE_PARENT'  # id of the span of the parent process
+ENV_SUBJECT = 'SCT_TRACE_SUBJECT'  # subject tag of the spans
+
+# unit of ru_maxrss: kilobytes on linux, bytes on macOS
+RU_MAXRSS_UNIT = 1024 ** 2 if sys.platform == 'darwin' else 1024
+
+_local = threading.local()
+
+
+def get_trace_file():
+    """
+    :return: trace file name, None if tracing is disabled
+    """
+    return os.getenv(ENV_TRACE) or None
+
+
+def current_span_id():
+    """
+    Id of the innermost open span of this thread, or of the parent process
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1].id
+    return os.getenv(ENV_PARENT) or None
+
+
+def _cpu_time(rusage):
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def _peak_rss(rusage):
+    return rusage.ru_maxrss / RU_MAXRSS_UNIT
+
+
+class Span(object):
+    """
+    A timed operation. Create with start_span(), close with finish().
+    """
+    def __init__(self, name, kind, fname_trace, parent=None, attributes=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.kind = kind
+        self.fname_trace = fname_trace
+        self.parent = parent
+        self.attributes = attributes or dict()
+        self.start = time.time()
+        self.finished = False
+
+    def finish(self, exit_code=None, cpu_time=None, peak_rss=None):
+        """
+        Close the span and append it to the trace file
+        :param exit_code: exit code of the command (None if unknown)
+        :param cpu_time: user + system CPU time (s)
+        :param peak_rss: peak memory (MB)
+        """
+        if self.finished:
+            return
+        self.finished = True
+        stack = getattr(_local, 'stack', [])
+        if self in stack:
+            stack.remove(self)
+        record = OrderedDict([
+         ('id', self.id),
+         ('parent', self.parent),
+         ('name', self.name),
+         ('kind', self.kind),
+         ('subject', os.getenv(ENV_SUBJECT)),
+         ('start', self.start),
+         ('wall', time.time() - self.start),
+         ('cpu', cpu_time),
+         ('peak_rss_mb', peak_rss),
+         ('exit_code', exit_code),
+         ('pid', os.getpid()),
+        ])
+        record.update(self.attributes)
+        write_record(self.fname_trace, record)
+
+
+def start_span(name, kind, attributes=None):
+    """
+    Open a span, child of the current span.
+    :param name: name of the operation (script or program name)
+    :param kind: 'main' (SCT script) or 'run' (command launched by sct.run)
+    :param attributes: dict of additional fields of the record
+    :return: Span, or None if tracing is disabled
+    """
+    fname_trace = get_trace_file()
+    if fname_trace is None:
+        return None
+    span = Span(name, kind, fname_trace, parent=current_span_id(), attributes=attributes)
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(span)
+    return span
+
+
+def write_record(fname_trace, record):
+    """
+    Append a record to the trace file. Each record is written with a single write on a file opened in append mode, so
+    that records of concurrent processes are not interleaved.
+    """
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    try:
+        fd = os.open(fname_trace, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        # tracing must never make a command fail
+        pass
+
+
+def child_env(span, env=None):
+    """
+    Environment of a child process, with the span as parent of the spans of the child. The tracing variables are
+    passed even if the caller gives its own environment.
+    """
+    env = dict(os.environ if env is None else env)
+    for name in (ENV_TRACE, ENV_SUBJECT):
+        if name in os.environ:
+            env.setdefault(name, os.environ[name])
+    if span is not None:
+        env[ENV_PARENT] = span.id
+    return env
+
+
+def wait_process(process):
+    """
+    Wait for a subprocess.Popen, and get its resource usage from wait4() where available.
+    On linux, the peak RSS of a child includes the memory inherited at fork, so it is an upper bound for short
+    commands launched from a large process.
+    :return: exit code, CPU time (s) or None, peak RSS (MB) or None
+    """
+    if getattr(process, 'pid', None) is None or not hasattr(os, 'wait4'):
+        # not a subprocess (e.g. msct_command_server.ServerProcess), or wait4 not available
+        return process.wait(), getattr(process, 'cpu_time', None), getattr(process, 'peak_rss', None)
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # already reaped
+                return process.wait(), None, None
+            raise
+    if os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    process.returncode = exit_code
+    return exit_code, _cpu_time(rusage), _peak_rss(rusage)
+
+
+_main_span = {}
+
+
+def start_main_span(argv=None):
+    """
+    Open the span of the current SCT script. It is closed at exit, with the CPU time and peak memory of the process.
+    Called by sct.init_sct().
+    """
+    import atexit
+    if _main_span or get_trace_file() is None:
+        return
+    if argv is None:
+        argv = sys.argv
+    span = start_span(os.path.splitext(os.path.basename(argv[0]))[0], 'main',
+                      attributes={'args': list(argv[1:]), 'cwd': os.getcwd()})
+    _main_span['span'] = span
+
+    excepthook = sys.excepthook
+
+    def trace_excepthook(exctype, value, traceback):
+        _main_span['exit_code'] = 1
+        excepthook(exctype, value, traceback)
+
+    sys.excepthook = trace_excepthook
+    atexit.register(finish_main_span)
+
+
+def finish_main_span(exit_code=None):
+    """
+    Close the span of the current script. Unless given, the exit code is only known when the script failed with an
+    exception; it is otherwise recorded by the sct.run() span of the parent process.
+    """
+    span = _main_span.get('span')
+    if span is None:
+        return
+    cpu_time = peak_rss = None
+    if resource is not None:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time, peak_rss = _cpu_time(rusage), _peak_rss(rusage)
+    if exit_code is None:
+        exit_code = _main_span.get('exit_code')
+    span.finish(exit_code=exit_code, cpu_time=cpu_time, peak_rss=peak_rss)
+
+
+# ======================================================================================================================
+# Summary
+# ======================================================================================================================
+def read_trace(fname_trace):
+    """
+    :return: list of span records
+    """
+    records = []
+    with io.open(fname_trace, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # line truncated by a killed process
+                continue
+    return records
+
+
+class Node(object):
+    """
+    Spans with the same name under the same parent node, merged (flame graph style)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.peak_rss = 0.
+        self.failures = 0
+        self.children = OrderedDict()
+
+    def add(self, record):
+        self.calls += 1
+        self.wall += record['wall']
+        self.cpu += record.get('cpu') or 0.
+        self.peak_rss = max(self.peak_rss, record.get('peak_rss_mb') or 0.)
+        if record.get('exit_code'):
+            self.failures += 1
+
+    @property
+    def self_time(self):
+        """
+        Wall time not spent in child spans
+        """
+        return max(0., self.wall - sum([c.wall for c in self.children.values()]))
+
+
+def build_tree(records):
+    """
+    Merge spans into a tree per subject.
+    :return: OrderedDict: subject -> root Node. Spans whose parent is not in the trace are children of the root.
+    """
+    by_id = dict([(r['id'], r) for r in records])
+    children = dict()
+    for r in sorted(records, key=lambda r: r['start']):
+        parent = r['parent'] if r['parent'] in by_id else None
+        children.setdefault(parent, []).append(r)
+
+    def add_children(node, parent_id):
+        for r in children.get(parent_id, []):
+            child = node.children.setdefault(r['name'], Node(r['name']))
+            child.add(r)
+            add_children(child, r['id'])
+
+    trees = OrderedDict()
+    for r in children.get(None, []):
+        subject = r.get('subject') or ''
+        root = trees.setdefault(subject, Node(subject))
+        child = root.children.setdefault(r['name'], Node(r['name']))
+        child.add(r)
+        add_children(child, r['id'])
+    for root in trees.values():
+        root.wall = sum([c.wall for c in root.children.values()])
+        root.cpu = sum([c.cpu for c in root.children.values()])
+        root.peak_rss = max([c.peak_rss for c in root.children.values()] or [0.])
+    return trees
+
+
+def format_tree(root, min_percent=1., max_depth=None):
+    """
+    Flame style breakdown of a tree: one line per node, indented by depth, with its share of the total time.
+    Nodes below min_percent of the total time are not displayed.
+    :return: list of lines
+    """
+    lines = ["{:>10} {:>6} {:>10} {:>10} {:>9} {:>6}  {}".format(
+     "wall(s)", "%", "self(s)", "cpu(s)", "RSS(MB)", "calls", "command")]
+    total = root.wall or 1.
+
+    def add_lines(node, depth):
+        for child in sorted(node.children.values(), key=lambda c: -c.wall):
+            percent = 100. * child.wall / total
+            if percent < min_percent:
+                continue
+            name = child.name + (" ({} failed)".format(child.failures) if child.failures else "")
+            lines.append("{:>10.2f} {:>6.1f} {:>10.2f} {:>10.2f} {:>9.0f} {:>6d}  {}{}".format(
+             child.wall, percent, child.self_time, child.cpu, child.peak_rss, child.calls, "  " * depth, name))
+            if max_depth is None or depth + 1 < max_depth:
+                add_lines(child, depth + 1)
+    add_lines(root, 0)
+    return lines
+
+
+def summarize(fname_trace, subject=None, min_percent=1., max_depth=None):
+    """
+    Text summary of a trace file, per subject
+    :return: str
+    """
+    trees = build_tree(read_trace(fname_trace))
+    lines = []
+    for name, root in trees.items():
+        if subject is not None and name != subject:
+            continue
+        lines.append("Subject: {} (total: {:.2f}s)".format(name or "-", root.wall))
+        lines += format_tree(root, min_percent=min_percent, max_depth=max_depth)
+        lines.append("")
+    return "\n".join(lines)
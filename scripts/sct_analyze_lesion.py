@@ -16,8 +16,6 @@ import shutil
 import sys
 
 import numpy as np
-import pandas as pd
-from skimage.measure import label
 
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
@@ -26,6 +24,10 @@ from msct_types import Centerline
 from sct_straighten_spinalcord import smooth_centerline
 import sct_utils as sct
 from sct_utils import extract_fname, printv, tmp_create
+from spinalcordtoolbox.utils import lazy_import
+
+pd = lazy_import('pandas')
+measure = lazy_import('skimage.measure')
 
 
 def get_parser():
@@ -440,7 +442,7 @@ class AnalyzeLeion:
         printv('\nLabel connected regions of the masked image...', self.verbose, 'normal')
         im = Image(self.fname_mask)
         im_2save = im.copy()
-        im_2save.data = label(im.data, connectivity=2)
+        im_2save.data = measure.label(im.data, connectivity=2)
         im_2save.save(self.fname_label)
 
         self.measure_pd['label'] = [l for l in np.unique(im_2save.data) if l]
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Performance benchmarks of the Spinal Cord Toolbox, with regression tracking.
+#
+# Run benchmarks (on synthetic data, offline) and save results:
+#   sct_benchmark run -o benchmark.json
+# Compare against a baseline (exit code 1 if a scenario regressed):
+#   sct_benchmark compare baseline.json benchmark.json
+#
+# Scenarios are defined in msct_benchmark.py.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+
+from __future__ import print_function, absolute_import
+
+import sys
+
+import sct_utils as sct
+import msct_benchmark
+
+
+# PARSER
+# ==========================================================================================
+def get_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+     description="Performance benchmarks of the Spinal Cord Toolbox: time and peak memory of the main processing steps, on synthetic data. Results are saved as json and can be compared against a baseline to detect regressions.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_run = subparsers.add_parser("run",
+     help="Run benchmarks",
+    )
+    parser_run.add_argument("--function", "-f",
+     help="Run these scenarios only. Available: {}".format(", ".join(msct_benchmark.SCENARIOS)),
+     nargs="+",
+     choices=list(msct_benchmark.SCENARIOS),
+     metavar="SCENARIO",
+    )
+    parser_run.add_argument("--output", "-o",
+     help="Output json file (default: benchmark.json)",
+     default="benchmark.json",
+    )
+    parser_run.add_argument("--repeat", "-n",
+     help="Number of timed runs of each scenario (default: defined per scenario)",
+     type=int,
+    )
+    parser_run.add_argument("--baseline", "-b",
+     help="Compare results against this baseline json file",
+    )
+    parser_run.add_argument("--verbose", "-v",
+     choices=("0", "1"),
+     default="1",
+    )
+
+    parser_compare = subparsers.add_parser("compare",
+     help="Compare results against a baseline",
+    )
+    parser_compare.add_argument("baseline",
+     help="Baseline json file",
+    )
+    parser_compare.add_argument("results",
+     help="json file to compare to the baseline",
+    )
+
+    for p in (parser_run, parser_compare):
+        p.add_argument("--threshold-time",
+         help="Relative increase of time above which a scenario is a regression (default: {})".format(msct_benchmark.THRESHOLD_TIME),
+         type=float,
+         default=msct_benchmark.THRESHOLD_TIME,
+        )
+        p.add_argument("--threshold-memory",
+         help="Relative increase of peak memory above which a scenario is a regression (default: {})".format(msct_benchmark.THRESHOLD_MEMORY),
+         type=float,
+         default=msct_benchmark.THRESHOLD_MEMORY,
+        )
+
+    return parser
+
+
+def print_comparison(comparison):
+    """
+    Print a comparison table
+    :return: number of regressions
+    """
+    print("{:<24} {:<12} {:>12} {:>12} {:>8}".format("scenario", "metric", "baseline", "value", "ratio"))
+    nb_regressions = 0
+    for c in comparison:
+        line = "{name:<24} {metric:<12} {baseline:>12.3f} {value:>12.3f} {ratio:>8.2f}".format(**c)
+        if c['regression']:
+            nb_regressions += 1
+            sct.printv(line + "  REGRESSION", 1, 'warning')
+        else:
+            print(line)
+    return nb_regressions
+
+
+# Main
+# ==========================================================================================
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    arguments = get_parser().parse_args(args)
+
+    if arguments.command == "run":
+        results = msct_benchmark.run_benchmarks(arguments.function, repeat=arguments.repeat,
+                                                verbose=int(arguments.verbose))
+        msct_benchmark.save_results(results, arguments.output)
+        sct.printv("Results saved in " + arguments.output, int(arguments.verbose))
+        if arguments.baseline is None:
+            return 0
+        results_baseline = msct_benchmark.load_results(arguments.baseline)
+    elif arguments.command == "compare":
+        results = msct_benchmark.load_results(arguments.results)
+        results_baseline = msct_benchmark.load_results(arguments.baseline)
+    else:
+        get_parser().print_help()
+        return 2
+
+    comparison = msct_benchmark.compare(results, results_baseline, threshold_time=arguments.threshold_time,
+                                        threshold_memory=arguments.threshold_memory)
+    nb_regressions = print_comparison(comparison)
+    if nb_regressions:
+        sct.printv("{} regression(s) against {}".format(nb_regressions, arguments.baseline), 1, 'warning')
+        return 1
+    return 0
+
+
+# START PROGRAM
+# ==========================================================================================
+if __name__ == "__main__":
+    sct.init_sct()
+    res = main()
+    raise SystemExit(res)
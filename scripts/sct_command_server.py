@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Start, stop or query the SCT command server.
+#
+# While the server is running, SCT scripts launched by other SCT scripts (through sct.run) run in processes forked from
+# the server, which has numpy, scipy, nibabel and the SCT modules already imported, instead of new python interpreters.
+# This saves the startup time of each script in pipelines such as sct_register_to_template.
+#
+#   sct_command_server start -b   # start in the background
+#   sct_command_server status
+#   sct_command_server stop
+#
+# The server is per user. It stops after one hour without request. Restart it after updating SCT, since it keeps the
+# modules that were imported when it started.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+
+from __future__ import print_function, absolute_import
+
+import sys, os, time
+
+import sct_utils as sct
+import msct_command_server
+
+
+# PARSER
+# ==========================================================================================
+def get_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+     description="SCT command server: keeps SCT modules imported to run the SCT scripts launched by other SCT scripts without starting a new python interpreter. Set {}=0 to disable its use.".format(msct_command_server.ENV_SERVER),
+    )
+    parser.add_argument("command",
+     choices=("start", "stop", "status"),
+    )
+    parser.add_argument("--background", "-b",
+     help="Start the server in the background.",
+     action="store_true",
+    )
+    parser.add_argument("--socket", "-s",
+     help="Socket of the server (default: {}, or the environment variable {})".format(msct_command_server.get_socket_path(), msct_command_server.ENV_SOCKET),
+     default=msct_command_server.get_socket_path(),
+    )
+    parser.add_argument("--idle-timeout",
+     help="Stop the server after this time without request, in seconds. 0: never (default: {})".format(msct_command_server.IDLE_TIMEOUT),
+     type=int,
+     default=msct_command_server.IDLE_TIMEOUT,
+    )
+    parser.add_argument("--log",
+     help="Log file of the server started in the background (default: server.log next to the socket)",
+    )
+    return parser
+
+
+def daemonize(fname_log):
+    """
+    Detach the current process from the terminal (double fork), with its output going to fname_log
+    :return: True in the daemon, False in the calling process
+    """
+    if os.fork() != 0:
+        return False
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    fd_null = os.open(os.devnull, os.O_RDONLY)
+    fd_log = os.open(fname_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    os.dup2(fd_null, 0)
+    os.dup2(fd_log, 1)
+    os.dup2(fd_log, 2)
+    return True
+
+
+# Main
+# ==========================================================================================
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    arguments = get_parser().parse_args(args)
+    path_socket = arguments.socket
+
+    if arguments.command == "status":
+        response = msct_command_server.request({'command': 'ping'}, path_socket)
+        if response is None:
+            print("Server not running ({})".format(path_socket))
+            return 1
+        print("Server running on {} (pid {}, up {:.0f}s, {} commands run)".format(
+         path_socket, response['pid'], response['uptime'], response['requests']))
+        return 0
+
+    if arguments.command == "stop":
+        response = msct_command_server.request({'command': 'stop'}, path_socket)
+        if response is None:
+            print("Server not running ({})".format(path_socket))
+            return 1
+        print("Server stopped (pid {})".format(response['pid']))
+        return 0
+
+    # start
+    if msct_command_server.request({'command': 'ping'}, path_socket) is not None:
+        print("Server already running ({})".format(path_socket))
+        return 1
+    server = msct_command_server.CommandServer(path_socket, idle_timeout=arguments.idle_timeout)
+    if arguments.background:
+        folder = os.path.dirname(path_socket)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, 0o700)
+        fname_log = arguments.log or os.path.join(folder, 'server.log')
+        if not daemonize(fname_log):
+            # wait until the server accepts connections
+            for i in range(300):
+                if msct_command_server.request({'command': 'ping'}, path_socket) is not None:
+                    print("Server started on {} (log: {})".format(path_socket, fname_log))
+                    return 0
+                time.sleep(0.1)
+            print("Server did not start, see {}".format(fname_log))
+            return 1
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.serve_forever()
+    return 0
+
+
+# START PROGRAM
+# ==========================================================================================
+if __name__ == "__main__":
+    sct.start_stream_logger()
+    res = main()
+    raise SystemExit(res)
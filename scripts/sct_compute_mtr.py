@@ -16,6 +16,8 @@ from __future__ import absolute_import, division
 import sys
 import os
 
+import numpy as np
+
 import sct_utils as sct
 from msct_parser import Parser
 
@@ -35,8 +37,6 @@ class Param:
 # main
 #=======================================================================================================================
 def main(args=None):
-    import numpy as np
-    import spinalcordtoolbox.image as msct_image
 
     # Initialization
     fname_mt0 = ''
@@ -66,31 +66,13 @@ def main(args=None):
     # create temporary folder
     path_tmp = sct.tmp_create()
 
-    # Copying input data to tmp folder and convert to nii
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    from sct_convert import convert
-    convert(fname_mt0, os.path.join(path_tmp, "mt0.nii"), dtype=np.float32)
-    convert(fname_mt1, os.path.join(path_tmp, "mt1.nii"), dtype=np.float32)
-
-    # go to tmp folder
-    curdir = os.getcwd()
-    os.chdir(path_tmp)
-
-    # compute MTR
+    # compute MTR by slabs of slices, in float32
     sct.printv('\nCompute MTR...', verbose)
-    nii_mt1 = msct_image.Image('mt1.nii')
-    data_mt1 = nii_mt1.data
-    data_mt0 = msct_image.Image('mt0.nii').data
-    data_mtr = 100 * (data_mt0 - data_mt1) / data_mt0
-    # save MTR file
-    nii_mtr = nii_mt1
-    nii_mtr.data = data_mtr
-    nii_mtr.save("mtr.nii")
+    from spinalcordtoolbox import voxelwise
+    voxelwise.compute_maps([fname_mt1, fname_mt0], [os.path.join(path_tmp, "mtr.nii")], mtr_kernel,
+                           path_tmp=path_tmp, verbose=verbose)
     # sct.run(fsloutput+'fslmaths -dt double mt0.nii -sub mt1.nii -mul 100 -div mt0.nii -thr 0 -uthr 100 mtr.nii', verbose)
 
-    # come back
-    os.chdir(curdir)
-
     # Generate output files
     sct.printv('\nGenerate output files...', verbose)
     sct.generate_output_file(os.path.join(path_tmp, "mtr.nii"), os.path.join(path_out, file_out + ext_out))
@@ -103,6 +85,19 @@ def main(args=None):
     sct.display_viewer_syntax([fname_mt0, fname_mt1, file_out])
 
 
+def mtr_kernel(data_mt1, data_mt0):
+    """
+    Compute MTR = 100 * (MT0 - MT1) / MT0 on a slab, in place.
+    :param data_mt1: float32 array, overwritten with the MTR
+    :param data_mt0: float32 array
+    :return: tuple with the float32 MTR array
+    """
+    np.subtract(data_mt0, data_mt1, out=data_mt1)
+    data_mt1 *= 100
+    data_mt1 /= data_mt0
+    return data_mt1,
+
+
 # ==========================================================================================
 def get_parser():
     # Initialize the parser
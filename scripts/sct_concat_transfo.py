@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 #########################################################################################
 #
-# Concatenate transformations. This function is a wrapper for isct_ComposeMultiTransform
+# Concatenate transformations. Displacement fields and ITK affine transformations are composed in-process
+# (see spinalcordtoolbox.warp), other transformations with isct_ComposeMultiTransform.
 #
 # ---------------------------------------------------------------------------------------
 # Copyright (c) 2014 Polytechnique Montreal <www.neuro.polymtl.ca>
@@ -20,6 +21,7 @@ import sys, io, os, getopt, functools
 import sct_utils as sct
 from msct_parser import Parser
 from spinalcordtoolbox.image import Image
+import spinalcordtoolbox.warp
 
 # DEFAULT PARAMETERS
 
@@ -62,6 +64,7 @@ def main():
 
     # Parse list of warping fields
     sct.printv('\nParse list of transformations...', verbose)
+    fname_transfo_list = list(fname_warp_list)
     use_inverse = []
     fname_warp_list_invert = []
     for i in range(len(fname_warp_list)):
@@ -96,6 +99,15 @@ def main():
 
     # Concatenate warping fields
     sct.printv('\nConcatenate warping fields...', verbose)
+    if spinalcordtoolbox.warp.can_read_transforms(fname_transfo_list):
+        # transformations are read once and composed in memory, the result is written once
+        field = spinalcordtoolbox.warp.compose(fname_transfo_list, im_dest.data.shape, im_dest.hdr.get_best_affine(),
+                                               ndim=int(dimensionality))
+        fname_out = os.path.join(path_out, file_out + ext_out)
+        field.save(fname_out, header=im_dest.hdr)
+        sct.printv('  File created: ' + fname_out, verbose)
+        return
+
     # N.B. Here we take the inverse of the warp list
     fname_warp_list_invert.reverse()
     fname_warp_list_invert = functools.reduce(lambda x,y: x+y, fname_warp_list_invert)
@@ -116,7 +128,7 @@ def main():
 def get_parser():
     # Initialize the parser
     parser = Parser(__file__)
-    parser.usage.set_description('Concatenate transformations. This function is a wrapper for isct_ComposeMultiTransform (ANTs). N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.')
+    parser.usage.set_description('Concatenate transformations. Warping fields and affine transformations are composed on the grid of the destination image, other transformations are passed to isct_ComposeMultiTransform (ANTs). N.B. Order of input warping fields is important. For example, if you want to concatenate: A->B and B->C to yield A->C, then you have to input warping fields like that: A->B,B->C.')
     parser.add_option(name="-d",
                       type_value="file",
                       description="Destination image.",
@@ -21,13 +21,9 @@ import os
 
 import numpy as np
 
-import nibabel
-from scipy import ndimage
-
 import sct_utils as sct
-import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
-from sct_image import concat_data
+from sct_label_utils import get_labels
 from msct_parser import Parser
 
 
@@ -99,151 +95,92 @@ def create_mask(param):
     if param.fname_out == '':
         param.fname_out = os.path.abspath(param.file_prefix + file_data + ext_data)
 
-    path_tmp = sct.tmp_create(basename="create_mask", verbose=param.verbose)
-
+    im_data = Image(param.fname_data)
     sct.printv('\nOrientation:', param.verbose)
-    orientation_input = Image(param.fname_data).orientation
+    orientation_input = im_data.orientation
     sct.printv('  ' + orientation_input, param.verbose)
 
-    # copy input data to tmp folder and re-orient to RPI
-    Image(param.fname_data).change_orientation("RPI").save(os.path.join(path_tmp, "data_RPI.nii"))
-    if method_type == 'centerline':
-        Image(method_val).change_orientation("RPI").save(os.path.join(path_tmp, "centerline_RPI.nii"))
-    if method_type == 'point':
-        Image(method_val).change_orientation("RPI").save(os.path.join(path_tmp, "point_RPI.nii"))
-
-    # go to tmp folder
-    curdir = os.getcwd()
-    os.chdir(path_tmp)
-
-    # Get dimensions of data
-    im_data = Image('data_RPI.nii')
-    nx, ny, nz, nt, px, py, pz, pt = im_data.dim
     sct.printv('\nDimensions:', param.verbose)
     sct.printv(im_data.dim, param.verbose)
     # in case user input 4d data
-    if nt != 1:
+    if im_data.dim[3] != 1:
         sct.printv('WARNING in ' + os.path.basename(__file__) + ': Input image is 4d but output mask will be 3D from first time slice.', param.verbose, 'warning')
-        # extract first volume to have 3d reference
-        nii = msct_image.empty_like(Image('data_RPI.nii'))
-        data3d = nii.data[:, :, :, 0]
-        nii.data = data3d
-        nii.save('data_RPI.nii')
+
+    # empty 3d mask in RPI orientation
+    hdr = im_data.hdr.copy()
+    shape = im_data.data.shape[:3] if im_data.data.ndim > 3 else im_data.data.shape
+    hdr.set_data_shape(shape)
+    im_mask = Image(np.zeros(shape, dtype=np.uint8), hdr=hdr).change_orientation("RPI")
+    if im_mask.data.ndim == 2:
+        im_mask.data = im_mask.data[:, :, np.newaxis]
+    nz = im_mask.data.shape[2]
 
     if method_type == 'coord':
         # parse to get coordinate
         coord = [x for x in map(int, method_val.split('x'))]
 
     if method_type == 'point':
-        # get file name
         # extract coordinate of point
         sct.printv('\nExtract coordinate of point...', param.verbose)
-        # TODO: change this way to remove dependence to sct.run. ProcessLabels.display_voxel returns list of coordinates
-        status, output = sct.run(['sct_label_utils', '-i', 'point_RPI.nii', '-display'], verbose=param.verbose)
-        # parse to get coordinate
-        # TODO fixup... this is quite magic
-        coord = output[output.find('Position=') + 10:-17].split(',')
+        labels = get_labels(Image(method_val).change_orientation("RPI"))
+        if not len(labels):
+            sct.printv('ERROR: ' + method_val + ' does not contain any point.', 1, 'error')
+        coord = labels[0, :2]
 
     if method_type == 'center':
         # set coordinate at center of FOV
-        coord = np.round(float(nx) / 2), np.round(float(ny) / 2)
+        coord = np.round(float(im_mask.data.shape[0]) / 2), np.round(float(im_mask.data.shape[1]) / 2)
 
     if method_type == 'centerline':
-        # get name of centerline from user argument
-        fname_centerline = 'centerline_RPI.nii'
+        # center of mass of the centerline in each slice
+        centers = get_centers(Image(method_val).change_orientation("RPI").data)
+        if len(centers) != nz:
+            sct.printv('ERROR: ' + method_val + ' does not have the same number of slices as the input image.', 1, 'error')
     else:
-        # generate volume with line along Z at coordinates 'coord'
-        sct.printv('\nCreate line...', param.verbose)
-        fname_centerline = create_line(param, 'data_RPI.nii', coord, nz)
+        # line along Z at coordinates 'coord'
+        centers = np.tile([int(coord[0]), int(coord[1])], (nz, 1)).astype(np.float64)
 
     # create mask
     sct.printv('\nCreate mask...', param.verbose)
-    centerline = nibabel.load(fname_centerline)  # open centerline
-    hdr = centerline.get_header()  # get header
-    hdr.set_data_dtype('uint8')  # set imagetype to uint8
-    spacing = hdr.structarr['pixdim']
-    data_centerline = centerline.get_data()  # get centerline
-    # if data is 2D, reshape with empty third dimension
-    if len(data_centerline.shape) == 2:
-        data_centerline_shape = list(data_centerline.shape)
-        data_centerline_shape.append(1)
-        data_centerline = data_centerline.reshape(data_centerline_shape)
-    z_centerline_not_null = [iz for iz in range(0, nz, 1) if data_centerline[:, :, iz].any()]
-    # get center of mass of the centerline
-    cx = [0] * nz
-    cy = [0] * nz
-    for iz in range(0, nz, 1):
-        if iz in z_centerline_not_null:
-            cx[iz], cy[iz] = ndimage.measurements.center_of_mass(np.array(data_centerline[:, :, iz]))
-    # create 2d masks
-    file_mask = 'data_mask'
-    for iz in range(nz):
-        if iz not in z_centerline_not_null:
-            # write an empty nifty volume
-            img = nibabel.Nifti1Image(data_centerline[:, :, iz], None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-        else:
-            center = np.array([cx[iz], cy[iz]])
-            mask2d = create_mask2d(param, center, param.shape, param.size, im_data=im_data)
-            # Write NIFTI volumes
-            img = nibabel.Nifti1Image(mask2d, None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-
-    fname_list = [file_mask + str(iz) + '.nii' for iz in range(nz)]
-    im_out = concat_data(fname_list, dim=2).save('mask_RPI.nii.gz')
-
-    im_out.change_orientation(orientation_input)
-    im_out.header = Image(param.fname_data).header
-    im_out.save(param.fname_out)
-
-    # come back
-    os.chdir(curdir)
-
-    # Remove temporary files
-    if param.remove_temp_files == 1:
-        sct.printv('\nRemove temporary files...', param.verbose)
-        sct.rmtree(path_tmp)
+    im_mask.data = create_mask3d(param, centers, param.shape, param.size, im_data=im_mask)
+
+    im_mask.change_orientation(orientation_input)
+    im_mask.header = im_data.header
+    im_mask.save(param.fname_out)
 
     sct.display_viewer_syntax([param.fname_data, param.fname_out], colormaps=['gray', 'red'], opacities=['', '0.5'])
 
 
-def create_line(param, fname, coord, nz):
+def get_centers(data_centerline):
     """
-    Create vertical line in 3D volume
-    :param param:
-    :param fname:
-    :param coord:
-    :param nz:
-    :return:
+    Center of mass of each axial slice of a centerline or segmentation, in one pass
+    :param data_centerline: 2D or 3D array, in RPI orientation
+    :return: (nz, 2) array of x, y coordinates, NaN for slices without centerline
     """
-
-    # duplicate volume (assumes input file is nifti)
-    sct.copy(fname, 'line.nii', verbose=param.verbose)
-
-    # set all voxels to zero
-    sct.run(['sct_maths', '-i', 'line.nii', '-mul', '0', '-o', 'line.nii'], param.verbose)
-
-    cmd = ['sct_label_utils', '-i', 'line.nii', '-o', 'line.nii', '-create-add']
-    for iz in range(nz):
-        if iz == nz - 1:
-            cmd += [str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1']
-        else:
-            cmd += [str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1:']
-
-    sct.run(cmd, param.verbose)
-
-    return 'line.nii'
-
-
-def create_mask2d(param, center, shape, size, im_data):
+    if data_centerline.ndim == 2:
+        data_centerline = data_centerline[:, :, np.newaxis]
+    data_centerline = np.asarray(data_centerline, dtype=np.float64)
+    nx, ny, nz = data_centerline.shape[:3]
+    mass = data_centerline.sum(axis=(0, 1))
+    mass_x = np.dot(np.arange(nx), data_centerline.sum(axis=1))
+    mass_y = np.dot(np.arange(ny), data_centerline.sum(axis=0))
+    centers = np.full((nz, 2), np.nan)
+    not_null = data_centerline.any(axis=(0, 1))
+    centers[not_null, 0] = mass_x[not_null] / mass[not_null]
+    centers[not_null, 1] = mass_y[not_null] / mass[not_null]
+    return centers
+
+
+def create_mask3d(param, centers, shape, size, im_data):
     """
-    Create a 2D mask
+    Create a 3D mask, made of a 2D mask around the center of each axial slice. Distances to the centers are computed
+    for all the slices at once, by broadcasting.
     :param param:
-    :param center:
+    :param centers: (nz, 2) array of x, y coordinates of the center of each slice. NaN: empty slice
     :param shape:
     :param size:
-    :param im_data: Image object for input data.
-    :return:
+    :param im_data: Image object for input data, in RPI orientation.
+    :return: (nx, ny, nz) array, uint8 (box, cylinder) or float (gaussian)
     """
     # get dim
     nx, ny, nz, nt, px, py, pz, pt = im_data.dim
@@ -251,13 +188,13 @@ def create_mask2d(param, center, shape, size, im_data):
     offset = param.offset.split(',')
     offset[0] = int(offset[0])
     offset[1] = int(offset[1])
-    # px, py = spacing[0], spacing[1]
 
-    # initialize 2d grid
-    xx, yy = np.mgrid[:nx, :ny]
-    mask2d = np.zeros((nx, ny))
-    xc = center[0]
-    yc = center[1]
+    # grids of the distance to the center of each slice: (nx, 1, nz) and (1, ny, nz)
+    centers = np.asarray(centers, dtype=np.float64)
+    valid = ~np.isnan(centers[:, 0])
+    xc, yc = np.where(valid, centers[:, 0], 0), np.where(valid, centers[:, 1], 0)
+    dx = np.arange(nx)[:, np.newaxis, np.newaxis] + offset[0] - xc
+    dy = np.arange(ny)[np.newaxis, :, np.newaxis] + offset[1] - yc
     if 'mm' in size:
         size = float(size[:-2])
         radius_x = np.ceil((int(np.round(size / px)) - 1) / 2.0)
@@ -267,16 +204,17 @@ def create_mask2d(param, center, shape, size, im_data):
         radius_y = radius_x
 
     if shape == 'box':
-        mask2d = ((abs(xx + offset[0] - xc) <= radius_x) & (abs(yy + offset[1] - yc) <= radius_y)) * 1
+        mask = (abs(dx) <= radius_x) & (abs(dy) <= radius_y)
 
     elif shape == 'cylinder':
-        mask2d = (((xx + offset[0] - xc) / radius_x) ** 2 + ((yy + offset[1] - yc) / radius_y) ** 2 <= 1) * 1
+        mask = (dx / radius_x) ** 2 + (dy / radius_y) ** 2 <= 1
 
     elif shape == 'gaussian':
         sigma = float(radius_x)
-        mask2d = np.exp(-(((xx + offset[0] - xc)**2) / (2 * (sigma**2)) + ((yy + offset[1] - yc)**2) / (2 * (sigma**2))))
+        mask = np.exp(-((dx ** 2) / (2 * (sigma ** 2)) + (dy ** 2) / (2 * (sigma ** 2))))
 
-    return mask2d
+    mask = mask * valid
+    return mask.astype(np.uint8) if mask.dtype == bool else mask
 
 
 def get_parser():
@@ -333,7 +271,7 @@ def get_parser():
                       example=['data.nii'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description='Remove temporary files.',
+                      description='Remove temporary files. Not used anymore: the mask is created in memory.',
                       mandatory=False,
                       default_value='1',
                       example=['0', '1'])
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #
-# This program is a wrapper for the isct_dice_coefficient binary
+# Compute the Dice coefficient between two segmentations, in 3D and on 2D slices
 #
 # ---------------------------------------------------------------------------------------
 # Copyright (c) 2013 Polytechnique Montreal <www.neuro.polymtl.ca>
@@ -10,15 +10,17 @@
 # About the license: see the file LICENSE.TXT
 #########################################################################################
 
-from __future__ import absolute_import
+from __future__ import absolute_import, division
 
 import sys
-import shutil
-import os
+
+import numpy as np
 
 from msct_parser import Parser
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import overlap
+
 
 def get_parser():
     parser = Parser(__file__)
@@ -65,7 +67,7 @@ def get_parser():
                       example='dice_coeff.txt')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description="Remove temporary files.",
+                      description="Remove temporary files. Not used anymore: no temporary file is created.",
                       mandatory=False,
                       default_value='1',
                       example=['0', '1'])
@@ -78,77 +80,100 @@ def get_parser():
 
     return parser
 
-if __name__ == "__main__":
-    sct.init_sct()
+
+def get_bounding_box(data1, data2, bounding_box=None, bmax=False, bzmax=False):
+    """
+    Region in which the Dice coefficient is computed
+    :param bounding_box: x_origin,x_size,y_origin,y_size,z_origin,z_size. Size -1: full extent of the dimension
+    :param bmax: box of the voxels that are non-zero in both images
+    :param bzmax: same as bmax, along the second dimension only
+    :return: origin, size
+    """
+    shape = data1.shape[:3]
+    origin, size = [0, 0, 0], list(shape)
+    if bounding_box is not None:
+        for dim in range(3):
+            origin[dim] = bounding_box[2 * dim]
+            if bounding_box[2 * dim + 1] != -1:
+                size[dim] = bounding_box[2 * dim + 1]
+    elif bmax or bzmax:
+        coordinates = np.argwhere((data1 != 0) & (data2 != 0))
+        start, end = np.zeros(3, dtype=int), np.zeros(3, dtype=int)
+        if len(coordinates):
+            start, end = coordinates.min(0), coordinates.max(0)
+        dims = range(3) if bmax else [1]
+        for dim in dims:
+            origin[dim], size[dim] = int(start[dim]), int(end[dim] - start[dim] + 1)
+    return origin, size
+
+
+def dice_report(data1, data2, dim_slices=None, origin=(0, 0, 0), size=None):
+    """
+    Dice coefficient of the non-zero voxels of two images, within a bounding box
+    :param dim_slices: if not None, also compute the Dice coefficient on each 2D slice along this dimension
+    :return: 3D Dice coefficient, array of the 2D Dice coefficients of the slices (None if dim_slices is None). Slices
+    where both images are empty have a Dice coefficient of 0.
+    """
+    if size is None:
+        size = data1.shape[:3]
+    box = tuple(slice(o, o + s) for o, s in zip(origin, size))
+    mask1, mask2 = data1[box] != 0, data2[box] != 0
+    # one pass over the voxels: counts of each slice, the 3D counts are their sum
+    labels, counts = overlap.confusion_matrix(mask1, mask2, labels=[1], axis=0 if dim_slices is None else dim_slices)
+    dice_3d = np.nan_to_num(overlap.metrics_from_counts(counts.sum(0))['dice'][0])
+    if dim_slices is None:
+        return dice_3d, None
+    return dice_3d, np.nan_to_num(overlap.metrics_from_counts(counts)['dice'][:, 0])
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
     parser = get_parser()
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
 
     fname_input1 = arguments['-i']
     fname_input2 = arguments['-d']
+    verbose = int(arguments['-v'])
+    dim_slices = int(arguments['-2d-slices']) if '-2d-slices' in arguments else None
+
+    data1 = Image(fname_input1).data
+    data2 = Image(fname_input2).data
+    if data1.shape[:3] != data2.shape[:3]:
+        sct.printv('ERROR: the images ' + fname_input1 + ' and ' + fname_input2 + ' do not have the same size: ' +
+                   str(data1.shape) + ' and ' + str(data2.shape), 1, 'error')
+    if data1.ndim < 3:
+        data1, data2 = data1.reshape(data1.shape + (1,) * (3 - data1.ndim)), data2.reshape(data2.shape + (1,) * (3 - data2.ndim))
+    if '-bin' not in arguments or arguments['-bin'] == '0':
+        # as the images are read as integer label images, values below 1 are background
+        data1, data2 = np.trunc(data1), np.trunc(data2)
+
+    bmax = arguments.get('-bmax') == '1'
+    origin, size = get_bounding_box(data1, data2, bounding_box=arguments.get('-b'), bmax=bmax,
+                                    bzmax=arguments.get('-bzmax') == '1')
+    dice_3d, dice_slices = dice_report(data1, data2, dim_slices=dim_slices, origin=origin, size=size)
+
+    output = ''
+    if bmax or arguments.get('-bzmax') == '1':
+        output += 'WARNING: please check bounding box\nOrigin: \t{}\t{}\t{}\nSize: \t\t{}\t{}\t{}\n\n'.format(*(origin + size))
+    output += '3D Dice coefficient = {}\n'.format(dice_3d)
+    if dice_slices is not None:
+        output += ('\nSlice Dice coefficient on dimension {}\n'
+                   'Mean 2D Dice coefficient = {}\n'
+                   'Median 2D Dice coefficient = {}\n'
+                   'Standard Deviation = {}\n'
+                   'Variance = {}\n\n'
+                   '2D Dice coefficient by slice:\n').format(dim_slices, np.mean(dice_slices), np.median(dice_slices),
+                                                            np.std(dice_slices), np.var(dice_slices))
+        output += '\n'.join('{} {}'.format(i + origin[dim_slices], dice) for i, dice in enumerate(dice_slices))
 
-    verbose = arguments['-v']
-
-    tmp_dir = sct.tmp_create(verbose=verbose)  # create tmp directory
-    tmp_dir = os.path.abspath(tmp_dir)
-
-    # copy input files to tmp directory
-    # for fname in [fname_input1, fname_input2]:
-    sct.copy(fname_input1, tmp_dir)
-    sct.copy(fname_input2, tmp_dir)
-    fname_input1 = ''.join(sct.extract_fname(fname_input1)[1:])
-    fname_input2 = ''.join(sct.extract_fname(fname_input2)[1:])
-
-    curdir = os.getcwd()
-    os.chdir(tmp_dir) # go to tmp directory
-
-    if '-bin' in arguments:
-        fname_input1_bin = sct.add_suffix(fname_input1, '_bin')
-        sct.run(['sct_maths', '-i', fname_input1, '-bin', '0', '-o', fname_input1_bin])
-        fname_input1 = fname_input1_bin
-        fname_input2_bin = sct.add_suffix(fname_input2, '_bin')
-        sct.run(['sct_maths', '-i', fname_input2, '-bin', '0', '-o', fname_input2_bin])
-        fname_input2 = fname_input2_bin
-
-    # copy header of im_1 to im_2
-    im_1 = Image(fname_input1)
-    im_2 = Image(fname_input2)
-    im_2.header = im_1.header
-    im_2.save()
-
-    cmd = ['isct_dice_coefficient', fname_input1, fname_input2]
-
-    if '-2d-slices' in arguments:
-        cmd += ['-2d-slices', arguments['-2d-slices']]
-    if '-b' in arguments:
-        bounding_box = arguments['-b']
-        cmd += ['-b'] + bounding_box
-    if '-bmax' in arguments and arguments['-bmax'] == '1':
-        cmd += ['-bmax']
-    if '-bzmax' in arguments and arguments['-bzmax'] == '1':
-        cmd += ['-bzmax']
     if '-o' in arguments:
-        path_output, fname_output, ext = sct.extract_fname(arguments['-o'])
-        cmd += ['-o', fname_output + ext]
-
-    if '-r' in arguments:
-        rm_tmp = bool(int(arguments['-r']))
-
-    # # Computation of Dice coefficient using Python implementation.
-    # # commented for now as it does not cover all the feature of isct_dice_coefficient
-    # #from spinalcordtoolbox.image import Image, compute_dice
-    # #dice = compute_dice(Image(fname_input1), Image(fname_input2), mode='3d', zboundaries=False)
-    # #sct.printv('Dice (python-based) = ' + str(dice), verbose)
+        with open(arguments['-o'], 'w') as f:
+            f.write(output + '\n')
 
-    status, output = sct.run(cmd, verbose)
-
-    os.chdir(curdir) # go back to original directory
-
-    # copy output file into original directory
-    if '-o' in arguments:
-        sct.copy(os.path.join(tmp_dir, fname_output+ext), os.path.join(path_output, fname_output+ext))
+    sct.printv(output, verbose)
 
-    # remove tmp_dir
-    if rm_tmp:
-        sct.rmtree(tmp_dir)
 
-    sct.printv(output, verbose)
+if __name__ == "__main__":
+    sct.init_sct()
+    main()
@@ -13,7 +13,10 @@
 from __future__ import absolute_import
 
 import sys
+import os
+import multiprocessing
 
+import numpy as np
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 import dipy.reconst.dti as dti
@@ -71,6 +74,12 @@ def get_parser():
                       description='Output prefix.',
                       mandatory=False,
                       default_value='dti_')
+    parser.add_option(name="-j",
+                      type_value="int",
+                      description="Number of processes used to fit the tensor model. 0: use all available CPUs.",
+                      mandatory=False,
+                      default_value=1,
+                      example=['0', '4'])
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose. 0: nothing. 1: basic. 2: extended.""",
@@ -101,24 +110,31 @@ def main(args = None):
     evecs = bool(arguments['-evecs'])
     if "-m" in arguments:
         file_mask = arguments['-m']
+    nb_jobs = int(arguments['-j'])
     param.verbose = int(arguments['-v'])
 
     # compute DTI
-    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask):
+    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask, nb_jobs=nb_jobs):
         sct.printv('ERROR in compute_dti()', 1, 'error')
 
 
 # compute_dti
 # ==========================================================================================
-def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask):
+def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_mask, nb_jobs=1, chunk_size=None):
     """
     Compute DTI.
+    Only the voxels inside the mask (or, without mask, the voxels with non-zero signal) are fitted. These voxels
+    are gathered into a float32 (voxels x volumes) matrix stored in a memory-mapped file, which is split into chunks
+    fitted in parallel by a pool of processes. Output maps are then written one at a time in float32.
     :param fname_in: input 4d file.
     :param bvals: bvals txt file
     :param bvecs: bvecs txt file
     :param prefix: output prefix. Example: "dti_"
     :param method: algo for computing dti
     :param evecs: bool: output diffusion tensor eigenvectors
+    :param file_mask: mask file. Empty string: no mask.
+    :param nb_jobs: int: number of processes used for fitting. 0: all available CPUs.
+    :param chunk_size: int: number of voxels fitted per job. None: a few chunks per process.
     :return: True/False
     """
     # Open file.
@@ -129,57 +145,123 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, evecs, file_
 
     # open bvecs/bvals
     bvals, bvecs = read_bvals_bvecs(fname_bvals, fname_bvecs)
-    gtab = gradient_table(bvals, bvecs)
 
-    # mask and crop the data. This is a quick way to avoid calculating Tensors on the background of the image.
+    # select voxels to fit. This is a quick way to avoid calculating Tensors on the background of the image.
     if not file_mask == '':
         sct.printv('Open mask file...', param.verbose)
         # open mask file
         nii_mask = Image(file_mask)
-        mask = nii_mask.data
+        mask = nii_mask.data > 0
+    else:
+        mask = np.any(data != 0, axis=3)
+    nb_voxels = int(np.count_nonzero(mask))
+    sct.printv('Number of voxels to fit: ' + str(nb_voxels) + ' / ' + str(mask.size), param.verbose)
 
-    # fit tensor model
-    sct.printv('Computing tensor using "' + method + '" method...', param.verbose)
-    import dipy.reconst.dti as dti
-    if method == 'standard':
-        tenmodel = dti.TensorModel(gtab)
-        if file_mask == '':
-            tenfit = tenmodel.fit(data)
-        else:
-            tenfit = tenmodel.fit(data, mask)
-    elif method == 'restore':
+    # noise estimate for robust fitting (computed on the whole data, as dipy does)
+    sigma = None
+    if method == 'restore':
         import dipy.denoise.noise_estimate as ne
         sigma = ne.estimate_sigma(data)
-        dti_restore = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
-        if file_mask == '':
-            tenfit = dti_restore.fit(data)
-        else:
-            tenfit = dti_restore.fit(data, mask)
 
-    # Compute metrics
+    # gather signal of voxels to fit into a memory-mapped file, shared by the fitting processes
+    path_tmp = sct.tmp_create(basename="dmri_compute_dti", verbose=param.verbose)
+    fname_signal = os.path.join(path_tmp, 'signal.dat')
+    shape_signal = (max(nb_voxels, 1), data.shape[3])
+    signal = np.memmap(fname_signal, dtype=np.float32, mode='w+', shape=shape_signal)
+    signal[:nb_voxels] = data[mask]
+    signal.flush()
+    del signal, data
+    nii.data = None
+
+    # split voxels into chunks
+    if nb_jobs == 0:
+        nb_jobs = multiprocessing.cpu_count()
+    if chunk_size is None:
+        # a few chunks per process to balance the load across processes
+        chunk_size = int(np.ceil(float(nb_voxels) / (4 * nb_jobs))) or 1
+    list_chunks = [(start, min(start + chunk_size, nb_voxels)) for start in range(0, nb_voxels, chunk_size)]
+
+    # fit tensor model
+    sct.printv('Computing tensor using "' + method + '" method (' + str(len(list_chunks)) + ' chunks, ' +
+               str(nb_jobs) + ' processes)...', param.verbose)
+    init_args = (fname_signal, shape_signal, bvals, bvecs, method, sigma)
+    evals = np.zeros((nb_voxels, 3), dtype=np.float32)
+    data_evecs = np.zeros((nb_voxels, 3, 3), dtype=np.float32)
+    if nb_jobs > 1 and len(list_chunks) > 1:
+        pool = multiprocessing.Pool(processes=nb_jobs, initializer=_init_fit_worker, initargs=init_args)
+        try:
+            for start, stop, evals_chunk, evecs_chunk in pool.imap_unordered(_fit_chunk, list_chunks):
+                evals[start:stop] = evals_chunk
+                data_evecs[start:stop] = evecs_chunk
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_fit_worker(*init_args)
+        for chunk in list_chunks:
+            start, stop, evals_chunk, evecs_chunk = _fit_chunk(chunk)
+            evals[start:stop] = evals_chunk
+            data_evecs[start:stop] = evecs_chunk
+    _fit_worker.clear()
+
+    # Compute metrics, one output map at a time
     sct.printv('Computing metrics...', param.verbose)
+    nii.hdr.set_data_dtype(np.float32)
+
+    def save_map(values, fname_out):
+        data_out = np.zeros(mask.shape + values.shape[1:], dtype=np.float32)
+        data_out[mask] = values
+        nii.data = data_out
+        nii.save(fname_out, dtype='float32')
+        nii.data = None
+
     # FA
-    nii.data = tenfit.fa
-    nii.save(prefix + 'FA.nii.gz', dtype='float32')
+    save_map(dti.fractional_anisotropy(evals), prefix + 'FA.nii.gz')
     # MD
-    nii.data = tenfit.md
-    nii.save(prefix + 'MD.nii.gz', dtype='float32')
+    save_map(dti.mean_diffusivity(evals), prefix + 'MD.nii.gz')
     # RD
-    nii.data = tenfit.rd
-    nii.save(prefix + 'RD.nii.gz', dtype='float32')
+    save_map(dti.radial_diffusivity(evals), prefix + 'RD.nii.gz')
     # AD
-    nii.data = tenfit.ad
-    nii.save(prefix + 'AD.nii.gz', dtype='float32')
+    save_map(dti.axial_diffusivity(evals), prefix + 'AD.nii.gz')
     if evecs:
-        data_evecs = tenfit.evecs
         # output 1st (V1), 2nd (V2) and 3rd (V3) eigenvectors as 4d data
         for idim in range(3):
-            nii.data = data_evecs[:, :, :, :, idim]
-            nii.save(prefix + 'V' + str(idim+1) + '.nii.gz', dtype="float32")
+            save_map(data_evecs[:, :, idim], prefix + 'V' + str(idim+1) + '.nii.gz')
+
+    # remove temporary files
+    sct.rmtree(path_tmp, verbose=0)
 
     return True
 
 
+# state of a fitting process: memory-mapped signal and tensor model
+_fit_worker = {}
+
+
+def _init_fit_worker(fname_signal, shape_signal, bvals, bvecs, method, sigma):
+    """
+    Open the memory-mapped signal and build the tensor model, once per fitting process.
+    """
+    gtab = gradient_table(bvals, bvecs)
+    if method == 'restore':
+        tenmodel = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
+    else:
+        tenmodel = dti.TensorModel(gtab)
+    _fit_worker['signal'] = np.memmap(fname_signal, dtype=np.float32, mode='r', shape=shape_signal)
+    _fit_worker['model'] = tenmodel
+
+
+def _fit_chunk(chunk):
+    """
+    Fit the tensor model on a chunk of voxels.
+    :param chunk: (start, stop) indexes of the voxels in the signal matrix
+    :return: start, stop, eigenvalues (n, 3) and eigenvectors (n, 3, 3) in float32
+    """
+    start, stop = chunk
+    tenfit = _fit_worker['model'].fit(np.asarray(_fit_worker['signal'][start:stop]))
+    return start, stop, tenfit.evals.astype(np.float32), tenfit.evecs.astype(np.float32)
+
+
 # START PROGRAM
 # ==========================================================================================
 if __name__ == "__main__":
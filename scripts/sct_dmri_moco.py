@@ -32,9 +32,8 @@
 
 from __future__ import division, absolute_import
 
-import sys, os, time, math
+import sys, os, time
 import importlib
-from tqdm import tqdm
 import numpy as np
 
 import sct_utils as sct
@@ -42,7 +41,6 @@ import msct_moco as moco
 from sct_dmri_separate_b0_and_dwi import identify_b0
 from sct_convert import convert
 from spinalcordtoolbox.image import Image
-from sct_image import split_data, concat_data
 from msct_parser import Parser
 
 
@@ -336,68 +334,51 @@ def dmri_moco(param):
 
     # Prepare NIFTI (mean/groups...)
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
+    # All the volumes and averages needed for the registration are computed from the loaded 4D array, without
+    # splitting the data into individual files.
+    data = im_data.data
+    hdr_float = im_data.hdr.copy()
+    hdr_float.set_data_dtype(np.float32)
+
+    # Extract b=0 target volume
+    if index_dwi[0] != 0:
+        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
+        # select it as the target image for registration of all b=0
+        index_b0_target = index_b0[index_dwi[0] - 1]
+    else:
+        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
+        index_b0_target = index_b0[0]
+    file_b0_target = file_data + '_T' + str(index_b0_target).zfill(4)
+    Image(data[..., index_b0_target], hdr=im_data.hdr.copy()).save(file_b0_target + ext_data)
 
     # Merge b=0 images
     sct.printv('\nMerge b=0...', param.verbose)
-    im_b0_list = []
-    for it in range(nb_b0):
-        im_b0_list.append(im_data_split_list[index_b0[it]])
-    im_b0_out = concat_data(im_b0_list, 3) \
-     .save(file_b0 + ext_data)
+    Image(data[..., index_b0], hdr=im_data.hdr.copy()).save(file_b0 + ext_data)
     sct.printv(('  File created: ' + file_b0), param.verbose)
 
     # Average b=0 images
     sct.printv('\nAverage b=0...', param.verbose)
     file_b0_mean = file_b0 + '_mean'
-    sct.run(['sct_maths', '-i', file_b0 + ext_data, '-o', file_b0_mean + ext_data, '-mean', 't'], param.verbose)
-
-    # Number of DWI groups
-    nb_groups = int(math.floor(nb_dwi / param.group_size))
+    moco.average_groups(im_data, [index_b0]).save(file_b0_mean + ext_data)
 
     # Generate groups indexes
-    group_indexes = []
-    for iGroup in range(nb_groups):
-        group_indexes.append(index_dwi[(iGroup * param.group_size):((iGroup + 1) * param.group_size)])
+    group_indexes = moco.get_group_indexes(index_dwi, param.group_size)
+    nb_groups = len(group_indexes)
 
-    # add the remaining images to the last DWI group
-    nb_remaining = nb_dwi%param.group_size  # number of remaining images
-    if nb_remaining > 0:
-        nb_groups += 1
-        group_indexes.append(index_dwi[len(index_dwi) - nb_remaining:len(index_dwi)])
-
-    # DWI groups
+    # Average DW Images within groups
+    sct.printv('\nAverage DW images within groups...', param.verbose)
+    im_dw_out = moco.average_groups(im_data, group_indexes)
+    im_dw_out.save(file_dwi_group + ext_data)
     file_dwi_mean = []
-    for iGroup in tqdm(range(nb_groups), unit='iter', unit_scale=False, desc="Merge within groups", ascii=True, ncols=80):
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
-        # Merge DW Images
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
-        im_dwi_list = []
-        for it in range(nb_dwi_i):
-            im_dwi_list.append(im_data_split_list[index_dwi_i[it]])
-        im_dwi_out = concat_data(im_dwi_list, 3).save(file_dwi_merge_i + ext_data)
-        # Average DW Images
-        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
-        sct.run(["sct_maths", "-i", file_dwi_merge_i + ext_data, "-o", file_dwi_mean[iGroup] + ext_data, "-mean", "t"], 0)
-
-    # Merge DWI groups means
-    sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    im_dw_list = []
     for iGroup in range(nb_groups):
-        im_dw_list.append(file_dwi_mean[iGroup] + ext_data)
-    im_dw_out = concat_data(im_dw_list, 3).save(file_dwi_group + ext_data)
+        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
+    # the first DWI group mean is the registration target and the reference for reslicing
+    Image(im_dw_out.data.reshape(im_dw_out.data.shape[:3] + (-1,))[..., 0], hdr=hdr_float.copy()).save(
+        file_dwi_mean[0] + ext_data)
 
     # Average DW Images
-    # TODO: USEFULL ???
     sct.printv('\nAveraging all DW images...', param.verbose)
-    sct.run(["sct_maths", "-i", file_dwi_group + ext_data, "-o", file_dwi_group + '_mean' + ext_data, "-mean", "t"], param.verbose)
+    moco.average_groups(im_dw_out, [list(range(nb_groups))]).save(file_dwi_group + '_mean' + ext_data)
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -422,14 +403,7 @@ def dmri_moco(param):
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco = param
     param_moco.file_data = 'b0'
-    # identify target image
-    if index_dwi[0] != 0:
-        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
-        # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0] - 1]).zfill(4)
-    else:
-        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+    param_moco.file_target = file_b0_target
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
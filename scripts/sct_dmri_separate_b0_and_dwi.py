@@ -23,7 +23,7 @@ import numpy as np
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
-from sct_image import split_data
+from msct_moco import average_groups
 from msct_parser import Parser
 
 
@@ -182,38 +182,23 @@ def main(args=None):
     sct.printv(fname_bvals)
     index_b0, index_dwi, nb_b0, nb_dwi = identify_b0(fname_bvecs, fname_bvals, param.bval_min, verbose)
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', verbose)
-    im_dmri_split_list = split_data(im_dmri, 3)
-    for im_d in im_dmri_split_list:
-        im_d.save()
+    # Extract b=0 and DWI volumes directly from the 4D array (no per-volume files)
+    data = im_dmri.data.reshape(im_dmri.data.shape[:3] + (-1,))
 
     # Merge b=0 images
     sct.printv('\nMerge b=0...', verbose)
-    from sct_image import concat_data
-    l = []
-    for it in range(nb_b0):
-        l.append(dmri_name + '_T' + str(index_b0[it]).zfill(4) + ext)
-    im_out = concat_data(l, 3).save(b0_name + ext)
-
-    # Average b=0 images
-    if average:
-        sct.printv('\nAverage b=0...', verbose)
-        sct.run(['sct_maths', '-i', b0_name + ext, '-o', b0_mean_name + ext, '-mean', 't'], verbose)
+    Image(data[..., index_b0], hdr=im_dmri.hdr.copy()).save(b0_name + ext)
 
     # Merge DWI
-    l = []
-    for it in range(nb_dwi):
-        l.append(dmri_name + '_T' + str(index_dwi[it]).zfill(4) + ext)
-    im_out = concat_data(l, 3).save(dwi_name + ext)
+    sct.printv('\nMerge DWI...', verbose)
+    Image(data[..., index_dwi], hdr=im_dmri.hdr.copy()).save(dwi_name + ext)
 
-    # Average DWI images
+    # Average b=0 and DWI images, in a single pass over the data
     if average:
-        sct.printv('\nAverage DWI...', verbose)
-        sct.run(['sct_maths', '-i', dwi_name + ext, '-o', dwi_mean_name + ext, '-mean', 't'], verbose)
-        # if not average_data_across_dimension('dwi.nii', 'dwi_mean.nii', 3):
-        #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-        # sct.run(fsloutput + 'fslmaths dwi -Tmean dwi_mean', verbose)
+        sct.printv('\nAverage b=0 and DWI...', verbose)
+        im_mean = average_groups(im_dmri, [index_b0, index_dwi])
+        Image(im_mean.data[..., 0], hdr=im_mean.hdr.copy()).save(b0_mean_name + ext)
+        Image(im_mean.data[..., 1], hdr=im_mean.hdr.copy()).save(dwi_mean_name + ext)
 
     # come back
     os.chdir(curdir)
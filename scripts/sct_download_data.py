@@ -12,26 +12,21 @@
 
 from __future__ import absolute_import
 
-import cgi
 import os
 import sys
 import tarfile
-import tempfile
 import zipfile
-import shutil
-
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util import Retry
-from tqdm import tqdm
 
 from msct_parser import Parser
+import msct_download
 import sct_utils as sct
 
 
 def get_parser():
     parser = Parser(__file__)
-    parser.usage.set_description('''Download binaries from the web.''')
+    parser.usage.set_description('''Download binaries from the web.
+Downloaded archives are kept in a cache folder (default: ~/.cache/sct/downloads, or the environment variable %s), \
+so that they are not downloaded again. Interrupted downloads are resumed.''' % msct_download.ENV_CACHE)
     parser.add_option(
         name="-d",
         type_value="multiple_choice",
@@ -66,6 +61,19 @@ def get_parser():
         type_value="folder_creation",
         description="path to save the downloaded data",
         mandatory=False)
+    parser.add_option(
+        name="-j",
+        type_value="int",
+        description="Number of parallel connections used to download and extract the data.",
+        mandatory=False,
+        default_value=msct_download.NB_JOBS)
+    parser.add_option(
+        name="-k",
+        type_value="multiple_choice",
+        description="Download the data again, even if it is in the cache. 0: use the cache. 1: download again.",
+        mandatory=False,
+        default_value=0,
+        example=['0', '1'])
     parser.add_option(
         name="-h",
         type_value=None,
@@ -112,6 +120,10 @@ def main(args=None):
         'deepseg_lesion_models': ['https://osf.io/eg7v9/?action=download',
                               'https://www.neuro.polymtl.ca/_media/downloads/sct/20180613_deepseg_lesion_models.zip']
     }
+    # sha256 of the archives, verified after download. For datasets without entry, the sha256 published by OSF for
+    # the file is used, when available.
+    dict_sha256 = {
+    }
 
     # Get parser info
     parser = get_parser()
@@ -119,10 +131,16 @@ def main(args=None):
     data_name = arguments['-d']
     verbose = int(arguments['-v'])
     dest_folder = arguments.get('-o', os.path.abspath(os.curdir))
+    nb_jobs = max(1, int(arguments['-j']))
+    refresh = bool(int(arguments['-k']))
 
     # Download data
     url = dict_url[data_name]
-    tmp_file = download_data(url, verbose)
+    sha256 = dict_sha256.get(data_name) or msct_download.get_osf_sha256(url)
+    if sha256 is None:
+        sct.printv('WARNING: no checksum available for ' + data_name + ', the download will not be verified.',
+                   verbose, 'warning')
+    fname_archive = download_data(url, verbose, sha256=sha256, nb_jobs=nb_jobs, refresh=refresh)
 
     # Check if folder already exists
     sct.printv('\nCheck if folder already exists...', verbose)
@@ -131,28 +149,25 @@ def main(args=None):
         sct.rmtree(data_name)
 
     # unzip
-    unzip(tmp_file, dest_folder, verbose)
-
-    sct.printv('\nRemove temporary file...', verbose)
-    os.remove(tmp_file)
+    unzip(fname_archive, dest_folder, verbose, nb_jobs=nb_jobs)
 
     sct.printv('Done!\n', verbose)
     return 0
 
 
-def unzip(compressed, dest_folder, verbose):
-    """Extract compressed file to the dest_folder"""
+def unzip(compressed, dest_folder, verbose, nb_jobs=1):
+    """Extract compressed file to the dest_folder. The format is detected from the content of the file, since
+    archives of the download cache have no extension."""
     sct.printv('\nUnzip data to: %s' % dest_folder, verbose)
-    if compressed.endswith('zip'):
+    if compressed.endswith('zip') or zipfile.is_zipfile(compressed):
         try:
-            zf = zipfile.ZipFile(compressed)
-            zf.extractall(dest_folder)
+            msct_download.extract_zip(compressed, dest_folder, nb_jobs=nb_jobs)
             return
         except (zipfile.BadZipfile):
             sct.printv(
                 'ERROR: ZIP package corrupted. Please try downloading again.',
                 verbose, 'error')
-    elif compressed.endswith('tar.gz'):
+    elif compressed.endswith('tar.gz') or tarfile.is_tarfile(compressed):
         try:
             tar = tarfile.open(compressed)
             tar.extractall(path=dest_folder)
@@ -163,56 +178,21 @@ def unzip(compressed, dest_folder, verbose):
         sct.printv('ERROR: The file %s is of wrong format' % compressed, verbose, 'error')
 
 
-def download_data(urls, verbose):
+def download_data(urls, verbose, sha256=None, nb_jobs=1, refresh=False):
     """Download the binaries from a URL and return the destination filename
 
-    Retry downloading if either server or connection errors occur on a SSL
-    connection
+    The file is taken from the download cache if it is there, otherwise it is downloaded into the cache (see
+    msct_download): resumed if a previous download was interrupted, by chunks over several connections if the servers
+    accept range requests, and verified against sha256 if given.
     urls: list of several urls (mirror servers) or single url (string)
+    refresh: download again, even if the file is in the cache
     """
-
-    # if urls is not a list, make it one
-    if not isinstance(urls, (list, tuple)):
-        urls = [urls]
-
-    # loop through URLs
-    for url in urls:
-        try:
-            sct.printv('\nTrying URL: %s' % url, verbose)
-            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 503, 504])
-            session = requests.Session()
-            session.mount('https://', HTTPAdapter(max_retries=retry))
-            response = session.get(url, stream=True)
-
-            if "Content-Disposition" in response.headers:
-                _, content = cgi.parse_header(response.headers['Content-Disposition'])
-                filename = content["filename"]
-            else:
-                sct.printv("Unexpected: link doesn't provide a filename", type="warning")
-                continue
-
-            tmp_path = os.path.join(tempfile.mkdtemp(), filename)
-            sct.printv('Downloading %s...' % filename, verbose)
-
-            with open(tmp_path, 'wb') as tmp_file:
-                total = int(response.headers.get('content-length', 1))
-                tqdm_bar = tqdm(total=total, unit='B', unit_scale=True,
-                                desc="Status", ascii=True)
-
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        tmp_file.write(chunk)
-                        if verbose > 0:
-                            dl_chunk = len(chunk)
-                            tqdm_bar.update(dl_chunk)
-
-                tqdm_bar.close()
-            return tmp_path
-
-        except Exception as e:
-            sct.printv("Link download error, trying next mirror (error was: %s)" % e, type='warning')
-    else:
-        sct.printv('\nDownload error', type='error')
+    try:
+        fname, filename = msct_download.download(urls, sha256=sha256, nb_jobs=nb_jobs, refresh=refresh,
+                                                 verbose=verbose)
+    except msct_download.DownloadError as e:
+        sct.printv('\n%s' % e, type='error')
+    return fname
 
 
 if __name__ == "__main__":
@@ -16,7 +16,6 @@ from __future__ import absolute_import, division
 import sys, os
 
 import numpy as np
-from skimage import transform, img_as_float, img_as_uint
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -38,7 +37,8 @@ class Param:
 #=======================================================================================================================
 # main
 #=======================================================================================================================
-def main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp, remove_temp_files, verbose):
+def main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp, remove_temp_files, verbose,
+         fname_warp=None):
 
     # load input image
     im_anat = Image(fname_anat)
@@ -50,36 +50,18 @@ def main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp,
     # load centerline
     im_centerline = Image(fname_centerline).change_orientation("RPI")
 
-    # smooth centerline and return fitted coordinates in voxel space
-    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(
-        im_centerline, algo_fitting=centerline_fitting, type_window='hanning', window_length=50,
-        nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
-
-    # compute translation for each slice, such that the flattened centerline is centered in the medial plane (R-L) and
-    # avoid discontinuity in slices where there is no centerline (in which case, simply copy the translation of the
-    # closest Z).
-    # first, get zmin and zmax spanned by the centerline (i.e. with non-zero values)
-    indz_centerline = np.where([np.sum(im_centerline.data[:, :, iz]) for iz in range(nz)])[0]
-    zmin, zmax = indz_centerline[0], indz_centerline[-1]
-    # then, extend the centerline by copying values below zmin and above zmax
-    x_centerline_extended = np.concatenate([np.ones(zmin) * x_centerline_fit[0],
-                                            x_centerline_fit,
-                                            np.ones(nz-zmax) * x_centerline_fit[-1]])
+    # translation of each slice along x (R-L)
+    translation_x = get_translations(im_centerline, centerline_fitting, verbose)
 
-    # loop across slices and apply translation
+    # apply translations to all slices at once, with linear interpolation
+    # output is float32 to minimize loss of precision. See #1790
     im_anat_flattened = msct_image.change_type(im_anat, np.float32)
-    # change type to float32 because of subsequent conversion (img_as_float). See #1790
-
-    for iz in range(nz):
-        # compute translation along x (R-L)
-        translation_x = x_centerline_extended[iz] - np.round(nx/2.0)
-        # apply transformation to 2D image with linear interpolation
-        # tform = tf.SimilarityTransform(scale=1, rotation=0, translation=(translation_x, 0))
-        tform = transform.SimilarityTransform(translation=(0, translation_x))
-        # important to force input in float to skikit image, because it will output float values
-        img = img_as_float(im_anat.data[:, :, iz])
-        img_reg = transform.warp(img, tform)
-        im_anat_flattened.data[:, :, iz] = img_reg  # img_as_uint(img_reg)
+    im_anat_flattened.data = shift_slices(im_anat.data, translation_x)
+
+    if fname_warp is not None:
+        # warping field from the input image to the flattened image (defined on the RPI grid)
+        affine = im_anat.hdr.get_best_affine()
+        get_displacement_field(translation_x, im_anat.data.shape[:3], affine).save(fname_warp, header=im_anat.hdr)
 
     # change back to native orientation
     im_anat_flattened.change_orientation(orientation_native)
@@ -90,6 +72,67 @@ def main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp,
     sct.display_viewer_syntax([fname_anat, fname_out])
 
 
+def get_translations(im_centerline, centerline_fitting='hanning', verbose=1):
+    """
+    Translation along x of each slice, such that the flattened centerline is centered in the medial plane (R-L).
+    Slices where there is no centerline get the translation of the closest slice with centerline, to avoid
+    discontinuities.
+    :param im_centerline: centerline or segmentation, in RPI orientation
+    :return: (nz,) array of translations, in voxels
+    """
+    nx, nz = im_centerline.data.shape[0], im_centerline.data.shape[2]
+    # smooth centerline and return fitted coordinates in voxel space
+    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(
+        im_centerline, algo_fitting=centerline_fitting, type_window='hanning', window_length=50,
+        nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
+
+    # first, get zmin and zmax spanned by the centerline (i.e. with non-zero values)
+    indz_centerline = np.flatnonzero(im_centerline.data.sum(axis=(0, 1)))
+    zmin, zmax = indz_centerline[0], indz_centerline[-1]
+    # then, extend the centerline by copying values below zmin and above zmax
+    x_centerline_extended = np.concatenate([np.ones(zmin) * x_centerline_fit[0],
+                                            x_centerline_fit,
+                                            np.ones(nz - zmax) * x_centerline_fit[-1]])[:nz]
+    return x_centerline_extended - np.round(nx / 2.0)
+
+
+def shift_slices(data, translation_x):
+    """
+    Translate each slice along x by linear interpolation: out[x, y, z] = data[x + translation_x[z], y, z], with zero
+    outside of the image. All the slices are interpolated at once, as a 1D interpolation along x.
+    :param data: 3D array (x, y, z)
+    :param translation_x: (nz,) translations, in voxels
+    :return: float32 array
+    """
+    nx, ny, nz = data.shape[:3]
+    # zero-padded along x, so that neighbours outside of the image are zero
+    padded = np.zeros((nx + 2, ny, nz), dtype=np.float32)
+    padded[1:-1] = data
+    x_src = np.arange(nx)[:, np.newaxis] + np.asarray(translation_x, dtype=np.float64)[np.newaxis, :]
+    x0 = np.floor(x_src)
+    weight = (x_src - x0).astype(np.float32)[:, np.newaxis, :]
+    # index in the padded array of the neighbours x0 and x0 + 1
+    index0 = np.clip(x0 + 1, 0, nx + 1).astype(int)[:, np.newaxis, :]
+    index1 = np.clip(x0 + 2, 0, nx + 1).astype(int)[:, np.newaxis, :]
+    iy, iz = np.arange(ny)[np.newaxis, :, np.newaxis], np.arange(nz)[np.newaxis, np.newaxis, :]
+    return (1 - weight) * padded[index0, iy, iz] + weight * padded[index1, iy, iz]
+
+
+def get_displacement_field(translation_x, shape, affine):
+    """
+    Warping field of the flattening, that can be applied with sct_apply_transfo
+    :param translation_x: (nz,) translations along x, in voxels
+    :param shape, affine: grid of the image, in RPI orientation
+    :return: spinalcordtoolbox.warp.DisplacementField
+    """
+    from spinalcordtoolbox.warp import DisplacementField
+    # displacement of one voxel along x, in mm (RAS)
+    displacement = affine[:3, 0][np.newaxis, :] * np.asarray(translation_x, dtype=np.float32)[:, np.newaxis]
+    field = np.empty(tuple(shape[:3]) + (3,), dtype=np.float32)
+    field[...] = displacement[np.newaxis, np.newaxis, :, :]
+    return DisplacementField(field, affine)
+
+
 def get_parser():
     param_default = Param()
     parser = Parser(__file__)
@@ -116,6 +159,12 @@ def get_parser():
                       description='Degree of fitting polynome.',
                       mandatory=False,
                       default_value=param_default.deg_poly)
+    parser.add_option(name='-owarp',
+                      type_value='file_output',
+                      description='Output warping field of the flattening, that can be applied to other images with '
+                                  'sct_apply_transfo.',
+                      mandatory=False,
+                      example='warp_flatten.nii.gz')
     parser.add_option(name='-f',
                       type_value='multiple_choice',
                       description='Fitting algorithm.',
@@ -160,6 +209,8 @@ if __name__ == "__main__":
     interp = arguments['-x']
     remove_temp_files = arguments['-r']
     verbose = int(arguments['-v'])
+    fname_warp = arguments.get('-owarp')
 
     # call main function
-    main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp, remove_temp_files, verbose)
+    main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp, remove_temp_files, verbose,
+         fname_warp=fname_warp)
@@ -19,9 +19,8 @@ import sys
 import numpy as np
 
 import sct_utils as sct
-import spinalcordtoolbox.image as msct_image
 from msct_parser import Parser
-from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import voxelwise
 
 
 class Param:
@@ -44,26 +43,33 @@ class Tsnr:
 
         fname_data = self.fmri
 
-        # open data
-        nii_data = Image(fname_data)
-        data = nii_data.data
-
-        # compute mean
-        data_mean = np.mean(data, 3)
-        # compute STD
-        data_std = np.std(data, 3, ddof=1)
-        # compute TSNR
-        data_tsnr = data_mean / data_std
-
-        # save TSNR
+        # compute TSNR by slabs of slices, and save it
         fname_tsnr = self.out
-        nii_tsnr = msct_image.empty_like(nii_data)
-        nii_tsnr.data = data_tsnr
-        nii_tsnr.save(fname_tsnr, dtype=np.float32)
+        voxelwise.compute_maps([fname_data], [fname_tsnr], tsnr_kernel, verbose=self.param.verbose)
 
         sct.display_viewer_syntax([fname_tsnr])
 
 
+def tsnr_kernel(data):
+    """
+    Compute tSNR (temporal mean / temporal STD) on a slab of an fMRI time series.
+    :param data: float32 array (x, y, z, t), modified in place
+    :return: tuple with the float32 tSNR array (x, y, z)
+    """
+    nt = data.shape[3]
+    # compute mean
+    data_mean = np.mean(data, 3, dtype=np.float64).astype(np.float32)
+    # compute STD
+    data -= data_mean[..., np.newaxis]
+    np.square(data, out=data)
+    data_std = np.sum(data, 3, dtype=np.float64)
+    data_std /= nt - 1
+    np.sqrt(data_std, out=data_std)
+    # compute TSNR
+    data_mean /= data_std
+    return data_mean,
+
+
 # PARSER
 # ==========================================================================================
 def get_parser():
@@ -100,6 +106,8 @@ def main(args=None):
     fname_dst = arguments.get("-o", sct.add_suffix(fname_src, "_tsnr"))
     verbose = int(arguments['-v'])
 
+    param.verbose = verbose
+
     # call main function
     tsnr = Tsnr(param=param, fmri=fname_src, out=fname_dst)
     tsnr.compute()
@@ -16,15 +16,11 @@ from __future__ import absolute_import, division
 import sys
 import os
 import time
-import math
-from tqdm import tqdm
 import numpy as np
 import sct_utils as sct
 import msct_moco as moco
-import sct_maths
 from sct_convert import convert
 from spinalcordtoolbox.image import Image
-from sct_image import split_data, concat_data
 from msct_parser import Parser
 
 
@@ -266,67 +262,24 @@ def fmri_moco(param):
         sct.printv('For sagittal data group_size should be one for more robustness. Forcing group_size=1.', 1, 'warning')
         param.group_size = 1
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data = Image(file_data + ext_data)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
-
-    # assign an index to each volume
-    index_fmri = list(range(0, nt))
-
-    # Number of groups
-    nb_groups = int(math.floor(nt / param.group_size))
-
     # Generate groups indexes
-    group_indexes = []
-    for iGroup in range(nb_groups):
-        group_indexes.append(index_fmri[(iGroup * param.group_size):((iGroup + 1) * param.group_size)])
-
-    # add the remaining images to the last fMRI group
-    nb_remaining = nt%param.group_size  # number of remaining images
-    if nb_remaining > 0:
-        nb_groups += 1
-        group_indexes.append(index_fmri[len(index_fmri) - nb_remaining:len(index_fmri)])
-
-    # groups
-    for iGroup in tqdm(range(nb_groups), unit='iter', unit_scale=False, desc="Merge within groups", ascii=True, ncols=80):
-        # get index
-        index_fmri_i = group_indexes[iGroup]
-        nt_i = len(index_fmri_i)
-
-        # Merge Images
-        file_data_merge_i = file_data + '_' + str(iGroup)
-        # cmd = fsloutput + 'fslmerge -t ' + file_data_merge_i
-        # for it in range(nt_i):
-        #     cmd = cmd + ' ' + file_data + '_T' + str(index_fmri_i[it]).zfill(4)
-
-        im_fmri_list = []
-        for it in range(nt_i):
-            im_fmri_list.append(im_data_split_list[index_fmri_i[it]])
-        im_fmri_concat = concat_data(im_fmri_list, 3, squeeze_data=True).save(file_data_merge_i + ext_data)
-
-        file_data_mean = file_data + '_mean_' + str(iGroup)
-        if param.group_size == 1:
-            # copy to new file name instead of averaging (faster)
-            # note: this is a bandage. Ideally we should skip this entire for loop if g=1
-            sct.copy(file_data_merge_i + '.nii', file_data_mean + '.nii')
-        else:
-            # Average Images
-            sct.run(['sct_maths', '-i', file_data_merge_i + '.nii', '-o', file_data_mean + '.nii', '-mean', 't'], verbose=0)
-        # if not average_data_across_dimension(file_data_merge_i+'.nii', file_data_mean+'.nii', 3):
-        #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-        # cmd = fsloutput + 'fslmaths ' + file_data_merge_i + ' -Tmean ' + file_data_mean
-        # sct.run(cmd, param.verbose)
-
-    # Merge groups means. The output 4D volume will be used for motion correction.
-    sct.printv('\nMerging volumes...', param.verbose)
+    group_indexes = moco.get_group_indexes(list(range(0, nt)), param.group_size)
+    nb_groups = len(group_indexes)
+
+    # Average volumes within groups, in a single pass over the 4D data. The output 4D volume will be used for motion
+    # correction.
+    sct.printv('\nAverage volumes within groups...', param.verbose)
     file_data_groups_means_merge = 'fmri_averaged_groups'
-    im_mean_list = []
-    for iGroup in range(nb_groups):
-        im_mean_list.append(Image(file_data + '_mean_' + str(iGroup) + ext_data))
-    im_mean_concat = concat_data(im_mean_list, 3).save(file_data_groups_means_merge + ext_data)
+    if param.group_size == 1:
+        # no averaging needed: use the data as is (faster)
+        im_mean_concat = im_data.copy()
+    else:
+        im_mean_concat = moco.average_groups(im_data, group_indexes)
+    im_mean_concat.save(file_data_groups_means_merge + ext_data)
+    # only the group means used as registration target and reslicing reference are written to disk
+    data_mean = im_mean_concat.data.reshape(im_mean_concat.data.shape[:3] + (-1,))
+    for iGroup in sorted(set([int(param.num_target), 0])):
+        Image(data_mean[..., iGroup], hdr=im_mean_concat.hdr.copy()).save(file_data + '_mean_' + str(iGroup) + ext_data)
 
     # Estimate moco
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
@@ -382,10 +335,7 @@ def fmri_moco(param):
 
     # Average volumes
     sct.printv('\nAveraging data...', param.verbose)
-    sct_maths.main(args=['-i', 'fmri_moco.nii',
-                         '-o', 'fmri_moco_mean.nii',
-                         '-mean', 't',
-                         '-v', '0'])
+    moco.average_groups(im_fmri_moco, [list(range(nt))]).save('fmri_moco_mean.nii')
 
 
 #=======================================================================================================================
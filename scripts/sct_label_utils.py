@@ -22,13 +22,38 @@ import os
 import sys
 
 import numpy as np
-from scipy import ndimage
 
 from msct_parser import Parser
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from msct_types import CoordinateValue
 import sct_utils as sct
+from spinalcordtoolbox.utils import lazy_import
+
+ndimage = lazy_import('scipy.ndimage')
+
+
+def get_labels(image):
+    """
+    Labels of an image as an array, the array counterpart of Image.getNonZeroCoordinates().
+    :param image: Image, 2D or 3D
+    :return: (N, 4) float array of x, y, z, value for each voxel > 0, in the order of getNonZeroCoordinates()
+    """
+    data = image.data
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    X, Y, Z = (data > 0).nonzero()
+    return np.column_stack([X, Y, Z, data[X, Y, Z]]).astype(np.float64)
+
+
+def label_index(image, coordinates):
+    """
+    Index of image.data for an array of x, y, z coordinates (N, 3+), for reading or writing many labels at once
+    """
+    coordinates = np.round(coordinates).astype(int)
+    if image.data.ndim == 2:
+        return coordinates[:, 0], coordinates[:, 1]
+    return coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]
 
 
 class Param:
@@ -144,13 +169,8 @@ class ProcessLabels(object):
         This function add a specified value to all non-zero voxels.
         """
         image_output = self.image_input.copy()
-        # image_output.data *= 0
-
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = image_output.data[int(coord.x), int(coord.y), int(coord.z)] + float(value)
+        mask = image_output.data > 0
+        image_output.data[mask] = image_output.data[mask] + float(value)
         return image_output
 
     def create_label(self, add=False):
@@ -235,25 +255,19 @@ class ProcessLabels(object):
         """
 
         image_output = msct_image.zeros_like(Image(self.image_ref))
-
-        image_input_neg = msct_image.zeros_like(Image(self.image_input))
-        image_input_pos = msct_image.zeros_like(Image(self.image_input))
-
-        X, Y, Z = (self.image_input.data < 0).nonzero()
-        for i in range(len(X)):
-            image_input_neg.data[X[i], Y[i], Z[i]] = -self.image_input.data[X[i], Y[i], Z[i]]  # in order to apply getNonZeroCoordinates
-        X_pos, Y_pos, Z_pos = (self.image_input.data > 0).nonzero()
-        for i in range(len(X_pos)):
-            image_input_pos.data[X_pos[i], Y_pos[i], Z_pos[i]] = self.image_input.data[X_pos[i], Y_pos[i], Z_pos[i]]
-
-        coordinates_input_neg = image_input_neg.getNonZeroCoordinates()
-        coordinates_input_pos = image_input_pos.getNonZeroCoordinates()
-
         image_output.change_type('float32')
-        for coord in coordinates_input_neg:
-            image_output.data[:, :, int(coord.z)] = -coord.value  # PB: takes the int value of coord.value
-        for coord in coordinates_input_pos:
-            image_output.data[:, :, int(coord.z)] = coord.value
+
+        data = self.image_input.data
+        # negative labels first, then positive labels: a slice gets the value of the last label written on it
+        Z, values = [], []
+        for mask in [data < 0, data > 0]:
+            X_label, Y_label, Z_label = mask.nonzero()
+            Z.append(Z_label)
+            values.append(data[X_label, Y_label, Z_label])
+        Z, values = np.concatenate(Z), np.concatenate(values)
+        _, index_last = np.unique(Z[::-1], return_index=True)
+        index_last = len(Z) - 1 - index_last
+        image_output.data[:, :, Z[index_last]] = values[index_last]
 
         return image_output
 
@@ -271,22 +285,22 @@ class ProcessLabels(object):
         # 0. Initialization of output image
         output_image = msct_image.zeros_like(self.image_input)
 
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.image_input.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
-
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        for value, list_coord in groups.items():
-            center_of_mass = sum(list_coord) / float(len(list_coord))
-            sct.printv("Value = " + str(center_of_mass.value) + " : (" + str(center_of_mass.x) + ", " + str(center_of_mass.y) + ", " + str(center_of_mass.z) + ") --> ( " + str(np.round(center_of_mass.x)) + ", " + str(np.round(center_of_mass.y)) + ", " + str(np.round(center_of_mass.z)) + ")", verbose=self.verbose)
-            output_image.data[int(np.round(center_of_mass.x)), int(np.round(center_of_mass.y)), int(np.round(center_of_mass.z))] = center_of_mass.value
+        # 1. Extraction of all non-null voxels in the image, and of their group (one group per value)
+        labels = get_labels(self.image_input)
+        if not len(labels):
+            return output_image
+        values, groups = np.unique(labels[:, 3], return_inverse=True)
+        image_groups = np.zeros(self.image_input.data.shape, dtype=np.int32)
+        image_groups[label_index(self.image_input, labels)] = groups + 1
+
+        # 2. Compute the center of mass of each group of voxels and write them into the output image
+        centers_of_mass = ndimage.center_of_mass(image_groups > 0, image_groups, np.arange(1, len(values) + 1))
+        centers_of_mass = np.array(centers_of_mass, dtype=np.float64).reshape(len(values), -1)
+        for value, center_of_mass in zip(values, centers_of_mass):
+            x, y = center_of_mass[:2]
+            z = center_of_mass[2] if len(center_of_mass) > 2 else 0.0
+            sct.printv("Value = " + str(value) + " : (" + str(x) + ", " + str(y) + ", " + str(z) + ") --> ( " + str(np.round(x)) + ", " + str(np.round(y)) + ", " + str(np.round(z)) + ")", verbose=self.verbose)
+        output_image.data[label_index(output_image, centers_of_mass)] = values
 
         return output_image
 
@@ -314,14 +328,23 @@ class ProcessLabels(object):
         """
         image_output = msct_image.zeros_like(self.image_input)
 
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-        coordinates_ref = self.image_ref.getNonZeroCoordinates(sorting='value')
-
-        # for all points in input, find the value that has to be set up, depending on the vertebral level
-        for i, coord in enumerate(coordinates_input):
-            for j in range(0, len(coordinates_ref) - 1):
-                if coordinates_ref[j + 1].z < coord.z <= coordinates_ref[j].z:
-                    image_output.data[int(coord.x), int(coord.y), int(coord.z)] = coordinates_ref[j].value
+        labels_input = get_labels(self.image_input)
+        labels_ref = get_labels(self.image_ref)
+        labels_ref = labels_ref[np.argsort(labels_ref[:, 3], kind='mergesort')]
+        z, z_ref = labels_input[:, 2], labels_ref[:, 2]
+
+        # a voxel gets the value of disc j if z_ref[j + 1] < z <= z_ref[j]
+        if np.all(np.diff(z_ref) <= 0):
+            # discs from top to bottom: the intervals are sorted, find the interval of each voxel by binary search
+            index_sorted = np.searchsorted(z_ref[::-1], z, side='left')
+            inside = (index_sorted > 0) & (index_sorted < len(z_ref))
+            level = len(z_ref) - 1 - index_sorted[inside]
+            image_output.data[label_index(image_output, labels_input[inside])] = labels_ref[level, 3]
+        else:
+            # overlapping intervals: the last disc matching a voxel gives its value
+            for j in range(len(z_ref) - 1):
+                inside = (z_ref[j + 1] < z) & (z <= z_ref[j])
+                image_output.data[label_index(image_output, labels_input[inside])] = labels_ref[j, 3]
 
         return image_output
 
@@ -332,18 +355,12 @@ class ProcessLabels(object):
         """
         # get center of mass of each vertebral level
         image_cubic2point = self.cubic_to_point()
-        # get list of coordinates for each label
-        list_coordinates = image_cubic2point.getNonZeroCoordinates(sorting='value')
         # if user did not specify levels, include all:
         if levels_user[0] == 0:
-            levels_user = [int(i.value) for i in list_coordinates]
-        # loop across labels and remove those that are not listed by the user
-        for i_label in range(len(list_coordinates)):
-            # check if this level is NOT in levels_user
-            if not levels_user.count(int(list_coordinates[i_label].value)):
-                # if not, set value to zero
-                image_cubic2point.data[int(list_coordinates[i_label].x), int(list_coordinates[i_label].y), int(list_coordinates[i_label].z)] = 0
-        # list all labels
+            return image_cubic2point
+        # remove labels that are not listed by the user
+        data = image_cubic2point.data
+        data[(data > 0) & ~np.isin(data.astype(int), levels_user)] = 0
         return image_cubic2point
 
     def MSE(self, threshold_mse=0):
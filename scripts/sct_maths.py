@@ -19,6 +19,7 @@ from msct_parser import Parser
 from spinalcordtoolbox.image import Image
 from sct_utils import printv, extract_fname
 import sct_utils as sct
+from spinalcordtoolbox import slicewise
 
 ALMOST_ZERO = 0.000000001
 
@@ -172,6 +173,14 @@ def get_parser():
                       description='Output type.',
                       mandatory=False,
                       example=['uint8', 'int16', 'int32', 'float32', 'complex64', 'float64', 'int8', 'uint16', 'uint32', 'int64', 'uint64'])
+    parser.add_option(name="-j",
+                      type_value="int",
+                      description="Number of processes used by -otsu_adap, -dilate, -erode and -denoise, which filter "
+                                  "slabs of slices in parallel (4D images are filtered volume by volume). 0: use all "
+                                  "available CPUs.",
+                      mandatory=False,
+                      default_value=1,
+                      example=['0', '4'])
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose. 0: nothing. 1: basic. 2: extended.""",
@@ -196,6 +205,7 @@ def main(args = None):
     fname_in = arguments["-i"]
     fname_out = arguments["-o"]
     verbose = int(arguments['-v'])
+    nb_jobs = int(arguments['-j'])
     if '-type' in arguments:
         output_type = arguments['-type']
     else:
@@ -213,7 +223,7 @@ def main(args = None):
 
     elif '-otsu_adap' in arguments:
         param = arguments['-otsu_adap']
-        data_out = otsu_adap(data, param[0], param[1])
+        data_out = otsu_adap(data, param[0], param[1], nb_jobs=nb_jobs)
 
     elif '-otsu_median' in arguments:
         param = arguments['-otsu_median']
@@ -296,10 +306,10 @@ def main(args = None):
         data_out = smooth(data, sigmas)
 
     elif '-dilate' in arguments:
-        data_out = dilate(data, arguments['-dilate'])
+        data_out = dilate(data, arguments['-dilate'], nb_jobs=nb_jobs)
 
     elif '-erode' in arguments:
-        data_out = erode(data, arguments['-erode'])
+        data_out = erode(data, arguments['-erode'], nb_jobs=nb_jobs)
 
     elif '-denoise' in arguments:
         # parse denoising arguments
@@ -310,7 +320,7 @@ def main(args = None):
                 p = int(i.split('=')[1])
             if 'b' in i:
                 b = int(i.split('=')[1])
-        data_out = denoise_nlmeans(data, patch_radius=p, block_radius=b)
+        data_out = denoise_nlmeans(data, patch_radius=p, block_radius=b, nb_jobs=nb_jobs)
 
     elif '-symmetrize' in arguments:
         data_out = (data + data[list(range(data.shape[0] - 1, -1, -1)), :, :]) / float(2)
@@ -382,13 +392,28 @@ def otsu(data, nbins):
     return data > thresh
 
 
-def otsu_adap(data, block_size, offset):
-    from skimage.filters import threshold_adaptive
+def otsu_adap(data, block_size, offset, nb_jobs=1):
+    """
+    Threshold each axial slice with a local threshold (Gaussian-weighted mean of a block_size neighbourhood minus
+    offset). Slices are processed in parallel by nb_jobs processes.
+    :return: mask, with the data type of data
+    """
+    return slicewise.apply_by_slabs(data, _otsu_adap_slab, (block_size, offset), nb_jobs=nb_jobs)
+
+
+def _otsu_adap_slab(data, block_size, offset):
+    try:
+        from skimage.filters import threshold_adaptive
+    except ImportError:
+        # removed from scikit-image 0.15
+        from skimage.filters import threshold_local
+
+        def threshold_adaptive(image, block_size, offset):
+            return image > threshold_local(image, block_size, offset=offset)
 
     mask = data
     for iz in range(data.shape[2]):
         mask[:, :, iz] = threshold_adaptive(data[:, :, iz], block_size, offset)
-        # mask[:, :, iz] = threshold_otsu(data[:, :, iz], 5)
     return mask
 
 
@@ -413,38 +438,51 @@ def binarise(data, bin_thr=0):
     return data > bin_thr
 
 
-def dilate(data, radius):
+def get_selem(radius):
+    """
+    Structuring element of dilate and erode
+    :param radius: radius of a ball OR dimensions of a box
+    """
+    from skimage.morphology import ball
+    if len(radius) == 1:
+        # define structured element as a ball
+        return ball(radius[0])
+    # define structured element as a box with input dimensions
+    return np.ones((radius[0], radius[1], radius[2]), dtype=np.uint8)
+
+
+def dilate(data, radius, nb_jobs=1):
     """
     Dilate data using ball structuring element
-    :param data: 2d or 3d array
+    :param data: 2d, 3d or 4d array (dilated volume by volume)
     :param radius: radius of structuring element OR comma-separated int.
+    :param nb_jobs: number of processes dilating slabs of slices
     :return: data dilated
     """
-    from skimage.morphology import dilation, ball
-    if len(radius) == 1:
-        # define structured element as a ball
-        selem = ball(radius[0])
-    else:
-        # define structured element as a box with input dimensions
-        selem = np.ones((radius[0], radius[1], radius[2]), dtype=np.dtype)
-    return dilation(data, selem=selem, out=None)
+    selem = get_selem(radius)
+    return slicewise.apply_by_slabs(data, _dilate_slab, (selem,), halo=selem.shape[-1] // 2, nb_jobs=nb_jobs)
+
 
+def _dilate_slab(data, selem):
+    from skimage.morphology import dilation
+    return dilation(data, selem)
 
-def erode(data, radius):
+
+def erode(data, radius, nb_jobs=1):
     """
     Erode data using ball structuring element
-    :param data: 2d or 3d array
+    :param data: 2d, 3d or 4d array (eroded volume by volume)
     :param radius: radius of structuring element
+    :param nb_jobs: number of processes eroding slabs of slices
     :return: data eroded
     """
-    from skimage.morphology import erosion, ball
-    if len(radius) == 1:
-        # define structured element as a ball
-        selem = ball(radius[0])
-    else:
-        # define structured element as a box with input dimensions
-        selem = np.ones((radius[0], radius[1], radius[2]), dtype=np.dtype)
-    return erosion(data, selem=selem, out=None)
+    selem = get_selem(radius)
+    return slicewise.apply_by_slabs(data, _erode_slab, (selem,), halo=selem.shape[-1] // 2, nb_jobs=nb_jobs)
+
+
+def _erode_slab(data, selem):
+    from skimage.morphology import erosion
+    return erosion(data, selem)
 
 
 def get_data(list_fname):
@@ -501,23 +539,29 @@ def concatenate_along_4th_dimension(data1, data2):
     return np.concatenate((data1, data2), axis=3)
 
 
-def denoise_nlmeans(data_in, patch_radius=1, block_radius=5):
+def denoise_nlmeans(data_in, patch_radius=1, block_radius=5, nb_jobs=1):
     """
-    data_in: nd_array to denoise
+    data_in: nd_array to denoise (4d arrays are denoised volume by volume)
+    nb_jobs: number of processes denoising slabs of slices. The noise level is estimated on the whole volume.
     for more info about patch_radius and block radius, please refer to the dipy website: http://nipy.org/dipy/reference/dipy.denoise.html#dipy.denoise.nlmeans.nlmeans
     """
-    from dipy.denoise.nlmeans import nlmeans
     from dipy.denoise.noise_estimate import estimate_sigma
     from numpy import asarray
     data_in = asarray(data_in)
 
-    block_radius_max = min(data_in.shape) - 1
+    block_radius_max = min(data_in.shape[:3]) - 1
     block_radius = block_radius_max if block_radius > block_radius_max else block_radius
 
     sigma = estimate_sigma(data_in)
-    denoised = nlmeans(data_in, sigma, patch_radius=patch_radius, block_radius=block_radius)
+    # a denoised voxel depends on the voxels within patch_radius + block_radius
+    return slicewise.apply_by_slabs(data_in, _denoise_slab, (patch_radius, block_radius),
+                                    args_volumes=[(s,) for s in np.atleast_1d(sigma)],
+                                    halo=patch_radius + block_radius, nb_jobs=nb_jobs)
+
 
-    return denoised
+def _denoise_slab(data, patch_radius, block_radius, sigma):
+    from dipy.denoise.nlmeans import nlmeans
+    return nlmeans(data, sigma, patch_radius=patch_radius, block_radius=block_radius)
 
 
 def smooth(data, sigmas):
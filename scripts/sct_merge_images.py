@@ -18,13 +18,14 @@ from __future__ import absolute_import
 # Python imports
 import sys
 import os
-import shutil
 import numpy as np
+import nibabel
 # SCT imports
 from msct_parser import Parser
 import sct_utils as sct
 import sct_apply_transfo
 import spinalcordtoolbox.image as msct_image
+import spinalcordtoolbox.warp
 import sct_maths
 
 
@@ -113,20 +114,47 @@ def merge_images(list_fname_src, fname_dest, list_fname_warp, param):
 
     """
 
-    # create temporary folder
-    path_tmp = sct.tmp_create()
-
     # get dimensions of destination file
     nii_dest = msct_image.Image(fname_dest)
 
-    # initialize variables
-    data = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2], len(list_fname_src)])
-    partial_volume = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2], len(list_fname_src)])
-    data_merge = np.zeros([nii_dest.dim[0], nii_dest.dim[1], nii_dest.dim[2]])
+    if param.interp in spinalcordtoolbox.warp.INTERP_ORDER and \
+     all([is_3d(fname_src) for fname_src in list_fname_src]) and \
+     all([spinalcordtoolbox.warp.can_read_transforms([fname_warp]) for fname_warp in list_fname_warp]):
+        # warp the images and their partial volume in-process, accumulating the weighted sum
+        sct.printv('\nMerge images...', int(param.verbose))
+        data_merge = spinalcordtoolbox.warp.merge_images(
+            list_fname_src, fname_dest, [[fname_warp] for fname_warp in list_fname_warp], interp=param.interp,
+            threshold=param.almost_zero, verbose=int(param.verbose))
+    else:
+        data_merge = merge_images_apply_transfo(list_fname_src, fname_dest, list_fname_warp, nii_dest.dim[:3], param)
+
+    # write result in file
+    nii_dest.data = data_merge
+    nii_dest.save(param.fname_out)
+
+
+def is_3d(fname):
+    return len(nibabel.load(fname).shape) == 3
+
+
+def merge_images_apply_transfo(list_fname_src, fname_dest, list_fname_warp, shape, param):
+    """
+    Same as merge_images, warping the images with sct_apply_transfo (e.g. for transformations that cannot be applied
+    in-process)
+    :return: merged data
+    """
+    # create temporary folder
+    path_tmp = sct.tmp_create()
+
+    # running sums of data * partial volume and of partial volume
+    sum_data = np.zeros(shape, dtype=np.float32)
+    sum_pv = np.zeros(shape, dtype=np.float32)
 
     # loop across files
-    i_file = 0
-    for fname_src in list_fname_src:
+    for i_file, fname_src in enumerate(list_fname_src):
+        fname_src_template = os.path.join(path_tmp, 'src_' + str(i_file) + '_template.nii.gz')
+        fname_src_bin = os.path.join(path_tmp, 'src_' + str(i_file) + 'native_bin.nii.gz')
+        fname_src_pv = os.path.join(path_tmp, 'src_' + str(i_file) + '_template_partialVolume.nii.gz')
 
         # apply transformation src --> dest
         sct_apply_transfo.main(args=[
@@ -134,40 +162,37 @@ def merge_images(list_fname_src, fname_dest, list_fname_warp, param):
             '-d', fname_dest,
             '-w', list_fname_warp[i_file],
             '-x', param.interp,
-            '-o', 'src_' + str(i_file) + '_template.nii.gz',
+            '-o', fname_src_template,
             '-v', param.verbose])
 
         # create binary mask from input file by assigning one to all non-null voxels
         sct_maths.main(args=[
             '-i', fname_src,
             '-bin', str(param.almost_zero),
-            '-o', 'src_' + str(i_file) + 'native_bin.nii.gz'])
+            '-o', fname_src_bin])
 
         # apply transformation to binary mask to compute partial volume
         sct_apply_transfo.main(args=[
-            '-i', 'src_' + str(i_file) + 'native_bin.nii.gz',
+            '-i', fname_src_bin,
             '-d', fname_dest,
             '-w', list_fname_warp[i_file],
             '-x', param.interp,
-            '-o', 'src_' + str(i_file) + '_template_partialVolume.nii.gz'])
-
-        # open data
-        data[:, :, :, i_file] = msct_image.Image('src_' + str(i_file) + '_template.nii.gz').data
-        partial_volume[:, :, :, i_file] = msct_image.Image('src_' + str(i_file) + '_template_partialVolume.nii.gz').data
-        i_file += 1
+            '-o', fname_src_pv])
 
-    # merge files using partial volume information (and convert nan resulting from division by zero to zeros)
-    data_merge = np.divide(np.sum(data * partial_volume, axis=3), np.sum(partial_volume, axis=3))
-    data_merge = np.nan_to_num(data_merge)
-
-    # write result in file
-    nii_dest.data = data_merge
-    nii_dest.save(param.fname_out)
+        # accumulate data weighted by partial volume
+        partial_volume = msct_image.Image(fname_src_pv).data.astype(np.float32)
+        sum_data += msct_image.Image(fname_src_template).data * partial_volume
+        sum_pv += partial_volume
 
     # remove temporary folder
     if param.rm_tmp:
         sct.rmtree(path_tmp)
 
+    # merge files using partial volume information (voxels without any image are set to zero)
+    np.divide(sum_data, sum_pv, out=sum_data, where=sum_pv != 0)
+    sum_data[sum_pv == 0] = 0
+    return sum_data
+
 
 # MAIN
 # ==========================================================================================
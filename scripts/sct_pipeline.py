@@ -53,7 +53,6 @@ path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 path_script = os.path.dirname(__file__)
 sys.path.append(os.path.join(path_sct, 'testing'))
 
-import concurrent.futures
 if "SCT_MPI_MODE" in os.environ:
     from mpi4py.futures import MPIPoolExecutor as PoolExecutor
     __MPI__ = True
@@ -70,6 +69,7 @@ import pandas as pd
 
 import sct_utils as sct
 import msct_parser
+import msct_pipeline_scheduler
 import sct_testing
 
 def _pickle_method(method):
@@ -312,9 +312,14 @@ def get_list_subj(folder_dataset, data_specifications=None, fname_database=''):
     return list_subj
 
 
-def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0):
+def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0, path_journal=None, max_retries=0, fname_profiles=None, memory=None):
     """
     Run a test function on the dataset using multiprocessing and save the results
+    :param path_journal: folder where the status and result of each job are saved as soon as it finishes. Jobs already
+    completed in this journal (e.g. by an interrupted run) are not run again.
+    :param max_retries: number of times a job that crashed is run again
+    :param fname_profiles: JSON file with the number of threads and memory (MB) needed by each function (see msct_pipeline_scheduler.ResourceProfiles)
+    :param memory: memory (MB) that jobs can use, RAM available at start if None
     :return: results
     # results are organized as the following: tuple of (status, output, DataFrame with results)
     """
@@ -322,36 +327,28 @@ def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None,
     # add full path to each subject
     list_subj_path = [os.path.join(folder_dataset, subject) for subject in list_subj]
 
-    # All scripts that are using multithreading with ITK must not use it when using multiprocessing
-    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = "1"
-
+    # Number of threads of ITK, BLAS and TensorFlow is set for each job according to the profile of the function, and
+    # jobs are only started when enough CPUs and RAM are available (see msct_pipeline_scheduler.run_jobs)
     # create list that finds all the combinations for function + subject path + arguments. Example of one list element:
     # ('sct_propseg', os.path.join(path_sct, 'data', 'sct_test_function', '200_005_s2''), '-i ' + os.path.join("t2", "t2.nii.gz") + ' -c t2', 1)
     list_func_subj_args = list(itertools.product(*[[function], list_subj_path, list_args, [test_integrity]]))
         # data_and_params = itertools.izip(itertools.repeat(function), data_subjects, itertools.repeat(parameters))
 
+    journal = None
+    if path_journal is not None:
+        journal = msct_pipeline_scheduler.Journal(path_journal)
+        sct.log.info('Journal: ' + path_journal)
+    profiles = msct_pipeline_scheduler.ResourceProfiles(fname_profiles=fname_profiles, journal=journal)
+    sct.log.info('Resources per job for {}: {}'.format(function, profiles.get(function)))
+
     sct.log.debug("stating pool with {} thread(s)".format(nb_cpu))
     pool = PoolExecutor(nb_cpu)
     compute_time = None
+    results_dataframe = None
     try:
         compute_time = time.time()
-        count = 0
-        all_results = []
-
-        # sct.log.info('Waiting for results, be patient')
-        future_dirs = {pool.submit(function_launcher, subject_arg): subject_arg
-                         for subject_arg in list_func_subj_args}
-
-        for future in concurrent.futures.as_completed(future_dirs):
-            count += 1
-            subject = os.path.basename(future_dirs[future][1])
-            arguments = future_dirs[future][2]
-            try:
-                result = future.result()
-                sct.no_new_line_log('Processing subjects... {}/{}'.format(count, len(list_func_subj_args)))
-                all_results.append(result)
-            except Exception as exc:
-                sct.log.error('{} {} generated an exception: {}'.format(subject, arguments, exc))
+
+        all_results = msct_pipeline_scheduler.run_jobs(pool, function_launcher, list_func_subj_args, journal=journal, max_retries=max_retries, profiles=profiles, nb_cpu=nb_cpu, memory=memory, verbose=verbose)
 
         compute_time = time.time() - compute_time
 
@@ -360,13 +357,11 @@ def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None,
 
     except KeyboardInterrupt:
         sct.log.warning("\nCaught KeyboardInterrupt, terminating workers")
-        for job in future_dirs:
-            job.cancel()
+        if journal is not None:
+            sct.log.warning("Completed jobs are saved in {}, use -journal {} to resume".format(path_journal, path_journal))
     except Exception as e:
         sct.log.error('Error on line {}'.format(sys.exc_info()[-1].tb_lineno))
         sct.log.exception(e)
-        for job in future_dirs:
-            job.cancel()
         raise
     finally:
         pool.shutdown()
@@ -430,6 +425,33 @@ def get_parser():
                       example=['0', '1'],
                       default_value='0')  # TODO: this should have values True/False as defined in sct_testing, not 0/1
 
+    parser.add_option(name="-journal",
+                      type_value="folder_creation",
+                      description="Folder where the status and result of each subject are saved as soon as they are"
+                                  " processed. To resume an interrupted run, use the same folder: subjects already"
+                                  " processed are skipped. By default, a new folder is created for each run.",
+                      mandatory=False,
+                      example="journal_sct_propseg/")
+
+    parser.add_option(name="-max-retries",
+                      type_value="int",
+                      description="Number of times a subject for which the function crashed is processed again.",
+                      mandatory=False,
+                      default_value=0)
+
+    parser.add_option(name="-profiles",
+                      type_value="file",
+                      description="JSON file with the number of threads and the memory (MB) needed by functions, e.g.:"
+                                  " {\"sct_register_to_template\": {\"threads\": 4, \"memory\": 4000}}."
+                                  " By default, built-in estimates are used, replaced by the peak memory observed in the journal.",
+                      mandatory=False)
+
+    parser.add_option(name="-mem",
+                      type_value="int",
+                      description="Memory (MB) that can be used by all jobs running at the same time. By default, the"
+                                  " RAM available at start is used.",
+                      mandatory=False)
+
     parser.usage.addSection("\nOUTPUT")
 
     parser.add_option(name="-log",
@@ -501,6 +523,9 @@ if __name__ == "__main__":
     else:
         jobs = cpu_count()  # uses maximum number of available CPUs
     test_integrity = int(arguments['-test-integrity'])
+    max_retries = int(arguments['-max-retries'])
+    fname_profiles = arguments['-profiles'] if '-profiles' in arguments else None
+    memory = arguments['-mem'] if '-mem' in arguments else None
     create_log = int(arguments['-log'])
     output_pickle = int(arguments['-pickle'])
 
@@ -532,9 +557,9 @@ if __name__ == "__main__":
     output_time = time.strftime("%y%m%d%H%M%S")
 
     # build log file name
+    file_log = "_".join([output_time, function_to_test, sct.__get_branch().replace("/", "~")]).replace("sct_", "")
     if create_log:
         # global log:
-        file_log = "_".join([output_time, function_to_test, sct.__get_branch().replace("/", "~")]).replace("sct_", "")
         fname_log = file_log + '.log'
         # handle_log = sct.ForkStdoutToFile(fname_log)
         file_handler = sct.add_file_handler_to_logger(fname_log)
@@ -567,6 +592,8 @@ if __name__ == "__main__":
 
     # check RAM
     sct.checkRAM(os_running, 0)
+    ram_available = sct.get_available_ram()
+    sct.log.info('Available RAM: ' + ('unknown' if ram_available is None else '{:.0f} MB'.format(ram_available)))
 
     # display command
     sct.log.info('\nCommand(s):')
@@ -585,7 +612,8 @@ if __name__ == "__main__":
             sct.remove_handler(file_handler)
         # run function
         sct.log.debug("enter test fct")
-        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1, test_integrity=test_integrity)
+        path_journal = arguments['-journal'] if '-journal' in arguments else file_log + '_journal'
+        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1, test_integrity=test_integrity, path_journal=os.path.abspath(path_journal), max_retries=max_retries, fname_profiles=fname_profiles, memory=memory)
         sct.log.debug("exit test fct")
         results = tests_ret['results']
         compute_time = tests_ret['compute_time']
@@ -21,7 +21,6 @@ import sys, io, os, shutil, time, math, pickle
 
 import numpy as np
 import scipy
-import pandas as pd
 
 import sct_utils as sct
 from sct_straighten_spinalcord import smooth_centerline
@@ -31,6 +30,10 @@ from msct_parser import Parser
 import msct_shape
 from msct_types import Centerline
 from spinalcordtoolbox.centerline import optic
+from spinalcordtoolbox.template import get_vertebral_level_index
+from spinalcordtoolbox.utils import lazy_import
+
+pd = lazy_import('pandas')
 
 
 class Param:
@@ -388,7 +391,7 @@ def compute_length(fname_segmentation, remove_temp_files, output_folder, overwri
 
             # get the slices corresponding to the vertebral levels
             # slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels(data_seg, vert_levels, im_vertebral_labeling.data, 1)
-            slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels_based_centerline(vert_levels, im_vertebral_labeling.data, z_centerline)
+            slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels_based_centerline(vert_levels, im_vertebral_labeling, z_centerline)
 
         elif not vert_levels:
             vert_levels_list = []
@@ -792,7 +795,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
 
             # get the slices corresponding to the vertebral levels
             # slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels(data_seg, vert_levels, im_vertebral_labeling.data, 1)
-            slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels_based_centerline(vert_levels, im_vertebral_labeling.data, z_centerline_voxel)
+            slices, vert_levels_list, warning = get_slices_matching_with_vertebral_levels_based_centerline(vert_levels, im_vertebral_labeling, z_centerline_voxel)
 
         elif not vert_levels:
             vert_levels_list = []
@@ -1014,7 +1017,7 @@ def save_results(fname_output, overwrite, fname_data, metric_name, method, mean,
 # ======================================================================================================================
 # Find min and max slices corresponding to vertebral levels based on the fitted centerline coordinates
 # ======================================================================================================================
-def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels, vertebral_labeling_data, z_centerline):
+def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels, im_vertebral_labeling, z_centerline):
 
     # Convert the selected vertebral levels chosen into a 2-element list [start_level end_level]
     vert_levels_list = [int(x) for x in vertebral_levels.split(':')]
@@ -1028,7 +1031,8 @@ def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels,
         sct.printv('\nERROR:  "' + vertebral_levels + '" is not correct. Enter format "1:4". Exit program.\n', type='error')
 
     # Extract the vertebral levels available in the metric image
-    vertebral_levels_available = np.array(list(set(vertebral_labeling_data[vertebral_labeling_data > 0])), dtype=np.int32)
+    vertlevel_index = get_vertebral_level_index(im_vertebral_labeling)
+    vertebral_levels_available = vertlevel_index.get_available_levels().astype(np.int32)
 
     # Check if the vertebral levels selected are available
     warning = []  # list of strings gathering the potential following warning(s) to be written in the output .txt file
@@ -1087,15 +1091,11 @@ def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels,
     # Find slices included in the vertebral levels wanted by the user
     # if the median vertebral level of this slice is in the vertebral levels asked by the user, record the slice number
     sct.printv('\tFind slices corresponding to vertebral levels based on the centerline...')
-    matching_slices_centerline_vert_labeling = []
-
-    z_centerline = [x for x in z_centerline if 0 < int(x) < vertebral_labeling_data.shape[2]]
-    vert_range = list(range(vert_levels_list[0], vert_levels_list[1] + 1))
-
-    for idx, z_slice in enumerate(vertebral_labeling_data.T[z_centerline, :, :]):
-        slice_idxs = np.nonzero(z_slice)
-        if np.asarray(slice_idxs).shape != (2, 0) and int(np.median(z_slice[slice_idxs])) in vert_range:
-            matching_slices_centerline_vert_labeling.append(idx)
+    z_centerline = np.array([int(x) for x in z_centerline if 0 < int(x) < im_vertebral_labeling.data.shape[2]], dtype=int)
+    median_levels = vertlevel_index.get_median_levels()[z_centerline]
+    matching_slices_centerline_vert_labeling = np.flatnonzero(
+        vertlevel_index.is_labeled[z_centerline] & (median_levels >= int(vert_levels_list[0])) &
+        (median_levels <= int(vert_levels_list[1])))
 
     # now, find the min and max slices that are included in the vertebral levels
     if len(matching_slices_centerline_vert_labeling) == 0:
@@ -18,14 +18,15 @@ from __future__ import division, absolute_import
 import os, sys
 
 import numpy as np
-from scipy import ndimage as ndi
 
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
-import sct_image
 import sct_utils as sct
 from msct_parser import Parser
 from spinalcordtoolbox.centerline import optic
+from spinalcordtoolbox.utils import lazy_import
+
+ndi = lazy_import('scipy.ndimage')
 
 
 def check_and_correct_segmentation(fname_segmentation, fname_centerline, folder_output='', threshold_distance=5.0,
@@ -33,7 +34,7 @@ def check_and_correct_segmentation(fname_segmentation, fname_centerline, folder_
     """
     This function takes the outputs of isct_propseg (centerline and segmentation) and check if the centerline of the
     segmentation is coherent with the centerline provided by the isct_propseg, especially on the edges (related
-    to issue #1074).
+    to issue #1074). Images are reoriented in memory and the segmentation is overwritten with the corrected one.
     Args:
         fname_segmentation: filename of binary segmentation
         fname_centerline: filename of binary centerline
@@ -43,104 +44,100 @@ def check_and_correct_segmentation(fname_segmentation, fname_centerline, folder_
     Returns: None
     """
     sct.printv('\nCheck consistency of segmentation...', verbose)
-    # creating a temporary folder in which all temporary files will be placed and deleted afterwards
-    path_tmp = sct.tmp_create(basename="propseg", verbose=verbose)
-    from sct_convert import convert
-    convert(fname_segmentation, os.path.join(path_tmp, "tmp.segmentation.nii.gz"), verbose=0)
-    convert(fname_centerline, os.path.join(path_tmp, "tmp.centerline.nii.gz"), verbose=0)
     fname_seg_absolute = os.path.abspath(fname_segmentation)
 
-    # go to tmp folder
-    curdir = os.getcwd()
-    os.chdir(path_tmp)
-
-    # convert segmentation image to RPI
-    im_input = Image('tmp.segmentation.nii.gz')
-    image_input_orientation = im_input.orientation
-
-    sct_image.main("-i tmp.segmentation.nii.gz -setorient RPI -o tmp.segmentation_RPI.nii.gz -v 0".split())
-    sct_image.main("-i tmp.centerline.nii.gz -setorient RPI -o tmp.centerline_RPI.nii.gz -v 0".split())
-
-    # go through segmentation image, and compare with centerline from propseg
-    im_seg = Image('tmp.segmentation_RPI.nii.gz')
-    im_centerline = Image('tmp.centerline_RPI.nii.gz')
+    # convert segmentation and centerline to RPI
+    im_seg = Image(fname_segmentation)
+    image_input_orientation = im_seg.orientation
+    im_seg.change_orientation('RPI')
+    im_centerline = Image(fname_centerline).change_orientation('RPI')
 
     # Get size of data
     sct.printv('\nGet data dimensions...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
 
+    slices_to_remove = get_slices_to_remove(im_seg.data, im_centerline.data, (px, py, pz), threshold_distance)
+    sct.printv('  Slices removed from the segmentation: ' + str(np.count_nonzero(slices_to_remove)) + '/' + str(nz),
+               verbose)
+
+    # remove the slices, back to the input orientation and replace old segmentation with the corrected one
+    data_seg = np.array(im_seg.data)
+    data_seg[:, :, slices_to_remove] = 0
+    im_seg.data = data_seg
+    im_seg.change_orientation(image_input_orientation)
+    im_seg.save(fname_seg_absolute, verbose=0)
+
+
+def get_slices_to_remove(data_seg, data_centerline, pixdim, threshold_distance=5.0):
+    """
+    Find the slices of the segmentation that are not coherent with the centerline. The centerline is defined as the
+    center of the tubular mesh outputed by propseg.
+    A slice is not coherent if it contains more than one object, or if the center of mass of its single object is
+    further than threshold_distance from the nearest slice of the centerline. Then, starting from the middle of the
+    centerline (in both directions), the first incoherent slice and all following slices are removed, so that the
+    segmentation remains continuous.
+    Args:
+        data_seg: segmentation array (x, y, z), in RPI
+        data_centerline: centerline array (x, y, z), in RPI
+        pixdim: (px, py, pz) voxel size in mm
+        threshold_distance: threshold, in mm
+
+    Returns: boolean array (z), True for slices to remove
+    """
+    nx, ny, nz = data_seg.shape[:3]
+    px, py, pz = pixdim
+
+    def center_of_mass_per_slice(data):
+        """Intensity-weighted center of mass of each axial slice; nan for empty slices"""
+        data = np.asarray(data, dtype=np.float64)
+        total = data.sum(axis=(0, 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.einsum('xyz,x->z', data, np.arange(nx, dtype=np.float64)) / total
+            y = np.einsum('xyz,y->z', data, np.arange(ny, dtype=np.float64)) / total
+        return x, y
+
     # extraction of centerline provided by isct_propseg and computation of center of mass for each slice
-    # the centerline is defined as the center of the tubular mesh outputed by propseg.
-    centerline, key_centerline = {}, []
-    for i in range(nz):
-        slice = im_centerline.data[:, :, i]
-        if np.any(slice):
-            x_centerline, y_centerline = ndi.measurements.center_of_mass(slice)
-            centerline[str(i)] = [x_centerline, y_centerline]
-            key_centerline.append(i)
-
-    minz_centerline = np.min(key_centerline)
-    maxz_centerline = np.max(key_centerline)
+    key_centerline = np.flatnonzero(np.any(data_centerline, axis=(0, 1)))
+    x_centerline, y_centerline = center_of_mass_per_slice(data_centerline)
+    minz_centerline = key_centerline.min()
+    maxz_centerline = key_centerline.max()
     mid_slice = int((maxz_centerline - minz_centerline) / 2)
 
-    # for each slice of the segmentation, check if only one object is present. If not, remove the slice from segmentation.
-    # If only one object (the spinal cord) is present in the slice, check if its center of mass is close to the centerline of isct_propseg.
-    slices_to_remove = [False] * nz  # flag that decides if the slice must be removed
-    for i in range(minz_centerline, maxz_centerline + 1):
-        # extraction of slice
-        slice = im_seg.data[:, :, i]
-        distance = -1
-        label_objects, nb_labels = ndi.label(slice)  # count binary objects in the slice
-        if nb_labels > 1:  # if there is more that one object in the slice, the slice is removed from the segmentation
-            slices_to_remove[i] = True
-        elif nb_labels == 1:  # check if the centerline is coherent with the one from isct_propseg
-            x_centerline, y_centerline = ndi.measurements.center_of_mass(slice)
-            slice_nearest_coord = min(key_centerline, key=lambda x: abs(x - i))
-            coord_nearest_coord = centerline[str(slice_nearest_coord)]
-            distance = np.sqrt(((x_centerline - coord_nearest_coord[0]) * px) ** 2 +
-                               ((y_centerline - coord_nearest_coord[1]) * py) ** 2 +
-                               ((i - slice_nearest_coord) * pz) ** 2)
-
-            if distance >= threshold_distance:  # threshold must be adjusted, default is 5 mm
-                slices_to_remove[i] = True
-
-    # Check list of removal and keep one continuous centerline (improve this comment)
-    # Method:
-    # starting from mid-centerline (in both directions), the first True encountered is applied to all following slices
-    slice_to_change = False
-    for i in range(mid_slice, nz):
-        if slice_to_change:
-            slices_to_remove[i] = True
-        elif slices_to_remove[i]:
-            slice_to_change = True
-
-    slice_to_change = False
-    for i in range(mid_slice, 0, -1):
-        if slice_to_change:
-            slices_to_remove[i] = True
-        elif slices_to_remove[i]:
-            slice_to_change = True
-
-    for i in range(0, nz):
-        # remove the slice
-        if slices_to_remove[i]:
-            im_seg.data[:, :, i] *= 0
-
-    # saving the image
-    im_seg.save('tmp.segmentation_RPI_c.nii.gz')
-
-    # replacing old segmentation with the corrected one
-    sct_image.main('-i tmp.segmentation_RPI_c.nii.gz -setorient {} -o {} -v 0'.
-                   format(image_input_orientation, fname_seg_absolute).split())
-
-    os.chdir(curdir)
-
-    # display information about how much of the segmentation has been corrected
-
-    # remove temporary files
-    if remove_temp_files:
-        # sct.printv("\nRemove temporary files...", verbose)
-        sct.rmtree(path_tmp)
+    # count binary objects in each slice, with a single 3-D labelling that does not connect objects across slices
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[:, :, 1] = ndi.generate_binary_structure(2, 1)
+    label_objects, nb_labels = ndi.label(data_seg, structure=structure)
+    z_objects = [obj[2].start for obj in ndi.find_objects(label_objects) if obj is not None]
+    nb_objects = np.bincount(np.asarray(z_objects, dtype=int), minlength=nz)
+
+    # nearest centerline slice of each slice (the lowest one in case of tie)
+    z = np.arange(nz)
+    ind_above = np.clip(np.searchsorted(key_centerline, z), 0, len(key_centerline) - 1)
+    ind_below = np.clip(ind_above - 1, 0, len(key_centerline) - 1)
+    use_below = np.abs(key_centerline[ind_below] - z) <= np.abs(key_centerline[ind_above] - z)
+    z_nearest = np.where(use_below, key_centerline[ind_below], key_centerline[ind_above])
+
+    # distance between the center of mass of the segmentation and the nearest centerline point
+    x_seg, y_seg = center_of_mass_per_slice(data_seg)
+    distance = np.sqrt(((x_seg - x_centerline[z_nearest]) * px) ** 2 +
+                       ((y_seg - y_centerline[z_nearest]) * py) ** 2 +
+                       ((z - z_nearest) * pz) ** 2)
+
+    # if there is more that one object in the slice, the slice is removed from the segmentation. If there is only one
+    # object, check if the centerline is coherent with the one from isct_propseg (threshold default is 5 mm).
+    in_centerline = (z >= minz_centerline) & (z <= maxz_centerline)
+    with np.errstate(invalid='ignore'):
+        slices_to_remove = in_centerline & ((nb_objects > 1) | ((nb_objects == 1) & (distance >= threshold_distance)))
+
+    # Check list of removal and keep one continuous centerline: starting from mid-centerline (in both directions),
+    # the first True encountered is applied to all following slices
+    if np.any(slices_to_remove[mid_slice:]):
+        slices_to_remove[mid_slice + np.argmax(slices_to_remove[mid_slice:]):] = True
+    if np.any(slices_to_remove[1:mid_slice + 1]):
+        slice_first = mid_slice - np.argmax(slices_to_remove[mid_slice:0:-1])
+        slices_to_remove[1:slice_first] = True
+
+    return slices_to_remove
 
 
 def get_parser():
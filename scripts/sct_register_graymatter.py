@@ -16,11 +16,14 @@ from __future__ import division, absolute_import
 
 import sys, io, os, shutil
 
+import numpy as np
+
 path_sct = os.environ.get("SCT_DIR", os.path.dirname(os.path.dirname(__file__)))
 
 from msct_parser import Parser
 from spinalcordtoolbox.image import Image
 from sct_convert import convert
+from sct_dice_coefficient import dice_report
 import sct_utils as sct
 
 
@@ -287,7 +290,7 @@ class MultiLabelRegistration:
         # Compute Dice coefficient
         # --- DC old template
         try:
-            status_old_gm, output_old_gm = sct.run(['sct_dice_coefficient', '-i', file_manual_gmseg + ext_manual_gmseg, '-d', fname_old_template_gm, '-2d-slices', '2'])
+            dc_old_gm = dice_slices(file_manual_gmseg + ext_manual_gmseg, fname_old_template_gm)
         except Exception:
             # put the result and the reference in the same space using a registration with ANTs with no iteration:
             corrected_manual_gmseg = file_manual_gmseg + '_in_old_template_space' + ext_manual_gmseg
@@ -295,10 +298,10 @@ class MultiLabelRegistration:
             sct.run('isct_antsRegistration -d 3 -t Translation[0] -m MI[' + fname_old_template_gm + ',' + file_manual_gmseg + ext_manual_gmseg + ',1,16] -o [reg_ref_to_res,' + corrected_manual_gmseg + '] -n BSpline[3] -c 0 -f 1 -s 0')
             # sct.run('sct_maths -i '+corrected_manual_gmseg+' -thr 0.1 -o '+corrected_manual_gmseg)
             sct.run(['sct_maths', '-i', corrected_manual_gmseg, '-bin', '0.1', '-o', corrected_manual_gmseg])
-            status_old_gm, output_old_gm = sct.run(['sct_dice_coefficient', '-i', corrected_manual_gmseg, '-d', fname_old_template_gm, '-2d-slices', '2'])
+            dc_old_gm = dice_slices(corrected_manual_gmseg, fname_old_template_gm)
 
         try:
-            status_old_wm, output_old_wm = sct.run(['sct_dice_coefficient', '-i', fname_manual_wmseg, '-d', fname_old_template_wm, '-2d-slices', '2'])
+            dc_old_wm = dice_slices(fname_manual_wmseg, fname_old_template_wm)
         except Exception:
             # put the result and the reference in the same space using a registration with ANTs with no iteration:
             path_manual_wmseg, file_manual_wmseg, ext_manual_wmseg = sct.extract_fname(fname_manual_wmseg)
@@ -307,11 +310,11 @@ class MultiLabelRegistration:
             sct.run('isct_antsRegistration -d 3 -t Translation[0] -m MI[' + fname_old_template_wm + ',' + fname_manual_wmseg + ',1,16] -o [reg_ref_to_res,' + corrected_manual_wmseg + '] -n BSpline[3] -c 0 -f 1 -s 0')
             # sct.run('sct_maths -i '+corrected_manual_wmseg+' -thr 0.1 -o '+corrected_manual_wmseg)
             sct.run('sct_maths -i ' + corrected_manual_wmseg + ' -bin 0.1 -o ' + corrected_manual_wmseg)
-            status_old_wm, output_old_wm = sct.run(['sct_dice_coefficient', '-i', corrected_manual_wmseg, '-d', fname_old_template_wm, '-2d-slices', '2'])
+            dc_old_wm = dice_slices(corrected_manual_wmseg, fname_old_template_wm)
 
         # --- DC new template
         try:
-            status_new_gm, output_new_gm = sct.run(['sct_dice_coefficient', '-i', file_manual_gmseg + ext_manual_gmseg, '-d', fname_new_template_gm, '-2d-slices', '2'])
+            dc_new_gm = dice_slices(file_manual_gmseg + ext_manual_gmseg, fname_new_template_gm)
         except Exception:
             # put the result and the reference in the same space using a registration with ANTs with no iteration:
             corrected_manual_gmseg = file_manual_gmseg + '_in_new_template_space' + ext_manual_gmseg
@@ -319,10 +322,10 @@ class MultiLabelRegistration:
             sct.run('isct_antsRegistration -d 3 -t Translation[0] -m MI[' + fname_new_template_gm + ',' + file_manual_gmseg + ext_manual_gmseg + ',1,16] -o [reg_ref_to_res,' + corrected_manual_gmseg + '] -n BSpline[3] -c 0 -f 1 -s 0')
             # sct.run('sct_maths -i '+corrected_manual_gmseg+' -thr 0.1 -o '+corrected_manual_gmseg)
             sct.run(['sct_maths', '-i', corrected_manual_gmseg, '-bin', '0.1', '-o', corrected_manual_gmseg])
-            status_new_gm, output_new_gm = sct.run(['sct_dice_coefficient', '-i', corrected_manual_gmseg, '-d', fname_new_template_gm, '-2d-slices', '2'])
+            dc_new_gm = dice_slices(corrected_manual_gmseg, fname_new_template_gm)
 
         try:
-            status_new_wm, output_new_wm = sct.run(['sct_dice_coefficient', '-i', fname_manual_wmseg, '-d', fname_new_template_wm, '-2d-slices', '2'])
+            dc_new_wm = dice_slices(fname_manual_wmseg, fname_new_template_wm)
         except Exception:
             # put the result and the reference in the same space using a registration with ANTs with no iteration:
             path_manual_wmseg, file_manual_wmseg, ext_manual_wmseg = sct.extract_fname(fname_manual_wmseg)
@@ -330,7 +333,7 @@ class MultiLabelRegistration:
             sct.run('isct_antsRegistration -d 3 -t Translation[0] -m MI[' + fname_new_template_wm + ',' + fname_manual_wmseg + ',1,16] -o [reg_ref_to_res,' + corrected_manual_wmseg + '] -n BSpline[3] -c 0 -f 1 -s 0')
             # sct.run('sct_maths -i '+corrected_manual_wmseg+' -thr 0.1 -o '+corrected_manual_wmseg)
             sct.run(['sct_maths', '-i', corrected_manual_wmseg, '-bin', '0.1', '-o', corrected_manual_wmseg])
-            status_new_wm, output_new_wm = sct.run(['sct_dice_coefficient', '-i', corrected_manual_wmseg, '-d', fname_new_template_wm, '-2d-slices', '2'])
+            dc_new_wm = dice_slices(corrected_manual_wmseg, fname_new_template_wm)
 
         dice_name = 'dice_multilabel_reg.txt'
         dice_fic = open(dice_name, 'w')
@@ -338,23 +341,9 @@ class MultiLabelRegistration:
                      'Diff = metric_corrected_reg - metric_regular_reg\n')
         dice_fic.write('#Slice, WM DC, WM diff, GM DC, GM diff\n')
 
-        init_dc = '2D Dice coefficient by slice:\n'
-
-        old_gm_dc = output_old_gm[output_old_gm.find(init_dc) + len(init_dc):].split('\n')
-        old_wm_dc = output_old_wm[output_old_wm.find(init_dc) + len(init_dc):].split('\n')
-        new_gm_dc = output_new_gm[output_new_gm.find(init_dc) + len(init_dc):].split('\n')
-        new_wm_dc = output_new_wm[output_new_wm.find(init_dc) + len(init_dc):].split('\n')
-
-        for i in range(len(old_gm_dc)):
+        for i in range(len(dc_old_gm)):
             if i not in no_ref_slices:
-                i_new_gm, val_new_gm = new_gm_dc[i].split(' ')
-                i_new_wm, val_new_wm = new_wm_dc[i].split(' ')
-                i_old_gm, val_old_gm = old_gm_dc[i].split(' ')
-                i_old_wm, val_old_wm = old_wm_dc[i].split(' ')
-
-                assert i == int(i_new_gm) == int(i_new_wm) == int(i_old_gm) == int(i_old_wm), 'ERROR: when comparing Dice coefficients, slice numbers differs.'
-
-                dice_fic.write(str(i) + ', ' + val_new_wm + ', ' + str(float(val_new_wm) - float(val_old_wm)) + ', ' + val_new_gm + ', ' + str(float(val_new_gm) - float(val_old_gm)) + '\n')
+                dice_fic.write(str(i) + ', ' + str(dc_new_wm[i]) + ', ' + str(dc_new_wm[i] - dc_old_wm[i]) + ', ' + str(dc_new_gm[i]) + ', ' + str(dc_new_gm[i] - dc_old_gm[i]) + '\n')
             else:
                 dice_fic.write(str(i) + ', NO MANUAL SEGMENTATION\n')
         dice_fic.close()
@@ -367,6 +356,17 @@ class MultiLabelRegistration:
             sct.rmtree(tmp_dir)
 
 
+def dice_slices(fname_ref, fname_seg):
+    """
+    Dice coefficient of each axial slice (third dimension) of two segmentations
+    :return: array of Dice coefficients. Raises ValueError if the images do not have the same size.
+    """
+    data_ref, data_seg = Image(fname_ref).data, Image(fname_seg).data
+    if data_ref.shape != data_seg.shape:
+        raise ValueError('Images do not have the same size: ' + fname_ref + ', ' + fname_seg)
+    return dice_report(np.trunc(data_ref), np.trunc(data_seg), dim_slices=2)[1]
+
+
 def thr_im(im, low_thr, high_thr):
     im.data[im.data > high_thr] = 1
     im.data[im.data <= low_thr] = 0
@@ -14,11 +14,15 @@
 '''
 INFORMATION:
 The model used in this function is compound of:
-  - a dictionary: a list of slices of WM/GM contrasted images with their manual segmentations [slices.pklz]
-  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [fitted_model.pklz]
-  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.pklz]
-  - the averaged median intensity in the white and gray matter in the model [intensities.pklz]
+  - a dictionary: slices of WM/GM contrasted images with their manual segmentations, stored as stacked arrays [im.npy, im_M.npy, gm_seg*.npy, wm_seg*.npy, level.npy]
+  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn), stored as plain arrays [space_*.npy]
+  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.npy]
+  - the averaged median intensity in the white and gray matter in the model [intensities_*.npy]
+  - a manifest describing the format and content of the model [model.json]
   - an information file indicating which parameters were used to construct this model, and te date of computation [info.txt]
+The arrays are memory-mapped when the model is loaded. Models saved by previous versions (.pklz files) are converted
+on first use, in the folder store/ of the model (or in the user cache if the model folder is read-only), and can also
+be converted with: msct_multiatlas_seg -convert-model path_old_gm_model/ -o path_new_gm_model/
 
 A constructed model is provided in the toolbox here: $PATH_SCT/data/gm_model.
 It's made from T2* images of 80 subjects and computed with the parameters that gives the best gray matter segmentation results.
@@ -50,8 +54,6 @@ import copy
 
 import numpy as np
 
-import matplotlib
-
 import sct_maths
 import sct_process_segmentation
 import sct_register_multimodal
@@ -18,7 +18,6 @@ import sys, io, os, shutil, time, bisect
 
 import numpy as np
 from nibabel import Nifti1Image, save
-from scipy import ndimage
 import tqdm
 
 import spinalcordtoolbox.image as msct_image
@@ -28,6 +27,9 @@ from msct_types import Centerline
 from sct_apply_transfo import Transform
 import sct_utils as sct
 from msct_smooth import smoothing_window, evaluate_derivative_3D, b_spline_nurbs
+from spinalcordtoolbox.utils import lazy_import
+
+ndimage = lazy_import('scipy.ndimage')
 
 
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0, nurbs_pts_number=1000, all_slices=True, phys_coordinates=False, remove_outliers=False):
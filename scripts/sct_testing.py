@@ -12,7 +12,7 @@
 
 from __future__ import print_function, absolute_import
 
-import sys, io, os, time, random, copy, shlex, importlib, multiprocessing, tempfile, shutil
+import sys, io, os, time, random, copy, shlex, importlib, multiprocessing, tempfile
 import signal, stat
 
 
@@ -22,6 +22,7 @@ from pandas import DataFrame
 
 from msct_parser import Parser
 import sct_utils as sct
+import msct_test_database
 
 # get path of SCT
 path_script = os.path.dirname(__file__)
@@ -30,24 +31,17 @@ sys.path.append(os.path.join(path_sct, 'testing'))
 
 
 def fs_signature(root):
-    ret = dict()
+    """
+    Signature of the files under root (except files at the root, temporary folder and QC folder)
+    :return: dict: relative path -> (size, modification time)
+    """
     root = os.path.abspath(root)
-    for cwd, dirs, files in os.walk(root):
-        if cwd == os.path.abspath(tempfile.gettempdir()):
-            continue
-        if cwd == os.path.join(root, "testing-qc"):
-            files[:] = []
-            dirs[:] = []
-            continue
-        dirs.sort()
-        files.sort()
-        for file in files:
-            if cwd == root:
-                continue
-            path = os.path.relpath(os.path.join(cwd, file), root)
-            data = os.stat(path)
-            ret[path] = data
-    return ret
+    exclude = ["testing-qc"]
+    path_tmp = os.path.abspath(tempfile.gettempdir())
+    if path_tmp.startswith(root + os.sep):
+        exclude.append(os.path.relpath(path_tmp, root))
+    signature = msct_test_database.tree_signature(root, exclude=exclude)
+    return dict([(path, data) for path, data in signature.items() if os.sep in path])
 
 def fs_ok(sig_a, sig_b, exclude=()):
     errors = list()
@@ -80,6 +74,7 @@ class Param:
         self.results = ''  # results in Panda DataFrame
         self.redirect_stdout = True  # for debugging, set to 0. Otherwise set to 1.
         self.fname_log = None
+        self.fname_database = os.path.join(path_sct, 'testing', 'sct_testing_db.json')  # results of previous runs
 
 
 # define nice colors
@@ -154,13 +149,24 @@ def get_parser():
     parser.add_argument("--execution-folder",
      help="Folder where to run tests from (default. temporary)",
     )
+    parser.add_argument("--force", "-F",
+     help="Run all tests, including those that passed with the same code and testing data.",
+     action="store_true",
+    )
+    parser.add_argument("--database",
+     help="Database of test results, used to skip unchanged tests and run the longest tests first (default: {})".format(param_default.fname_database),
+     default=param_default.fname_database,
+    )
 
     return parser
 
 
 def process_function(fname, param):
     """
+    Run all the tests of a function
+    :return: list of outputs, list of statuses (one per set of arguments), duration (s)
     """
+    time_start = time.time()
     param.function_to_test = fname
     # display script name
     # load modules of function to test
@@ -191,7 +197,7 @@ def process_function(fname, param):
             list_status_function.append(param_test.status)
             list_output.append(param_test.output)
 
-    return list_output, list_status_function
+    return list_output, list_status_function, time.time() - time_start
 
 def process_function_multiproc(fname, param):
     """ Wrapper that makes ^C work in multiprocessing code """
@@ -264,17 +270,45 @@ def main(args=None):
         elif first_func in functions_serial:
             functions_serial = functions_serial[functions_serial.index(first_func):]
 
-    if arguments.check_filesystem and jobs != 1:
-        print("Check filesystem used -> jobs forced to 1")
-        jobs = 1
+    # skip tests that passed with the same code and testing data, and start the longest tests first
+    database = msct_test_database.TestDatabase(arguments.database)
+    sct.printv('\nFingerprint code and testing data...', param.verbose)
+    data_signature = msct_test_database.tree_signature(param.path_data)
+    code_signature = dict()
+    for folder in ('scripts', 'spinalcordtoolbox', 'testing'):
+        signature = msct_test_database.tree_signature(os.path.join(path_sct, folder), extensions=msct_test_database.CODE_EXTENSIONS)
+        code_signature.update([(os.path.join(folder, path), data) for path, data in signature.items()])
+    code_hash = msct_test_database.tree_hash(code_signature)
+    test_signatures = dict()
+    functions_skipped = list()
+    for f in functions_serial + functions_parallel:
+        test_signatures[f] = get_test_signature(f, param, data_signature, code_hash)
+        if not arguments.force and test_signatures[f] is not None and database.is_up_to_date(f, test_signatures[f]):
+            functions_skipped.append(f)
+    functions_serial = database.sort_longest_first([f for f in functions_serial if f not in functions_skipped])
+    functions_parallel = database.sort_longest_first([f for f in functions_parallel if f not in functions_skipped])
+    if functions_to_test:
+        jobs = max(1, min(jobs, len(functions_parallel)))
 
     print("Will run through the following tests:")
+    if functions_skipped:
+        print("- skipped (unchanged since last successful run): {}".format(" ".join(functions_skipped)))
     if functions_serial:
         print("- sequentially: {}".format(" ".join(functions_serial)))
     if functions_parallel:
         print("- in parallel with {} jobs: {}".format(jobs, " ".join(functions_parallel)))
 
+    if arguments.check_filesystem:
+        # the tests must only write in their output folder: the execution folder is fingerprinted once before and
+        # once after all the tests
+        tmp_signature = fs_signature(path_tmp)
+
     list_status = []
+    for f in functions_skipped:
+        print_line('Checking ' + f)
+        print_skip()
+        list_status.append((f, 0))
+
     for name, functions in (
       ("serial", functions_serial),
       ("parallel", functions_parallel),
@@ -302,23 +336,14 @@ def main(args=None):
             for idx_function, f in enumerate(functions):
                 print_line('Checking ' + f)
                 if functions == functions_serial or jobs == 1:
-                    if arguments.check_filesystem:
-                        if os.path.exists(os.path.join(path_tmp, f)):
-                            shutil.rmtree(os.path.join(path_tmp, f))
-                        sig_0 = fs_signature(path_tmp)
-
                     func_param = copy.deepcopy(param)
                     func_param.path_output = f
 
                     res = process_function(f, func_param)
-
-                    if arguments.check_filesystem:
-                        sig_1 = fs_signature(path_tmp)
-                        fs_ok(sig_0, sig_1, exclude=(f,))
                 else:
                     res = results[idx_function].get()
 
-                list_output, list_status_function = res
+                list_output, list_status_function, duration = res
                 # manage status
                 if any(list_status_function):
                     if 1 in list_status_function:
@@ -339,6 +364,10 @@ def main(args=None):
                     status = (f, 0)
                 # append status function to global list of status
                 list_status.append(status)
+                # keep track of the result, so that the test can be skipped next time if nothing changed
+                if test_signatures[f] is not None:
+                    database.record(f, test_signatures[f], status[1], list_status_function, duration)
+                    database.save()
                 if any([s for (f, s) in list_status]) and arguments.abort_on_failure:
                     break
         except KeyboardInterrupt:
@@ -348,6 +377,15 @@ def main(args=None):
                 pool.terminate()
                 pool.join()
 
+    if arguments.check_filesystem:
+        try:
+            fs_ok(tmp_signature, fs_signature(path_tmp), exclude=tuple(functions_serial + functions_parallel))
+        except RuntimeError:
+            list_status.append(("execution folder", 1))
+        if msct_test_database.tree_signature(param.path_data) != data_signature:
+            sct.log.error("Error: testing data was modified by the tests: %s", param.path_data)
+            list_status.append(("testing data", 1))
+
     print('status: ' + str([s for (f, s) in list_status]))
     if any([s for (f, s) in list_status]):
         print("Failures: {}".format(" ".join([f for (f, s) in list_status if s])))
@@ -372,6 +410,22 @@ def main(args=None):
     sys.exit(e)
 
 
+def get_test_signature(fname, param, data_signature, code_hash):
+    """
+    Signature of the tests of a function, from their arguments, input data and the code
+    :return: str, or None if the arguments of the tests cannot be retrieved (in that case the tests always run)
+    """
+    param_init = copy.deepcopy(param)
+    param_init.args = []
+    try:
+        module_testing = importlib.import_module('test_' + fname)
+        list_args = module_testing.init(param_init).args
+    except Exception as e:
+        sct.log.debug("Cannot retrieve arguments of %s: %s", fname, e)
+        return None
+    return msct_test_database.get_test_signature(fname, list_args, data_signature, code_hash)
+
+
 def downloaddata(param):
     """
     Download testing data from internet.
@@ -472,6 +526,10 @@ def print_warning():
     sct.log.warning("[" + bcolors.WARNING + "WARNING" + bcolors.ENDC + "]")
 
 
+def print_skip():
+    sct.log.info("[" + bcolors.OKBLUE + "SKIPPED" + bcolors.ENDC + "]")
+
+
 def print_fail():
     sct.log.error("[" + bcolors.FAIL + "FAIL" + bcolors.ENDC + "]")
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Summarize a trace of SCT commands: where the time goes, per subject.
+#
+# To record a trace, set the environment variable SCT_TRACE before running SCT commands or a pipeline, e.g.:
+#   export SCT_TRACE=$PWD/trace.jsonl
+#   export SCT_TRACE_SUBJECT=sub-01  # optional: tag of the subject being processed
+#   sct_register_to_template ...
+# Then:
+#   sct_trace_summary -i trace.jsonl
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+
+from __future__ import print_function, absolute_import
+
+import sys
+
+import sct_utils as sct
+import msct_trace
+
+
+# PARSER
+# ==========================================================================================
+def get_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+     description="Summarize a trace of SCT commands (recorded by setting the environment variable {}={}): breakdown of wall time, CPU time and peak memory of nested commands, per subject.".format(msct_trace.ENV_TRACE, "trace.jsonl"),
+    )
+    parser.add_argument("--input", "-i",
+     help="Trace file (json lines).",
+     required=True,
+    )
+    parser.add_argument("--subject", "-s",
+     help="Only summarize this subject ({} tag).".format(msct_trace.ENV_SUBJECT),
+    )
+    parser.add_argument("--min-percent", "-m",
+     help="Hide commands taking less than this percentage of the total time (default: 1).",
+     type=float,
+     default=1.,
+    )
+    parser.add_argument("--depth", "-d",
+     help="Maximum depth of nested commands displayed (default: all).",
+     type=int,
+    )
+    return parser
+
+
+# Main
+# ==========================================================================================
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    arguments = get_parser().parse_args(args)
+    print(msct_trace.summarize(arguments.input, subject=arguments.subject, min_percent=arguments.min_percent,
+                               max_depth=arguments.depth))
+
+
+# START PROGRAM
+# ==========================================================================================
+if __name__ == "__main__":
+    sct.init_sct()
+    main()
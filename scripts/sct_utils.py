@@ -22,12 +22,11 @@ import logging.config
 import shutil
 import subprocess
 import tempfile
+import threading
+import contextlib
 
-import numpy as np
-
-if os.getenv('SENTRY_DSN', None):
-    # do no import if Sentry is not set (i.e., if variable SENTRY_DSN is not defined)
-    import raven
+import msct_trace
+import msct_command_server
 
 if sys.hexversion < 0x03030000:
     import pipes
@@ -53,10 +52,6 @@ log.setLevel(logging.DEBUG)
 stream_handler = logging.StreamHandler(sys.stdout)
 nh = logging.NullHandler()
 log.addHandler(nh)
-LOG_LEVEL = os.getenv('SCT_LOG_LEVEL')
-LOG_FORMAT = os.getenv('SCT_LOG_FORMAT')
-if not LOG_FORMAT:
-    LOG_FORMAT = None
 
 
 def check_exe(name):
@@ -153,10 +148,44 @@ def _version_string():
     else:
         return "{install_type}-{sct_branch}-{sct_commit}".format(**locals())
 
+_version = []
+
+
+def get_version():
+    """
+    Version of SCT. It is computed on first use, since it can call git several times.
+    """
+    if not _version:
+        _version.append(_version_string())
+    return _version[0]
+
+
+def read_environment():
+    """
+    Read the sct configuration from the environment (log level and format, sct and data folders).
+    Called at import, and by the command server before running a script with the environment of its caller.
+    """
+    global LOG_LEVEL, LOG_FORMAT, __sct_dir__, __data_dir__
+    LOG_LEVEL = os.getenv('SCT_LOG_LEVEL')
+    LOG_FORMAT = os.getenv('SCT_LOG_FORMAT') or None
+    sct_dir = os.getenv("SCT_DIR", os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    if sct_dir != globals().get('__sct_dir__'):
+        # the version depends on the sct folder
+        del _version[:]
+    __sct_dir__ = sct_dir
+    __data_dir__ = os.getenv("SCT_DATA_DIR", os.path.join(__sct_dir__, 'data'))
+
+
 # Basic sct config
-__sct_dir__ = os.getenv("SCT_DIR", os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-__data_dir__ = os.getenv("SCT_DATA_DIR", os.path.join(__sct_dir__, 'data'))
-__version__ = _version_string()
+read_environment()
+if sys.hexversion < 0x03070000:
+    __version__ = get_version()
+else:
+    def __getattr__(name):
+        # module attributes computed on first access (PEP 562)
+        if name == '__version__':
+            return get_version()
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def init_sct():
@@ -166,6 +195,7 @@ def init_sct():
     """
     start_stream_logger()
     init_error_client()
+    msct_trace.start_main_span()
 
 
 def start_stream_logger():
@@ -190,24 +220,61 @@ def start_stream_logger():
     log.addHandler(stream_handler)
 
 
-def init_error_client():
-    """ Send traceback to neuropoly servers
+_error_client = {}
 
-    :return:
+
+def get_error_client():
+    """ Sentry client, created on first use: raven is only imported when an error is reported
+
+    :return: the client, None if the DSN is not valid
     """
-    if os.getenv('SENTRY_DSN'):
-        log.debug('Configuring sentry report')
+    if 'client' not in _error_client:
+        import raven
         try:
-            client = raven.Client(
-             release=__version__,
+            _error_client['client'] = raven.Client(
+             release=get_version(),
              processors=(
               'raven.processors.RemoveStackLocalsProcessor',
               'raven.processors.SanitizePasswordsProcessor'),
             )
-            server_log_handler(client)
-            traceback_to_server(client)
+        except raven.exceptions.InvalidDsn:
+            # This could happen if sct staff change the dsn
+            log.debug('Sentry DSN not valid anymore, not reporting errors')
+            _error_client['client'] = None
+    return _error_client['client']
+
+
+class LazySentryHandler(logging.Handler):
+    """
+    Log handler creating the Sentry client and handler on the first error
+    """
+    def __init__(self):
+        super(LazySentryHandler, self).__init__(level=logging.ERROR)
+        self.handler = None
+
+    def emit(self, record):
+        if self.handler is None:
+            client = get_error_client()
+            if client is None:
+                return
+            self.handler = sentry_log_handler(client)
+        self.handler.handle(record)
+
 
-            old_exitfunc = sys.exitfunc
+def init_error_client():
+    """ Send traceback to neuropoly servers
+    The client is only created when an error is reported, so that it does not slow down the startup of scripts.
+
+    :return:
+    """
+    if os.getenv('SENTRY_DSN'):
+        log.debug('Configuring sentry report')
+        log.addHandler(LazySentryHandler())
+        traceback_to_server()
+
+        old_exitfunc = getattr(sys, 'exitfunc', None)
+        if old_exitfunc is not None:
+            # python 2 only
             def exitfunc():
                 sent_something = False
                 try:
@@ -223,19 +290,19 @@ def init_error_client():
                     print("Note: you can opt out of Sentry reporting by editing the file ${SCT_DIR}/bin/sct_launcher and delete the line starting with \"export SENTRY_DSN\"")
 
             sys.exitfunc = exitfunc
-        except raven.exceptions.InvalidDsn:
-            # This could happen if sct staff change the dsn
-            log.debug('Sentry DSN not valid anymore, not reporting errors')
 
 
-def traceback_to_server(client):
+def traceback_to_server(client=None):
     """
         Send all traceback children of Exception to sentry
+        If client is None, it is created when the first exception is reported.
     """
 
     def excepthook(exctype, value, traceback):
         if issubclass(exctype, Exception):
-            client.captureException(exc_info=(exctype, value, traceback))
+            c = client or get_error_client()
+            if c is not None:
+                c.captureException(exc_info=(exctype, value, traceback))
         sys.__excepthook__(exctype, value, traceback)
 
     sys.excepthook = excepthook
@@ -244,6 +311,16 @@ def traceback_to_server(client):
 def server_log_handler(client):
     """ Adds sentry log handler to the logger
 
+    :return: the sentry handler
+    """
+    sh = sentry_log_handler(client)
+    log.addHandler(sh)
+    return sh
+
+
+def sentry_log_handler(client):
+    """ Sentry log handler, for errors
+
     :return: the sentry handler
     """
     from raven.handlers.logging import SentryHandler
@@ -266,7 +343,6 @@ def server_log_handler(client):
     formatter.converter = time.gmtime
     sh.setFormatter(formatter)
 
-    log.addHandler(sh)
     return sh
 
 
@@ -430,6 +506,25 @@ def run_old(cmd, verbose=1):
         return status, output
 
 
+# environment variables added to the environment of the commands started by run() in the current thread
+_child_env = threading.local()
+
+
+@contextlib.contextmanager
+def child_env(variables):
+    """
+    Add variables to the environment of the commands started by run() in the current thread, without changing
+    os.environ (e.g. thread limits of the jobs of sct_pipeline)
+    :param variables: dict of environment variables
+    """
+    previous = getattr(_child_env, 'variables', {})
+    _child_env.variables = dict(previous, **variables)
+    try:
+        yield
+    finally:
+        _child_env.variables = previous
+
+
 def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
     # if verbose == 2:
     #     printv(sys._getframe().f_back.f_code.co_name, 1, 'process')
@@ -439,6 +534,8 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
 
     if env is None:
         env = os.environ
+    if getattr(_child_env, 'variables', None):
+        env = dict(env, **_child_env.variables)
 
     if sys.hexversion < 0x03000000 and isinstance(cmd, unicode):
         cmd = str(cmd)
@@ -453,19 +550,30 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None):
 
     shell = isinstance(cmd, str)
 
-    process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    # trace span of the command (None if tracing is disabled, see msct_trace)
+    span = msct_trace.start_span(os.path.basename(cmdline.split(None, 1)[0]) if cmdline.strip() else '', 'run',
+                                 attributes={'cmd': cmdline, 'cwd': cwd})
+    if span is not None:
+        env = msct_trace.child_env(span, env)
+
+    # SCT scripts run in the command server when it is running, with their modules already imported
+    process = msct_command_server.start_process(cmd, cwd=cwd, env=env)
+    if process is None:
+        process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
     output_final = ''
     while True:
         # Watch out for deadlock!!!
         output = process.stdout.readline().decode("utf-8")
-        if output == '' and process.poll() is not None:
+        if output == '':
+            # end of output: the process has exited or is about to
             break
-        if output:
-            if verbose == 2:
-                printv(output.strip())
-            output_final += output.strip() + '\n'
+        if verbose == 2:
+            printv(output.strip())
+        output_final += output.strip() + '\n'
 
-    status = process.returncode
+    status, cpu_time, peak_rss = msct_trace.wait_process(process)
+    if span is not None:
+        span.finish(exit_code=status, cpu_time=cpu_time, peak_rss=peak_rss)
     output = output_final.rstrip()
 
     # process.stdin.close()
@@ -659,6 +767,36 @@ def checkRAM(os, verbose=1):
         return ram_total
 
 
+def get_available_ram():
+    """
+    Memory available for starting new processes, without swapping
+    :return: available RAM in MB, or None if it cannot be computed on this platform
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024 / 1024
+    except ImportError:
+        pass
+
+    if sys.platform.startswith('linux'):
+        meminfo = {}
+        with io.open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = float(value.split()[0])  # kB
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable'] / 1024
+        return (meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)) / 1024
+
+    elif sys.platform == 'darwin':
+        vm = subprocess.Popen(['vm_stat'], stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
+        page_size = int(re.search(r'page size of (\d+) bytes', vm).group(1))
+        pages = dict((k.strip(), int(v.strip().strip('.'))) for k, v in re.findall(r'^(Pages [^:]+):\s+(\d+)\.?$', vm, re.M))
+        return (pages.get('Pages free', 0) + pages.get('Pages inactive', 0)) * page_size / 1024 / 1024
+
+    return None
+
+
 class ForkStdoutToFile(object):
     """Use to redirect stdout to file
     Default mode is to send stdout to file AND to terminal
@@ -977,6 +1115,7 @@ def check_if_installed(cmd, name_software):
 #=======================================================================================================================
 # check if two images are in the same space and same orientation
 def check_if_same_space(fname_1, fname_2):
+    import numpy as np
     from spinalcordtoolbox.image import Image
 
     im_1 = Image(fname_1)
@@ -16,6 +16,7 @@ from __future__ import absolute_import
 import sys, io, os, time
 
 import spinalcordtoolbox.metadata
+import spinalcordtoolbox.warp
 
 from spinalcordtoolbox.image import Image
 
@@ -111,12 +112,17 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
         if not os.path.exists(os.path.join(path_out, folder_label)):
             os.makedirs(os.path.join(path_out, folder_label))
         # Warp label
-        for i in range(0, len(template_label_file)):
-            fname_label = os.path.join(path_label, folder_label, template_label_file[i])
-            # check if file exists
-            # sct.check_file_exist(fname_label)
-            # apply transfo
-            sct.run('sct_apply_transfo -i ' + fname_label + ' -o ' + os.path.join(path_out, folder_label, template_label_file[i]) + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
+        fname_label = [os.path.join(path_label, folder_label, f) for f in template_label_file]
+        fname_label_out = [os.path.join(path_out, folder_label, f) for f in template_label_file]
+        if spinalcordtoolbox.warp.is_displacement_field(fname_transfo):
+            # all labels are warped in this process: the warping field is read once and the sampling coordinates
+            # are shared by all the labels
+            spinalcordtoolbox.warp.warp_images(fname_label, fname_label_out, fname_src, [fname_transfo],
+                                               interp=[get_interp(f) for f in template_label_file],
+                                               verbose=param.verbose)
+        else:
+            for i in range(0, len(template_label_file)):
+                sct.run('sct_apply_transfo -i ' + fname_label[i] + ' -o ' + fname_label_out[i] + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
         # Copy list.txt
         sct.copy(os.path.join(path_label, folder_label, param.file_info_label), os.path.join(path_out, folder_label))
 
@@ -34,6 +34,8 @@ except Exception as e:
 else:
     sys.stderr = original_stderr
 
+from spinalcordtoolbox.utils import set_keras_threads
+
 from spinalcordtoolbox.resample import nipy_resample
 from . import model
 
@@ -230,6 +232,7 @@ def segment_volume(ninput_volume, model_name,
         # larger sizer, crop at 200x200
         net_input_size = (SMALL_INPUT_SIZE, SMALL_INPUT_SIZE)
 
+    set_keras_threads()
     deepgmseg_model = model.create_model(metadata['filters'],
                                          net_input_size)
 
@@ -26,6 +26,8 @@ except Exception as e:
 else:
     sys.stderr = original_stderr
 
+from spinalcordtoolbox.utils import set_keras_threads
+
 
 def downsampling_block(input_tensor, filters, padding='same', batchnorm=True, dropout=0.0):
     _, height, width, _ = K.int_shape(input_tensor)
@@ -77,6 +79,7 @@ def upsampling_block(input_tensor, skip_tensor, filters, padding='same', batchno
 
 
 def nn_architecture_seg(height, width, channels=1, classes=1, features=32, depth=2, temperature=1.0, padding='same', batchnorm=False, dropout=0.0):
+    set_keras_threads()
     x = Input(shape=(height, width, channels))
     inputs = x
 
@@ -130,6 +133,7 @@ def downsampling_block_ctr(input_tensor, filters, padding='same', batchnorm=True
 
 
 def nn_architecture_ctr(height, width, channels=1, classes=1, features=16, depth=2, temperature=1.0, padding='same', batchnorm=True, dropout=0.0, dilation_layers=2):
+    set_keras_threads()
     x = Input(shape=(height, width, channels))
     inputs = x
 
@@ -17,7 +17,6 @@ import nibabel
 import nibabel.orientations
 
 import numpy as np
-from scipy.ndimage import map_coordinates
 
 import transforms3d.affines as affines
 
@@ -594,6 +593,7 @@ class Image(object):
         :param interpolation_mode: 0=nearest neighbor, 1= linear, 2= 2nd-order spline, 3= 2nd-order spline, 4= 2nd-order spline, 5= 5th-order spline
         :return: intensity values at continuouspix with interpolation_mode
         """
+        from scipy.ndimage import map_coordinates
         return map_coordinates(self.data, coordi, output=np.float32, order=interpolation_mode, mode=border, cval=cval)
 
     def get_transform(self, im_ref, mode='affine'):
@@ -704,68 +704,57 @@ class Image(object):
 
 def compute_dice(image1, image2, mode='3d', label=1, zboundaries=False):
     """
-    This function computes the Dice coefficient between two binary images.
+    This function computes the Dice coefficient between two label images.
     Args:
         image1: object Image
         image2: object Image
         mode: mode of computation of Dice.
                 3d: compute Dice coefficient over the full 3D volume
-                2d-slices: compute the 2D Dice coefficient for each slice of the volumes
-        label: binary label for which Dice coefficient will be computed. Default=1
+                2d-slices: compute the 2D Dice coefficient for each axial slice of the volumes
+        label: label for which Dice coefficient will be computed (voxel values are rounded). Default=1
         zboundaries: True/False. If True, the Dice coefficient is computed over a Z-ROI where both segmentations are
                      present. Default=False.
 
-    Returns: Dice coefficient as a float between 0 and 1. Raises ValueError exception if an error occurred.
+    Returns: Dice coefficient as a float between 0 and 1 (3d), or array of Dice coefficients of the axial slices, from
+    inferior to superior (2d-slices, NaN for slices where the label is in none of the images). Raises ValueError
+    exception if an error occurred.
 
     """
+    from spinalcordtoolbox import overlap
+
     MODES = ['3d', '2d-slices']
     if mode not in MODES:
         raise ValueError('\n\nERROR: mode must be one of these values:' + ',  '.join(MODES))
 
-    dice = 0.0  # default value of dice is 0
+    # voxels are compared one to one: bring image2 to the orientation of image1
+    if image2.orientation != image1.orientation:
+        image2 = change_orientation(image2, image1.orientation)
 
     # check if images are in the same coordinate system
     assert image1.data.shape == image2.data.shape, "\n\nERROR: the data (" + image1.absolutepath + " and " + image2.absolutepath + ") don't have the same size.\nPlease use  \"sct_register_multimodal -i im1.nii.gz -d im2.nii.gz -identity 1\"  to put the input images in the same space"
 
-    # if necessary, change orientation of images to RPI and compute segmentation boundaries
-    if mode == '2d-slices' or (mode == '3d' and zboundaries):
-        # changing orientation to RPI if necessary
-        if image1.orientation != 'RPI':
-            image1 = change_orientation(image1, "RPI")
-        if image2.orientation != 'RPI':
-            image2 = change_orientation(image2, "RPI")
-
-        zmin, zmax = 0, image1.data.shape[2] - 1
-        if zboundaries:
-            # compute Z-ROI for which both segmentations are present.
-            for z in range(zmin, zmax + 1):  # going from inferior to superior
-                if np.any(image1.data[:, :, z]) and np.any(image2.data[:, :, z]):
-                    zmin = z
-                    break
-            for z in range(zmax, zmin + 1, -1):  # going from superior to inferior
-                if np.any(image1.data[:, :, z]) and np.any(image2.data[:, :, z]):
-                    zmax = z
-                    break
-
-        if zmin > zmax:
-            # segmentations do not overlap
-            return 0.0
-
-        if mode == '3d':
-            # compute dice coefficient over Z-ROI
-            data1 = image1.data[:, :, zmin:zmax]
-            data2 = image2.data[:, :, zmin:zmax]
-
-            dice = np.sum(data2[data1 == label]) * 2.0 / (np.sum(data1) + np.sum(data2))
-
-        elif mode == '2d-slices':
-            raise ValueError('2D slices Dice coefficient feature is not implemented yet')
-
-    elif mode == '3d':
-        # compute 3d dice coefficient
-        dice = np.sum(image2.data[image1.data == label]) * 2.0 / (np.sum(image1.data) + np.sum(image2.data))
-
-    return dice
+    if mode == '3d' and not zboundaries:
+        labels, metrics = overlap.compute_overlap(image1.data, image2.data, labels=[label])
+        return metrics['dice'][0]
+
+    # per-slice counts along the inferior-superior axis, without reorienting the images
+    orientation = image1.orientation
+    axis_z = orientation.index('I') if 'I' in orientation else orientation.index('S')
+    labels, counts = overlap.confusion_matrix(image1.data, image2.data, labels=[label], axis=axis_z)
+    if orientation[axis_z] == 'S':
+        # slices from inferior to superior
+        counts = counts[::-1]
+
+    if mode == '2d-slices':
+        return overlap.metrics_from_counts(counts)['dice'][:, 0]
+
+    # compute Z-ROI for which both segmentations are present
+    present = np.flatnonzero((counts[:, 1, :].sum(-1) > 0) & (counts[:, :, 1].sum(-1) > 0))
+    if not len(present):
+        # segmentations do not overlap
+        return 0.0
+    zmin, zmax = present[0], present[-1]
+    return overlap.metrics_from_counts(counts[zmin:zmax + 1].sum(0))['dice'][0]
 
 
 def find_zmin_zmax(im, threshold=0.1):
@@ -0,0 +1,124 @@
+# coding: utf-8
+# Overlap metrics between label images (Dice, Jaccard, volume difference, sensitivity)
+# All the labels, and all the slices along an axis, are evaluated in one pass: each voxel gets the combined id
+# (slice, label in the reference, label in the segmentation), and np.bincount over these ids gives the confusion
+# matrices from which all the metrics are derived.
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+# About the license: see the file LICENSE.TXT
+
+from __future__ import absolute_import, division
+
+from collections import OrderedDict
+
+import numpy as np
+import nibabel
+
+
+METRICS = ['dice', 'jaccard', 'volume_difference', 'sensitivity']
+
+
+def as_labels(data):
+    """
+    :return: integer label array (values are rounded)
+    """
+    data = np.asarray(data)
+    if data.dtype.kind in 'iub':
+        return data.astype(np.int64, copy=False)
+    return np.rint(data).astype(np.int64)
+
+
+def confusion_matrix(data_ref, data_seg, labels=None, axis=None):
+    """
+    Count the voxels of each pair (label in the reference, label in the segmentation)
+    :param data_ref: reference label array (e.g. manual segmentation)
+    :param data_seg: segmentation label array, same shape as data_ref
+    :param labels: values of the labels. None: all the non-zero values of both arrays
+    :param axis: None: one matrix for the whole arrays. int: one matrix per slice along this axis
+    :return: labels (sorted), counts: (n+1, n+1) or (nb_slices, n+1, n+1) array. Index 0 is for voxels that are not
+    in the labels (background), index i is for labels[i-1]. Rows are the reference, columns the segmentation.
+    """
+    data_ref, data_seg = as_labels(data_ref), as_labels(data_seg)
+    if data_ref.shape != data_seg.shape:
+        raise ValueError('Images do not have the same shape: {} and {}'.format(data_ref.shape, data_seg.shape))
+    if labels is None:
+        labels = np.union1d(np.unique(data_ref), np.unique(data_seg))
+        labels = labels[labels != 0]
+    labels = np.unique(np.asarray(labels, dtype=np.int64))
+    n = len(labels) + 1
+    labels_ref, labels_seg = index_labels(labels, data_ref), index_labels(labels, data_seg)
+
+    ids = labels_ref * n + labels_seg
+    if axis is None:
+        counts = np.bincount(ids.ravel(), minlength=n * n)
+        return labels, counts.reshape(n, n)
+    nb_slices = data_ref.shape[axis]
+    slices = np.arange(nb_slices).reshape([-1 if i == axis else 1 for i in range(data_ref.ndim)])
+    ids = ids + slices * (n * n)
+    counts = np.bincount(ids.ravel(), minlength=nb_slices * n * n)
+    return labels, counts.reshape(nb_slices, n, n)
+
+
+def index_labels(labels, data):
+    """
+    :param labels: sorted label values
+    :return: 1 + index of the value of each voxel in labels, 0 if the value is not in labels
+    """
+    if not len(labels):
+        return np.zeros(data.shape, dtype=np.int64)
+    position = np.minimum(np.searchsorted(labels, data), len(labels) - 1)
+    return np.where(labels[position] == data, position + 1, 0)
+
+
+def metrics_from_counts(counts):
+    """
+    :param counts: confusion matrices (..., n+1, n+1), see confusion_matrix()
+    :return: OrderedDict of (..., n) arrays for each metric, NaN where a metric is not defined (e.g. the label is in
+    none of the images). volume_difference is relative to the volume of the reference.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.shape[-1]
+    true_positive = counts[..., np.arange(1, n), np.arange(1, n)]
+    volume_ref = counts.sum(-1)[..., 1:]
+    volume_seg = counts.sum(-2)[..., 1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = OrderedDict([
+         ('dice', 2 * true_positive / (volume_ref + volume_seg)),
+         ('jaccard', true_positive / (volume_ref + volume_seg - true_positive)),
+         ('volume_difference', (volume_seg - volume_ref) / volume_ref),
+         ('sensitivity', true_positive / volume_ref),
+         ('volume_ref', volume_ref),
+         ('volume_seg', volume_seg),
+        ])
+    return metrics
+
+
+def compute_overlap(data_ref, data_seg, labels=None, axis=None):
+    """
+    Overlap metrics of all the labels, for the whole arrays or for each slice along an axis
+    :return: labels, OrderedDict of metrics (see metrics_from_counts): (n,) arrays, or (nb_slices, n) arrays if axis is
+    given
+    """
+    labels, counts = confusion_matrix(data_ref, data_seg, labels=labels, axis=axis)
+    return labels, metrics_from_counts(counts)
+
+
+def _compute_overlap_files(args):
+    fname_ref, fname_seg, labels, axis = args
+    data_ref = np.asanyarray(nibabel.load(fname_ref).dataobj)
+    data_seg = np.asanyarray(nibabel.load(fname_seg).dataobj)
+    return compute_overlap(data_ref, data_seg, labels=labels, axis=axis)
+
+
+def compute_overlap_files(pairs, labels=None, axis=None, nb_jobs=1):
+    """
+    Overlap metrics of many pairs of images
+    :param pairs: list of (reference image, segmentation) file names
+    :param nb_jobs: number of processes
+    :return: list of (labels, metrics), in the order of pairs
+    """
+    args = [(fname_ref, fname_seg, labels, axis) for fname_ref, fname_seg in pairs]
+    if nb_jobs == 1:
+        return [_compute_overlap_files(a) for a in args]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=nb_jobs) as executor:
+        return list(executor.map(_compute_overlap_files, args, chunksize=max(1, len(args) // (4 * nb_jobs))))
@@ -10,7 +10,10 @@ import logging
 import warnings
 import datetime
 import io
-from string import Template
+import fcntl
+import glob
+import uuid
+import contextlib
 
 warnings.filterwarnings("ignore")
 
@@ -24,6 +27,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.colorbar as colorbar
 import matplotlib.colors as color
+import matplotlib.image
 import matplotlib.pyplot as plt
 
 import sct_utils as sct
@@ -88,16 +92,27 @@ class QcImage(object):
     Ex: if 'colorbar' is in the list, the process will generate a color bar in the "img" folder
     """
 
+    # Built-in actions return the RGBA overlay computed from the mask, which is saved at the native resolution of the
+    # mask. Other actions (e.g. hooks drawing text or patches on the current axes) are rendered through a figure.
+    _array_actions = ('listed_seg', 'template', 'no_seg_seg', 'sequential_seg')
+
+    # interpolation orders used to stretch images to the aspect ratio of the voxels, for the interpolations of
+    # matplotlib (other interpolations are cubic)
+    _interpolation_orders = {'none': 0, 'nearest': 0, 'bilinear': 1}
+
     def listed_seg(self, mask):
         img = np.rint(np.ma.masked_where(mask < 1, mask))
-        fig = plt.imshow(img,
-                         cmap=color.ListedColormap(self._labels_color),
-                         norm=color.Normalize(vmin=0, vmax=len(self._labels_color)),
-                         interpolation=self.interpolation,
-                         alpha=1,
-                         aspect=float(self.aspect_mask))
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return self._to_rgba(img,
+                             color.ListedColormap(self._labels_color),
+                             color.Normalize(vmin=0, vmax=len(self._labels_color)))
+
+    @staticmethod
+    def _template_cmap():
+        color_white = color.colorConverter.to_rgba('white', alpha=0.0)
+        color_blue = color.colorConverter.to_rgba('blue', alpha=0.7)
+        color_cyan = color.colorConverter.to_rgba('cyan', alpha=0.8)
+        return color.LinearSegmentedColormap.from_list('cmap_atlas',
+                                                       [color_white, color_blue, color_cyan], N=256)
 
     def template(self, mask):
         """
@@ -105,37 +120,48 @@ class QcImage(object):
         """
         values = mask
         values[values < 0.5] = 0
-        color_white = color.colorConverter.to_rgba('white', alpha=0.0)
-        color_blue = color.colorConverter.to_rgba('blue', alpha=0.7)
-        color_cyan = color.colorConverter.to_rgba('cyan', alpha=0.8)
-        cmap = color.LinearSegmentedColormap.from_list('cmap_atlas',
-                                                       [color_white, color_blue, color_cyan], N=256)
-
-        fig = plt.imshow(values,
-                         cmap=cmap,
-                         interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
-
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return self._to_rgba(values, self._template_cmap())
 
     def no_seg_seg(self, mask):
-        values = np.ma.masked_equal(np.rint(mask), 0)
-        fig = plt.imshow(values,
-                         cmap=plt.cm.gray,
-                         interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return self._to_rgba(np.ma.masked_equal(np.rint(mask), 0), plt.cm.gray)
 
     def sequential_seg(self, mask):
-        values = np.ma.masked_equal(np.rint(mask), 0)
-        fig = plt.imshow(values,
-                         cmap=self._seg_colormap,
-                         interpolation=self.interpolation,
-                         aspect=self.aspect_mask)
-        fig.axes.get_xaxis().set_visible(False)
-        fig.axes.get_yaxis().set_visible(False)
+        return self._to_rgba(np.ma.masked_equal(np.rint(mask), 0), self._seg_colormap)
+
+    @staticmethod
+    def _to_rgba(values, cmap, norm=None):
+        """Map a 2D (masked) array to RGBA bytes, as imshow would do. Masked values are transparent.
+        """
+        if norm is None:
+            norm = color.Normalize()
+        return cmap(norm(values), bytes=True)
+
+    @staticmethod
+    def _aspect_shape(shape, aspect):
+        """Shape (h, w) of an image of the given shape, stretched so that pixels have the aspect ratio (height/width)
+        of the voxels
+        """
+        aspect = float(aspect)
+        h, w = shape[:2]
+        if aspect >= 1:
+            return int(round(h * aspect)), w
+        return h, int(round(w / aspect))
+
+    def _apply_aspect(self, rgba, aspect):
+        """Stretch the image to the aspect ratio of the voxels, with the interpolation of the QcImage
+        """
+        h, w = rgba.shape[:2]
+        h1, w1 = self._aspect_shape(rgba.shape, aspect)
+        if (h1, w1) == (h, w):
+            return rgba
+        order = self._interpolation_orders.get(self.interpolation, 3)
+        if order == 0:
+            rows = np.minimum(np.floor(np.arange(h1) * h / h1).astype(int), h - 1)
+            cols = np.minimum(np.floor(np.arange(w1) * w / w1).astype(int), w - 1)
+            return rgba[rows][:, cols]
+        from scipy import ndimage
+        stretched = ndimage.zoom(rgba.astype(np.float32), (h1 / h, w1 / w, 1), order=order, mode='nearest')
+        return np.clip(np.rint(stretched), 0, 255).astype(rgba.dtype)
 
     def colorbar(self):
         fig = plt.figure(figsize=(9, 1.5))
@@ -203,47 +229,62 @@ class QcImage(object):
                     return np.array(c * (max_ - min_) + min_, dtype=a.dtype)
                 img = equalized(img)
 
-            plt.figure()
-            fig = plt.imshow(img, cmap=plt.cm.gray, interpolation=self.interpolation, aspect=float(aspect_img))
-            fig.axes.get_xaxis().set_visible(False)
-            fig.axes.get_yaxis().set_visible(False)
-            self._save(self.qc_report.qc_params.abs_bkg_img_path())
+            bkg = self._to_rgba(img, plt.cm.gray)
+            self._save_array(self._apply_aspect(bkg, aspect_img), self.qc_report.qc_params.abs_bkg_img_path())
 
             for action in self.action_list:
                 logger.debug('Action List %s', action.__name__)
-                plt.clf()
-                plt.figure()
                 if self._stretch_contrast and action.__name__ in ("no_seg_seg",):
                     print("Mask type %s" % mask.dtype)
                     mask = equalized(mask)
-                action(self, mask)
-                self._save(self.qc_report.qc_params.abs_overlay_img_path())
-            plt.close()
+                if action.__name__ in self._array_actions and \
+                 QcImage.__dict__.get(action.__name__) is getattr(action, '__func__', action):
+                    overlay = action(self, mask)
+                    self._save_array(self._apply_aspect(overlay, self.aspect_mask), self.qc_report.qc_params.abs_overlay_img_path())
+                else:
+                    self._save_figure(action, mask, self.qc_report.qc_params.abs_overlay_img_path())
 
             self.qc_report.update_description_file(img.shape)
 
         return wrapped_f
 
-    def _save(self, img_path, format='png', bbox_inches='tight', pad_inches=0.00):
-        """ Save the current figure into an image.
+    def _save_array(self, rgba, img_path):
+        """ Save an RGBA array into a png image, at the native resolution of the array.
 
         Parameters
         ----------
+        rgba : numpy.ndarray
+            (h, w, 4) uint8 image
         img_path : str
-            path of the folder where the image is saved
-        format : str
-            image format
-        bbox_inches : str
-        pad_inches : float
-
+            path of the image file
         """
         logger.debug('Save image %s', img_path)
-        plt.savefig(img_path,
-                    format=format,
-                    bbox_inches=bbox_inches,
-                    pad_inches=pad_inches,
-                    transparent=True,
-                    dpi=600)
+        matplotlib.image.imsave(img_path, rgba, format='png')
+
+    def _save_figure(self, action, mask, img_path, dpi=100):
+        """ Render an action that draws on the current matplotlib axes, with a figure sized to the native resolution
+        of the mask.
+
+        Parameters
+        ----------
+        action : function
+            called as action(self, mask)
+        mask : numpy.ndarray
+        img_path : str
+            path of the image file
+        dpi : int
+        """
+        h, w = self._aspect_shape(mask.shape, self.aspect_mask)
+        fig = plt.figure(figsize=(w / dpi, h / dpi), dpi=dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        try:
+            action(self, mask)
+            ax.set_aspect('auto')
+            logger.debug('Save image %s', img_path)
+            fig.savefig(img_path, format='png', transparent=True, dpi=dpi)
+        finally:
+            plt.close(fig)
 
 
 class Params(object):
@@ -358,33 +399,158 @@ class QcReport(object):
             'dimension': '%dx%d' % dimension,
             'moddate': datetime.datetime.now().isoformat(' ')
         }
-        logger.debug('Description file: %s', self.qc_params.qc_results)
-        results = []
-        if os.path.isfile(self.qc_params.qc_results):
-            results = json.load(open(self.qc_params.qc_results, 'r'))
-        results.append(output)
-        json.dump(results, open(self.qc_params.qc_results, "w"), indent=2)
-        self._update_html_assets(results)
-
-    def _update_html_assets(self, json_data):
-        """Update the html file and assets"""
-        assets_path = os.path.join(os.path.dirname(__file__), 'assets')
-        dest_path = self.qc_params.root_folder
-
-        with io.open(os.path.join(assets_path, 'index.html')) as template_index:
-            template = Template(template_index.read())
-            output = template.substitute(sct_json_data=json.dumps(json_data))
-            io.open(os.path.join(dest_path, 'index.html'), 'w').write(output)
-
-        for path in ['css', 'js', 'imgs', 'fonts']:
-            src_path = os.path.join(assets_path, '_assets', path)
-            dest_full_path = os.path.join(dest_path, '_assets', path)
-            if not os.path.exists(dest_full_path):
-                os.makedirs(dest_full_path)
-            for file_ in os.listdir(src_path):
-                if not os.path.isfile(os.path.join(dest_full_path, file_)):
-                    sct.copy(os.path.join(src_path, file_),
-                             dest_full_path)
+        write_result_entry(self.qc_params.root_folder, output)
+
+
+@contextlib.contextmanager
+def _locked(path_qc):
+    """Hold an exclusive lock on the QC folder, so that concurrent processes do not write the index at the same time
+    """
+    with open(os.path.join(path_qc, '.qc.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_atomic(path, text):
+    """Write a text file through a temporary file and a rename, so that readers never see a partial file
+    """
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    with open(tmp_path, 'wb') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def _entries_folder(path_qc):
+    return os.path.join(path_qc, '_json')
+
+
+def _entries_script(path_qc):
+    """Script loaded by index.html, appended with one line per result: the browser merges the results when the report
+    is viewed
+    """
+    return os.path.join(_entries_folder(path_qc), 'qc_results.js')
+
+
+def _entry_script_line(entry):
+    return 'sct_data.push({});\n'.format(json.dumps(entry))
+
+
+def write_result_entry(path_qc, entry):
+    """Add a QC result to the QC folder.
+
+    Each result is written to its own file in `_json/`, so that concurrent processes never overwrite each other's
+    results, and appended to the script read by index.html and to qc_results.json. The cost of adding a result does
+    not depend on the number of results: the browser merges them when the report is viewed.
+
+    :param path_qc: QC root folder
+    :param entry: dict describing the result
+    """
+    if not os.path.isdir(_entries_folder(path_qc)) or not os.path.isfile(os.path.join(path_qc, 'index.html')):
+        with _locked(path_qc):
+            _import_legacy_results(path_qc)
+            _install_viewer(path_qc)
+    fname = 'qc_{}_{}_{}.json'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid(), uuid.uuid4().hex[:8])
+    with _locked(path_qc):
+        _write_atomic(os.path.join(_entries_folder(path_qc), fname), json.dumps(entry, indent=2))
+        with io.open(_entries_script(path_qc), 'a', encoding='utf-8') as f:
+            f.write(_entry_script_line(entry))
+        _append_results_json(path_qc, entry)
+
+
+def _append_results_json(path_qc, entry):
+    """Append a result to qc_results.json in place, as `json.dumps(results, indent=2)` would write it: the end of the
+    list is replaced by the new entry. The file is rebuilt from the result entries if it is missing or invalid.
+    Must be called with the lock held.
+    """
+    fname_results = os.path.join(path_qc, 'qc_results.json')
+    text = '\n  '.join(json.dumps(entry, indent=2).split('\n'))
+    if os.path.isfile(fname_results):
+        with open(fname_results, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            # closing bracket, and the character before it: '[' if the list is empty
+            f.seek(max(f.tell() - 2, 0))
+            tail = f.read()
+            if tail.endswith(b'\n]') or tail == b'[]':
+                f.seek(-1 if tail == b'[]' else -2, os.SEEK_END)
+                f.write('{}\n  {}\n]'.format('' if tail == b'[]' else ',', text).encode('utf-8'))
+                return
+    _write_atomic(fname_results, json.dumps(load_results(path_qc), indent=2))
+
+
+def _import_legacy_results(path_qc):
+    """Split a qc_results.json written by previous versions into result entries. Must be called with the lock held.
+    """
+    entries_folder = _entries_folder(path_qc)
+    if os.path.isdir(entries_folder):
+        return
+    tmp_folder = '{}.{}.tmp'.format(entries_folder, uuid.uuid4().hex)
+    os.makedirs(tmp_folder)
+    fname_results = os.path.join(path_qc, 'qc_results.json')
+    results = []
+    if os.path.isfile(fname_results):
+        with io.open(fname_results, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        for i, entry in enumerate(results):
+            _write_atomic(os.path.join(tmp_folder, 'qc_0_legacy_{:06d}.json'.format(i)), json.dumps(entry, indent=2))
+    _write_atomic(os.path.join(tmp_folder, os.path.basename(_entries_script(path_qc))),
+                  ''.join(_entry_script_line(entry) for entry in results))
+    os.rename(tmp_folder, entries_folder)
+
+
+def _install_viewer(path_qc):
+    """Copy index.html, which loads the results from `_json/qc_results.js`, and the html assets. Must be called with
+    the lock held.
+    """
+    assets_path = os.path.join(os.path.dirname(__file__), 'assets')
+    sct.copy(os.path.join(assets_path, 'index.html'), os.path.join(path_qc, 'index.html'))
+    for path in ['css', 'js', 'imgs', 'fonts']:
+        src_path = os.path.join(assets_path, '_assets', path)
+        dest_full_path = os.path.join(path_qc, '_assets', path)
+        if not os.path.exists(dest_full_path):
+            os.makedirs(dest_full_path)
+        for file_ in os.listdir(src_path):
+            if not os.path.isfile(os.path.join(dest_full_path, file_)):
+                sct.copy(os.path.join(src_path, file_),
+                         dest_full_path)
+
+
+def load_results(path_qc):
+    """Merge the result entries of a QC folder
+
+    :param path_qc: QC root folder
+    :return: list of results, sorted by file name (i.e. by date of creation)
+    """
+    results = []
+    for fname in sorted(glob.glob(os.path.join(_entries_folder(path_qc), 'qc_*.json'))):
+        try:
+            with io.open(fname, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        except ValueError:
+            logger.warning('Ignoring corrupted QC entry %s', fname)
+    return results
+
+
+def generate_report(path_qc):
+    """Merge the result entries of a QC folder into qc_results.json, rewrite the script read by index.html in the
+    order of creation of the results, and copy the html assets.
+
+    Adding results does not need it (qc_results.json and the script are appended with each result): it rebuilds them,
+    e.g. after result files were removed by hand.
+
+    :param path_qc: QC root folder
+    """
+    with _locked(path_qc):
+        _import_legacy_results(path_qc)
+        results = load_results(path_qc)
+        _write_atomic(os.path.join(path_qc, 'qc_results.json'), json.dumps(results, indent=2))
+        _write_atomic(_entries_script(path_qc), ''.join(_entry_script_line(entry) for entry in results))
+        _install_viewer(path_qc)
+    return results
 
 
 def add_entry(src, process, args, path_qc, plane, background=None, foreground=None,
@@ -419,7 +585,7 @@ def add_entry(src, process, args, path_qc, plane, background=None, foreground=No
 
         report.update_description_file(foreground.shape[:2])
 
-    sct.printv('Sucessfully generated the QC results in %s' % qc_param.qc_results)
+    sct.printv('Sucessfully generated the QC results in %s' % qc_param.root_folder)
     sct.printv('Use the following command to see the results in a browser:')
     try:
         from sys import platform as _platform
@@ -10,11 +10,12 @@
 #########################################################################################
 from __future__ import division, absolute_import
 
-import copy
+import multiprocessing
 
 import nipy
 import numpy as np
-from nipy.algorithms.registration.resample import resample as n_resample
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
 
 import sct_utils as sct
 
@@ -68,15 +69,13 @@ def resample_image(input_image, new_size, new_size_type,
     affine = input_image.coordmap.affine
     sct.printv('  affine matrix: \n' + str(affine), verbose)
 
-    # create ref image
-    arr_r = np.zeros(n_r)
+    # create ref geometry
     R = np.eye(len(n) + 1)
     for i in range(len(n)):
         R[i, i] = n[i] / float(n_r[i])
     affine_r = np.dot(affine, R)
     coordmap_r = input_image.coordmap
     coordmap_r.affine = affine_r
-    nii_r = nipy.core.api.Image(arr_r, coordmap_r)
 
     sct.printv('\nCalculate affine transformation...', verbose)
     # create affine transformation
@@ -97,43 +96,60 @@ def resample_image(input_image, new_size, new_size_type,
     elif interpolation == 'spline':
         interp_order = 2
 
-    # create 3d coordmap because resample only accepts 3d data (jcohenadad 2016-07-26)
-    if len(n) == 4:
-        coordmap3d = copy.deepcopy(input_image.coordmap)
-        from nipy.core.reference.coordinate_system import CoordinateSystem
-        coordmap3d.function_domain = CoordinateSystem('xyz')
-        # create 3d affine transfo
-        affine3d = np.delete(affine, 3, 0)
-        affine3d = np.delete(affine3d, 3, 1)
-        coordmap3d.affine = affine3d
-
-    # resample data
-    if len(n) == 3:
-        data_r = n_resample(input_image, transform=transfo, reference=nii_r, mov_voxel_coords=True,
-                          ref_voxel_coords=True, dtype='double', interp_order=interp_order,
-                          mode='nearest')
-    elif len(n) == 4:
-        data_r = np.zeros(n_r)
-
-        # loop across 4th dimension
-        for it in range(n[3]):
-            # create 3d nipy-like data
-            arr3d = data[:, :, :, it]
-            nii3d = nipy.core.api.Image(arr3d, coordmap3d)
-            arr_r3d = arr_r[:, :, :, it]
-            nii_r3d = nipy.core.api.Image(arr_r3d, coordmap3d)
-            # resample data
-            data3d_r = n_resample(nii3d, transform=transfo, reference=nii_r3d,
-                                mov_voxel_coords=True, ref_voxel_coords=True,
-                                dtype='double', interp_order=interp_order,
-                                mode='nearest')
-            data_r[:, :, :, it] = data3d_r.get_data()
+    # resample data: the target->source voxel mapping is the same for all volumes, so it is computed once and applied
+    # to each volume (in parallel for 4d data)
+    data_r = resample_volumes(data, transfo, n_r, interp_order=interp_order, verbose=verbose)
 
     nii_r = nipy.core.api.Image(data_r, coordmap_r)
 
     return nii_r
 
 
+def get_resampling_coordinates(transfo, shape_r):
+    """Compute the voxel coordinates in the source image of all voxels of the
+    target grid.
+
+    :param transfo: 4x4 affine transformation from target to source voxel coordinates
+    :param shape_r: 3d shape of the target grid
+    :return: coordinates array (3, nx_r, ny_r, nz_r)
+    """
+    coordinates = np.indices(shape_r, dtype='f8').reshape(3, -1)
+    coordinates = np.dot(transfo[:3, :3], coordinates) + transfo[:3, 3:4]
+    return coordinates.reshape((3,) + tuple(shape_r))
+
+
+def resample_volumes(data, transfo, shape_r, interp_order=1, nb_threads=None, verbose=1):
+    """Resample a 3d or 4d array with an affine transformation defined in voxel
+    coordinates. The target->source coordinates are computed once per call
+    (and released when it returns) and each volume is interpolated with a single map_coordinates call, which computes
+    the spline coefficients of the volume once when the order requires them.
+
+    :param data: 3d or 4d array
+    :param transfo: 4x4 affine transformation from target to source voxel coordinates
+    :param shape_r: shape of the output (3d or 4d, the 4th dimension is not resampled)
+    :param interp_order: interpolation order (0: nn, 1: linear, 2: spline)
+    :param nb_threads: number of threads used to resample volumes. None: number of CPUs
+    :param verbose: Verbosity level
+    :return: resampled array (float64)
+    """
+    coordinates = get_resampling_coordinates(transfo, shape_r[:3])
+    if data.ndim == 3:
+        return ndimage.map_coordinates(data, coordinates, output='f8', order=interp_order, mode='nearest')
+
+    # volumes are stored along the first axis so that each output volume is contiguous
+    data_r = np.zeros((data.shape[3],) + tuple(shape_r[:3]), dtype='f8')
+
+    def resample_volume(it):
+        ndimage.map_coordinates(data[..., it], coordinates, output=data_r[it], order=interp_order, mode='nearest')
+
+    if nb_threads is None:
+        nb_threads = multiprocessing.cpu_count()
+    sct.printv('  resample ' + str(data.shape[3]) + ' volumes (' + str(nb_threads) + ' threads)', verbose)
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        list(executor.map(resample_volume, range(data.shape[3])))
+    return np.rollaxis(data_r, 0, 4)
+
+
 def resample_file(fname_data, fname_out, new_size, new_size_type,
                   interpolation, verbose):
     """This function will resample the specified input
@@ -0,0 +1,128 @@
+# coding: utf-8
+# Slab-parallel application of image filters
+# The volume is split into slabs of slices along z, extended by a halo of neighbouring slices covering the reach of the
+# filter along z, and the slabs are filtered by a pool of processes. Input and output arrays are shared with the
+# processes through memory-mapped files: only slab bounds are sent to the processes. As each output slice is computed
+# from the same neighbourhood as in the whole volume, the result is identical to filtering the whole volume.
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+# About the license: see the file LICENSE.TXT
+
+from __future__ import absolute_import, division
+
+import os
+import multiprocessing
+
+import numpy as np
+
+import sct_utils as sct
+
+
+def get_nb_jobs(nb_jobs):
+    """
+    :param nb_jobs: number of processes. 0: all available CPUs
+    """
+    return multiprocessing.cpu_count() if nb_jobs == 0 else max(1, nb_jobs)
+
+
+def iter_slabs(nz, slab_size, halo=0):
+    """
+    Split range(nz) into consecutive slabs, extended by halo slices on each side (within range(nz)).
+    :return: generator of (start, stop) of the extended slab, (start, stop) of the slab inside the extended slab
+    """
+    for z in range(0, nz, slab_size):
+        start, stop = max(0, z - halo), min(nz, z + slab_size + halo)
+        yield (start, stop), (z - start, min(z + slab_size, nz) - start)
+
+
+def apply_by_slabs(data, function, args=(), args_volumes=None, halo=0, nb_jobs=1, slab_size=None, dtype=None):
+    """
+    Apply a filter to a 3D (or 4D, volume-wise) array by slabs of slices along z.
+    :param data: 2D, 3D or 4D array. 2D arrays are filtered at once, 4D arrays volume by volume.
+    :param function: function(slab, *args) returning the filtered 3D slab, with the same shape as slab. It must be
+                     defined at module level, to be used by other processes.
+    :param args: tuple of additional arguments of function
+    :param args_volumes: list with a tuple of arguments for each volume, added after args (e.g. the noise level of
+                         each volume). For 3D data, a list with one tuple.
+    :param halo: number of slices on each side of a slab that are needed to compute the slab (reach of the filter
+                 along z)
+    :param nb_jobs: number of processes. 0: all available CPUs
+    :param slab_size: number of slices per slab. Default: a few slabs per process.
+    :param dtype: data type of the output. Default: same as data.
+    :return: filtered array
+    """
+    dtype = data.dtype if dtype is None else np.dtype(dtype)
+    volumes = data.shape[3] if data.ndim == 4 else None
+    list_args = [tuple(args) + tuple(a) for a in (args_volumes or [()] * (volumes or 1))]
+    if data.ndim < 3:
+        return np.asarray(function(data, *list_args[0]), dtype=dtype)
+    nb_jobs = get_nb_jobs(nb_jobs)
+    nz = data.shape[2]
+    if slab_size is None:
+        slab_size = max(1, int(np.ceil(nz * (volumes or 1) / (4. * nb_jobs))))
+    list_tasks = [(t, slab, inside) for t in range(volumes or 1) for slab, inside in iter_slabs(nz, slab_size, halo)]
+
+    if nb_jobs == 1 or len(list_tasks) == 1:
+        data_out = np.empty(data.shape, dtype=dtype)
+        _init_worker(data, data_out, list_args, function)
+        for task in list_tasks:
+            _filter_slab(task)
+        _worker.clear()
+        return data_out
+
+    # memory-mapped input and output, opened by each process
+    path_tmp = sct.tmp_create(basename="slicewise", verbose=0)
+    try:
+        fname_in, fname_out = os.path.join(path_tmp, 'input.dat'), os.path.join(path_tmp, 'output.dat')
+        data_in = np.memmap(fname_in, dtype=data.dtype, mode='w+', shape=data.shape)
+        data_in[...] = data
+        data_in.flush()
+        del data_in
+        np.memmap(fname_out, dtype=dtype, mode='w+', shape=data.shape).flush()
+        init_args = ((fname_in, data.dtype, data.shape), (fname_out, dtype, data.shape), list_args, function)
+        pool = multiprocessing.Pool(processes=min(nb_jobs, len(list_tasks)), initializer=_init_worker,
+                                    initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_filter_slab, list_tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        return np.array(np.memmap(fname_out, dtype=dtype, mode='r', shape=data.shape))
+    finally:
+        sct.rmtree(path_tmp, verbose=0)
+
+
+# state of a filtering process: input and output arrays, filter
+_worker = {}
+
+
+def _open(array, mode):
+    if isinstance(array, np.ndarray):
+        return array
+    fname, dtype, shape = array
+    return np.memmap(fname, dtype=dtype, mode=mode, shape=shape)
+
+
+def _init_worker(data_in, data_out, list_args, function):
+    """
+    Open the input and output arrays (arrays, or (file name, dtype, shape) of memory-mapped files), once per process.
+    """
+    _worker['in'] = _open(data_in, 'r')
+    _worker['out'] = _open(data_out, 'r+')
+    _worker['args'] = list_args
+    _worker['function'] = function
+
+
+def _filter_slab(task):
+    """
+    Filter one extended slab of one volume and write the slab in the output array.
+    :param task: index of the volume, (start, stop) of the extended slab, (start, stop) of the slab inside it
+    """
+    t, (start, stop), (inside_start, inside_stop) = task
+    data_in, data_out = _worker['in'], _worker['out']
+    index = (Ellipsis, slice(start, stop)) if data_in.ndim == 3 else (Ellipsis, slice(start, stop), t)
+    slab = _worker['function'](np.array(data_in[index]), *_worker['args'][t])
+    index_out = (Ellipsis, slice(start + inside_start, start + inside_stop))
+    if data_in.ndim == 4:
+        index_out += (t,)
+    data_out[index_out] = slab[..., inside_start:inside_stop]
@@ -2,55 +2,123 @@
 # -*- coding: utf-8
 # Functions that utilize the template (e.g., PAM50)
 
-from __future__ import absolute_import
+from __future__ import absolute_import, division
 
 import numpy as np
 
 from sct_utils import log
 
-def get_slices_from_vertebral_levels(im_vertlevel, level):
+
+class VertebralLevelIndex(object):
+    """
+    Index between the slices and the vertebral levels of a vertebral labeling, built in one pass over the image.
+    The level of a slice is the average of its non-null values, rounded to the closest integer (or the median of its
+    non-null values, truncated to integer, with get_median_levels).
+    Important: the 3rd dimension is assumed to be Z.
+    """
+
+    def __init__(self, data_vertlevel):
+        self.data = data_vertlevel
+        self.shape = data_vertlevel.shape
+        nz = data_vertlevel.shape[2]
+        # non-null values, grouped by slice
+        data_z = np.moveaxis(np.asanyarray(data_vertlevel), 2, 0).reshape(nz, -1)
+        mask = data_z != 0
+        self._values = data_z[mask]
+        self.counts = np.count_nonzero(mask, axis=1)
+        self._slices_values = np.repeat(np.arange(nz), self.counts)
+        self.is_labeled = self.counts > 0
+        # average of non-null values and round to closest
+        sums = np.bincount(self._slices_values, weights=self._values.astype(np.float64), minlength=nz)
+        self.levels = np.zeros(nz, dtype=int)
+        self.levels[self.is_labeled] = np.round(sums[self.is_labeled] / self.counts[self.is_labeled])
+        # slices of each level, sorted by level then slice
+        self._slices_sorted = np.flatnonzero(self.is_labeled)[np.argsort(self.levels[self.is_labeled], kind='mergesort')]
+        self._levels_sorted = self.levels[self._slices_sorted]
+        self._median_levels = None
+
+    def get_slices(self, level_min, level_max=None):
+        """
+        :param level_min: int: vertebral level
+        :param level_max: int: if provided, return the slices of all levels between level_min and level_max (included)
+        :return: array of int: slices, sorted by level then slice
+        """
+        level_max = level_min if level_max is None else level_max
+        start = np.searchsorted(self._levels_sorted, level_min, side='left')
+        stop = np.searchsorted(self._levels_sorted, level_max, side='right')
+        return self._slices_sorted[start:stop]
+
+    def get_level(self, idx_slice):
+        """
+        :param idx_slice: int: slice (z)
+        :return: int: vertebral level. None if the slice only contains zeros.
+        """
+        return int(self.levels[idx_slice]) if self.is_labeled[idx_slice] else None
+
+    def get_median_levels(self):
+        """
+        :return: array of int: median of the non-null values of each slice, truncated to integer (0 for empty slices)
+        """
+        if self._median_levels is None:
+            values = self._values[np.lexsort((self._values, self._slices_values))]
+            starts = np.cumsum(self.counts) - self.counts
+            labeled = self.is_labeled
+            median = (values[starts[labeled] + (self.counts[labeled] - 1) // 2] +
+                      values[starts[labeled] + self.counts[labeled] // 2]) / 2.
+            self._median_levels = np.zeros(len(self.counts), dtype=int)
+            self._median_levels[labeled] = median.astype(int)
+        return self._median_levels
+
+    def get_available_levels(self):
+        """
+        :return: array: sorted positive values of the vertebral labeling
+        """
+        return np.unique(self._values[self._values > 0])
+
+
+def get_vertebral_level_index(im_vertlevel, refresh=False):
+    """
+    Index of the vertebral labeling, cached on the image object until its data is replaced (e.g. by
+    change_orientation) or reshaped.
+    Important: the content of the data is not checked, so in-place edits (e.g. im.data[...] = 0 or im.data *= 2) leave
+    a stale index: after such edits, use refresh=True, or pass an index built with VertebralLevelIndex to the functions
+    below.
+    :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
+    :param refresh: bool: rebuild the index
+    :return: VertebralLevelIndex
+    """
+    index = getattr(im_vertlevel, '_vertlevel_index', None)
+    if refresh or index is None or index.data is not im_vertlevel.data or index.shape != im_vertlevel.data.shape:
+        index = im_vertlevel._vertlevel_index = VertebralLevelIndex(im_vertlevel.data)
+    return index
+
+
+def get_slices_from_vertebral_levels(im_vertlevel, level, index=None):
     """
     Find the slices of the corresponding vertebral level.
     Important: This function assumes that the 3rd dimension is Z.
     :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
     :param level: int: vertebral level
+    :param index: VertebralLevelIndex of im_vertlevel (default: cached index, see get_vertebral_level_index)
     :return: list of int: slices
     """
-    data_vertlevel = im_vertlevel.data
-    slices = []
-    # loop across z
-    for iz in range(im_vertlevel.dim[2]):
-        # find indices of non-null values
-        indx, indy = np.where(data_vertlevel[:, :, iz])
-        # average non-null values and round to closest
-        try:
-            average_value = int(np.round(np.mean(data_vertlevel[indx, indy, iz])))
-            # if that matches the desired level, append it to slice list
-            if average_value == level:
-                slices.append(iz)
-        except ValueError as e:
-            # slice is empty (no indx found). Do nothing.
-            log.debug('Empty slice: z=%s (%s)', iz, e)
-    return slices
-
-
-def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
+    if index is None:
+        index = get_vertebral_level_index(im_vertlevel)
+    return index.get_slices(level).tolist()
+
+
+def get_vertebral_level_from_slice(im_vertlevel, idx_slice, index=None):
     """
     Find the vertebral level of the corresponding slice.
     Important: This function assumes that the 3rd dimension is Z.
     :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
     :param idx_slice: int: slice (z)
+    :param index: VertebralLevelIndex of im_vertlevel (default: cached index, see get_vertebral_level_index)
     :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
     """
-    data_vertlevel = im_vertlevel.data
-    # average non-null values and round to closest
-    try:
-        # find indices of non-null values
-        indx, indy = np.where(data_vertlevel[:, :, idx_slice])
-        vert_level = int(np.round(np.mean(data_vertlevel[indx, indy, idx_slice])))
-    except ValueError as e:
-        # slice is empty (no indx found). Do nothing.
-        log.debug('Empty slice: z=%s (%s)', idx_slice, e)
-        vert_level = None
+    if index is None:
+        index = get_vertebral_level_index(im_vertlevel)
+    vert_level = index.get_level(idx_slice)
+    if vert_level is None:
+        log.debug('Empty slice: z=%s', idx_slice)
     return vert_level
-
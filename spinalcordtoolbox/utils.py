@@ -4,7 +4,7 @@
 
 from __future__ import absolute_import
 
-import re
+import sys, re, importlib, types
 
 def parse_num_list(str_num):
     """
@@ -39,3 +39,67 @@ def parse_num_list(str_num):
         raise ValueError("unexpected group element {} group spec {}".format(element, str_num))
 
     return list_num
+
+
+_keras_threads_set = []
+
+
+def set_keras_threads():
+    """
+    Limit the number of threads used by the TensorFlow backend of Keras, if the environment variables
+    TF_NUM_INTRAOP_THREADS and/or TF_NUM_INTEROP_THREADS are set (e.g. by sct_pipeline, to share a node between jobs).
+    Recent versions of TensorFlow read these variables directly; this sets them for older versions.
+    Called before building a model: the session is only created once, when a model is actually needed.
+    """
+    import os
+    if _keras_threads_set:
+        return
+    _keras_threads_set.append(True)
+    intra_op = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+    inter_op = int(os.environ.get('TF_NUM_INTEROP_THREADS', 0))
+    if not intra_op and not inter_op:
+        return
+
+    from keras import backend as K
+    if K.backend() != 'tensorflow' or not hasattr(K, 'set_session'):
+        return
+    import tensorflow as tf
+    if not hasattr(tf, 'ConfigProto'):
+        return
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op, inter_op_parallelism_threads=inter_op)
+    K.set_session(tf.Session(config=config))
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder of a module, which is imported on first access to one of its attributes.
+    Heavy dependencies that are only needed by some code paths (pandas, sklearn, matplotlib, ...) are imported with
+    lazy_import(), so that they do not slow down the startup of command-line tools.
+    """
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """
+    Import a module on first use. Example: pd = lazy_import('pandas')
+    :param name: full name of the module, e.g. 'scipy.ndimage'
+    :return: the module if it is already imported, otherwise a LazyModule
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,125 @@
+# coding: utf-8
+# Slab-wise computation of voxelwise quantitative maps (tSNR, MTR, MTsat, ...)
+# Input images are read by slabs of slices along z, in float32, and each output map is filled slab by slab in a
+# memory-mapped file before being written to NIfTI, so that the memory used does not depend on the size of the data.
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+# About the license: see the file LICENSE.TXT
+
+from __future__ import absolute_import, division
+
+import os
+import gzip
+import shutil
+
+import numpy as np
+import nibabel
+
+import sct_utils as sct
+
+
+DEFAULT_MEMORY = 1024  # memory budget for the input slabs and kernel temporaries, in MB
+NB_TEMPORARIES = 4  # number of float32 temporaries per input voxel assumed when sizing slabs
+
+
+def open_input(fname, path_tmp, prefix='input'):
+    """
+    Open an image without loading its data. Compressed images are first decompressed into path_tmp, so that their
+    data can be memory-mapped and read by slabs.
+    :param fname: image file name (.nii or .nii.gz)
+    :param path_tmp: folder for the decompressed image
+    :param prefix: prefix of the decompressed file name
+    :return: nibabel image
+    """
+    if fname.endswith('.gz'):
+        fname_raw = os.path.join(path_tmp, prefix + '_' + os.path.basename(fname)[:-3])
+        with gzip.open(fname, 'rb') as f_in, open(fname_raw, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 ** 2)
+        fname = fname_raw
+    return nibabel.load(fname)
+
+
+def get_slab_size(list_shape, memory=DEFAULT_MEMORY):
+    """
+    Number of slices along z that can be processed at once within the memory budget.
+    :param list_shape: list of input shapes (x, y, z[, t])
+    :param memory: memory budget in MB
+    :return: int
+    """
+    nb_voxels_per_z = sum([int(np.prod(shape[:2] + shape[3:])) for shape in list_shape])
+    nb_bytes_per_z = nb_voxels_per_z * np.dtype(np.float32).itemsize * NB_TEMPORARIES
+    return max(1, int(memory * 1024 ** 2 // nb_bytes_per_z))
+
+
+def iter_slabs(nz, slab_size):
+    """
+    Split range(nz) into consecutive slabs.
+    :return: generator of slices
+    """
+    for z in range(0, nz, slab_size):
+        yield slice(z, min(z + slab_size, nz))
+
+
+def nan_to_num(data):
+    """
+    In-place equivalent of np.nan_to_num for float arrays.
+    """
+    info = np.finfo(data.dtype)
+    data[np.isnan(data)] = 0
+    data[np.isposinf(data)] = info.max
+    data[np.isneginf(data)] = info.min
+    return data
+
+
+def compute_maps(list_fname_in, list_fname_out, kernel, memory=DEFAULT_MEMORY, path_tmp=None, verbose=1):
+    """
+    Compute voxelwise maps by slabs of slices along z.
+    :param list_fname_in: list of input images. They must have the same x, y, z dimensions; 4D images are read with all
+                          their volumes.
+    :param list_fname_out: list of output images (x, y, z), written in float32 with the header of the first input.
+    :param kernel: function taking one float32 array per input, for a slab of slices (x, y, slab[, t]), and returning
+                   a tuple with one array (x, y, slab) per output. The input arrays are owned by the kernel and can be
+                   modified in place.
+    :param memory: memory budget in MB, used to choose the slab size
+    :param path_tmp: folder for temporary files. If None, a temporary folder is created and removed afterwards.
+    :param verbose:
+    :return: list_fname_out
+    """
+    remove_tmp = path_tmp is None
+    if remove_tmp:
+        path_tmp = sct.tmp_create(basename="voxelwise", verbose=verbose)
+
+    list_im = [open_input(fname, path_tmp, 'input{}'.format(i)) for i, fname in enumerate(list_fname_in)]
+    list_shape = [tuple(im.shape) for im in list_im]
+    shape_out = list_shape[0][:3]
+    for fname, shape in zip(list_fname_in, list_shape):
+        if shape[:3] != shape_out:
+            raise ValueError("Image {} has dimensions {}, expected {}".format(fname, shape[:3], shape_out))
+
+    # outputs are filled slab by slab in memory-mapped files (Fortran order, so that z-slabs are contiguous)
+    list_data_out = [np.memmap(os.path.join(path_tmp, 'output{}.dat'.format(i)), dtype=np.float32, mode='w+',
+                               shape=shape_out, order='F')
+                     for i in range(len(list_fname_out))]
+
+    slab_size = get_slab_size(list_shape, memory)
+    sct.printv('Process {} slices by slabs of {}...'.format(shape_out[2], slab_size), verbose)
+    for slab in iter_slabs(shape_out[2], slab_size):
+        list_data_in = [np.asarray(im.dataobj[:, :, slab], dtype=np.float32) for im in list_im]
+        list_result = kernel(*list_data_in)
+        for data_out, result in zip(list_data_out, list_result):
+            data_out[:, :, slab] = result
+        del list_data_in, list_result
+
+    # write outputs. nibabel writes the data in chunks, directly from the memory-mapped arrays.
+    hdr = list_im[0].header.copy()
+    hdr.set_data_shape(shape_out)
+    hdr.set_data_dtype(np.float32)
+    for data_out, fname_out in zip(list_data_out, list_fname_out):
+        data_out.flush()
+        nibabel.save(nibabel.Nifti1Image(data_out, None, hdr), fname_out)
+        sct.printv('  File created: ' + fname_out, verbose)
+
+    del list_im, list_data_out
+    if remove_tmp:
+        sct.rmtree(path_tmp, verbose=0)
+
+    return list_fname_out
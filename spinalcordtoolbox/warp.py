@@ -0,0 +1,520 @@
+# coding: utf-8
+# Apply displacement fields in-process, with the conventions of antsApplyTransforms.
+#
+# A displacement field written by ANTs is a 5D NIfTI file (nx, ny, nz, 1, 3) with the vector intent (2 components for
+# 2D fields). For each voxel of its grid, it holds the displacement (in mm, in ITK's LPS physical space) from a point
+# of the destination space to the corresponding point of the source space. ITK affine transformations (.txt, .mat)
+# also map destination points to source points.
+# Warping an image samples the source image at the destination points moved by the transformations. Composing
+# transformations samples the chain of transformations at the points of a grid, giving a single displacement field.
+# Sampling coordinates are computed once per destination/source geometry, and shared by all the images warped
+# with the same transformation (e.g. all the files of the PAM50 template).
+# Copyright (c) 2018 Polytechnique Montreal <www.neuro.polymtl.ca>
+# About the license: see the file LICENSE.TXT
+
+from __future__ import division, absolute_import
+
+import os
+import threading
+import multiprocessing
+
+import numpy as np
+import nibabel
+from concurrent.futures import ThreadPoolExecutor
+
+import sct_utils as sct
+from spinalcordtoolbox.utils import lazy_import
+
+ndimage = lazy_import('scipy.ndimage')
+
+
+# interpolation orders of the interpolations of sct_apply_transfo
+INTERP_ORDER = {'nn': 0, 'linear': 1, 'spline': 3}
+
+# conversion of vectors between ITK's LPS and NIfTI's RAS physical spaces
+LPS_TO_RAS = np.array([-1., -1., 1.])
+
+CHUNK_SIZE = 2 ** 18  # number of points transformed or sampled at once
+NB_THREADS = 4  # default maximum number of images warped in parallel
+SPLINE_PADDING = 12  # padding of the images before computing their spline coefficients, as in scipy.ndimage
+
+
+def apply_affine(affine, points):
+    """
+    :param points: (3, N) array
+    """
+    return np.dot(affine[:3, :3], points) + affine[:3, 3:4]
+
+
+def inside_grid(coordinates, shape):
+    """
+    :param coordinates: (3, N) voxel coordinates
+    :return: (N,) boolean, True for the points that ITK interpolators consider inside the grid [-0.5, n - 0.5]
+    """
+    inside = np.ones(coordinates.shape[1], dtype=bool)
+    for axis in range(3):
+        inside &= (coordinates[axis] >= -0.5) & (coordinates[axis] <= shape[axis] - 0.5)
+    return inside
+
+
+def get_nb_threads(nb_threads=None):
+    """
+    :param nb_threads: number of threads. None: number of CPUs, up to NB_THREADS (each thread holds whole volumes)
+    """
+    return min(NB_THREADS, multiprocessing.cpu_count()) if nb_threads is None else max(1, nb_threads)
+
+
+def iter_chunks(size, chunk_size=CHUNK_SIZE):
+    """
+    :return: generator of (start, stop) of consecutive chunks of range(size)
+    """
+    for start in range(0, size, chunk_size):
+        yield start, min(start + chunk_size, size)
+
+
+def prefilter(data, order):
+    """
+    Spline coefficients of an image, computed once and sampled by chunks with map_coordinates(..., prefilter=False)
+    (map_coordinates would otherwise filter the whole image for each chunk). As map_coordinates does, the image is
+    padded with its edge values before filtering, so that the result matches mode='nearest'.
+    :param order: interpolation order. Orders 0 and 1 do not need coefficients: data is returned as is
+    :return: coefficients, padding (number of voxels added before the first voxel of each axis)
+    """
+    if order <= 1:
+        return data, 0
+    try:
+        return ndimage.spline_filter(np.pad(data, SPLINE_PADDING, mode='edge'), order, output=np.float64, mode='nearest'), SPLINE_PADDING
+    except TypeError:
+        # scipy < 1.6: map_coordinates neither pads the image nor takes the mode into account to filter it
+        return ndimage.spline_filter(data, order, output=np.float64), 0
+
+
+def get_grid_points(shape, affine, start, stop):
+    """
+    :return: (3, stop - start) physical coordinates of the voxels start to stop of the flattened grid
+    """
+    return apply_affine(affine, np.array(np.unravel_index(np.arange(start, stop), shape), dtype=np.float64))
+
+
+def is_displacement_field(fname):
+    """
+    :return: True if fname is a displacement field that can be applied by this module (NIfTI with vector intent)
+    """
+    if fname.startswith('-') or not fname.endswith(('.nii', '.nii.gz')) or not os.path.isfile(fname):
+        return False
+    img = nibabel.load(fname)
+    return img.header.get_intent()[0] == 'vector' and len(img.shape) == 5 and img.shape[3] == 1 \
+     and img.shape[4] in [2, 3]
+
+
+class DisplacementField(object):
+    """
+    Displacement field, in the RAS space
+    """
+    def __init__(self, field, affine, ndim=3):
+        """
+        :param field: (nx, ny, nz, 3) displacement in mm, RAS
+        :param affine: affine of the grid of the field
+        :param ndim: 2 for the 2D fields of ITK, which do not depend on z and do not move points along z
+        """
+        self.field = field
+        self.affine = affine
+        self.ndim = ndim
+
+    @classmethod
+    def load(cls, fname, dtype=np.float32):
+        if not is_displacement_field(fname):
+            raise ValueError("Displacement field in {} is invalid: should be encoded in a 5D file with vector intent"
+                             " code".format(fname))
+        img = nibabel.load(fname)
+        data = np.asarray(img.dataobj, dtype=dtype)[:, :, :, 0, :]
+        field = np.zeros(data.shape[:3] + (3,), dtype=dtype)
+        field[..., :data.shape[3]] = data * LPS_TO_RAS[:data.shape[3]]
+        return cls(field, img.affine, ndim=data.shape[3])
+
+    def transform_points(self, points):
+        """
+        :param points: (3, N) physical coordinates (RAS, mm)
+        """
+        coordinates = apply_affine(np.linalg.inv(self.affine), points)
+        if self.ndim == 2:
+            coordinates[2] = 0
+        inside = inside_grid(coordinates, self.field.shape)
+        displacement = np.zeros_like(points)
+        for axis in range(self.ndim):
+            # points outside the field are not moved
+            displacement[axis, inside] = ndimage.map_coordinates(self.field[..., axis], coordinates[:, inside],
+                                                                 order=1, mode='nearest')
+        return points + displacement
+
+    def save(self, fname, header=None):
+        """
+        Save the field as ANTs does (5D, LPS, vector intent), in float32
+        :param header: header of the image of the grid of the field (e.g. the destination image)
+        """
+        data = (self.field[..., :self.ndim] * LPS_TO_RAS[:self.ndim]).astype(np.float32)
+        data = data[:, :, :, np.newaxis, :]
+        header = nibabel.Nifti1Header() if header is None else header.copy()
+        header.set_data_dtype(np.float32)
+        header.set_data_shape(data.shape)
+        img = nibabel.Nifti1Image(data, self.affine, header)
+        img.header.set_intent('vector')
+        nibabel.save(img, fname)
+
+
+class AffineTransform(object):
+    """
+    Affine transformation of physical points (RAS), from the destination space to the source space
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    @classmethod
+    def from_itk(cls, parameters, fixed_parameters):
+        """
+        :param parameters: matrix (row-major) and translation of the ITK transformation, in the LPS space
+        :param fixed_parameters: center of the ITK transformation, in the LPS space
+        """
+        parameters = np.asarray(parameters, dtype=np.float64).ravel()
+        center = np.asarray(fixed_parameters, dtype=np.float64).ravel()
+        ndim = len(center)
+        if ndim not in [2, 3] or len(parameters) != ndim * ndim + ndim:
+            raise ValueError('Invalid affine transformation parameters')
+        # x -> A (x - c) + t + c, in 3D (2D transformations do not move points along z)
+        matrix = np.eye(4)
+        matrix[:ndim, :ndim] = parameters[:ndim * ndim].reshape(ndim, ndim)
+        matrix[:ndim, 3] = parameters[ndim * ndim:] + center - np.dot(matrix[:ndim, :ndim], center)
+        # LPS -> RAS
+        flip = np.diag(np.append(LPS_TO_RAS, 1))
+        return cls(np.dot(flip, np.dot(matrix, flip)))
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Read an ITK affine transformation, in text (.txt) or Matlab (.mat) format
+        """
+        if fname.endswith('.mat'):
+            from scipy.io import loadmat
+            content = loadmat(fname)
+            names = [name for name in content if name.startswith(('AffineTransform', 'MatrixOffsetTransformBase'))]
+            if not names or 'fixed' not in content:
+                raise ValueError('Unsupported transformation in {}'.format(fname))
+            return cls.from_itk(content[names[0]], content['fixed'])
+        transform, parameters, fixed_parameters = None, None, None
+        with open(fname) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'Transform':
+                    transform = value.strip()
+                elif key == 'Parameters':
+                    parameters = [float(v) for v in value.split()]
+                elif key == 'FixedParameters':
+                    fixed_parameters = [float(v) for v in value.split()]
+        if transform is None or not transform.startswith(('AffineTransform', 'MatrixOffsetTransformBase')) \
+         or parameters is None or fixed_parameters is None:
+            raise ValueError('Unsupported transformation in {}: {}'.format(fname, transform))
+        return cls.from_itk(parameters, fixed_parameters)
+
+    def inverse(self):
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    def transform_points(self, points):
+        return apply_affine(self.matrix, points)
+
+
+def read_transform(fname):
+    """
+    Read a transformation as given to sct_apply_transfo and sct_concat_transfo: a displacement field, or an affine
+    transformation, inverted if its file name starts with '-'
+    :return: DisplacementField or AffineTransform
+    """
+    if fname.startswith('-'):
+        if fname[1:].endswith(('.nii', '.nii.gz')):
+            raise ValueError('Displacement fields cannot be inverted, use the inverse warping field: {}'.format(fname))
+        return AffineTransform.load(fname[1:]).inverse()
+    if fname.endswith(('.nii', '.nii.gz')):
+        return DisplacementField.load(fname)
+    return AffineTransform.load(fname)
+
+
+def can_read_transforms(fname_warp):
+    """
+    :return: True if all the transformations can be read by this module
+    """
+    for fname in fname_warp:
+        path = fname[1:] if fname.startswith('-') else fname
+        if not os.path.isfile(path):
+            return False
+        if path.endswith(('.nii', '.nii.gz')):
+            if fname.startswith('-') or not is_displacement_field(path):
+                return False
+        else:
+            try:
+                AffineTransform.load(path)
+            except (ValueError, IOError, KeyError):
+                return False
+    return True
+
+
+def read_transforms(fname_warp):
+    """
+    :param fname_warp: list of transformations (file names, DisplacementField or AffineTransform)
+    :return: list of DisplacementField or AffineTransform
+    """
+    return [transform if hasattr(transform, 'transform_points') else read_transform(transform)
+            for transform in fname_warp]
+
+
+def transform_points(points, fname_warp):
+    """
+    Move points of the destination space to the source space.
+    :param points: (3, N) physical coordinates (RAS, mm)
+    :param fname_warp: list of transformations (file names, DisplacementField or AffineTransform), in the order of
+    sct_apply_transfo -w (the first one is the closest to the source space: it is applied last to the points)
+    :return: (3, N) physical coordinates in the source space
+    """
+    for transform in fname_warp[::-1]:
+        if not hasattr(transform, 'transform_points'):
+            transform = read_transform(transform)
+        points = transform.transform_points(points)
+    return points
+
+
+def get_sampling_coordinates(fname_warp, shape_dest, affine_dest, affine_src, chunk_size=CHUNK_SIZE):
+    """
+    Voxel coordinates in the source image of all the voxels of the destination image. The transformations are read
+    once, and the points of the destination grid are transformed by chunks.
+    :return: (3, N) float32 array, in the order of the flattened destination grid
+    """
+    transforms = read_transforms(fname_warp)
+    shape_dest = tuple(shape_dest[:3])
+    affine_src_inv = np.linalg.inv(affine_src)
+    coordinates = np.empty((3, int(np.prod(shape_dest))), dtype=np.float32)
+    for start, stop in iter_chunks(coordinates.shape[1], chunk_size):
+        points = transform_points(get_grid_points(shape_dest, affine_dest, start, stop), transforms)
+        coordinates[:, start:stop] = apply_affine(affine_src_inv, points)
+    return coordinates
+
+
+def compose(fname_warp, shape, affine, ndim=3, chunk_size=CHUNK_SIZE, dtype=np.float32):
+    """
+    Compose transformations into a single displacement field defined on a grid, as isct_ComposeMultiTransform does.
+    The transformations are read once, and the points of the grid are transformed by chunks.
+    :param fname_warp: list of transformations, in the order of sct_concat_transfo -w
+    :param shape: shape of the grid (e.g. the destination image)
+    :param affine: affine of the grid
+    :param ndim: 2 to compose 2D ITK transformations
+    :param dtype: dtype of the displacement field
+    :return: DisplacementField
+    """
+    transforms = read_transforms(fname_warp)
+    # 2D images have a single slice
+    shape = tuple(shape[:3]) + (1,) * (3 - len(shape[:3]))
+    field = np.zeros((int(np.prod(shape)), 3), dtype=dtype)
+    for start, stop in iter_chunks(len(field), chunk_size):
+        points = get_grid_points(shape, affine, start, stop)
+        field[start:stop] = (transform_points(points, transforms) - points).T
+    return DisplacementField(field.reshape(shape + (3,)), affine, ndim=ndim)
+
+
+def inverse_consistency(fname_forward, fname_inverse, shape, affine, chunk_size=CHUNK_SIZE):
+    """
+    Inverse consistency of two chains of transformations: distance between the points of a grid and the same points
+    moved by the forward, then by the inverse transformations.
+    :param fname_forward: list of transformations, e.g. warping fields from src to dest (defined in the dest space)
+    :param fname_inverse: list of transformations, e.g. warping fields from dest to src (defined in the src space)
+    :param shape, affine: grid of the points, in the space of fname_forward
+    :return: (shape) array of distances, in mm
+    """
+    field = compose(list(fname_inverse) + list(fname_forward), shape, affine, chunk_size=chunk_size,
+                    dtype=np.float64)
+    return np.sqrt(np.sum(field.field ** 2, axis=-1))
+
+
+class Sampler(object):
+    """
+    Sampling of source images of a given geometry at the same coordinates, by chunks of points. Only the bounding box
+    of the sampled voxels is read from each source image.
+    """
+    def __init__(self, coordinates, shape_src, chunk_size=CHUNK_SIZE):
+        """
+        :param coordinates: (3, N) voxel coordinates in the source images (see get_sampling_coordinates)
+        """
+        self.inside = inside_grid(coordinates, shape_src)
+        self.chunk_size = chunk_size
+        if self.inside.any():
+            coordinates_min = np.full(3, np.inf)
+            coordinates_max = np.full(3, -np.inf)
+            for a, b in iter_chunks(len(self.inside), chunk_size):
+                c = coordinates[:, a:b][:, self.inside[a:b]]
+                if c.size:
+                    coordinates_min = np.minimum(coordinates_min, c.min(1))
+                    coordinates_max = np.maximum(coordinates_max, c.max(1))
+            start = np.clip(np.floor(coordinates_min), 0, np.array(shape_src[:3]) - 1).astype(int)
+            stop = np.clip(np.ceil(coordinates_max), 0, np.array(shape_src[:3]) - 1).astype(int) + 1
+        else:
+            start = stop = np.zeros(3, dtype=int)
+        self.bbox = tuple(slice(a, b) for a, b in zip(start, stop))
+        self.start = start
+        self.coordinates = coordinates
+
+    def read(self, img):
+        """
+        :param img: source image (nibabel)
+        :return: float32 array of the bounding box of the sampled voxels
+        """
+        return np.asarray(img.dataobj[self.bbox], dtype=np.float32)
+
+    def sample(self, img, interp='linear'):
+        """
+        :param img: source image (nibabel), or array returned by read()
+        :return: (N,) float32 array, 0 outside the source image
+        """
+        values = np.zeros(self.inside.shape, dtype=np.float32)
+        if not self.inside.any():
+            return values
+        order = INTERP_ORDER[interp]
+        data, padding = prefilter(img if isinstance(img, np.ndarray) else self.read(img), order)
+        offset = (padding - self.start)[:, np.newaxis]
+        for start, stop in iter_chunks(len(values), self.chunk_size):
+            inside = self.inside[start:stop]
+            coordinates = self.coordinates[:, start:stop][:, inside].astype(np.float64) + offset
+            values[start:stop][inside] = ndimage.map_coordinates(data, coordinates, order=order, mode='nearest',
+                                                                 prefilter=False)
+        return values
+
+
+def warp_images(fname_in, fname_out, fname_dest, fname_warp, interp='linear', nb_threads=None, verbose=1):
+    """
+    Warp 3D images to the destination space, as sct_apply_transfo would do for each image. The sampling coordinates
+    are computed once for each geometry of the input images (float32, by chunks of points), and the images are warped
+    in parallel: each thread holds the output volume of its image.
+    :param fname_in: list of 3D images
+    :param fname_out: list of output images (float32, in the space of fname_dest)
+    :param fname_dest: destination image
+    :param fname_warp: list of displacement fields, in the order of sct_apply_transfo -w
+    :param interp: 'nn', 'linear' or 'spline', or list of interpolations for each image
+    :param nb_threads: number of images warped in parallel. None: number of CPUs, up to NB_THREADS
+    """
+    if isinstance(interp, str):
+        interp = [interp] * len(fname_in)
+    img_dest = nibabel.load(fname_dest)
+    shape_dest = img_dest.shape[:3]
+    header = img_dest.header.copy()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(shape_dest)
+
+    # one sampler per geometry of the input images
+    samplers = {}
+    imgs = [nibabel.load(fname) for fname in fname_in]
+    for img in imgs:
+        if len(img.shape) != 3:
+            raise ValueError('Only 3D images can be warped in-process: {}'.format(img.get_filename()))
+        key = (img.shape, img.affine.tobytes())
+        if key not in samplers:
+            sct.printv('  compute sampling coordinates (' + 'x'.join(str(n) for n in img.shape) + ' -> ' +
+                       'x'.join(str(n) for n in shape_dest) + ')', verbose)
+            coordinates = get_sampling_coordinates(fname_warp, shape_dest, img_dest.affine, img.affine)
+            samplers[key] = Sampler(coordinates, img.shape)
+
+    def warp(i):
+        img = imgs[i]
+        values = samplers[(img.shape, img.affine.tobytes())].sample(img, interp[i])
+        img_out = nibabel.Nifti1Image(values.reshape(shape_dest), img_dest.affine, header)
+        nibabel.save(img_out, fname_out[i])
+        sct.printv('  ' + os.path.basename(fname_out[i]) + ' (' + interp[i] + ')', verbose)
+
+    with ThreadPoolExecutor(max_workers=get_nb_threads(nb_threads)) as executor:
+        list(executor.map(warp, range(len(imgs))))
+
+
+class TransformCache(object):
+    """
+    Transformations shared by several images: each file is read once, and released after the last image using it
+    """
+    def __init__(self, list_fname_warp):
+        """
+        :param list_fname_warp: list with the list of transformations of each image
+        """
+        self.count = {}
+        for fname_warp in list_fname_warp:
+            for fname in fname_warp:
+                self.count[fname] = self.count.get(fname, 0) + 1
+        self.transforms = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, fname_warp):
+        """
+        :return: list of DisplacementField or AffineTransform
+        """
+        with self.lock:
+            for fname in fname_warp:
+                if fname not in self.transforms:
+                    self.transforms[fname] = read_transforms([fname])[0]
+            return [self.transforms[fname] for fname in fname_warp]
+
+    def release(self, fname_warp):
+        with self.lock:
+            for fname in fname_warp:
+                self.count[fname] -= 1
+                if not self.count[fname]:
+                    del self.transforms[fname]
+
+
+def merge_images(fname_src, fname_dest, fname_warp, interp='linear', threshold=0., nb_threads=None,
+                 chunk_size=CHUNK_SIZE, verbose=1):
+    """
+    Merge 3D images in the destination space, as a weighted average by the partial volume of each image: its binary
+    support (voxels > threshold) warped with the same interpolation. Each image and its support are sampled at the same
+    coordinates, computed by chunks of destination voxels, and accumulated into two float32 buffers, so that the
+    memory used does not depend on the number of images. Images are warped in parallel, and each transformation file
+    is read once.
+    :param fname_src: list of 3D images
+    :param fname_dest: destination image
+    :param fname_warp: list with the list of transformations of each image, in the order of sct_apply_transfo -w
+    :param threshold: voxels above threshold are in the support of an image
+    :param nb_threads: number of images warped in parallel. None: number of CPUs, up to NB_THREADS
+    :return: float32 array with the shape of the destination image: sum(data * pv) / sum(pv), 0 where sum(pv) is 0
+    """
+    img_dest = nibabel.load(fname_dest)
+    shape_dest = img_dest.shape[:3]
+    sum_data = np.zeros(int(np.prod(shape_dest)), dtype=np.float32)
+    sum_pv = np.zeros_like(sum_data)
+    lock = threading.Lock()
+    cache = TransformCache(fname_warp)
+
+    def warp(i):
+        img = nibabel.load(fname_src[i])
+        if len(img.shape) != 3:
+            raise ValueError('Only 3D images can be merged in-process: {}'.format(fname_src[i]))
+        order = INTERP_ORDER[interp]
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        support, padding = prefilter((data > threshold).astype(np.float32), order)
+        data, padding = prefilter(data, order)
+        affine_src_inv = np.linalg.inv(img.affine)
+        transforms = cache.acquire(fname_warp[i])
+        try:
+            for start, stop in iter_chunks(len(sum_data), chunk_size):
+                points = transform_points(get_grid_points(shape_dest, img_dest.affine, start, stop), transforms)
+                coordinates = apply_affine(affine_src_inv, points)
+                inside = inside_grid(coordinates, img.shape)
+                if not inside.any():
+                    continue
+                coordinates = coordinates[:, inside] + padding
+                partial_volume = ndimage.map_coordinates(support, coordinates, order=order, mode='nearest',
+                                                         prefilter=False)
+                values = ndimage.map_coordinates(data, coordinates, order=order, mode='nearest', prefilter=False)
+                values *= partial_volume
+                with lock:
+                    sum_data[start:stop][inside] += values
+                    sum_pv[start:stop][inside] += partial_volume
+        finally:
+            cache.release(fname_warp[i])
+        sct.printv('  ' + os.path.basename(fname_src[i]), verbose)
+
+    with ThreadPoolExecutor(max_workers=get_nb_threads(nb_threads)) as executor:
+        list(executor.map(warp, range(len(fname_src))))
+
+    np.divide(sum_data, sum_pv, out=sum_data, where=sum_pv != 0)
+    sum_data[sum_pv == 0] = 0
+    return sum_data.reshape(shape_dest)
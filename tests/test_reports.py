@@ -119,7 +119,7 @@ def test_propseg(t2_image, t2_seg_image):
     test(qcslice.Axial(t2_image, t2_seg_image))
     assert os.path.isfile(param.abs_bkg_img_path())
     assert os.path.isfile(param.abs_overlay_img_path())
-    assert os.path.isfile(param.qc_results)
+    assert os.path.isfile(os.path.join(param.root_folder, 'index.html'))
 
 
 
@@ -135,3 +135,109 @@ def test_propseg(t2_image, t2_seg_image):
 #
 #     test(qcslice.Axial(t2_image, t2_seg_image), param.nb_column, param.threshold)
 #     assert_qc_assets('/tmp/qc')
+
+
+class FakeSlice(object):
+    """Minimal stand-in for spinalcordtoolbox.reports.slice.Slice"""
+    def __init__(self, img, mask, aspect=1.):
+        self.img, self.mask, self._aspect = img, mask, aspect
+
+    def get_name(self):
+        return 'Axial'
+
+    def aspect(self):
+        return [self._aspect, self._aspect]
+
+
+def _write_entry(args):
+    path_qc, i = args
+    param = qc.Params(os.path.join(path_qc, 'sub', 'contrast', 'im.nii.gz'), 'sct_test', ['-i', str(i)], 'Axial', path_qc)
+    report = qc.QcReport(param, '')
+    report.make_content_path()
+    report.update_description_file((10, 10))
+
+
+def test_concurrent_entries(tmpdir):
+    import multiprocessing
+    path_qc = str(tmpdir)
+    pool = multiprocessing.Pool(4)
+    pool.map(_write_entry, [(path_qc, i) for i in range(16)])
+    pool.close()
+    pool.join()
+    # the results are merged by the browser, from the script read by index.html
+    assert os.path.isfile(os.path.join(path_qc, 'index.html'))
+    with open(os.path.join(path_qc, '_json', 'qc_results.js')) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 16 and all(line.startswith('sct_data.push({') for line in lines)
+    # qc_results.json is appended with each result
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        results_appended = json.load(f)
+    assert sorted(r['cmdline'] for r in results_appended) == sorted('sct_test -i {}'.format(i) for i in range(16))
+    results = qc.generate_report(path_qc)
+    assert sorted(r['cmdline'] for r in results) == sorted('sct_test -i {}'.format(i) for i in range(16))
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        assert len(json.load(f)) == 16
+    assert os.path.isfile(os.path.join(path_qc, 'index.html'))
+
+
+def test_legacy_results_are_kept(tmpdir):
+    path_qc = str(tmpdir)
+    with open(os.path.join(path_qc, 'qc_results.json'), 'w') as f:
+        json.dump([{'cmdline': 'old'}], f)
+    _write_entry((path_qc, 0))
+    assert [r['cmdline'] for r in qc.load_results(path_qc)] == ['old', 'sct_test -i 0']
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        assert [r['cmdline'] for r in json.load(f)] == ['old', 'sct_test -i 0']
+    with open(os.path.join(path_qc, '_json', 'qc_results.js')) as f:
+        assert f.read().count('sct_data.push(') == 2
+
+
+def test_results_json_appended(tmpdir):
+    path_qc = str(tmpdir)
+    for i in range(3):
+        _write_entry((path_qc, i))
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        text = f.read()
+    # same file as the one written by generate_report
+    qc.generate_report(path_qc)
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        assert f.read() == text
+    # an invalid file is rebuilt from the result entries
+    with open(os.path.join(path_qc, 'qc_results.json'), 'w') as f:
+        f.write('[\n  {"cmdline":')
+    _write_entry((path_qc, 3))
+    with open(os.path.join(path_qc, 'qc_results.json')) as f:
+        assert [r['cmdline'] for r in json.load(f)] == ['sct_test -i {}'.format(i) for i in range(4)]
+
+
+def test_native_resolution_overlay(tmpdir):
+    import numpy as np
+    import matplotlib.image
+    param = qc.Params(os.path.join(str(tmpdir), 'sub', 'contrast', 'im.nii.gz'), 'sct_test', [], 'Axial', str(tmpdir))
+    report = qc.QcReport(param, '')
+
+    @qc.QcImage(report, 'none', [qc.QcImage.listed_seg, ], stretch_contrast=False)
+    def test(qslice):
+        return qslice.img, qslice.mask
+
+    img = np.random.rand(20, 30)
+    mask = np.zeros((20, 30))
+    mask[5:10, 5:10] = 1
+    test(FakeSlice(img, mask, aspect=2.))
+    overlay = matplotlib.image.imread(param.abs_overlay_img_path())
+    assert overlay.shape == (40, 30, 4)
+    assert overlay[0, 0, 3] == 0
+    assert overlay[12, 6, 3] == 1
+
+
+def test_interpolation(tmpdir):
+    import numpy as np
+    param = qc.Params(os.path.join(str(tmpdir), 'sub', 'contrast', 'im.nii.gz'), 'sct_test', [], 'Axial', str(tmpdir))
+    rgba = np.zeros((4, 3, 4), dtype=np.uint8)
+    rgba[2:, :, :] = 255
+    nearest = qc.QcImage(qc.QcReport(param, ''), 'none', [])._apply_aspect(rgba, 2.)
+    assert nearest.shape == (8, 3, 4)
+    assert set(np.unique(nearest)) == {0, 255}
+    bilinear = qc.QcImage(qc.QcReport(param, ''), 'bilinear', [])._apply_aspect(rgba, 2.)
+    assert bilinear.shape == (8, 3, 4) and bilinear.dtype == np.uint8
+    assert len(np.unique(bilinear)) > 2
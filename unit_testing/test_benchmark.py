@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_benchmark
+
+from __future__ import print_function, absolute_import
+
+import copy
+
+import pytest
+
+import msct_benchmark
+
+
+@pytest.fixture
+def scenarios():
+    """
+    Temporarily register test scenarios
+    """
+    scenarios_orig = msct_benchmark.SCENARIOS.copy()
+
+    @msct_benchmark.scenario('test_sum', repeat=2)
+    def bench_sum(path_tmp):
+        import numpy as np
+        data = np.ones((100, 100))
+        return lambda: data.sum()
+
+    @msct_benchmark.scenario('test_skipped')
+    def bench_skipped(path_tmp):
+        msct_benchmark.require_executable('isct_this_binary_does_not_exist')
+
+    @msct_benchmark.scenario('test_error')
+    def bench_error(path_tmp):
+        raise ValueError('failed setup')
+
+    yield
+    msct_benchmark.SCENARIOS.clear()
+    msct_benchmark.SCENARIOS.update(scenarios_orig)
+
+
+def test_run_benchmarks(scenarios, tmpdir):
+    results = msct_benchmark.run_benchmarks(['test_sum', 'test_skipped', 'test_error'], verbose=0)
+    result = results['results']['test_sum']
+    assert result['status'] == msct_benchmark.STATUS_OK
+    assert len(result['times']) == 2
+    assert result['time_min'] <= result['time_median']
+    assert result['peak_rss_mb'] > 0
+    assert results['results']['test_skipped']['status'] == msct_benchmark.STATUS_SKIPPED
+    assert results['results']['test_error']['status'] == msct_benchmark.STATUS_ERROR
+    assert 'failed setup' in results['results']['test_error']['reason']
+    # round trip through json
+    fname = str(tmpdir.join('benchmark.json'))
+    msct_benchmark.save_results(results, fname)
+    assert msct_benchmark.load_results(fname)['results']['test_sum']['times'] == result['times']
+
+
+def test_run_unknown_scenario():
+    with pytest.raises(ValueError):
+        msct_benchmark.run_benchmarks(['this_scenario_does_not_exist'], verbose=0)
+
+
+def test_compare():
+    baseline = {'results': {
+     'a': {'status': 'ok', 'time_min': 1.0, 'peak_rss_mb': 100.},
+     'b': {'status': 'ok', 'time_min': 2.0, 'peak_rss_mb': 100.},
+     'c': {'status': 'skipped', 'reason': ''},
+    }}
+    results = copy.deepcopy(baseline)
+    results['results']['a']['time_min'] = 1.5
+    results['results']['b']['peak_rss_mb'] = 110.
+    results['results']['c'] = {'status': 'ok', 'time_min': 1.0, 'peak_rss_mb': 100.}
+    comparison = msct_benchmark.compare(results, baseline, threshold_time=0.2, threshold_memory=0.2)
+    regressions = [(c['name'], c['metric']) for c in comparison if c['regression']]
+    assert regressions == [('a', 'time_min')]
+    # scenarios not run in both are not compared
+    assert 'c' not in [c['name'] for c in comparison]
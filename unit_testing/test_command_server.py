@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_command_server
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import multiprocessing
+
+import pytest
+
+import sct_utils as sct
+import msct_command_server
+
+
+def test_get_argv():
+    assert msct_command_server.get_argv(['sct_maths', '-i', 'a b.nii']) == ['sct_maths', '-i', 'a b.nii']
+    assert msct_command_server.get_argv('sct_maths -i "a b.nii" -bin 0.5') == ['sct_maths', '-i', 'a b.nii', '-bin', '0.5']
+    assert msct_command_server.get_argv('/opt/sct/bin/sct_maths -h') == ['/opt/sct/bin/sct_maths', '-h']
+    # shell syntax and other programs run in a subprocess
+    assert msct_command_server.get_argv('sct_maths -i a.nii -bin 0.5 > log.txt') is None
+    assert msct_command_server.get_argv(['isct_antsRegistration', '-h']) is None
+    assert msct_command_server.get_argv(['sct_this_script_does_not_exist']) is None
+
+
+@pytest.fixture
+def server(tmpdir, monkeypatch):
+    path_socket = str(tmpdir.join('socket'))
+    monkeypatch.setenv(msct_command_server.ENV_SOCKET, path_socket)
+    monkeypatch.delenv(msct_command_server.ENV_SERVER, raising=False)
+    server = msct_command_server.CommandServer(path_socket, preload=['numpy'], verbose=0)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.start()
+    for i in range(100):
+        if msct_command_server.request({'command': 'ping'}) is not None:
+            break
+        time.sleep(0.1)
+    yield path_socket
+    msct_command_server.request({'command': 'stop'})
+    process.join(10)
+
+
+def test_run_through_server(server, tmpdir):
+    status, output = sct.run(['sct_maths', '-h'], verbose=0, raise_exception=False, cwd=str(tmpdir))
+    assert status == 0
+    assert 'DESCRIPTION' in output
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 1
+    # exit code of a failing script
+    status, output = sct.run('sct_maths -i does_not_exist.nii -bin 0.5 -o out.nii', verbose=0,
+                             raise_exception=False, cwd=str(tmpdir))
+    assert status != 0
+    assert 'does_not_exist.nii' in output
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 2
+    # other commands run in a subprocess
+    status, output = sct.run(['echo', 'hello'], verbose=0)
+    assert output == 'hello'
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 2
+
+
+def test_environment_of_caller(server, tmpdir, monkeypatch):
+    # the worker was forked with sct_utils already imported: the environment of the request must still apply
+    monkeypatch.setenv('SCT_LOG_LEVEL', 'DISABLE')
+    status, output = sct.run('sct_maths -i does_not_exist.nii -bin 0.5 -o out.nii', verbose=0,
+                             raise_exception=False, cwd=str(tmpdir))
+    assert status != 0
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 1
+    assert 'does_not_exist.nii' not in output
+
+
+@pytest.fixture
+def script_threads(tmpdir, monkeypatch):
+    """
+    SCT script printing the number of threads of the BLAS thread pools of the process running it
+    """
+    pytest.importorskip('threadpoolctl')
+    path_scripts = tmpdir.mkdir('scripts')
+    fname = path_scripts.join('sct_threads.py')
+    fname.write('#!{}\n'
+                'import threadpoolctl\n'
+                'import numpy\n'
+                'print(max(info["num_threads"] for info in threadpoolctl.threadpool_info()))\n'.format(sys.executable))
+    os.symlink(str(fname), str(path_scripts.join('sct_threads')))
+    fname.chmod(0o755)
+    monkeypatch.setattr(msct_command_server, 'path_scripts', str(path_scripts))
+    monkeypatch.setenv('PATH', str(path_scripts) + os.pathsep + os.environ['PATH'])
+    for name in msct_command_server.PRELOAD_ENV_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_thread_limits(script_threads, server, tmpdir):
+    # same environment as the server: run in the server
+    status, output = sct.run('sct_threads', verbose=0, cwd=str(tmpdir))
+    assert status == 0
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 1
+    # thread limits of a pipeline job: run in a subprocess, where the thread pools honour them
+    with sct.child_env(dict((name, '1') for name in msct_command_server.PRELOAD_ENV_VARIABLES)):
+        status, output = sct.run('sct_threads', verbose=0, cwd=str(tmpdir))
+    assert status == 0
+    assert output == '1'
+    assert msct_command_server.request({'command': 'ping'})['requests'] == 1
+
+
+def test_fallback_without_server(tmpdir, monkeypatch):
+    monkeypatch.setenv(msct_command_server.ENV_SOCKET, str(tmpdir.join('socket')))
+    assert msct_command_server.start_process(['sct_maths', '-h']) is None
+    monkeypatch.setenv(msct_command_server.ENV_SERVER, '0')
+    assert msct_command_server.connect() is None
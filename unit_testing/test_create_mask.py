@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the mask generation of sct_create_mask
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+import pytest
+from scipy import ndimage
+
+from spinalcordtoolbox.image import Image
+import sct_create_mask
+
+
+def make_image(data, zooms=(1., 1., 1.)):
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    hdr.set_zooms(zooms)
+    return Image(data, hdr=hdr)
+
+
+def create_mask2d(param, center, shape, size, im_data):
+    """
+    Reference implementation: one slice at a time
+    """
+    nx, ny, nz, nt, px, py, pz, pt = im_data.dim
+    offset = [int(o) for o in param.offset.split(',')]
+    xx, yy = np.mgrid[:nx, :ny]
+    xc, yc = center
+    if 'mm' in size:
+        size = float(size[:-2])
+        radius_x = np.ceil((int(np.round(size / px)) - 1) / 2.0)
+        radius_y = np.ceil((int(np.round(size / py)) - 1) / 2.0)
+    else:
+        radius_x = np.ceil((int(size) - 1) / 2.0)
+        radius_y = radius_x
+    if shape == 'box':
+        return ((abs(xx + offset[0] - xc) <= radius_x) & (abs(yy + offset[1] - yc) <= radius_y)) * 1
+    elif shape == 'cylinder':
+        return (((xx + offset[0] - xc) / radius_x) ** 2 + ((yy + offset[1] - yc) / radius_y) ** 2 <= 1) * 1
+    sigma = float(radius_x)
+    return np.exp(-(((xx + offset[0] - xc)**2) / (2 * (sigma**2)) + ((yy + offset[1] - yc)**2) / (2 * (sigma**2))))
+
+
+@pytest.fixture
+def centerline():
+    data = np.zeros((30, 25, 12))
+    data[10:14, 8:11, 2:10] = 1
+    data[12:16, 9:11, 5] = 2
+    data[3, 20, 11] = 1
+    return data
+
+
+def test_get_centers(centerline):
+    centers = sct_create_mask.get_centers(centerline)
+    assert centers.shape == (12, 2)
+    for iz in range(12):
+        if centerline[:, :, iz].any():
+            assert np.allclose(centers[iz], ndimage.center_of_mass(centerline[:, :, iz]))
+        else:
+            assert np.all(np.isnan(centers[iz]))
+
+
+@pytest.mark.parametrize('shape', ['box', 'cylinder', 'gaussian'])
+@pytest.mark.parametrize('size', ['7', '5mm'])
+def test_create_mask3d(centerline, shape, size):
+    param = sct_create_mask.Param()
+    im_data = make_image(np.zeros((30, 25, 12), dtype=np.uint8), zooms=(0.8, 0.6, 2.))
+    centers = sct_create_mask.get_centers(centerline)
+    mask = sct_create_mask.create_mask3d(param, centers, shape, size, im_data)
+    assert mask.shape == (30, 25, 12)
+    for iz in range(12):
+        if np.isnan(centers[iz, 0]):
+            assert not mask[:, :, iz].any()
+        else:
+            assert np.allclose(mask[:, :, iz], create_mask2d(param, centers[iz], shape, size, im_data))
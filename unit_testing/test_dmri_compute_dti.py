@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the chunked DTI fitting of sct_dmri_compute_dti
+
+from __future__ import print_function, absolute_import
+
+
+import pytest
+
+import numpy as np
+import nibabel
+
+dti = pytest.importorskip("dipy.reconst.dti")
+from dipy.core.gradients import gradient_table
+
+import sct_dmri_compute_dti
+
+
+@pytest.fixture
+def dmri(tmpdir):
+    rs = np.random.RandomState(0)
+    bvecs = np.concatenate([np.zeros((1, 3)), rs.randn(12, 3)])
+    bvecs[1:] /= np.linalg.norm(bvecs[1:], axis=1)[:, np.newaxis]
+    bvals = np.array([0] + [800] * 12)
+    # random diffusion tensors
+    shape = (6, 5, 4)
+    evals = np.array([1.7e-3, 0.4e-3, 0.3e-3])
+    data = np.zeros(shape + (len(bvals),))
+    for idx in np.ndindex(shape):
+        rot = np.linalg.qr(rs.randn(3, 3))[0]
+        tensor = rot.dot(np.diag(evals)).dot(rot.T)
+        data[idx] = 1000 * np.exp(-bvals * np.einsum('ij,jk,ik->i', bvecs, tensor, bvecs))
+    data[0] = 0  # background
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[2:5, 1:4, :] = 1
+
+    fname_data = str(tmpdir.join('dmri.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(data.astype(np.float32), np.eye(4)), fname_data)
+    fname_mask = str(tmpdir.join('mask.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(mask, np.eye(4)), fname_mask)
+    fname_bvals = str(tmpdir.join('bvals.txt'))
+    np.savetxt(fname_bvals, bvals[np.newaxis])
+    fname_bvecs = str(tmpdir.join('bvecs.txt'))
+    np.savetxt(fname_bvecs, bvecs.T)
+    return data, mask, bvals, bvecs, fname_data, fname_mask, fname_bvals, fname_bvecs
+
+
+@pytest.mark.parametrize("nb_jobs, use_mask", [(1, False), (2, True)])
+def test_compute_dti_chunks(tmpdir, dmri, nb_jobs, use_mask):
+    data, mask, bvals, bvecs, fname_data, fname_mask, fname_bvals, fname_bvecs = dmri
+    sct_dmri_compute_dti.param = sct_dmri_compute_dti.Param()
+    prefix = str(tmpdir.join('dti_'))
+    assert sct_dmri_compute_dti.compute_dti(fname_data, fname_bvals, fname_bvecs, prefix, 'standard', True,
+                                            fname_mask if use_mask else '', nb_jobs=nb_jobs, chunk_size=7)
+
+    tenfit = dti.TensorModel(gradient_table(bvals, bvecs)).fit(data)
+    mask_fit = mask > 0 if use_mask else np.any(data != 0, axis=3)
+    fa = nibabel.load(prefix + 'FA.nii.gz').get_fdata()
+    assert np.allclose(fa[mask_fit], tenfit.fa[mask_fit], atol=1e-4)
+    assert np.all(fa[~mask_fit] == 0)
+    md = nibabel.load(prefix + 'MD.nii.gz').get_fdata()
+    assert np.allclose(md[mask_fit], tenfit.md[mask_fit], rtol=1e-3)
+    v1 = nibabel.load(prefix + 'V1.nii.gz').get_fdata()
+    assert v1.shape == data.shape[:3] + (3,)
+    assert np.allclose(np.abs(np.sum(v1[mask_fit] * tenfit.evecs[..., 0][mask_fit], axis=1)), 1, atol=1e-3)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_download, against a local http server
+
+from __future__ import print_function, absolute_import
+
+import os
+import io
+import re
+import time
+import hashlib
+import threading
+import zipfile
+import multiprocessing
+
+import pytest
+
+pytest.importorskip('requests')
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import msct_download
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(files, ranges=True, fail_after=None):
+    """
+    Local http server serving files (dict path -> bytes), with range requests if ranges is True.
+    If fail_after is set, each response is cut after this number of bytes (server.fail_after can be changed later).
+    :return: server, list of requests (path, range header)
+    """
+    requests_log = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            requests_log.append((self.path, self.headers.get('Range')))
+            data = files.get(self.path)
+            if data is None:
+                self.send_error(404)
+                return
+            start, stop = 0, len(data)
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+            if ranges and match:
+                start = int(match.group(1))
+                stop = int(match.group(2)) + 1 if match.group(2) else len(data)
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, len(data)))
+            else:
+                self.send_response(200)
+            if ranges:
+                self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(stop - start))
+            self.send_header('Content-Disposition', 'attachment; filename="{}"'.format(os.path.basename(self.path)))
+            self.end_headers()
+            body = data[start:stop]
+            if self.server.fail_after is not None:
+                body = body[:self.server.fail_after]
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.fail_after = fail_after
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, requests_log
+
+
+def url(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+@pytest.fixture
+def archive():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for i in range(10):
+            zf.writestr('data/file{}.txt'.format(i), os.urandom(50000))
+    return buf.getvalue()
+
+
+def test_download_parallel_and_cache(tmpdir, archive):
+    server, log = make_server({'/data.zip': archive})
+    store = msct_download.ContentStore(str(tmpdir.join('cache')))
+    sha256 = hashlib.sha256(archive).hexdigest()
+    fname, filename = msct_download.download([url(server, '/data.zip')], sha256=sha256, store=store, nb_jobs=3,
+                                             chunk_size=100000, verbose=0)
+    assert filename == 'data.zip'
+    assert open(fname, 'rb').read() == archive
+    assert os.path.basename(fname) == sha256
+    # downloaded by chunks
+    assert len([r for r in log if r[1] is not None]) == 6
+    # second download is served by the store: found by its hash, without request
+    nb_requests = len(log)
+    assert msct_download.download([url(server, '/data.zip')], sha256=sha256, store=store, verbose=0) == \
+        (fname, 'data.zip')
+    assert len(log) == nb_requests
+    # without hash: found by url, after checking that the server still serves the same file
+    assert msct_download.download([url(server, '/data.zip')], store=store, verbose=0) == (fname, 'data.zip')
+    assert log[nb_requests:] == [('/data.zip', None)]
+    # extraction
+    msct_download.extract_zip(fname, str(tmpdir.join('out')), nb_jobs=3)
+    assert len(tmpdir.join('out', 'data').listdir()) == 10
+    server.shutdown()
+
+
+def test_download_mirrors(tmpdir, archive):
+    server_bad, _ = make_server({})
+    server_good, _ = make_server({'/data.zip': archive})
+    store = msct_download.ContentStore(str(tmpdir.join('cache')))
+    fname, filename = msct_download.download([url(server_bad, '/data.zip'), url(server_good, '/data.zip')],
+                                             store=store, nb_jobs=1, verbose=0)
+    assert open(fname, 'rb').read() == archive
+    server_bad.shutdown()
+    server_good.shutdown()
+
+
+def test_download_resume(tmpdir, archive):
+    store = msct_download.ContentStore(str(tmpdir.join('cache')))
+    chunk_size = 200000
+    # interrupted connections: each chunk is partially downloaded
+    server, log = make_server({'/data.zip': archive}, fail_after=80000)
+    urls = [url(server, '/data.zip')]
+    with pytest.raises(msct_download.DownloadError):
+        msct_download.download(urls, store=store, nb_jobs=2, chunk_size=chunk_size, verbose=0)
+    assert os.path.isfile(store.partial(urls) + '.json')
+    # resumed from the partial file once the server works again
+    server.fail_after = None
+    del log[:]
+    fname, filename = msct_download.download(urls, store=store, nb_jobs=2, chunk_size=chunk_size, verbose=0)
+    assert open(fname, 'rb').read() == archive
+    assert not os.path.exists(store.partial(urls))
+    # no chunk restarted from its beginning
+    starts = [int(re.match(r'bytes=(\d+)-', r).group(1)) for p, r in log if r is not None]
+    assert starts and all([start % chunk_size for start in starts])
+    server.shutdown()
+
+
+def test_download_checksum_mismatch(tmpdir, archive):
+    server, _ = make_server({'/data.zip': archive}, ranges=False)
+    store = msct_download.ContentStore(str(tmpdir.join('cache')))
+    with pytest.raises(msct_download.DownloadError):
+        msct_download.download([url(server, '/data.zip')], sha256='0' * 64, store=store, verbose=0)
+    assert os.listdir(store.path_objects) == []
+    server.shutdown()
+
+
+def test_download_updated_file(tmpdir, archive):
+    files = {'/data.zip': archive}
+    server, log = make_server(files)
+    store = msct_download.ContentStore(str(tmpdir.join('cache')))
+    urls = [url(server, '/data.zip')]
+    fname, _ = msct_download.download(urls, store=store, nb_jobs=1, verbose=0)
+    # same file on the server: served by the store
+    nb_requests = len(log)
+    assert msct_download.download(urls, store=store, nb_jobs=1, verbose=0)[0] == fname
+    assert len(log) == nb_requests + 1
+    # the dataset is updated on the server: downloaded again
+    files['/data.zip'] = archive + b'updated'
+    fname_new, _ = msct_download.download(urls, store=store, nb_jobs=1, verbose=0)
+    assert open(fname_new, 'rb').read() == archive + b'updated'
+    # refresh: downloaded again, even if unchanged
+    nb_requests = len(log)
+    assert msct_download.download(urls, store=store, nb_jobs=1, refresh=True, verbose=0)[0] == fname_new
+    assert len(log) - nb_requests >= 2
+    server.shutdown()
+
+
+def test_download_waits_for_other_process(tmpdir, archive):
+    server, log = make_server({'/data.zip': archive})
+    path_store = str(tmpdir.join('cache'))
+    store = msct_download.ContentStore(path_store)
+    urls = [url(server, '/data.zip')]
+    result = []
+    # another process is downloading the file: the download waits for it, then uses its result
+    with msct_download.ContentStore(path_store).lock_partial(urls, verbose=0):
+        thread = threading.Thread(target=lambda: result.append(msct_download.download(urls, store=store, verbose=0)))
+        thread.start()
+        time.sleep(0.5)
+        assert thread.is_alive() and log == []
+        fname_other = str(tmpdir.join('other'))
+        with open(fname_other, 'wb') as f:
+            f.write(archive)
+        msct_download.ContentStore(path_store).add(fname_other, urls, 'data.zip')
+    thread.join()
+    assert open(result[0][0], 'rb').read() == archive
+    assert log == []
+    server.shutdown()
+
+
+def _add_to_store(args):
+    path_store, i = args
+    fname = os.path.join(path_store, 'file{}'.format(i))
+    with open(fname, 'wb') as f:
+        f.write(str(i).encode('utf-8'))
+    msct_download.ContentStore(path_store).add(fname, ['http://mirror/file{}'.format(i)], 'file{}'.format(i))
+
+
+def test_store_index_concurrent_processes(tmpdir):
+    path_store = str(tmpdir.join('cache'))
+    msct_download.ContentStore(path_store)
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(_add_to_store, [(path_store, i) for i in range(40)])
+    finally:
+        pool.close()
+        pool.join()
+    store = msct_download.ContentStore(path_store)
+    for i in range(40):
+        fname, filename = store.get(['http://mirror/file{}'.format(i)])
+        assert filename == 'file{}'.format(i) and open(fname, 'rb').read() == str(i).encode('utf-8')
+
+
+def test_extract_zip_without_folder_entries(tmpdir):
+    fname = str(tmpdir.join('nested.zip'))
+    with zipfile.ZipFile(fname, 'w') as zf:
+        for i in range(40):
+            zf.writestr('data/sub{}/deep/file{}.txt'.format(i % 4, i), os.urandom(1000))
+    for i in range(10):
+        dest = str(tmpdir.join('out{}'.format(i)))
+        msct_download.extract_zip(fname, dest, nb_jobs=8)
+        assert sum([len(files) for _, _, files in os.walk(dest)]) == 40
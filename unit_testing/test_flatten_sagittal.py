@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_flatten_sagittal
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox import warp
+import sct_flatten_sagittal
+
+
+def test_shift_slices():
+    from skimage import transform
+    rs = np.random.RandomState(0)
+    data = rs.rand(20, 6, 9).astype(np.float32)
+    data[0, :, :] = 0
+    translation_x = np.array([-2.5, -1, -0.3, 0, 0.7, 1, 3.2, 19.5, -25])
+    data_flat = sct_flatten_sagittal.shift_slices(data, translation_x)
+    assert data_flat.dtype == np.float32
+    for iz in range(9):
+        # reference: per-slice warp with scikit-image, as previously done
+        tform = transform.SimilarityTransform(translation=(0, translation_x[iz]))
+        assert np.allclose(data_flat[:, :, iz], transform.warp(data[:, :, iz].astype(np.float64), tform), atol=1e-6)
+
+
+def test_displacement_field(tmpdir):
+    rs = np.random.RandomState(1)
+    data = rs.rand(16, 5, 7).astype(np.float32)
+    affine = np.diag([0.5, 0.8, 2., 1.])
+    translation_x = np.linspace(-2, 3, 7)
+    fname_src = str(tmpdir.join('src.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(data, affine), fname_src)
+    fname_warp = str(tmpdir.join('warp_flatten.nii.gz'))
+    sct_flatten_sagittal.get_displacement_field(translation_x, data.shape, affine).save(fname_warp)
+    assert warp.is_displacement_field(fname_warp)
+    fname_out = str(tmpdir.join('src_flatten.nii.gz'))
+    warp.warp_images([fname_src], [fname_out], fname_src, [fname_warp], nb_threads=1, verbose=0)
+    # same as the flattening, away from the edges of the image
+    data_flat = sct_flatten_sagittal.shift_slices(data, translation_x)
+    assert np.allclose(nibabel.load(fname_out).get_fdata()[4:12], data_flat[4:12], atol=1e-5)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the GM model array store
+
+from __future__ import print_function, absolute_import
+
+import os
+
+import pytest
+
+import numpy as np
+import pandas as pd
+from sklearn import decomposition, manifold
+
+from msct_gmseg_utils import Slice
+import msct_multiatlas_seg
+
+
+def fake_slices(n_slices=12, shape=(10, 10)):
+    np.random.seed(0)
+    slices = []
+    for i in range(n_slices):
+        n_raters = 1 + i % 2
+        gm_seg = (np.random.rand(n_raters, *shape) > 0.5).astype(float)
+        slices.append(Slice(slice_id=i, im=np.random.rand(*shape), gm_seg=gm_seg, wm_seg=1 - gm_seg,
+                            im_m=np.random.rand(*shape), gm_seg_m=gm_seg, wm_seg_m=1 - gm_seg, level=i // 4 + 1))
+    return slices
+
+
+@pytest.mark.parametrize("method", ['pca', 'isomap'])
+def test_model_store_roundtrip(tmpdir, method):
+    slices = fake_slices()
+    model_data = np.asarray([dic_slice.im_M.flatten() for dic_slice in slices])
+    if method == 'pca':
+        estimator = decomposition.PCA(n_components=0.95)
+    else:
+        estimator = manifold.Isomap(n_neighbors=5, n_components=6)
+    fitted_data = estimator.fit_transform(model_data)
+    intensities = pd.DataFrame({'GM': pd.Series([1., 2., 1.5], index=[1, 2, 0]),
+                                'WM': pd.Series([3., 4., 3.5], index=[1, 2, 0]),
+                                'MIN': pd.Series([0., 0., 0.], index=[1, 2, 0]),
+                                'MAX': pd.Series([9., 8., 9.], index=[1, 2, 0])})
+
+    path_model = str(tmpdir.join('gm_model'))
+    reduced_space = msct_multiatlas_seg.ReducedSpace.from_estimator(estimator, method)
+    msct_multiatlas_seg.save_model_store(path_model, slices, intensities, reduced_space, fitted_data)
+    assert os.path.isfile(os.path.join(path_model, msct_multiatlas_seg.MODEL_STORE_MANIFEST))
+
+    slices_l, intensities_l, reduced_space_l, fitted_data_l, mean_image_l = msct_multiatlas_seg.load_model_store(path_model)
+
+    assert len(slices_l) == len(slices)
+    for dic_slice, dic_slice_l in zip(slices, slices_l):
+        assert dic_slice_l.id == dic_slice.id
+        assert dic_slice_l.level == dic_slice.level
+        assert np.array_equal(dic_slice_l.im_M, dic_slice.im_M)
+        assert np.array_equal(dic_slice_l.gm_seg_M, dic_slice.gm_seg_M)
+        assert np.array_equal(dic_slice_l.wm_seg, dic_slice.wm_seg)
+    assert np.allclose(mean_image_l, np.mean([dic_slice.im for dic_slice in slices], axis=0))
+    assert np.array_equal(fitted_data_l, fitted_data)
+    assert intensities_l['GM'][2] == 2.
+    assert 0 in intensities_l.index
+
+    target = np.random.rand(3, model_data.shape[1])
+    assert np.allclose(reduced_space_l.transform(target), estimator.transform(target))
+
+
+def save_legacy_model(path_model):
+    import gzip
+    import pickle
+    slices = fake_slices()
+    estimator = decomposition.PCA(n_components=0.95)
+    fitted_data = estimator.fit_transform(np.asarray([dic_slice.im_M.flatten() for dic_slice in slices]))
+    intensities = pd.DataFrame({'GM': [1., 2.], 'WM': [3., 4.], 'MIN': [0., 0.], 'MAX': [9., 8.]}, index=[1, 0])
+    os.makedirs(path_model)
+    for obj, fname in [(slices, 'slices.pklz'), (intensities, 'intensities.pklz'), (estimator, 'fitted_model.pklz'),
+                       (fitted_data, 'fitted_data.pklz')]:
+        with gzip.open(os.path.join(path_model, fname), 'wb') as f:
+            pickle.dump(obj, f)
+    return estimator, fitted_data
+
+
+def load_model(path_model):
+    param_model = msct_multiatlas_seg.ParamModel()
+    param_model.path_model_to_load = path_model
+    param = msct_multiatlas_seg.Param()
+    param.verbose = 0
+    model = msct_multiatlas_seg.Model(param_model=param_model, param=param)
+    model.load_model()
+    return model
+
+
+def test_legacy_model_converted_once(tmpdir, monkeypatch):
+    path_model = str(tmpdir.join('gm_model'))
+    estimator, fitted_data = save_legacy_model(path_model)
+    model = load_model(path_model)
+    assert np.array_equal(model.fitted_data, fitted_data)
+    path_store = os.path.join(path_model, msct_multiatlas_seg.MODEL_STORE_CACHE)
+    assert msct_multiatlas_seg.get_converted_model(path_model) == path_store
+
+    # next runs load the converted store
+    def load_legacy_model(self):
+        raise AssertionError('legacy model loaded')
+    monkeypatch.setattr(msct_multiatlas_seg.Model, 'load_legacy_model', load_legacy_model)
+    model = load_model(path_model)
+    assert isinstance(model.fitted_model, msct_multiatlas_seg.ReducedSpace)
+    assert np.array_equal(model.fitted_data, fitted_data)
+    target = np.random.rand(2, model.slices[0].im_M.size)
+    assert np.allclose(model.fitted_model.transform(target), estimator.transform(target))
+
+
+def test_legacy_model_converted_in_user_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    path_model = str(tmpdir.join('gm_model'))
+    save_legacy_model(path_model)
+    # the store cannot be created in the model folder
+    tmpdir.join('gm_model', msct_multiatlas_seg.MODEL_STORE_CACHE).write('')
+    load_model(path_model)
+    path_store = msct_multiatlas_seg.get_converted_model(path_model)
+    assert path_store == msct_multiatlas_seg.get_converted_model_dirs(path_model)[1]
+    assert path_store.startswith(str(tmpdir.join('cache')))
+    assert not [fname for fname in os.listdir(path_model) if fname.startswith('.')]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the label operations of sct_label_utils
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+import pytest
+
+from spinalcordtoolbox.image import Image
+import sct_label_utils
+
+
+def make_image(data):
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    return Image(data, hdr=hdr)
+
+
+@pytest.fixture
+def segmentation():
+    data = np.zeros((20, 20, 60), dtype=np.uint8)
+    data[8:12, 7:13, 2:58] = 1
+    return make_image(data)
+
+
+@pytest.fixture
+def discs():
+    data = np.zeros((20, 20, 60), dtype=np.uint8)
+    # RPI: top disc has the largest z
+    for value, z in zip([2, 3, 4, 5, 6], [55, 44, 32, 20, 9]):
+        data[10, 10, z] = value
+    return make_image(data)
+
+
+def labelize_from_disks_loop(data, data_ref):
+    """
+    Reference implementation, with Coordinate objects
+    """
+    coordinates_input = make_image(data).getNonZeroCoordinates()
+    coordinates_ref = make_image(data_ref).getNonZeroCoordinates(sorting='value')
+    data_output = np.zeros_like(data)
+    for coord in coordinates_input:
+        for j in range(0, len(coordinates_ref) - 1):
+            if coordinates_ref[j + 1].z < coord.z <= coordinates_ref[j].z:
+                data_output[int(coord.x), int(coord.y), int(coord.z)] = coordinates_ref[j].value
+    return data_output
+
+
+def test_get_labels(discs):
+    labels = sct_label_utils.get_labels(discs)
+    coordinates = discs.getNonZeroCoordinates()
+    assert labels.shape == (5, 4)
+    assert np.array_equal(labels, [[c.x, c.y, c.z, c.value] for c in coordinates])
+
+
+def test_labelize_from_disks(segmentation, discs):
+    data_output = sct_label_utils.ProcessLabels(segmentation, fname_ref=discs, verbose=0).labelize_from_disks().data
+    assert np.array_equal(data_output, labelize_from_disks_loop(segmentation.data, discs.data))
+    assert set(np.unique(data_output)) == {0, 2, 3, 4, 5}
+    assert np.all(data_output[:, :, 45:56][segmentation.data[:, :, 45:56] > 0] == 2)
+    # discs not ordered along z
+    data_ref = discs.data.copy()
+    data_ref[10, 10, 20], data_ref[10, 10, 9] = 6, 5
+    data_output = sct_label_utils.ProcessLabels(segmentation, fname_ref=make_image(data_ref), verbose=0).labelize_from_disks().data
+    assert np.array_equal(data_output, labelize_from_disks_loop(segmentation.data, data_ref))
+
+
+def test_cubic_to_point():
+    data = np.zeros((20, 20, 30), dtype=np.uint8)
+    data[2:5, 3:6, 4:7] = 1
+    data[10:12, 10:14, 20:23] = 7
+    data[15, 15, 25] = 3
+    data_output = sct_label_utils.ProcessLabels(make_image(data), verbose=0).cubic_to_point().data
+    assert sorted(zip(*data_output.nonzero())) == [(3, 4, 5), (10, 12, 21), (15, 15, 25)]
+    assert [data_output[3, 4, 5], data_output[10, 12, 21], data_output[15, 15, 25]] == [1, 7, 3]
+    # -vert-body: only the listed levels
+    data_output = sct_label_utils.ProcessLabels(make_image(data), verbose=0).label_vertebrae([3, 7]).data
+    assert sorted(zip(*data_output.nonzero())) == [(10, 12, 21), (15, 15, 25)]
+
+
+def test_plan_ref():
+    data = np.zeros((10, 10, 12), dtype=np.int16)
+    data[2, 3, 4] = -2
+    data[5, 5, 4] = 3
+    data[1, 1, 8] = -1
+    data[0, 0, 10] = 5
+    data[9, 9, 10] = 6
+    im_ref = make_image(np.zeros((6, 7, 12), dtype=np.uint8))
+    data_output = sct_label_utils.ProcessLabels(make_image(data), fname_ref=im_ref, verbose=0).plan_ref().data
+    assert data_output.shape == (6, 7, 12)
+    assert data_output.dtype == np.float32
+    expected = np.zeros(12)
+    expected[[4, 8, 10]] = [3, -1, 6]
+    assert np.array_equal(data_output, np.broadcast_to(expected, data_output.shape))
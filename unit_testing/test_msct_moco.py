@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the group averaging of msct_moco
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.image import Image
+import msct_moco
+
+
+def fake_4d_image(nt=7):
+    data = np.random.RandomState(0).randint(0, 100, size=(4, 5, 3, nt)).astype(np.int16)
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    hdr.set_data_dtype(np.int16)
+    return Image(data, hdr=hdr)
+
+
+def test_get_group_indexes():
+    assert msct_moco.get_group_indexes([1, 2, 4, 5, 6, 8, 9], 3) == [[1, 2, 4], [5, 6, 8], [9]]
+    assert msct_moco.get_group_indexes([0, 1, 2, 3], 2) == [[0, 1], [2, 3]]
+    assert msct_moco.get_group_indexes([0, 1], 1) == [[0], [1]]
+
+
+def test_average_groups():
+    im = fake_4d_image()
+    group_indexes = [[0, 2, 3], [6], [1, 5]]  # volume 4 is not used
+    im_mean = msct_moco.average_groups(im, group_indexes)
+    assert im_mean.data.shape == (4, 5, 3, 3)
+    assert im_mean.data.dtype == np.float32
+    assert im_mean.hdr.get_data_dtype() == np.float32
+    for iGroup, index_group in enumerate(group_indexes):
+        assert np.allclose(im_mean.data[..., iGroup], np.mean(im.data[..., index_group], axis=3))
+
+
+def test_average_groups_single_group(tmpdir):
+    im = fake_4d_image()
+    # the mean of all volumes is a 3D image, as expected by the tools using fmri_moco_mean or b0_mean
+    im_mean = msct_moco.average_groups(im, [list(range(7))])
+    assert im_mean.data.shape == (4, 5, 3)
+    assert np.allclose(im_mean.data, np.mean(im.data, axis=3))
+    fname = str(tmpdir.join('mean.nii.gz'))
+    im_mean.save(fname)
+    assert nibabel.load(fname).shape == (4, 5, 3)
+    # 3D input, as the group means of a single group
+    assert msct_moco.average_groups(im_mean, [[0]]).data.shape == (4, 5, 3)
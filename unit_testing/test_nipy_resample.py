@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.resample.nipy_resample
+
+from __future__ import print_function, absolute_import
+
+import pytest
+
+import numpy as np
+from scipy import ndimage
+
+pytest.importorskip("nipy")
+from spinalcordtoolbox.resample import nipy_resample
+
+
+@pytest.mark.parametrize("interp_order", [0, 1, 2])
+def test_resample_volumes(interp_order):
+    data = np.random.RandomState(0).rand(6, 7, 5, 4)
+    shape_r = (12, 5, 5, 4)
+    transfo = np.eye(4)
+    for i in range(3):
+        transfo[i, i] = data.shape[i] / float(shape_r[i])
+        transfo[i, 3] = (transfo[i, i] - 1) / 2
+
+    data_r = nipy_resample.resample_volumes(data, transfo, shape_r, interp_order=interp_order, verbose=0)
+    assert data_r.shape == shape_r
+    for it in range(data.shape[3]):
+        # per-volume affine resampling, as done by nipy's resample
+        data3d_r = ndimage.affine_transform(data[..., it], transfo[:3, :3], offset=transfo[:3, 3],
+                                            output_shape=shape_r[:3], order=interp_order, mode='nearest')
+        assert np.allclose(data_r[..., it], data3d_r)
+    # 3d data gives the same result as the first volume
+    assert np.allclose(nipy_resample.resample_volumes(data[..., 0], transfo, shape_r[:3], interp_order, verbose=0),
+                       data_r[..., 0])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.overlap
+
+from __future__ import print_function, absolute_import, division
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox import overlap
+from spinalcordtoolbox.image import Image, compute_dice
+import sct_dice_coefficient
+
+
+def dice_loop(data_ref, data_seg, label):
+    """
+    Reference implementation: one label, one slice at a time
+    """
+    ref, seg = data_ref == label, data_seg == label
+    if not ref.sum() + seg.sum():
+        return np.nan
+    return 2. * (ref & seg).sum() / (ref.sum() + seg.sum())
+
+
+def make_image(data, affine=np.eye(4)):
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    hdr.set_sform(affine, code=1)
+    hdr.set_qform(affine, code=1)
+    return Image(data, hdr=hdr)
+
+
+def test_compute_overlap():
+    rs = np.random.RandomState(0)
+    data_ref = rs.randint(0, 4, (10, 12, 8))
+    data_seg = np.where(rs.rand(10, 12, 8) < 0.7, data_ref, rs.randint(0, 4, (10, 12, 8)))
+    data_seg[:, :, 7][data_seg[:, :, 7] == 3] = 0
+    data_ref[:, :, 7][data_ref[:, :, 7] == 3] = 0
+    labels, metrics = overlap.compute_overlap(data_ref, data_seg.astype(np.float32))
+    assert list(labels) == [1, 2, 3]
+    assert list(metrics)[:4] == overlap.METRICS
+    for i, label in enumerate(labels):
+        ref, seg = data_ref == label, data_seg == label
+        assert np.isclose(metrics['dice'][i], dice_loop(data_ref, data_seg, label))
+        assert np.isclose(metrics['jaccard'][i], (ref & seg).sum() / (ref | seg).sum())
+        assert np.isclose(metrics['sensitivity'][i], (ref & seg).sum() / ref.sum())
+        assert np.isclose(metrics['volume_difference'][i], (seg.sum() - ref.sum()) / ref.sum())
+
+    # per slice, with a label absent from both images
+    labels, metrics = overlap.compute_overlap(data_ref, data_seg, labels=[3, 1, 5], axis=2)
+    assert list(labels) == [1, 3, 5]
+    assert metrics['dice'].shape == (8, 3)
+    for z in range(8):
+        for i, label in enumerate(labels):
+            assert np.allclose(metrics['dice'][z, i], dice_loop(data_ref[:, :, z], data_seg[:, :, z], label),
+                               equal_nan=True)
+    assert np.all(np.isnan(metrics['dice'][:, 2]))
+    assert np.isnan(metrics['dice'][7, 1])
+
+
+def test_compute_overlap_files(tmpdir):
+    rs = np.random.RandomState(1)
+    pairs = []
+    for i in range(3):
+        fnames = []
+        for name in ['ref', 'seg']:
+            fname = str(tmpdir.join('{}{}.nii.gz'.format(name, i)))
+            nibabel.save(nibabel.Nifti1Image(rs.randint(0, 3, (6, 6, 4)).astype(np.uint8), np.eye(4)), fname)
+            fnames.append(fname)
+        pairs.append(fnames)
+    results = overlap.compute_overlap_files(pairs, labels=[1, 2], nb_jobs=2)
+    assert len(results) == 3
+    for (fname_ref, fname_seg), (labels, metrics) in zip(pairs, results):
+        data_ref, data_seg = np.asanyarray(nibabel.load(fname_ref).dataobj), np.asanyarray(nibabel.load(fname_seg).dataobj)
+        assert np.allclose(metrics['dice'], [dice_loop(data_ref, data_seg, 1), dice_loop(data_ref, data_seg, 2)])
+
+
+def test_compute_dice():
+    data1 = np.zeros((8, 8, 10), dtype=np.uint8)
+    data2 = np.zeros((8, 8, 10), dtype=np.uint8)
+    data1[2:6, 2:6, 1:7] = 1
+    data2[3:6, 2:6, 3:9] = 1
+    assert np.isclose(compute_dice(make_image(data1), make_image(data2)), dice_loop(data1, data2, 1))
+    # Z-ROI where both segmentations are present: slices 3 to 6
+    assert np.isclose(compute_dice(make_image(data1), make_image(data2), zboundaries=True),
+                      dice_loop(data1[:, :, 3:7], data2[:, :, 3:7], 1))
+    dice_slices = compute_dice(make_image(data1), make_image(data2), mode='2d-slices')
+    assert np.allclose(dice_slices, [dice_loop(data1[:, :, z], data2[:, :, z], 1) for z in range(10)], equal_nan=True)
+    # superior to inferior orientation: slices are returned from inferior to superior
+    affine = np.diag([1., 1., -1., 1.])
+    dice_slices_flipped = compute_dice(make_image(data1[:, :, ::-1], affine), make_image(data2[:, :, ::-1], affine),
+                                       mode='2d-slices')
+    assert np.allclose(dice_slices_flipped, dice_slices, equal_nan=True)
+    # images in different orientations (RPI and LPI): image2 is reoriented to image1
+    affine_lpi = np.diag([-1., 1., 1., 1.])
+    data3 = np.zeros((8, 8, 10), dtype=np.uint8)
+    data3[4:7, 2:6, 3:9] = 1
+    for kwargs in [{}, {'zboundaries': True}, {'mode': '2d-slices'}]:
+        assert np.allclose(compute_dice(make_image(data3), make_image(data2[::-1], affine_lpi), **kwargs),
+                           compute_dice(make_image(data3), make_image(data2), **kwargs), equal_nan=True)
+
+
+def test_dice_report():
+    data1 = np.zeros((8, 8, 10))
+    data2 = np.zeros((8, 8, 10))
+    data1[2:6, 2:6, 1:7] = 1
+    data2[3:6, 2:6, 3:9] = 2
+    origin, size = sct_dice_coefficient.get_bounding_box(data1, data2, bmax=True)
+    assert origin == [3, 2, 3] and size == [3, 4, 4]
+    dice_3d, dice_slices = sct_dice_coefficient.dice_report(data1, data2, dim_slices=2, origin=[0, 0, 2],
+                                                            size=[8, 8, 8])
+    mask1, mask2 = data1[:, :, 2:] != 0, data2[:, :, 2:] != 0
+    assert np.isclose(dice_3d, dice_loop(mask1, mask2, True))
+    # empty slices have a Dice coefficient of 0, as with isct_dice_coefficient
+    assert np.allclose(dice_slices, np.nan_to_num([dice_loop(mask1[:, :, z], mask2[:, :, z], True) for z in range(8)]))
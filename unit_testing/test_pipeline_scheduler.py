@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_pipeline_scheduler
+
+from __future__ import print_function, absolute_import
+
+import os
+
+import concurrent.futures
+import pandas as pd
+
+import msct_pipeline_scheduler
+import sct_utils as sct
+
+
+def fake_launcher(job):
+    function, path_subject, args, test_integrity = job
+    if 'crash' in path_subject:
+        return pd.DataFrame(index=[''], data={'status': 1, 'output': 'ERROR: Function crashed.'})
+    return pd.DataFrame(index=[os.path.basename(path_subject)], data={'status': 0, 'output': args})
+
+
+def jobs(list_subj):
+    return [('sct_test', os.path.join('/data', subj), '-i im.nii.gz', 0) for subj in list_subj]
+
+
+def test_resume_from_journal(tmpdir):
+    path_journal = str(tmpdir.join('journal'))
+    pool = concurrent.futures.ThreadPoolExecutor(2)
+
+    journal = msct_pipeline_scheduler.Journal(path_journal)
+    results = msct_pipeline_scheduler.run_jobs(pool, fake_launcher, jobs(['s1', 's2']), journal=journal)
+    assert len(results) == 2
+    assert os.path.isfile(os.path.join(path_journal, 'results_partial.csv'))
+
+    # a new run with the same journal only runs the new subject
+    calls = []
+
+    def counting_launcher(job):
+        calls.append(job)
+        return fake_launcher(job)
+
+    journal = msct_pipeline_scheduler.Journal(path_journal)
+    results = msct_pipeline_scheduler.run_jobs(pool, counting_launcher, jobs(['s1', 's2', 's3']), journal=journal)
+    assert len(results) == 3
+    assert [os.path.basename(job[1]) for job in calls] == ['s3']
+    assert sorted(pd.concat(results).index) == ['s1', 's2', 's3']
+    partial = pd.read_csv(os.path.join(path_journal, 'results_partial.csv'), index_col=0)
+    assert sorted(partial.index) == ['s1', 's2', 's3']
+
+
+def test_partial_results_are_appended(tmpdir):
+    journal = msct_pipeline_scheduler.Journal(str(tmpdir))
+    journal.write_partial_results([])
+    journal.append_partial_result(pd.DataFrame(index=['s1'], data={'status': 0, 'output': 'a'}))
+    journal.append_partial_result(pd.DataFrame(index=['s2'], data={'output': 'b', 'status': 0}))
+    # a result with a new column
+    journal.append_partial_result(pd.DataFrame(index=['s3'], data={'status': 0, 'output': 'c', 'dice': 0.9}))
+    journal.append_partial_result(pd.DataFrame(index=['s4'], data={'status': 1, 'output': 'd'}))
+    partial = pd.read_csv(str(tmpdir.join('results_partial.csv')), index_col=0)
+    assert partial.index.tolist() == ['s1', 's2', 's3', 's4']
+    assert partial['output'].tolist() == ['a', 'b', 'c', 'd']
+    assert partial['status'].tolist() == [0, 0, 0, 1]
+    assert partial['dice'].iloc[2] == 0.9
+
+
+def test_retries_are_capped(tmpdir):
+    path_journal = str(tmpdir.join('journal'))
+    pool = concurrent.futures.ThreadPoolExecutor(2)
+    journal = msct_pipeline_scheduler.Journal(path_journal)
+    results = msct_pipeline_scheduler.run_jobs(pool, fake_launcher, jobs(['s1', 'crash']), journal=journal, max_retries=2)
+    assert len(results) == 2
+    key = msct_pipeline_scheduler.job_key(jobs(['crash'])[0])
+    assert journal.status(key) == msct_pipeline_scheduler.STATUS_FAILED
+    assert journal.attempts[key] == 3
+    # failed jobs are run again when resuming
+    journal = msct_pipeline_scheduler.Journal(path_journal)
+    assert not journal.is_done(key)
+    assert journal.is_done(msct_pipeline_scheduler.job_key(jobs(['s1'])[0]))
+
+
+def test_jobs_are_admitted_by_threads(tmpdir):
+    import threading
+    import time
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+    omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+
+    def launcher(job):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        # the thread limits are passed to the commands, without changing the environment of the worker
+        assert sct.run('echo $OMP_NUM_THREADS', verbose=0)[1].strip() == '2'
+        assert os.environ.get('OMP_NUM_THREADS') == omp_num_threads
+        return fake_launcher(job)
+
+    fname_profiles = str(tmpdir.join('profiles.json'))
+    with open(fname_profiles, 'w') as f:
+        f.write('{"sct_test": {"threads": 2, "memory": 10}}')
+    profiles = msct_pipeline_scheduler.ResourceProfiles(fname_profiles=fname_profiles)
+    pool = concurrent.futures.ThreadPoolExecutor(4)
+    results = msct_pipeline_scheduler.run_jobs(pool, launcher, jobs(['s1', 's2', 's3', 's4']), profiles=profiles, nb_cpu=4, memory=1000)
+    assert len(results) == 4
+    assert running[1] == 2
+
+
+def test_profiles_learn_peak_memory(tmpdir):
+    path_journal = str(tmpdir.join('journal'))
+    journal = msct_pipeline_scheduler.Journal(path_journal)
+    journal.record(jobs(['s1'])[0], msct_pipeline_scheduler.STATUS_DONE, 1., peak_rss=500.)
+    profiles = msct_pipeline_scheduler.ResourceProfiles(journal=msct_pipeline_scheduler.Journal(path_journal))
+    assert profiles.get('sct_test')['memory'] == 500. * msct_pipeline_scheduler.MEMORY_MARGIN
+    assert profiles.get('sct_unknown') == msct_pipeline_scheduler.DEFAULT_PROFILE
+
+
+def test_jobs_run_when_ram_is_unknown(monkeypatch):
+    monkeypatch.setattr(sct, 'get_available_ram', lambda: None)
+    pool = concurrent.futures.ThreadPoolExecutor(2)
+    results = msct_pipeline_scheduler.run_jobs(pool, fake_launcher, jobs(['s1', 's2']), nb_cpu=2)
+    assert len(results) == 2
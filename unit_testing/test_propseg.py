@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the segmentation consistency check of sct_propseg
+
+from __future__ import print_function, absolute_import
+
+import pytest
+
+import numpy as np
+from scipy import ndimage as ndi
+
+import sct_propseg
+
+
+def slices_to_remove_loop(data_seg, data_centerline, pixdim, threshold_distance):
+    """Slice-by-slice reference implementation"""
+    nz = data_seg.shape[2]
+    px, py, pz = pixdim
+    centerline, key_centerline = {}, []
+    for i in range(nz):
+        if np.any(data_centerline[:, :, i]):
+            centerline[i] = ndi.measurements.center_of_mass(data_centerline[:, :, i])
+            key_centerline.append(i)
+    minz_centerline, maxz_centerline = np.min(key_centerline), np.max(key_centerline)
+    mid_slice = int((maxz_centerline - minz_centerline) / 2)
+    slices_to_remove = [False] * nz
+    for i in range(minz_centerline, maxz_centerline + 1):
+        label_objects, nb_labels = ndi.label(data_seg[:, :, i])
+        if nb_labels > 1:
+            slices_to_remove[i] = True
+        elif nb_labels == 1:
+            x, y = ndi.measurements.center_of_mass(data_seg[:, :, i])
+            nearest = min(key_centerline, key=lambda z: abs(z - i))
+            distance = np.sqrt(((x - centerline[nearest][0]) * px) ** 2 + ((y - centerline[nearest][1]) * py) ** 2 +
+                               ((i - nearest) * pz) ** 2)
+            if distance >= threshold_distance:
+                slices_to_remove[i] = True
+    slice_to_change = False
+    for i in range(mid_slice, nz):
+        if slice_to_change:
+            slices_to_remove[i] = True
+        elif slices_to_remove[i]:
+            slice_to_change = True
+    slice_to_change = False
+    for i in range(mid_slice, 0, -1):
+        if slice_to_change:
+            slices_to_remove[i] = True
+        elif slices_to_remove[i]:
+            slice_to_change = True
+    return np.array(slices_to_remove)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_get_slices_to_remove(seed):
+    rs = np.random.RandomState(seed)
+    nx, ny, nz = 20, 20, 40
+    data_centerline = np.zeros((nx, ny, nz), dtype=np.uint8)
+    data_seg = np.zeros((nx, ny, nz), dtype=np.uint8)
+    for iz in range(3, nz - 2):
+        x, y = 10 + int(3 * np.sin(iz / 5.)), 10
+        if iz % 4:  # centerline with gaps
+            data_centerline[x, y, iz] = 1
+        data_seg[x - 2:x + 3, y - 2:y + 3, iz] = 1
+        if rs.rand() < 0.1:  # spurious object
+            data_seg[0:2, 0:2, iz] = 1
+        if rs.rand() < 0.1:  # shifted cord
+            data_seg[:, :, iz] = np.roll(data_seg[:, :, iz], 6, axis=0)
+    pixdim = (0.5, 0.5, 1.)
+    assert np.array_equal(sct_propseg.get_slices_to_remove(data_seg, data_centerline, pixdim, 2.),
+                          slices_to_remove_loop(data_seg, data_centerline, pixdim, 2.))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_register_landmarks
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import pytest
+
+import msct_register_landmarks
+
+
+def transform(points, angles, scaling, translation):
+    barycenter = np.mean(points, axis=0)
+    matrix = np.dot(np.diag(scaling), msct_register_landmarks.get_rotation_matrix(*angles))
+    return np.dot(points - barycenter, matrix.T) + barycenter + translation
+
+
+def sse_powell(points_dest, points_src, constraints):
+    """
+    Reference: derivative-free minimization of the SSE over the free parameters, as previously done
+    """
+    from scipy.optimize import minimize
+    free = np.concatenate(msct_register_landmarks.parse_constraints(constraints)[:3])
+    params = np.array([0., 0., 0., 0., 0., 0., 1., 1., 1.])
+
+    def sse(x):
+        p = params.copy()
+        p[free] = x
+        return np.sum((points_dest - transform(points_src, p[3:6], p[6:9], p[0:3])) ** 2)
+
+    return minimize(sse, params[free], method='Powell', options={'xtol': 1e-10, 'ftol': 1e-10, 'maxiter': 100000}).fun
+
+
+@pytest.fixture
+def points():
+    return np.random.RandomState(0).rand(8, 3) * 50
+
+
+@pytest.mark.parametrize('constraints, angles, scaling', [
+    ('Tx_Ty_Tz_Rx_Ry_Rz', [0.3, -0.2, 0.1], [1, 1, 1]),
+    ('Tx_Ty_Tz_Sz', [0, 0, 0], [1, 1, 1.3]),
+    ('Tx_Ty_Tz_Rx_Sx_Sy_Sz', [0.2, 0, 0], [0.9, 1.1, 1.2]),
+    ('Tx_Ty_Tz_Rx_Ry_Rz_Sx_Sy_Sz', [0.1, 0.2, -0.3], [0.9, 1.1, 1.2]),
+])
+def test_recover_transform(points, constraints, angles, scaling):
+    points_dest = transform(points, angles, scaling, [3, -2, 5])
+    rotsc_matrix, translation_array, points_src_reg, barycenter = \
+        msct_register_landmarks.getRigidTransformFromLandmarks(points_dest.tolist(), points.tolist(), constraints)
+    assert np.allclose(points_src_reg, points_dest, atol=1e-5)
+    assert np.allclose(translation_array, [[3, -2, 5]], atol=1e-5)
+    assert np.allclose(barycenter, np.mean(points, axis=0))
+
+
+@pytest.mark.parametrize('constraints', ['Tx_Ty_Tz_Rx_Ry_Rz', 'Tx_Ty_Sz', 'Tx_Ty_Tz_Rx_Ry_Sz', 'Tz_Ry'])
+def test_sse_noisy(points, constraints):
+    rs = np.random.RandomState(1)
+    points_dest = transform(points, [0.1, -0.1, 0.2], [1.1, 0.9, 1.2], [1, 2, 3]) + rs.randn(8, 3)
+    points_src_reg = msct_register_landmarks.getRigidTransformFromLandmarks(points_dest, points, constraints)[2]
+    sse = np.sum((points_dest - points_src_reg) ** 2)
+    assert sse <= sse_powell(points_dest, points, constraints) + 1e-6
+
+
+def test_affine(points):
+    matrix = np.array([[1.1, 0.2, 0], [-0.1, 0.9, 0.3], [0.05, 0, 1.2]])
+    points_dest = np.dot(points, matrix.T) + [1, 2, 3]
+    rotsc_matrix, translation_array, points_src_reg, barycenter = \
+        msct_register_landmarks.getRigidTransformFromLandmarks(points_dest, points, 'Tx_Ty_Tz_Affine')
+    assert np.allclose(rotsc_matrix, matrix)
+    assert np.allclose(points_src_reg, points_dest)
+
+
+def test_register_points_icp(points):
+    points_dest = transform(points, [0.05, 0.03, -0.04], [1, 1, 1], [0.5, -0.3, 0.2])
+    order = np.random.RandomState(2).permutation(8)
+    rotsc_matrix, translation_array, points_src_reg, barycenter, indexes = \
+        msct_register_landmarks.register_points_icp(points_dest[order], points)
+    assert np.allclose(points_src_reg, points_dest, atol=1e-5)
+    assert np.array_equal(order[indexes], np.arange(8))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.slicewise and the slab-parallel filters of sct_maths
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import pytest
+
+from spinalcordtoolbox import slicewise
+import sct_maths
+
+
+def shift_sum(data, offset):
+    """
+    Filter reaching one slice on each side along z
+    """
+    padded = np.pad(data, ((0, 0), (0, 0), (1, 1)), mode='edge')
+    return (padded[:, :, :-2] + padded[:, :, 1:-1] + padded[:, :, 2:] + offset).astype(data.dtype)
+
+
+def test_iter_slabs():
+    slabs = list(slicewise.iter_slabs(10, 4, halo=2))
+    assert slabs == [((0, 6), (0, 4)), ((2, 10), (2, 6)), ((6, 10), (2, 4))]
+
+
+@pytest.mark.parametrize('nb_jobs', [1, 3])
+def test_apply_by_slabs(nb_jobs):
+    data = np.random.RandomState(0).randint(0, 100, (5, 6, 11, 2)).astype(np.int32)
+    out = slicewise.apply_by_slabs(data, shift_sum, args_volumes=[(1,), (2,)], halo=1, nb_jobs=nb_jobs,
+                                   slab_size=2)
+    assert out.dtype == np.int32
+    assert np.array_equal(out[..., 0], shift_sum(data[..., 0], 1))
+    assert np.array_equal(out[..., 1], shift_sum(data[..., 1], 2))
+
+
+@pytest.mark.parametrize('radius', [[2], [3, 2, 4]])
+def test_dilate_erode(radius):
+    from skimage.morphology import dilation, erosion
+    data = (np.random.RandomState(1).rand(20, 18, 16) > 0.9).astype(np.uint8)
+    selem = sct_maths.get_selem(radius)
+    assert np.array_equal(sct_maths.dilate(data, radius, nb_jobs=3), dilation(data, selem))
+    assert np.array_equal(sct_maths.erode(1 - data, radius, nb_jobs=3), erosion(1 - data, selem))
+
+
+def test_otsu_adap():
+    data = np.random.RandomState(2).rand(16, 16, 6).astype(np.float32)
+    mask_serial = sct_maths.otsu_adap(data.copy(), 5, 0)
+    mask = sct_maths.otsu_adap(data.copy(), 5, 0, nb_jobs=2)
+    assert mask.dtype == np.float32
+    assert np.array_equal(mask, mask_serial)
+    assert set(np.unique(mask)) == {0, 1}
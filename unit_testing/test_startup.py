@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for the startup time of SCT command-line tools: modules imported by the scripts and import time
+# budget
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from spinalcordtoolbox.utils import lazy_import, LazyModule
+
+
+# maximum import time (s) of the modules needed by a typical command-line tool. It is well above the measured time
+# (~0.3s), to avoid failures on slow machines, but catches heavy dependencies imported at startup.
+IMPORT_TIME_BUDGET = float(os.getenv('SCT_IMPORT_TIME_BUDGET', 1.5))
+
+# heavy dependencies that must only be imported by the code paths that need them
+HEAVY_MODULES = ['raven', 'scipy.spatial', 'matplotlib', 'pandas', 'sklearn', 'skimage', 'keras', 'tensorflow']
+
+COMMON_SCRIPTS = ['sct_image', 'sct_maths', 'sct_label_utils', 'sct_propseg', 'sct_apply_transfo', 'sct_crop_image',
+                  'sct_register_multimodal', 'sct_warp_template']
+
+
+def import_in_subprocess(modules):
+    """
+    Import modules in a new python process
+    :return: import time (s), list of imported modules
+    """
+    code = ("import sys, time, json; t = time.time(); "
+            + "".join(["import {}; ".format(m) for m in modules])
+            + "print(json.dumps([time.time() - t, list(sys.modules)]))")
+    path_sct = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(path_sct, 'scripts'), path_sct])
+    env.pop('SENTRY_DSN', None)
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], env=env)
+    duration, modules = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return duration, modules
+
+
+def test_sct_utils_is_light():
+    duration, modules = import_in_subprocess(['sct_utils'])
+    # numpy is not needed to log or run commands
+    assert 'numpy' not in modules
+    assert 'raven' not in modules
+
+
+@pytest.mark.parametrize('script', COMMON_SCRIPTS)
+def test_scripts_heavy_modules(script):
+    duration, modules = import_in_subprocess([script])
+    assert [m for m in HEAVY_MODULES if m in modules] == []
+
+
+def test_import_time_budget():
+    # best of 3, to be robust to the load of the machine
+    duration = min([import_in_subprocess(['sct_utils', 'msct_parser', 'spinalcordtoolbox.image'])[0]
+                    for i in range(3)])
+    assert duration < IMPORT_TIME_BUDGET
+
+
+def test_lazy_import():
+    module = lazy_import('json')
+    assert module is sys.modules['json']
+
+    name = 'this_module_does_not_exist'
+    module = lazy_import(name)
+    assert isinstance(module, LazyModule)
+    with pytest.raises(ImportError):
+        module.attribute
+
+    module = LazyModule('colorsys')
+    assert module.rgb_to_hsv(1., 0., 0.) == (0., 1., 1.)
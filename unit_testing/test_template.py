@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.template
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+import pytest
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import template
+import sct_process_segmentation
+
+
+def level_loop(data, iz, average=np.mean):
+    """
+    Reference implementation: one slice at a time
+    """
+    values = data[:, :, iz][np.nonzero(data[:, :, iz])]
+    if not values.size:
+        return None
+    return int(np.round(average(values))) if average is np.mean else int(average(values))
+
+
+@pytest.fixture
+def im_vertlevel():
+    data = np.zeros((10, 8, 30), dtype=np.float32)
+    for level, (start, stop) in enumerate([(2, 8), (8, 15), (15, 22), (22, 27)], 1):
+        data[3:7, 2:6, start:stop] = level
+    # partial volume at the boundary between levels, and an outlier
+    data[3:5, 2:6, 14] = 3
+    data[3, 2, 20] = 9
+    hdr = nibabel.Nifti1Header()
+    hdr.set_data_shape(data.shape)
+    return Image(data, hdr=hdr)
+
+
+def test_vertebral_level_index(im_vertlevel):
+    data = im_vertlevel.data
+    index = template.get_vertebral_level_index(im_vertlevel)
+    assert template.get_vertebral_level_index(im_vertlevel) is index
+    for iz in range(30):
+        assert template.get_vertebral_level_from_slice(im_vertlevel, iz) == level_loop(data, iz)
+        median = level_loop(data, iz, np.median)
+        assert index.get_median_levels()[iz] == (0 if median is None else median)
+    for level in range(0, 10):
+        assert template.get_slices_from_vertebral_levels(im_vertlevel, level) == \
+            [iz for iz in range(30) if level_loop(data, iz) == level]
+    assert index.get_slices(2, 3).tolist() == list(range(8, 22))
+    assert index.get_available_levels().tolist() == [1, 2, 3, 4, 9]
+    # the index is rebuilt when the data is replaced
+    im_vertlevel.data = data[:, :, ::-1]
+    assert template.get_vertebral_level_index(im_vertlevel) is not index
+    assert template.get_slices_from_vertebral_levels(im_vertlevel, 1) == list(range(22, 28))
+
+
+def test_vertebral_level_index_in_place_edit(im_vertlevel):
+    index = template.get_vertebral_level_index(im_vertlevel)
+    im_vertlevel.data[:, :, 2:8] = 0
+    # in-place edits are not detected: the index is rebuilt on request, or passed explicitly
+    assert template.get_vertebral_level_index(im_vertlevel) is index
+    assert template.get_slices_from_vertebral_levels(im_vertlevel, 1, index=template.VertebralLevelIndex(im_vertlevel.data)) == []
+    assert template.get_vertebral_level_index(im_vertlevel, refresh=True) is not index
+    assert template.get_slices_from_vertebral_levels(im_vertlevel, 1) == []
+    assert template.get_vertebral_level_from_slice(im_vertlevel, 5) is None
+    # reshaping the data in place rebuilds the index
+    index = template.get_vertebral_level_index(im_vertlevel)
+    im_vertlevel.data.shape = (10, 8, 30, 1)
+    assert template.get_vertebral_level_index(im_vertlevel) is not index
+
+
+def test_get_slices_matching_with_vertebral_levels_based_centerline(im_vertlevel):
+    slices, vert_levels_list, warning = \
+        sct_process_segmentation.get_slices_matching_with_vertebral_levels_based_centerline(
+            '2:3', im_vertlevel, np.arange(1, 29).astype(float))
+    # positions in the centerline (starting at z=1) of slices 8 to 21, with a median level of 2 or 3
+    assert slices == '7:20'
+    assert vert_levels_list == [2, 3]
+    assert warning == []
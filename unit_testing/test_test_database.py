@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_test_database
+
+from __future__ import print_function, absolute_import
+
+import os
+
+import msct_test_database
+
+
+def make_data(root):
+    for path in ['t2/t2.nii.gz', 't2/t2_seg_manual.nii.gz', 'mt/mt0.nii.gz', 'mt/mt1.nii.gz', 'testing-qc/index.html']:
+        root.join(path).write(path, ensure=True)
+
+
+def test_tree_signature(tmpdir):
+    make_data(tmpdir)
+    signature = msct_test_database.tree_signature(str(tmpdir), exclude=('testing-qc',))
+    assert sorted(signature.keys()) == [os.path.join('mt', 'mt0.nii.gz'), os.path.join('mt', 'mt1.nii.gz'),
+                                        os.path.join('t2', 't2.nii.gz'), os.path.join('t2', 't2_seg_manual.nii.gz')]
+    hash_before = msct_test_database.tree_hash(signature)
+    tmpdir.join('t2/t2.nii.gz').write('modified data')
+    signature_after = msct_test_database.tree_signature(str(tmpdir), exclude=('testing-qc',))
+    assert msct_test_database.tree_hash(signature_after) != hash_before
+    # only files used by a test change its signature
+    mt_files = [p for p in signature if p.startswith('mt')]
+    assert msct_test_database.tree_hash(signature_after, mt_files) == msct_test_database.tree_hash(signature, mt_files)
+
+
+def test_test_signature(tmpdir):
+    make_data(tmpdir)
+    data_signature = msct_test_database.tree_signature(str(tmpdir))
+    assert msct_test_database.get_input_files(['-i t2/t2.nii.gz -c t2 -qc testing-qc'], data_signature) == \
+        set([os.path.join('t2', 't2.nii.gz'), os.path.join('t2', 't2_seg_manual.nii.gz'),
+             os.path.join('testing-qc', 'index.html')])
+    signature_mtr = msct_test_database.get_test_signature('sct_compute_mtr', ['-mt0 mt/mt0.nii.gz -mt1 mt/mt1.nii.gz'],
+                                                          data_signature, 'code')
+    tmpdir.join('t2/t2_seg_manual.nii.gz').write('new ground truth')
+    data_signature = msct_test_database.tree_signature(str(tmpdir))
+    assert signature_mtr == msct_test_database.get_test_signature(
+        'sct_compute_mtr', ['-mt0 mt/mt0.nii.gz -mt1 mt/mt1.nii.gz'], data_signature, 'code')
+    assert signature_mtr != msct_test_database.get_test_signature(
+        'sct_compute_mtr', ['-mt0 mt/mt0.nii.gz -mt1 mt/mt1.nii.gz'], data_signature, 'new code')
+
+
+def test_database(tmpdir):
+    fname_database = str(tmpdir.join('db', 'sct_testing_db.json'))
+    database = msct_test_database.TestDatabase(fname_database)
+    database.record('sct_propseg', 'sig_a', 0, [0], 30.)
+    database.record('sct_maths', 'sig_b', 1, [0, 1], 2.)
+    database.record('sct_register_to_template', 'sig_c', 0, [0], 300.)
+    database.save()
+
+    database = msct_test_database.TestDatabase(fname_database)
+    assert database.is_up_to_date('sct_propseg', 'sig_a')
+    assert not database.is_up_to_date('sct_propseg', 'sig_other')
+    assert not database.is_up_to_date('sct_maths', 'sig_b')  # failed last time
+    assert database.sort_longest_first(['sct_maths', 'sct_propseg', 'sct_new', 'sct_register_to_template']) == \
+        ['sct_new', 'sct_register_to_template', 'sct_propseg', 'sct_maths']
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_trace
+
+from __future__ import print_function, absolute_import
+
+import sys
+
+import sct_utils as sct
+import msct_trace
+
+
+def test_run_disabled(tmpdir, monkeypatch):
+    monkeypatch.delenv(msct_trace.ENV_TRACE, raising=False)
+    status, output = sct.run([sys.executable, '-c', 'print("hello")'], verbose=0)
+    assert status == 0
+    assert output == 'hello'
+    assert tmpdir.listdir() == []
+
+
+def test_run_nested(tmpdir, monkeypatch):
+    fname_trace = str(tmpdir.join('trace.jsonl'))
+    monkeypatch.setenv(msct_trace.ENV_TRACE, fname_trace)
+    monkeypatch.setenv(msct_trace.ENV_SUBJECT, 'sub-01')
+    monkeypatch.delenv(msct_trace.ENV_PARENT, raising=False)
+    # the child records its own span, under the span of the command that launched it
+    code = ("import os, msct_trace; "
+            "span = msct_trace.start_span('child', 'main'); "
+            "print(os.environ['{}']); "
+            "span.finish(exit_code=3); "
+            "raise SystemExit(3)").format(msct_trace.ENV_PARENT)
+    status, output = sct.run([sys.executable, '-c', code], verbose=0, raise_exception=False,
+                             env=dict(PYTHONPATH=':'.join(sys.path)))
+    assert status == 3
+
+    records = msct_trace.read_trace(fname_trace)
+    assert len(records) == 2
+    child, run = records
+    assert run['kind'] == 'run' and run['parent'] is None
+    assert run['exit_code'] == 3
+    assert run['wall'] > 0 and run['cpu'] is not None and run['peak_rss_mb'] > 0
+    assert output == run['id']
+    assert child['parent'] == run['id']
+    assert child['subject'] == 'sub-01'
+
+    summary = msct_trace.summarize(fname_trace, min_percent=0)
+    assert 'Subject: sub-01' in summary
+    assert '(1 failed)' in summary
+    assert '  child' in summary
+
+
+def test_build_tree():
+    records = [
+     {'id': 'a', 'parent': None, 'name': 'sct_register_to_template', 'start': 0, 'wall': 10., 'cpu': 1., 'peak_rss_mb': 100., 'exit_code': 0, 'subject': 's1'},
+     {'id': 'b', 'parent': 'a', 'name': 'sct_apply_transfo', 'start': 1, 'wall': 3., 'cpu': 3., 'peak_rss_mb': 200., 'exit_code': 0, 'subject': 's1'},
+     {'id': 'c', 'parent': 'a', 'name': 'sct_apply_transfo', 'start': 5, 'wall': 4., 'cpu': 4., 'peak_rss_mb': 300., 'exit_code': 0, 'subject': 's1'},
+     {'id': 'd', 'parent': 'unknown', 'name': 'sct_propseg', 'start': 0, 'wall': 2., 'cpu': 2., 'peak_rss_mb': 50., 'exit_code': 1, 'subject': 's2'},
+    ]
+    trees = msct_trace.build_tree(records)
+    assert list(trees.keys()) == ['s1', 's2']
+    node = trees['s1'].children['sct_register_to_template']
+    child = node.children['sct_apply_transfo']
+    # spans with the same name under the same parent are merged
+    assert child.calls == 2
+    assert child.wall == 7.
+    assert child.peak_rss == 300.
+    assert node.self_time == 3.
+    assert trees['s2'].children['sct_propseg'].failures == 1
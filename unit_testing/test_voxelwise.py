@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.voxelwise
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox import voxelwise
+from spinalcordtoolbox.mtsat import mtsat
+import sct_fmri_compute_tsnr
+
+
+def save_image(data, fname):
+    affine = np.diag([0.5, 0.5, 2., 1.])
+    nibabel.save(nibabel.Nifti1Image(data, affine), fname)
+    return fname
+
+
+def test_slab_size():
+    assert voxelwise.get_slab_size([(100, 100, 50)], memory=1) == 6
+    assert voxelwise.get_slab_size([(100, 100, 50, 1000)], memory=1) == 1
+    assert [(s.start, s.stop) for s in voxelwise.iter_slabs(10, 4)] == [(0, 4), (4, 8), (8, 10)]
+
+
+def test_compute_maps_tsnr(tmpdir):
+    rs = np.random.RandomState(0)
+    data = (100 + 10 * rs.randn(8, 7, 9, 20)).astype(np.int16)
+    fname_in = save_image(data, str(tmpdir.join('fmri.nii.gz')))
+    fname_out = str(tmpdir.join('fmri_tsnr.nii.gz'))
+    # a tiny memory budget forces one slice per slab
+    voxelwise.compute_maps([fname_in], [fname_out], sct_fmri_compute_tsnr.tsnr_kernel, memory=1e-3, verbose=0)
+
+    im_out = nibabel.load(fname_out)
+    assert im_out.get_data_dtype() == np.float32
+    assert im_out.shape == data.shape[:3]
+    assert np.allclose(im_out.affine, np.diag([0.5, 0.5, 2., 1.]))
+    assert np.allclose(im_out.get_fdata(), np.mean(data, 3) / np.std(data, 3, ddof=1), rtol=1e-5)
+
+
+def test_mtsat_kernel():
+    rs = np.random.RandomState(0)
+    shape = (5, 6, 4)
+    mt, pd, t1 = [(200 + 800 * rs.rand(*shape)) for i in range(3)]
+    pd[0, 0, 0] = t1[0, 0, 0] = 0
+    b1 = 0.8 + 0.4 * rs.rand(*shape)
+    tr_mt, tr_pd, tr_t1, fa_mt, fa_pd, fa_t1 = 30., 30., 15., 9., 9., 15.
+
+    data_mtsat, data_t1map = mtsat.mtsat_kernel(mt.astype(np.float32), pd.astype(np.float32), t1.astype(np.float32),
+                                                b1.astype(np.float32), tr_mt, tr_pd, tr_t1, fa_mt, fa_pd, fa_t1)
+
+    # reference computed in float64 on whole volumes
+    tr_mt, tr_pd, tr_t1 = tr_mt * 0.001, tr_pd * 0.001, tr_t1 * 0.001
+    fa_mt, fa_pd, fa_t1 = np.radians(fa_mt), np.radians(fa_pd), np.radians(fa_t1)
+    with np.errstate(all='ignore'):
+        r1map = np.nan_to_num(0.5 * ((fa_t1 / tr_t1) * t1 - (fa_pd / tr_pd) * pd) / (pd / fa_pd - t1 / fa_t1))
+        r1map[r1map < 0.01] = np.inf
+        a = (tr_pd * fa_t1 / fa_pd - tr_t1 * fa_pd / fa_t1) * pd * t1 / (tr_pd * fa_t1 * t1 - tr_t1 * fa_pd * pd)
+        ref_mtsat = np.nan_to_num(tr_mt * (fa_mt * a / mt - 1) * r1map - (fa_mt ** 2) / 2.)
+    ref_mtsat[np.abs(ref_mtsat) > 1] = 0
+    ref_mtsat = 100 * ref_mtsat * (1 - 0.4) / (1 - 0.4 * b1)
+
+    assert data_mtsat.dtype == np.float32
+    assert np.allclose(data_t1map, 1. / r1map, rtol=1e-4, atol=1e-6)
+    assert np.allclose(data_mtsat, ref_mtsat, rtol=1e-3, atol=1e-4)
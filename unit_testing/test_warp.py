@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.warp
+
+from __future__ import print_function, absolute_import
+
+import numpy as np
+import nibabel
+from scipy import ndimage
+
+from spinalcordtoolbox import warp
+
+
+def save_image(data, fname, affine=None):
+    nibabel.save(nibabel.Nifti1Image(data, np.eye(4) if affine is None else affine), fname)
+    return fname
+
+
+def save_field(displacement_lps, shape, fname, affine=None):
+    """
+    Constant displacement field (in the LPS space, as written by ANTs)
+    """
+    data = np.zeros(tuple(shape) + (1, 3), dtype=np.float32)
+    data[...] = displacement_lps
+    img = nibabel.Nifti1Image(data, np.eye(4) if affine is None else affine)
+    img.header.set_intent('vector')
+    nibabel.save(img, fname)
+    return fname
+
+
+def test_is_displacement_field(tmpdir):
+    fname_field = save_field([0, 0, 0], (4, 4, 4), str(tmpdir.join('warp.nii.gz')))
+    fname_image = save_image(np.zeros((4, 4, 4), dtype=np.float32), str(tmpdir.join('image.nii.gz')))
+    assert warp.is_displacement_field(fname_field)
+    assert not warp.is_displacement_field(fname_image)
+    assert not warp.is_displacement_field('-' + fname_field)
+    assert not warp.is_displacement_field(str(tmpdir.join('affine.txt')))
+
+
+def test_warp_images(tmpdir):
+    rs = np.random.RandomState(0)
+    data = rs.rand(12, 10, 14).astype(np.float32)
+    labels = rs.randint(0, 5, (12, 10, 14)).astype(np.uint8)
+    fname_in = [save_image(data, str(tmpdir.join('data.nii.gz'))), save_image(labels, str(tmpdir.join('levels.nii.gz')))]
+    fname_dest = save_image(np.zeros((12, 10, 14), dtype=np.int16), str(tmpdir.join('dest.nii.gz')))
+    # LPS (-2, 0, 3) is RAS (2, 0, 3): the destination voxel (x, y, z) samples the source voxel (x + 2, y, z + 3)
+    fname_warp = save_field([-2, 0, 3], (12, 10, 14), str(tmpdir.join('warp.nii.gz')))
+    fname_out = [str(tmpdir.join('data_reg.nii.gz')), str(tmpdir.join('levels_reg.nii.gz'))]
+    warp.warp_images(fname_in, fname_out, fname_dest, [fname_warp], interp=['linear', 'nn'], nb_threads=2, verbose=0)
+
+    for fname, expected in zip(fname_out, [data, labels]):
+        img = nibabel.load(fname)
+        assert img.get_data_dtype() == np.float32
+        assert np.allclose(img.affine, np.eye(4))
+        out = img.get_fdata()
+        assert np.allclose(out[:10, :, :11], expected[2:, :, 3:])
+        # outside of the source image
+        assert np.all(out[11:, :, :] == 0)
+        assert np.all(out[:, :, 12:] == 0)
+
+
+def test_transform_points_order(tmpdir):
+    # the last field of the list is applied first to the points: it is defined on the destination grid
+    affine_dest = np.diag([2., 2., 2., 1.])
+    fname_warp_dest = save_field([-4, 0, 0], (10, 10, 10), str(tmpdir.join('warp_dest.nii.gz')), affine_dest)
+    # the first field only covers x > 10 mm
+    affine_src = np.eye(4)
+    affine_src[0, 3] = 10
+    fname_warp_src = save_field([0, 0, 1], (20, 20, 20), str(tmpdir.join('warp_src.nii.gz')), affine_src)
+    points = np.array([[0., 8.], [0., 0.], [0., 0.]])
+    points_src = warp.transform_points(points, [fname_warp_src, fname_warp_dest])
+    # x=0 -> x=4, outside of the first field; x=8 -> x=12 inside the first field
+    assert np.allclose(points_src, [[4., 12.], [0., 0.], [0., 1.]])
+
+
+def save_affine_txt(matrix, translation, center, fname):
+    """
+    ITK affine transformation (LPS), as written by msct_register_landmarks
+    """
+    with open(fname, 'w') as f:
+        f.write("#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n")
+        f.write("Parameters: " + ' '.join(str(v) for v in list(np.ravel(matrix)) + list(translation)) + "\n")
+        f.write("FixedParameters: " + ' '.join(str(v) for v in center) + "\n")
+    return fname
+
+
+def test_affine_transform(tmpdir):
+    matrix = np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])
+    translation, center = [1., 2., 3.], [10., 0., -5.]
+    fname = save_affine_txt(matrix, translation, center, str(tmpdir.join('affine.txt')))
+    points_ras = np.array([[1., -4.], [2., 0.], [3., 7.]])
+    # ITK: x -> A (x - c) + t + c, in LPS
+    points_lps = points_ras * warp.LPS_TO_RAS[:, np.newaxis]
+    expected = (np.dot(matrix, points_lps - np.array(center)[:, np.newaxis]) +
+                np.array(translation)[:, np.newaxis] + np.array(center)[:, np.newaxis]) * warp.LPS_TO_RAS[:, np.newaxis]
+    assert np.allclose(warp.transform_points(points_ras, [fname]), expected)
+    # inverse with '-'
+    assert np.allclose(warp.transform_points(points_ras, [fname, '-' + fname]), points_ras)
+    assert warp.can_read_transforms([fname, '-' + fname])
+    assert not warp.can_read_transforms([str(tmpdir.join('missing.txt'))])
+
+
+def test_compose(tmpdir):
+    affine_grid = np.diag([0.5, 0.5, 2., 1.])
+    affine_grid[:3, 3] = [-3, -2, -10]
+    fname_field = save_field([0.5, -1, 2], (20, 18, 12), str(tmpdir.join('warp.nii.gz')), affine_grid)
+    fname_affine = save_affine_txt(np.eye(3) * 1.1, [1., 0., -2.], [0., 0., 0.], str(tmpdir.join('affine.txt')))
+    chain = [fname_affine, fname_field]
+    # small chunks, to compose by several chunks
+    field = warp.compose(chain, (20, 18, 12), affine_grid, chunk_size=1000)
+    assert field.field.dtype == np.float32
+    fname_out = str(tmpdir.join('warp_composed.nii.gz'))
+    field.save(fname_out)
+    assert warp.is_displacement_field(fname_out)
+    img = nibabel.load(fname_out)
+    assert img.shape == (20, 18, 12, 1, 3)
+    assert img.get_data_dtype() == np.float32
+    # the composed field moves the points as the chain of transformations
+    points = warp.apply_affine(affine_grid, np.array([[0, 5, 19], [0, 9, 17], [0, 6, 11]], dtype=float))
+    assert np.allclose(warp.transform_points(points, [fname_out]), warp.transform_points(points, chain), atol=1e-4)
+
+
+def test_compose_2d(tmpdir):
+    from scipy.io import savemat
+    theta = 0.1
+    fname_mat = str(tmpdir.join('0GenericAffine.mat'))
+    savemat(fname_mat, {'AffineTransform_double_2_2': np.array([[np.cos(theta), -np.sin(theta), np.sin(theta),
+                                                                  np.cos(theta), 2., -1.]]).T,
+                        'fixed': np.array([[1., 1.]]).T}, format='4')
+    field = warp.compose([fname_mat], (10, 12), np.eye(4), ndim=2)
+    fname_out = str(tmpdir.join('warp2d.nii.gz'))
+    field.save(fname_out)
+    assert nibabel.load(fname_out).shape == (10, 12, 1, 1, 2)
+    field_inv = warp.compose(['-' + fname_mat], (10, 12), np.eye(4), ndim=2)
+    points = np.array([[3., 4.], [5., 2.], [0., 0.]])
+    assert np.allclose(warp.transform_points(warp.transform_points(points, [field_inv]), [field]), points, atol=1e-4)
+
+
+def test_inverse_consistency(tmpdir):
+    fname_forward = save_field([1, 2, 0], (10, 10, 10), str(tmpdir.join('warp_src2dest.nii.gz')))
+    fname_inverse = save_field([-1, -2, 0], (10, 10, 10), str(tmpdir.join('warp_dest2src.nii.gz')))
+    distance = warp.inverse_consistency([fname_forward], [fname_inverse], (10, 10, 10), np.eye(4))
+    assert distance.shape == (10, 10, 10)
+    # RAS displacement (-1, -2, 0): points moved outside the inverse field are not brought back
+    assert np.allclose(distance[1:, 2:, :], 0)
+    assert np.all(distance[0, :, :] > 0)
+    assert np.all(distance[:, :2, :] > 0)
+
+
+def test_merge_images(tmpdir):
+    rs = np.random.RandomState(2)
+    shape = (10, 8, 12)
+    fname_dest = save_image(np.zeros(shape, dtype=np.int16), str(tmpdir.join('dest.nii.gz')))
+    # two overlapping chunks of the destination: z < 8 and z >= 5
+    list_data, list_fname, list_warp = [], [], []
+    for i, (z0, nz) in enumerate([(0, 8), (5, 7)]):
+        data = rs.rand(10, 8, nz).astype(np.float32) + 1
+        affine = np.eye(4)
+        affine[2, 3] = z0
+        list_data.append((z0, data))
+        list_fname.append(save_image(data, str(tmpdir.join('src{}.nii.gz'.format(i))), affine))
+        list_warp.append([save_field([0, 0, 0], shape, str(tmpdir.join('warp{}.nii.gz'.format(i))))])
+    merged = warp.merge_images(list_fname, fname_dest, list_warp, nb_threads=2, verbose=0)
+    assert merged.dtype == np.float32 and merged.shape == shape
+    # weighted average of the warped images, with the partial volume of each image as weight
+    sum_data, sum_pv = np.zeros(shape), np.zeros(shape)
+    for z0, data in list_data:
+        pv = np.zeros(shape)
+        pv[:, :, z0:z0 + data.shape[2]] = 1
+        values = np.zeros(shape)
+        values[:, :, z0:z0 + data.shape[2]] = data
+        sum_data += values * pv
+        sum_pv += pv
+    assert np.allclose(merged, sum_data / sum_pv)
+    # by small chunks, with a warping field shared by both images
+    merged_chunks = warp.merge_images(list_fname, fname_dest, [list_warp[0], list_warp[0]], nb_threads=2,
+                                      chunk_size=100, verbose=0)
+    assert np.allclose(merged_chunks, merged)
+    # the spline interpolates the voxels exactly: same result at the voxels of the destination
+    merged_spline = warp.merge_images(list_fname, fname_dest, list_warp, interp='spline', nb_threads=2,
+                                      chunk_size=100, verbose=0)
+    assert np.allclose(merged_spline, merged, atol=1e-4)
+
+
+def test_sampling_by_chunks(tmpdir):
+    rs = np.random.RandomState(3)
+    data = rs.rand(9, 8, 7).astype(np.float32)
+    affine_src = np.diag([0.9, 1.1, 1.3, 1.])
+    fname_src = save_image(data, str(tmpdir.join('src.nii.gz')), affine_src)
+    fname_warp = save_field([0.7, -0.4, 1.9], (8, 8, 8), str(tmpdir.join('warp.nii.gz')))
+    coordinates = warp.get_sampling_coordinates([fname_warp], (8, 8, 8), np.eye(4), affine_src, chunk_size=50)
+    assert coordinates.dtype == np.float32
+    assert np.allclose(coordinates, warp.get_sampling_coordinates([fname_warp], (8, 8, 8), np.eye(4), affine_src),
+                       atol=1e-5)
+    # reference: all the points at once
+    points = warp.apply_affine(np.eye(4), np.indices((8, 8, 8), dtype=np.float64).reshape(3, -1))
+    expected = warp.apply_affine(np.linalg.inv(affine_src), warp.transform_points(points, [fname_warp]))
+    assert np.allclose(coordinates, expected, atol=1e-5)
+    values = warp.Sampler(coordinates, data.shape, chunk_size=37).sample(nibabel.load(fname_src))
+    inside = warp.inside_grid(expected, data.shape)
+    assert np.allclose(values[inside], ndimage.map_coordinates(data, expected[:, inside], order=1, mode='nearest'),
+                       atol=1e-5)
+    assert np.all(values[~inside] == 0)
+
+
+def test_sampler_bbox_and_spline():
+    rs = np.random.RandomState(4)
+    data = rs.rand(12, 10, 9).astype(np.float32)
+    coordinates = (rs.rand(3, 500) * [[8], [6], [9]] + [[2], [1], [-2]]).astype(np.float32)
+    inside = warp.inside_grid(coordinates, data.shape)
+    sampler = warp.Sampler(coordinates, data.shape, chunk_size=64)
+    # bounding box of the points inside the image, computed with plain boolean indexing
+    expected_min = np.clip(np.floor(coordinates[:, inside].min(1)), 0, np.array(data.shape) - 1).astype(int)
+    expected_max = np.clip(np.ceil(coordinates[:, inside].max(1)), 0, np.array(data.shape) - 1).astype(int) + 1
+    assert sampler.bbox == tuple(slice(a, b) for a, b in zip(expected_min, expected_max))
+    # the spline coefficients are computed once, and give the same values as map_coordinates on all the points
+    values = sampler.sample(data[sampler.bbox], 'spline')
+    expected = ndimage.map_coordinates(data[sampler.bbox], coordinates[:, inside].astype(np.float64) -
+                                       expected_min[:, np.newaxis], order=3, mode='nearest')
+    assert np.allclose(values[inside], expected, atol=1e-5)
+    assert np.all(values[~inside] == 0)